@@ -1,48 +1,653 @@
 """
 Redis caching layer for FastAPI application
 Provides decorators and utilities for caching API responses and database queries
+
+Reads go through a small in-process LRU (L1) before Redis (L2). Every
+key belongs to a namespace (its prefix before the first ":"), and each
+namespace has a generation counter in Redis that is embedded in the
+stored key ("recommendations:g3:..."). Invalidating a namespace is one
+INCR: new reads and writes move to the next generation and old keys
+simply age out via their TTL (or an optional SCAN+UNLINK cleaner).
+Workers re-read counters at most every CACHE_VERSION_CHECK_SECONDS and
+ignore L1 entries stamped with an older generation, so hot reads cost a
+dict lookup while invalidations still reach every worker.
+
+Async callers use a separate redis.asyncio pool (the a* methods), so
+cached async endpoints never block the event loop on Redis I/O.
+Batch reads and writes (mget/mset, get_entries/set_entries and the
+cached_many decorator) cost one round trip however many keys they touch.
+
+The hottest @cached keys are recomputed shortly before they expire by a
+refresh-ahead warmer (see cache_warmer.py) when CACHE_WARMER_ENABLED.
+
+With CACHE_BACKEND="auto" the cache keeps working in process memory
+(LocalBackend) while Redis is down and moves back once it answers again;
+"local" never uses Redis and "redis" disables caching without it.
 """
 
 import redis
+import redis.asyncio as aioredis
 from redis.connection import ConnectionPool
-from typing import Any, Optional, Callable, TypeVar, cast
+from collections import OrderedDict
+from typing import Any, Dict, Iterable, List, NamedTuple, Optional, Callable, Sequence, Tuple, TypeVar, cast
 from functools import wraps
 import json
 import hashlib
+import inspect
 import logging
-from datetime import datetime, timedelta
+import math
+import random
+import threading
+import time
+import uuid
+from datetime import date, datetime, time as dt_time, timedelta, timezone
+from decimal import Decimal
+from enum import Enum
+from pydantic import BaseModel
+from sqlalchemy.orm import Session
+from app.core.cache_backends import AsyncLocalBackend, LocalBackend, RELEASE_LOCK_SCRIPT
+from app.core.cache_metrics import CacheMetrics
+from app.core.cache_warmer import RefreshAheadWarmer
+from app.core.cache_serializers import CacheCodec
 from app.core.config import settings
 
+try:
+    import xxhash
+except ImportError:  # pragma: no cover - optional speedup
+    xxhash = None
+
 logger = logging.getLogger(__name__)
 
 # Type variable for decorator
 F = TypeVar('F', bound=Callable[..., Any])
 
+# Redis key holding a namespace's generation counter
+VERSION_KEY = "cache:version:{namespace}"
+# Cross-worker recompute lock for a (generation-stamped) key
+LOCK_KEY = "cache:lock:{key}"
+
+# Compare-and-delete so a worker only releases a lock it still owns
+_RELEASE_LOCK_SCRIPT = RELEASE_LOCK_SCRIPT
+
+_MISSING = object()
+
+
+class CacheEntry(NamedTuple):
+    """A cached value with the metadata used for stampede protection"""
+    value: Any
+    expires_at: float  # Epoch seconds after which the value is stale
+    delta: float  # Seconds the value took to compute
+
+
+def key_namespace(key: str) -> str:
+    """Namespace of a cache key or pattern ("recommendations:x:y" -> "recommendations")"""
+    return key.split(":", 1)[0].rstrip("*")
+
+
+def _stamp_key(key: str, version: int) -> str:
+    """Embed a namespace generation in a key ("kb:x" -> "kb:g3:x")"""
+    namespace, sep, rest = key.partition(":")
+    if sep:
+        return f"{namespace}:g{version}:{rest}"
+    return f"{namespace}:g{version}"
+
+
+def _stamp_keys(keys: List[str], versions: Dict[str, int]) -> List[Tuple[str, int]]:
+    """Stamp keys with their namespace versions; returns [(redis key, version)]"""
+    stamped = []
+    for key in keys:
+        version = versions[key.partition(":")[0]]
+        stamped.append((_stamp_key(key, version), version))
+    return stamped
+
+
+def _entry_payload(entry: CacheEntry) -> Dict[str, Any]:
+    return {"v": entry.value, "e": entry.expires_at, "d": entry.delta}
+
+
+def _entry_from_payload(data: Dict[str, Any]) -> CacheEntry:
+    return CacheEntry(data["v"], data["e"], data["d"])
+
+
+class LocalCache:
+    """
+    Bounded in-process LRU with per-entry TTL (L1)
+    
+    Entries are stamped with their namespace version; a lookup with a
+    newer version treats the entry as missing. Thread-safe, since sync
+    endpoints run in FastAPI's threadpool.
+    
+    Values are kept encoded and decoded on every hit, so each caller gets
+    its own copy (as from Redis) and mutating a result never changes what
+    the next request sees. CacheEntry metadata stays decoded.
+    """
+    
+    def __init__(self, max_entries: int = 10000, ttl_seconds: float = 60, codec: Optional[CacheCodec] = None):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        # Uncompressed by default: L1 trades memory for decode speed
+        self.codec = codec or CacheCodec(compress_min_bytes=0)
+        # key -> (encoded value or CacheEntry of one, expires_at, namespace version)
+        self.entries: "OrderedDict[str, Tuple[Any, float, int]]" = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+    
+    def get(self, key: str, version: int = 0) -> Any:
+        """
+        Get an entry stamped with version
+        
+        Returns:
+            The value, or _MISSING if absent, expired or stale
+        """
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or entry[1] <= time.monotonic() or entry[2] != version:
+                if entry is not None:
+                    del self.entries[key]
+                self.misses += 1
+                return _MISSING
+            
+            self.entries.move_to_end(key)
+            self.hits += 1
+            stored = entry[0]
+        
+        if isinstance(stored, CacheEntry):
+            return stored._replace(value=self.codec.decode(stored.value))
+        return self.codec.decode(stored)
+    
+    def set(self, key: str, value: Any, version: int = 0, ttl_seconds: Optional[float] = None) -> None:
+        """Store an entry, evicting least recently used ones beyond max_entries"""
+        ttl = self.ttl_seconds if ttl_seconds is None else min(ttl_seconds, self.ttl_seconds)
+        if isinstance(value, CacheEntry):
+            value = value._replace(value=self.codec.encode(value.value))
+        else:
+            value = self.codec.encode(value)
+        with self.lock:
+            self.entries[key] = (value, time.monotonic() + ttl, version)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+    
+    def delete(self, key: str) -> None:
+        with self.lock:
+            self.entries.pop(key, None)
+    
+    def delete_namespace(self, namespace: str) -> int:
+        """Drop every entry in a namespace"""
+        prefix = f"{namespace}:"
+        with self.lock:
+            keys = [key for key in self.entries if key.startswith(prefix)]
+            for key in keys:
+                del self.entries[key]
+        return len(keys)
+    
+    def clear(self) -> None:
+        with self.lock:
+            self.entries.clear()
+    
+    def get_stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self.entries),
+            "max_entries": self.max_entries,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 3) if lookups else 0.0,
+        }
+
+
 class RedisCache:
     """Wrapper around Redis for caching functionality"""
     
-    def __init__(self, url: Optional[str] = None, **kwargs):
+    def __init__(
+        self,
+        url: Optional[str] = None,
+        local_max_entries: Optional[int] = None,
+        local_ttl_seconds: Optional[float] = None,
+        version_check_seconds: Optional[float] = None,
+        async_max_connections: Optional[int] = None,
+        backend: Optional[str] = None,
+        serializer: Optional[str] = None,
+        **kwargs
+    ):
         """
         Initialize Redis connection pool
         
         Args:
             url: Redis URL (e.g., redis://localhost:6379/0)
+            local_max_entries: L1 capacity (0 disables the L1 layer)
+            local_ttl_seconds: Upper bound on how long L1 keeps an entry
+            version_check_seconds: How often namespace versions are re-read
+            async_max_connections: Size of the redis.asyncio pool
+            backend: "redis", "local" or "auto" (Redis with in-process fallback)
+            serializer: "json" or "msgpack" for values written to the store
             **kwargs: Additional Redis options
         """
         if url is None:
             url = settings.REDIS_URL or "redis://localhost:6379/0"
+        self.url = url
+        self.redis_options = kwargs
+        
+        max_entries = settings.CACHE_L1_MAX_ENTRIES if local_max_entries is None else local_max_entries
+        self.local: Optional[LocalCache] = LocalCache(
+            max_entries=max_entries,
+            ttl_seconds=settings.CACHE_L1_TTL_SECONDS if local_ttl_seconds is None else local_ttl_seconds,
+            codec=CacheCodec(serializer or settings.CACHE_SERIALIZER, compress_min_bytes=0),
+        ) if max_entries > 0 else None
+        self.version_check_seconds = (
+            settings.CACHE_VERSION_CHECK_SECONDS if version_check_seconds is None else version_check_seconds
+        )
+        # namespace -> (version, monotonic time it was read)
+        self._versions: Dict[str, Tuple[int, float]] = {}
+        self._cleaner_stop: Optional[threading.Event] = None
+        # redis.asyncio pool, created lazily on the event loop that uses it
+        self.async_max_connections = (
+            settings.REDIS_ASYNC_MAX_CONNECTIONS if async_max_connections is None else async_max_connections
+        )
+        self.async_pool = None
+        self._async_client = None
+        self._async_loop: Optional[asyncio.AbstractEventLoop] = None
+        
+        self.metrics = CacheMetrics(enabled=settings.CACHE_METRICS_ENABLED)
+        self.codec = CacheCodec(
+            serializer or settings.CACHE_SERIALIZER,
+            compress_min_bytes=settings.CACHE_COMPRESS_MIN_BYTES,
+            compress_level=settings.CACHE_COMPRESS_LEVEL
+        )
+        # Refresh-ahead for the hottest @cached keys, see start_warmer
+        self.warmer: Optional[RefreshAheadWarmer] = None
+        
+        # Active store: the Redis client, the in-process backend, or None (caching off)
+        self.backend_mode = backend or settings.CACHE_BACKEND
+        self.pool = None
+        self.redis_client: Optional[redis.Redis] = None
+        self.local_backend: Optional[LocalBackend] = None
+        self._async_local_backend: Optional[AsyncLocalBackend] = None
+        self.client = None
+        # Namespaces invalidated while Redis was unreachable, replayed on recovery
+        self._offline_invalidations: set = set()
+        self._offline_flush = False
+        self._backend_lock = threading.Lock()
+        self._monitor_stop: Optional[threading.Event] = None
+        
+        if self.backend_mode != "redis":
+            self.local_backend = LocalBackend(settings.CACHE_LOCAL_MAX_ENTRIES)
+            self._async_local_backend = AsyncLocalBackend(self.local_backend)
+        
+        if self.backend_mode == "local":
+            self.client = self.local_backend
+            logger.info("✓ Cache using in-process backend")
+            return
         
         try:
             self.pool = ConnectionPool.from_url(url, **kwargs)
-            self.client = redis.Redis(connection_pool=self.pool)
+            self.redis_client = redis.Redis(connection_pool=self.pool)
             
             # Test connection
-            self.client.ping()
+            self.redis_client.ping()
+            self.client = self.redis_client
             logger.info("✓ Redis connected successfully")
         except Exception as e:
             logger.warning(f"⚠ Redis connection failed: {e}")
-            self.client = None
-            self.pool = None
+            if self.backend_mode == "redis":
+                self.redis_client = None
+                self.pool = None
+            else:
+                self.client = self.local_backend
+                logger.warning("⚠ Cache falling back to in-process backend until Redis recovers")
+        
+        if self.backend_mode == "auto" and self.redis_client is not None:
+            self.start_backend_monitor(settings.CACHE_REDIS_RETRY_SECONDS)
+    
+    # ===========================
+    # Backend switching
+    # ===========================
+    
+    @property
+    def backend(self) -> Optional[str]:
+        """Active backend: "redis", "local" or None when caching is off"""
+        if self.client is None:
+            return None
+        return "local" if self.client is self.local_backend else "redis"
+    
+    def check_backend(self) -> Optional[str]:
+        """
+        Ping Redis and switch backends if its health changed (auto mode)
+        
+        Returns:
+            Active backend after the check
+        """
+        if self.backend_mode != "auto" or self.redis_client is None:
+            return self.backend
+        
+        try:
+            self.redis_client.ping()
+            healthy = True
+        except Exception:
+            healthy = False
+        
+        if healthy and self.client is self.local_backend:
+            self._use_redis()
+        elif not healthy and self.client is self.redis_client:
+            self._use_local()
+        return self.backend
+    
+    def _use_local(self) -> None:
+        with self._backend_lock:
+            if self.client is self.local_backend:
+                return
+            self.client = self.local_backend
+            self._reset_local_state()
+        logger.warning("⚠ Redis unavailable, cache switched to in-process backend")
+    
+    def _use_redis(self) -> None:
+        with self._backend_lock:
+            if self.client is self.redis_client:
+                return
+            try:
+                # Redis missed invalidations made while it was away: replay them
+                if self._offline_flush:
+                    self.redis_client.flushdb()
+                for namespace in self._offline_invalidations:
+                    self.redis_client.incr(VERSION_KEY.format(namespace=namespace))
+            except Exception as e:
+                logger.error(f"Cache recovery error, staying on in-process backend: {e}")
+                return
+            
+            self._offline_invalidations.clear()
+            self._offline_flush = False
+            self.client = self.redis_client
+            self._reset_local_state()
+            self.local_backend.flushdb()
+        logger.info("✓ Redis recovered, cache switched back to Redis")
+    
+    def _reset_local_state(self) -> None:
+        """Forget L1 entries and versions read from the previous backend"""
+        self._versions.clear()
+        if self.local:
+            self.local.clear()
+    
+    def start_backend_monitor(self, interval_seconds: float) -> None:
+        """Run check_backend every interval_seconds in a daemon thread"""
+        if self._monitor_stop is not None or interval_seconds <= 0:
+            return
+        
+        self._monitor_stop = stop = threading.Event()
+        
+        def run():
+            while not stop.wait(interval_seconds):
+                self.check_backend()
+        
+        threading.Thread(target=run, name="cache-backend-monitor", daemon=True).start()
+    
+    def stop_backend_monitor(self) -> None:
+        """Stop the background backend monitor"""
+        if self._monitor_stop is not None:
+            self._monitor_stop.set()
+            self._monitor_stop = None
+    
+    # ===========================
+    # Namespace versions
+    # ===========================
+    
+    def get_namespace_version(self, namespace: str) -> int:
+        """
+        Get a namespace's version, re-reading Redis at most every version_check_seconds
+        
+        Args:
+            namespace: Cache namespace (key prefix)
+        
+        Returns:
+            Current version (0 if never invalidated or Redis is unavailable)
+        """
+        versions, stale = self._known_versions([namespace])
+        if stale and self.client:
+            try:
+                versions[namespace] = int(self.client.get(VERSION_KEY.format(namespace=namespace)) or 0)
+            except Exception as e:
+                logger.error(f"Cache VERSION error for namespace {namespace}: {e}")
+        
+        self._record_versions(versions, stale)
+        return versions[namespace]
+    
+    def get_namespace_versions(self, namespaces: Iterable[str]) -> Dict[str, int]:
+        """Get several namespace versions, re-reading stale ones with one MGET"""
+        versions, stale = self._known_versions(namespaces)
+        if stale and self.client:
+            try:
+                values = self.client.mget([VERSION_KEY.format(namespace=ns) for ns in stale])
+                versions.update((ns, int(value or 0)) for ns, value in zip(stale, values))
+            except Exception as e:
+                logger.error(f"Cache VERSION error for namespaces {stale}: {e}")
+        
+        self._record_versions(versions, stale)
+        return versions
+    
+    async def aget_namespace_versions(self, namespaces: Iterable[str]) -> Dict[str, int]:
+        """Async variant of get_namespace_versions"""
+        versions, stale = self._known_versions(namespaces)
+        client = self.get_async_client() if stale else None
+        if client:
+            try:
+                values = await client.mget([VERSION_KEY.format(namespace=ns) for ns in stale])
+                versions.update((ns, int(value or 0)) for ns, value in zip(stale, values))
+            except Exception as e:
+                logger.error(f"Cache VERSION error for namespaces {stale}: {e}")
+        
+        self._record_versions(versions, stale)
+        return versions
+    
+    def _known_versions(self, namespaces: Iterable[str]) -> Tuple[Dict[str, int], List[str]]:
+        """
+        Split namespaces into versions still fresh in this worker and ones to re-read
+        
+        Returns:
+            (namespace -> last known version, namespaces due for a re-read)
+        """
+        now = time.monotonic()
+        versions: Dict[str, int] = {}
+        stale: List[str] = []
+        for namespace in namespaces:
+            cached_version = self._versions.get(namespace)
+            versions[namespace] = cached_version[0] if cached_version else 0
+            if not cached_version or now - cached_version[1] >= self.version_check_seconds:
+                stale.append(namespace)
+        return versions, stale
+    
+    def _record_versions(self, versions: Dict[str, int], namespaces: List[str]) -> None:
+        now = time.monotonic()
+        for namespace in namespaces:
+            self._versions[namespace] = (versions[namespace], now)
+    
+    def invalidate_namespace(self, namespace: str) -> int:
+        """
+        Invalidate a namespace on every worker in O(1)
+        
+        Bumps the generation embedded in the namespace's Redis keys, so
+        existing entries become unreachable and expire via their TTL.
+        
+        Args:
+            namespace: Cache namespace (key prefix)
+        
+        Returns:
+            New namespace version
+        """
+        version = self._versions.get(namespace, (0, 0))[0] + 1
+        if self.client:
+            try:
+                version = int(self.client.incr(VERSION_KEY.format(namespace=namespace)))
+            except Exception as e:
+                logger.error(f"Cache VERSION INCR error for namespace {namespace}: {e}")
+        
+        return self._namespace_invalidated(namespace, version)
+    
+    async def ainvalidate_namespace(self, namespace: str) -> int:
+        """Async variant of invalidate_namespace"""
+        version = self._versions.get(namespace, (0, 0))[0] + 1
+        client = self.get_async_client()
+        if client:
+            try:
+                version = int(await client.incr(VERSION_KEY.format(namespace=namespace)))
+            except Exception as e:
+                logger.error(f"Cache VERSION INCR error for namespace {namespace}: {e}")
+        
+        return self._namespace_invalidated(namespace, version)
+    
+    def _namespace_invalidated(self, namespace: str, version: int) -> int:
+        if self.client is not None and self.client is self.local_backend:
+            self._offline_invalidations.add(namespace)
+        self._versions[namespace] = (version, time.monotonic())
+        if self.local:
+            self.local.delete_namespace(namespace)
+        return version
+    
+    def _redis_key(self, key: str) -> Tuple[str, int]:
+        """
+        Map a cache key to its generation-stamped Redis key
+        
+        Returns:
+            (redis key, namespace version)
+        """
+        version = self.get_namespace_version(key.partition(":")[0])
+        return _stamp_key(key, version), version
+    
+    async def _aredis_key(self, key: str) -> Tuple[str, int]:
+        """Async variant of _redis_key"""
+        namespace = key.partition(":")[0]
+        version = (await self.aget_namespace_versions([namespace]))[namespace]
+        return _stamp_key(key, version), version
+    
+    def _redis_keys(self, keys: List[str]) -> List[Tuple[str, int]]:
+        """_redis_key for many keys, re-reading versions with one MGET"""
+        versions = self.get_namespace_versions({key.partition(":")[0] for key in keys})
+        return _stamp_keys(keys, versions)
+    
+    async def _aredis_keys(self, keys: List[str]) -> List[Tuple[str, int]]:
+        """Async variant of _redis_keys"""
+        versions = await self.aget_namespace_versions({key.partition(":")[0] for key in keys})
+        return _stamp_keys(keys, versions)
+    
+    # ===========================
+    # Async client
+    # ===========================
+    
+    def get_async_client(self) -> Optional["aioredis.Redis"]:
+        """
+        Get the redis.asyncio client for the running event loop
+        
+        The async pool is separate from the sync one and created on first
+        use, since asyncio connections belong to the loop that opened them.
+        
+        Returns:
+            redis.asyncio client, an async facade over the in-process
+            backend, or None if caching is off
+        """
+        if not self.client:
+            return None
+        if self.client is self.local_backend:
+            return self._async_local_backend
+        
+        loop = asyncio.get_running_loop()
+        if self._async_client is None or self._async_loop is not loop:
+            self.async_pool = aioredis.ConnectionPool.from_url(
+                self.url, max_connections=self.async_max_connections, **self.redis_options
+            )
+            self._async_client = aioredis.Redis(connection_pool=self.async_pool)
+            self._async_loop = loop
+        return self._async_client
+    
+    async def aclose(self) -> None:
+        """Close the async pool (call on shutdown, from the loop that used it)"""
+        if self.async_pool is not None:
+            try:
+                await self.async_pool.disconnect()
+            except Exception as e:
+                logger.warning(f"⚠ Error closing async Redis pool: {e}")
+        self.async_pool = None
+        self._async_client = None
+        self._async_loop = None
+    
+    def cleanup_stale_generations(self, batch_size: int = 500) -> int:
+        """
+        Unlink keys left behind in old namespace generations
+        
+        Uses SCAN (incremental, never blocks Redis) and UNLINK (frees
+        memory in a background thread). Optional: stale keys expire via
+        TTL anyway; this only reclaims memory sooner.
+        
+        Args:
+            batch_size: SCAN COUNT hint and UNLINK batch size
+        
+        Returns:
+            Number of keys unlinked
+        """
+        if not self.client:
+            return 0
+        
+        removed = 0
+        try:
+            for version_key in self.client.scan_iter(match=VERSION_KEY.format(namespace="*"), count=batch_size):
+                if isinstance(version_key, bytes):
+                    version_key = version_key.decode()
+                namespace = version_key[len(VERSION_KEY.format(namespace="")):]
+                current = int(self.client.get(version_key) or 0)
+                
+                stale = []
+                for key in self.client.scan_iter(match=f"{namespace}:g*", count=batch_size):
+                    generation = (key.decode() if isinstance(key, bytes) else key).split(":", 2)[1][1:]
+                    if generation.isdigit() and int(generation) < current:
+                        stale.append(key)
+                    if len(stale) >= batch_size:
+                        removed += self.client.unlink(*stale)
+                        stale = []
+                if stale:
+                    removed += self.client.unlink(*stale)
+        except Exception as e:
+            logger.error(f"Cache generation cleanup error: {e}")
+        
+        if removed:
+            logger.info(f"🧹 Unlinked {removed} stale cache keys")
+        return removed
+    
+    def start_generation_cleaner(self, interval_seconds: float) -> None:
+        """Run cleanup_stale_generations every interval_seconds in a daemon thread"""
+        if self._cleaner_stop is not None:
+            return
+        
+        self._cleaner_stop = stop = threading.Event()
+        
+        def run():
+            while not stop.wait(interval_seconds):
+                self.cleanup_stale_generations()
+        
+        threading.Thread(target=run, name="cache-generation-cleaner", daemon=True).start()
+        logger.info(f"✓ Cache generation cleaner started (every {interval_seconds}s)")
+    
+    def stop_generation_cleaner(self) -> None:
+        """Stop the background generation cleaner"""
+        if self._cleaner_stop is not None:
+            self._cleaner_stop.set()
+            self._cleaner_stop = None
+    
+    def start_warmer(self) -> None:
+        """Start refreshing the hottest @cached entries ahead of expiry (on the running loop)"""
+        if self.warmer is None:
+            self.warmer = RefreshAheadWarmer(
+                self,
+                top_n=settings.CACHE_WARMER_TOP_N,
+                interval_seconds=settings.CACHE_WARMER_INTERVAL_SECONDS,
+                refresh_window_seconds=settings.CACHE_WARMER_REFRESH_WINDOW_SECONDS,
+                concurrency=settings.CACHE_WARMER_CONCURRENCY,
+                decay_seconds=settings.CACHE_WARMER_DECAY_SECONDS,
+                min_hits=settings.CACHE_WARMER_MIN_HITS,
+            )
+        self.warmer.start()
+    
+    async def stop_warmer(self) -> None:
+        """Stop the refresh-ahead warmer"""
+        if self.warmer is not None:
+            await self.warmer.stop()
     
     def set(self, key: str, value: Any, ttl_seconds: int = 3600) -> bool:
         """
@@ -50,7 +655,7 @@ class RedisCache:
         
         Args:
             key: Cache key
-            value: Value to cache (will be JSON serialized)
+            value: Value to cache (serialized by self.codec)
             ttl_seconds: Time-to-live in seconds
         
         Returns:
@@ -59,9 +664,14 @@ class RedisCache:
         if not self.client:
             return False
         
+        started = time.perf_counter()
         try:
-            serialized = json.dumps(value)
-            self.client.setex(key, ttl_seconds, serialized)
+            serialized = self.codec.encode(value)
+            redis_key, version = self._redis_key(key)
+            self.client.setex(redis_key, ttl_seconds, serialized)
+            if self.local:
+                self.local.set(key, value, version, ttl_seconds)
+            self.metrics.record_set(key, time.perf_counter() - started, len(serialized))
             return True
         except Exception as e:
             logger.error(f"Cache SET error for key {key}: {e}")
@@ -80,15 +690,603 @@ class RedisCache:
         if not self.client:
             return None
         
+        started = time.perf_counter()
+        redis_key, version = self._redis_key(key)
+        if self.local:
+            value = self.local.get(key, version)
+            if value is not _MISSING:
+                self.metrics.record_get(key, "l1_hit", time.perf_counter() - started)
+                return value
+        
         try:
-            value = self.client.get(key)
+            value = self.client.get(redis_key)
             if value:
-                return json.loads(value)
+                result = self.codec.decode(value)
+                if self.local:
+                    self.local.set(key, result, version)
+                self.metrics.record_get(key, "l2_hit", time.perf_counter() - started, len(value))
+                return result
+            self.metrics.record_get(key, "miss", time.perf_counter() - started)
+            return None
+        except Exception as e:
+            logger.error(f"Cache GET error for key {key}: {e}")
             return None
+    
+    async def aset(self, key: str, value: Any, ttl_seconds: int = 3600) -> bool:
+        """Async variant of set"""
+        client = self.get_async_client()
+        if not client:
+            return False
+        
+        started = time.perf_counter()
+        try:
+            serialized = self.codec.encode(value)
+            redis_key, version = await self._aredis_key(key)
+            await client.setex(redis_key, ttl_seconds, serialized)
+            if self.local:
+                self.local.set(key, value, version, ttl_seconds)
+            self.metrics.record_set(key, time.perf_counter() - started, len(serialized))
+            return True
+        except Exception as e:
+            logger.error(f"Cache SET error for key {key}: {e}")
+            return False
+    
+    async def aget(self, key: str) -> Optional[Any]:
+        """Async variant of get"""
+        client = self.get_async_client()
+        if not client:
+            return None
+        
+        started = time.perf_counter()
+        redis_key, version = await self._aredis_key(key)
+        if self.local:
+            value = self.local.get(key, version)
+            if value is not _MISSING:
+                self.metrics.record_get(key, "l1_hit", time.perf_counter() - started)
+                return value
+        
+        try:
+            value = await client.get(redis_key)
+            if value:
+                result = self.codec.decode(value)
+                if self.local:
+                    self.local.set(key, result, version)
+                self.metrics.record_get(key, "l2_hit", time.perf_counter() - started, len(value))
+                return result
+            self.metrics.record_get(key, "miss", time.perf_counter() - started)
+            return None
+        except Exception as e:
+            logger.error(f"Cache GET error for key {key}: {e}")
+            return None
+    
+    def mget(self, keys: List[str]) -> Dict[str, Any]:
+        """
+        Get many values with one Redis round trip (L1 hits skip Redis)
+        
+        Args:
+            keys: Cache keys
+        
+        Returns:
+            key -> value for the keys found
+        """
+        if not self.client or not keys:
+            return {}
+        
+        started = time.perf_counter()
+        found, missing = self._mget_local(keys, self._redis_keys(keys), started)
+        if not missing:
+            return found
+        
+        try:
+            values = self.client.mget([redis_key for _, redis_key, _ in missing])
+        except Exception as e:
+            logger.error(f"Cache MGET error for {len(missing)} keys: {e}")
+            return found
+        return self._mget_fill(found, missing, values, started)
+    
+    async def amget(self, keys: List[str]) -> Dict[str, Any]:
+        """Async variant of mget"""
+        client = self.get_async_client()
+        if not client or not keys:
+            return {}
+        
+        started = time.perf_counter()
+        found, missing = self._mget_local(keys, await self._aredis_keys(keys), started)
+        if not missing:
+            return found
+        
+        try:
+            values = await client.mget([redis_key for _, redis_key, _ in missing])
+        except Exception as e:
+            logger.error(f"Cache MGET error for {len(missing)} keys: {e}")
+            return found
+        return self._mget_fill(found, missing, values, started)
+    
+    def _mget_local(
+        self,
+        keys: List[str],
+        redis_keys: List[Tuple[str, int]],
+        started: float
+    ) -> Tuple[Dict[str, Any], List[Tuple[str, str, int]]]:
+        """Serve what L1 has; returns (found, [(key, redis key, version)] still to fetch)"""
+        found: Dict[str, Any] = {}
+        missing: List[Tuple[str, str, int]] = []
+        for key, (redis_key, version) in zip(keys, redis_keys):
+            value = self.local.get(key, version) if self.local else _MISSING
+            if value is _MISSING:
+                missing.append((key, redis_key, version))
+            else:
+                found[key] = value
+                self.metrics.record_get(key, "l1_hit", time.perf_counter() - started)
+        return found, missing
+    
+    def _mget_fill(
+        self,
+        found: Dict[str, Any],
+        missing: List[Tuple[str, str, int]],
+        values: List[Any],
+        started: float
+    ) -> Dict[str, Any]:
+        elapsed = time.perf_counter() - started
+        for (key, _, version), value in zip(missing, values):
+            if not value:
+                self.metrics.record_get(key, "miss", elapsed)
+                continue
+            try:
+                found[key] = result = self.codec.decode(value)
+            except Exception as e:
+                logger.error(f"Cache GET error for key {key}: {e}")
+                continue
+            if self.local:
+                self.local.set(key, result, version)
+            self.metrics.record_get(key, "l2_hit", elapsed, len(value))
+        return found
+    
+    def mset(self, mapping: Dict[str, Any], ttl_seconds: int = 3600) -> bool:
+        """
+        Set many values with TTL in one pipelined round trip
+        
+        Args:
+            mapping: key -> value to cache (serialized by self.codec)
+            ttl_seconds: Time-to-live in seconds
+        
+        Returns:
+            True if set successfully, False otherwise
+        """
+        if not self.client or not mapping:
+            return False
+        
+        keys = list(mapping)
+        started = time.perf_counter()
+        try:
+            redis_keys = self._redis_keys(keys)
+            pipe = self.client.pipeline(transaction=False)
+            sizes = []
+            for key, (redis_key, _) in zip(keys, redis_keys):
+                serialized = self.codec.encode(mapping[key])
+                sizes.append(len(serialized))
+                pipe.setex(redis_key, ttl_seconds, serialized)
+            pipe.execute()
+        except Exception as e:
+            logger.error(f"Cache MSET error for {len(keys)} keys: {e}")
+            return False
+        
+        self._mset_local(mapping, redis_keys, ttl_seconds)
+        elapsed = time.perf_counter() - started
+        for key, size in zip(keys, sizes):
+            self.metrics.record_set(key, elapsed, size)
+        return True
+    
+    async def amset(self, mapping: Dict[str, Any], ttl_seconds: int = 3600) -> bool:
+        """Async variant of mset"""
+        client = self.get_async_client()
+        if not client or not mapping:
+            return False
+        
+        keys = list(mapping)
+        started = time.perf_counter()
+        try:
+            redis_keys = await self._aredis_keys(keys)
+            pipe = client.pipeline(transaction=False)
+            sizes = []
+            for key, (redis_key, _) in zip(keys, redis_keys):
+                serialized = self.codec.encode(mapping[key])
+                sizes.append(len(serialized))
+                pipe.setex(redis_key, ttl_seconds, serialized)
+            await pipe.execute()
+        except Exception as e:
+            logger.error(f"Cache MSET error for {len(keys)} keys: {e}")
+            return False
+        
+        self._mset_local(mapping, redis_keys, ttl_seconds)
+        elapsed = time.perf_counter() - started
+        for key, size in zip(keys, sizes):
+            self.metrics.record_set(key, elapsed, size)
+        return True
+    
+    def _mset_local(self, mapping: Dict[str, Any], redis_keys: List[Tuple[str, int]], ttl_seconds: int) -> None:
+        if self.local:
+            for (key, value), (_, version) in zip(mapping.items(), redis_keys):
+                self.local.set(key, value, version, ttl_seconds)
+    
+    def get_entry(self, key: str) -> Optional[CacheEntry]:
+        """
+        Get a cached entry, including stale ones still inside their grace period
+        
+        Args:
+            key: Cache key
+        
+        Returns:
+            CacheEntry or None if not found/error
+        """
+        if not self.client:
+            return None
+        
+        started = time.perf_counter()
+        redis_key, version = self._redis_key(key)
+        entry = self._local_entry(key, version)
+        if entry is not None:
+            self.metrics.record_get(key, "l1_hit", time.perf_counter() - started)
+            return entry
+        
+        try:
+            value = self.client.get(redis_key)
+            if not value:
+                self.metrics.record_get(key, "miss", time.perf_counter() - started)
+                return None
+            entry = self._remember_entry(key, version, value)
+            self.metrics.record_get(key, "l2_hit", time.perf_counter() - started, len(value))
+            return entry
         except Exception as e:
             logger.error(f"Cache GET error for key {key}: {e}")
             return None
     
+    async def aget_entry(self, key: str) -> Optional[CacheEntry]:
+        """Async variant of get_entry"""
+        client = self.get_async_client()
+        if not client:
+            return None
+        
+        started = time.perf_counter()
+        redis_key, version = await self._aredis_key(key)
+        entry = self._local_entry(key, version)
+        if entry is not None:
+            self.metrics.record_get(key, "l1_hit", time.perf_counter() - started)
+            return entry
+        
+        try:
+            value = await client.get(redis_key)
+            if not value:
+                self.metrics.record_get(key, "miss", time.perf_counter() - started)
+                return None
+            entry = self._remember_entry(key, version, value)
+            self.metrics.record_get(key, "l2_hit", time.perf_counter() - started, len(value))
+            return entry
+        except Exception as e:
+            logger.error(f"Cache GET error for key {key}: {e}")
+            return None
+    
+    def _local_entry(self, key: str, version: int) -> Optional[CacheEntry]:
+        if self.local:
+            entry = self.local.get(key, version)
+            # Stale entries are re-read: another worker may have refreshed them
+            if entry is not _MISSING and entry.expires_at > time.time():
+                return entry
+        return None
+    
+    def _remember_entry(self, key: str, version: int, raw: Any) -> CacheEntry:
+        entry = _entry_from_payload(self.codec.decode(raw))
+        remaining = entry.expires_at - time.time()
+        if self.local and remaining > 0:
+            self.local.set(key, entry, version, remaining)
+        return entry
+    
+    def set_entry(
+        self,
+        key: str,
+        value: Any,
+        ttl_seconds: int = 3600,
+        delta: float = 0.0,
+        stale_ttl_seconds: int = 0
+    ) -> bool:
+        """
+        Store a value with its logical expiry and compute time
+        
+        Args:
+            key: Cache key
+            value: Value to cache (serialized by self.codec)
+            ttl_seconds: Seconds until the value is stale
+            delta: Seconds the value took to compute
+            stale_ttl_seconds: Extra seconds a stale value is kept to be
+                served while it is being recomputed
+        
+        Returns:
+            True if set successfully, False otherwise
+        """
+        if not self.client:
+            return False
+        
+        entry = CacheEntry(value, time.time() + ttl_seconds, delta)
+        started = time.perf_counter()
+        try:
+            serialized = self.codec.encode(_entry_payload(entry))
+            redis_key, version = self._redis_key(key)
+            self.client.setex(redis_key, ttl_seconds + stale_ttl_seconds, serialized)
+            if self.local:
+                self.local.set(key, entry, version, ttl_seconds + stale_ttl_seconds)
+            self.metrics.record_set(key, time.perf_counter() - started, len(serialized))
+            return True
+        except Exception as e:
+            logger.error(f"Cache SET error for key {key}: {e}")
+            return False
+    
+    async def aset_entry(
+        self,
+        key: str,
+        value: Any,
+        ttl_seconds: int = 3600,
+        delta: float = 0.0,
+        stale_ttl_seconds: int = 0
+    ) -> bool:
+        """Async variant of set_entry"""
+        client = self.get_async_client()
+        if not client:
+            return False
+        
+        entry = CacheEntry(value, time.time() + ttl_seconds, delta)
+        started = time.perf_counter()
+        try:
+            serialized = self.codec.encode(_entry_payload(entry))
+            redis_key, version = await self._aredis_key(key)
+            await client.setex(redis_key, ttl_seconds + stale_ttl_seconds, serialized)
+            if self.local:
+                self.local.set(key, entry, version, ttl_seconds + stale_ttl_seconds)
+            self.metrics.record_set(key, time.perf_counter() - started, len(serialized))
+            return True
+        except Exception as e:
+            logger.error(f"Cache SET error for key {key}: {e}")
+            return False
+    
+    def get_entries(self, keys: List[str]) -> Dict[str, CacheEntry]:
+        """
+        Get many cached entries with one MGET (see get_entry)
+        
+        Args:
+            keys: Cache keys
+        
+        Returns:
+            {key: CacheEntry} for the keys found, stale ones included
+        """
+        if not self.client or not keys:
+            return {}
+        
+        started = time.perf_counter()
+        found, missing = self._entries_local(keys, self._redis_keys(keys), started)
+        if not missing:
+            return found
+        
+        try:
+            values = self.client.mget([redis_key for _, redis_key, _ in missing])
+        except Exception as e:
+            logger.error(f"Cache MGET error for {len(missing)} keys: {e}")
+            return found
+        return self._entries_fill(found, missing, values, started)
+    
+    async def aget_entries(self, keys: List[str]) -> Dict[str, CacheEntry]:
+        """Async variant of get_entries"""
+        client = self.get_async_client()
+        if not client or not keys:
+            return {}
+        
+        started = time.perf_counter()
+        found, missing = self._entries_local(keys, await self._aredis_keys(keys), started)
+        if not missing:
+            return found
+        
+        try:
+            values = await client.mget([redis_key for _, redis_key, _ in missing])
+        except Exception as e:
+            logger.error(f"Cache MGET error for {len(missing)} keys: {e}")
+            return found
+        return self._entries_fill(found, missing, values, started)
+    
+    def _entries_local(
+        self,
+        keys: List[str],
+        redis_keys: List[Tuple[str, int]],
+        started: float
+    ) -> Tuple[Dict[str, CacheEntry], List[Tuple[str, str, int]]]:
+        """Serve what L1 has; returns (found, [(key, redis key, version)] still to fetch)"""
+        found: Dict[str, CacheEntry] = {}
+        missing: List[Tuple[str, str, int]] = []
+        for key, (redis_key, version) in zip(keys, redis_keys):
+            entry = self._local_entry(key, version)
+            if entry is None:
+                missing.append((key, redis_key, version))
+            else:
+                found[key] = entry
+                self.metrics.record_get(key, "l1_hit", time.perf_counter() - started)
+        return found, missing
+    
+    def _entries_fill(
+        self,
+        found: Dict[str, CacheEntry],
+        missing: List[Tuple[str, str, int]],
+        values: List[Any],
+        started: float
+    ) -> Dict[str, CacheEntry]:
+        elapsed = time.perf_counter() - started
+        for (key, _, version), value in zip(missing, values):
+            if not value:
+                self.metrics.record_get(key, "miss", elapsed)
+                continue
+            try:
+                found[key] = self._remember_entry(key, version, value)
+            except Exception as e:
+                logger.error(f"Cache GET error for key {key}: {e}")
+                continue
+            self.metrics.record_get(key, "l2_hit", elapsed, len(value))
+        return found
+    
+    def set_entries(
+        self,
+        values: Dict[str, Any],
+        ttl_seconds: int = 3600,
+        delta: float = 0.0,
+        stale_ttl_seconds: int = 0
+    ) -> bool:
+        """
+        Store many entries in one pipeline (see set_entry)
+        
+        Args:
+            values: {key: value}
+            ttl_seconds: Seconds until the values are stale
+            delta: Seconds each value took to compute
+            stale_ttl_seconds: Extra seconds stale values are kept
+        
+        Returns:
+            True if set successfully, False otherwise
+        """
+        if not self.client or not values:
+            return False
+        
+        keys = list(values)
+        started = time.perf_counter()
+        try:
+            redis_keys = self._redis_keys(keys)
+            pipe = self.client.pipeline(transaction=False)
+            entries, sizes = self._queue_entries(pipe, values, redis_keys, ttl_seconds, delta, stale_ttl_seconds)
+            pipe.execute()
+        except Exception as e:
+            logger.error(f"Cache MSET error for {len(keys)} keys: {e}")
+            return False
+        
+        self._entries_stored(entries, redis_keys, sizes, ttl_seconds + stale_ttl_seconds, started)
+        return True
+    
+    async def aset_entries(
+        self,
+        values: Dict[str, Any],
+        ttl_seconds: int = 3600,
+        delta: float = 0.0,
+        stale_ttl_seconds: int = 0
+    ) -> bool:
+        """Async variant of set_entries"""
+        client = self.get_async_client()
+        if not client or not values:
+            return False
+        
+        keys = list(values)
+        started = time.perf_counter()
+        try:
+            redis_keys = await self._aredis_keys(keys)
+            pipe = client.pipeline(transaction=False)
+            entries, sizes = self._queue_entries(pipe, values, redis_keys, ttl_seconds, delta, stale_ttl_seconds)
+            await pipe.execute()
+        except Exception as e:
+            logger.error(f"Cache MSET error for {len(keys)} keys: {e}")
+            return False
+        
+        self._entries_stored(entries, redis_keys, sizes, ttl_seconds + stale_ttl_seconds, started)
+        return True
+    
+    def _queue_entries(
+        self,
+        pipe: Any,
+        values: Dict[str, Any],
+        redis_keys: List[Tuple[str, int]],
+        ttl_seconds: int,
+        delta: float,
+        stale_ttl_seconds: int
+    ) -> Tuple[Dict[str, CacheEntry], List[int]]:
+        """Queue a SETEX per entry on pipe; returns (entries, encoded sizes)"""
+        expires_at = time.time() + ttl_seconds
+        entries: Dict[str, CacheEntry] = {}
+        sizes: List[int] = []
+        for (key, value), (redis_key, _) in zip(values.items(), redis_keys):
+            entries[key] = entry = CacheEntry(value, expires_at, delta)
+            serialized = self.codec.encode(_entry_payload(entry))
+            sizes.append(len(serialized))
+            pipe.setex(redis_key, ttl_seconds + stale_ttl_seconds, serialized)
+        return entries, sizes
+    
+    def _entries_stored(
+        self,
+        entries: Dict[str, CacheEntry],
+        redis_keys: List[Tuple[str, int]],
+        sizes: List[int],
+        keep_seconds: int,
+        started: float
+    ) -> None:
+        elapsed = time.perf_counter() - started
+        for (key, entry), (_, version), size in zip(entries.items(), redis_keys, sizes):
+            if self.local:
+                self.local.set(key, entry, version, keep_seconds)
+            self.metrics.record_set(key, elapsed, size)
+    
+    def acquire_lock(self, key: str, timeout_seconds: float = 30) -> Optional[str]:
+        """
+        Try to become the one worker recomputing key
+        
+        Args:
+            key: Cache key
+            timeout_seconds: Lock expiry, in case the holder dies
+        
+        Returns:
+            Lock token, or None if another worker holds the lock
+        """
+        token = uuid.uuid4().hex
+        if not self.client:
+            return token
+        
+        try:
+            lock_key = LOCK_KEY.format(key=self._redis_key(key)[0])
+            if self.client.set(lock_key, token, nx=True, px=int(timeout_seconds * 1000)):
+                return token
+            return None
+        except Exception as e:
+            logger.error(f"Cache LOCK error for key {key}: {e}")
+            return token  # Redis trouble: don't block the caller
+    
+    def release_lock(self, key: str, token: str) -> None:
+        """Release a lock taken with acquire_lock"""
+        if not self.client:
+            return
+        
+        try:
+            lock_key = LOCK_KEY.format(key=self._redis_key(key)[0])
+            self.client.eval(_RELEASE_LOCK_SCRIPT, 1, lock_key, token)
+        except Exception as e:
+            logger.error(f"Cache UNLOCK error for key {key}: {e}")
+    
+    async def aacquire_lock(self, key: str, timeout_seconds: float = 30) -> Optional[str]:
+        """Async variant of acquire_lock"""
+        token = uuid.uuid4().hex
+        client = self.get_async_client()
+        if not client:
+            return token
+        
+        try:
+            lock_key = LOCK_KEY.format(key=(await self._aredis_key(key))[0])
+            if await client.set(lock_key, token, nx=True, px=int(timeout_seconds * 1000)):
+                return token
+            return None
+        except Exception as e:
+            logger.error(f"Cache LOCK error for key {key}: {e}")
+            return token  # Redis trouble: don't block the caller
+    
+    async def arelease_lock(self, key: str, token: str) -> None:
+        """Async variant of release_lock"""
+        client = self.get_async_client()
+        if not client:
+            return
+        
+        try:
+            lock_key = LOCK_KEY.format(key=(await self._aredis_key(key))[0])
+            await client.eval(_RELEASE_LOCK_SCRIPT, 1, lock_key, token)
+        except Exception as e:
+            logger.error(f"Cache UNLOCK error for key {key}: {e}")
+    
     def delete(self, key: str) -> bool:
         """
         Delete cache entry
@@ -99,11 +1297,30 @@ class RedisCache:
         Returns:
             True if deleted, False otherwise
         """
+        if self.local:
+            self.local.delete(key)
+        
         if not self.client:
             return False
         
         try:
-            self.client.delete(key)
+            self.client.delete(self._redis_key(key)[0])
+            return True
+        except Exception as e:
+            logger.error(f"Cache DELETE error for key {key}: {e}")
+            return False
+    
+    async def adelete(self, key: str) -> bool:
+        """Async variant of delete"""
+        if self.local:
+            self.local.delete(key)
+        
+        client = self.get_async_client()
+        if not client:
+            return False
+        
+        try:
+            await client.delete((await self._aredis_key(key))[0])
             return True
         except Exception as e:
             logger.error(f"Cache DELETE error for key {key}: {e}")
@@ -111,25 +1328,19 @@ class RedisCache:
     
     def delete_pattern(self, pattern: str) -> int:
         """
-        Delete all keys matching pattern
+        Invalidate every key matching pattern
+        
+        Invalidation works per namespace: the pattern's namespace gets a
+        new generation (one INCR, no KEYS scan), so narrower patterns
+        like "profile:12:*" invalidate the whole "profile" namespace.
         
         Args:
             pattern: Key pattern (e.g., "user:*" or "pred:*")
         
         Returns:
-            Number of keys deleted
+            New namespace version
         """
-        if not self.client:
-            return 0
-        
-        try:
-            keys = self.client.keys(pattern)
-            if keys:
-                return self.client.delete(*keys)
-            return 0
-        except Exception as e:
-            logger.error(f"Cache PATTERN DELETE error for pattern {pattern}: {e}")
-            return 0
+        return self.invalidate_namespace(key_namespace(pattern))
     
     def clear_all(self) -> bool:
         """
@@ -138,8 +1349,14 @@ class RedisCache:
         Returns:
             True if successful, False otherwise
         """
+        if self.local:
+            self.local.clear()
+        self._versions.clear()
+        
         if not self.client:
             return False
+        if self.client is self.local_backend:
+            self._offline_flush = self.backend_mode == "auto"
         
         try:
             self.client.flushdb()
@@ -156,13 +1373,29 @@ class RedisCache:
         Returns:
             Dictionary with cache stats
         """
+        local_stats = self.local.get_stats() if self.local else None
         if not self.client:
-            return {"connected": False}
+            return {"connected": False, "backend": None, "l1": local_stats}
+        if self.client is self.local_backend:
+            return {
+                "connected": False,
+                "backend": "local",
+                "backend_mode": self.backend_mode,
+                "l1": local_stats,
+                "local_backend": self.local_backend.get_stats(),
+                "codec": self.codec.get_stats(),
+                "warmer": self.warmer.get_stats() if self.warmer else None,
+            }
         
         try:
             info = self.client.info()
             return {
                 "connected": True,
+                "backend": "redis",
+                "backend_mode": self.backend_mode,
+                "l1": local_stats,
+                "codec": self.codec.get_stats(),
+                "warmer": self.warmer.get_stats() if self.warmer else None,
                 "used_memory_mb": info.get('used_memory', 0) / (1024 * 1024),
                 "used_memory_peak_mb": info.get('used_memory_peak', 0) / (1024 * 1024),
                 "evicted_keys": info.get('evicted_keys', 0),
@@ -171,11 +1404,11 @@ class RedisCache:
             }
         except Exception as e:
             logger.error(f"Cache STATS error: {e}")
-            return {"connected": False, "error": str(e)}
+            return {"connected": False, "error": str(e), "l1": local_stats}
     
     def health_check(self) -> bool:
         """
-        Check if Redis is healthy
+        Check if the active cache backend is healthy
         
         Returns:
             True if healthy, False otherwise
@@ -220,92 +1453,526 @@ def get_cache() -> RedisCache:
 # Decorators for easy caching
 # ===========================
 
+# Bump when the canonical key encoding changes, so old keys are never read
+CACHE_KEY_SCHEMA_VERSION = 1
+
+
+def _canonical(value: Any) -> Any:
+    """
+    Reduce a value to JSON types with one stable representation
+    
+    Dicts are key-sorted by the JSON encoder, sets are sorted, datetimes
+    become UTC ISO strings and models their field dicts. Anything else
+    is rejected rather than falling back to repr(), which usually embeds
+    a memory address and would make every key unique.
+    """
+    if value is None or isinstance(value, (bool, int, str)):
+        return value
+    if isinstance(value, float):
+        return value if math.isfinite(value) else repr(value)
+    if isinstance(value, Enum):
+        return _canonical(value.value)
+    if isinstance(value, datetime):
+        if value.tzinfo is not None:
+            value = value.astimezone(timezone.utc).replace(tzinfo=None)
+        return value.isoformat()
+    if isinstance(value, (date, dt_time)):
+        return value.isoformat()
+    if isinstance(value, (Decimal, uuid.UUID)):
+        return str(value)
+    if isinstance(value, bytes):
+        return value.hex()
+    if isinstance(value, dict):
+        return {str(_canonical(k)): _canonical(v) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_canonical(item) for item in value]
+    if isinstance(value, (set, frozenset)):
+        return sorted((_canonical(item) for item in value), key=lambda item: json.dumps(item, sort_keys=True))
+    if isinstance(value, BaseModel):
+        return _canonical(value.dict())
+    raise TypeError(
+        f"Can't build a cache key from {type(value).__name__}; "
+        f"pass key_params= or exclude= to cached()"
+    )
+
+
+def _digest(data: bytes) -> str:
+    """Fast non-cryptographic 128-bit hash (xxh3 when installed, else blake2b)"""
+    if xxhash is not None:
+        return xxhash.xxh3_128_hexdigest(data)
+    return hashlib.blake2b(data, digest_size=16).hexdigest()
+
+
 def cache_key(*args, **kwargs) -> str:
-    """Generate cache key from function arguments"""
-    key_parts = [str(arg) for arg in args]
-    key_parts.extend([f"{k}={v}" for k, v in sorted(kwargs.items())])
-    key_str = "|".join(key_parts)
-    hash_obj = hashlib.md5(key_str.encode())
-    return hash_obj.hexdigest()
+    """Generate a deterministic hash of arguments (Session arguments are ignored)"""
+    payload = [
+        [_canonical(arg) for arg in args if not isinstance(arg, Session)],
+        {k: _canonical(v) for k, v in kwargs.items() if not isinstance(v, Session)},
+    ]
+    return _digest(json.dumps(payload, sort_keys=True, separators=(",", ":")).encode())
 
 
-def cached(ttl_seconds: int = 3600, prefix: str = ""):
+class KeyBuilder:
+    """
+    Builds cache keys for one decorated function
+    
+    Arguments are bound to the signature (with defaults applied), so
+    f(3), f(limit=3) and f() with limit=3 as default share a key. self,
+    cls and SQLAlchemy Session arguments never take part.
+    
+    Keys look like "{prefix}:{func}:v{version}:{hash}", so the prefix
+    stays the key's namespace.
+    """
+    
+    def __init__(
+        self,
+        func: Callable,
+        prefix: str = "",
+        key_params: Optional[Sequence[str]] = None,
+        exclude: Optional[Sequence[str]] = None,
+        version: int = CACHE_KEY_SCHEMA_VERSION
+    ):
+        """
+        Args:
+            func: The function being cached
+            prefix: Cache key prefix (namespace)
+            key_params: Only these parameters make up the key
+            exclude: Parameters left out of the key
+            version: Key schema version, bump it when the cached value's shape changes
+        """
+        self.signature = inspect.signature(func)
+        params = list(self.signature.parameters)
+        unknown = set(key_params or ()) | set(exclude or ())
+        unknown -= set(params)
+        if unknown:
+            raise ValueError(f"{func.__qualname__} has no parameters {sorted(unknown)}")
+        
+        skipped = set(exclude or ())
+        if params and params[0] in ("self", "cls"):
+            skipped.add(params[0])
+        self.params = [
+            name for name in params
+            if name not in skipped and (key_params is None or name in key_params)
+        ]
+        base = f"{prefix}:{func.__name__}" if prefix else func.__name__
+        self.base = f"{base}:v{version}"
+    
+    def __call__(self, args: tuple, kwargs: dict) -> str:
+        bound = self.signature.bind(*args, **kwargs)
+        bound.apply_defaults()
+        
+        values = {}
+        for name in self.params:
+            value = bound.arguments[name]
+            if isinstance(value, Session):
+                continue
+            kind = self.signature.parameters[name].kind
+            if kind is inspect.Parameter.VAR_KEYWORD:
+                value = {k: v for k, v in value.items() if not isinstance(v, Session)}
+            elif kind is inspect.Parameter.VAR_POSITIONAL:
+                value = [v for v in value if not isinstance(v, Session)]
+            values[name] = _canonical(value)
+        
+        payload = json.dumps(values, sort_keys=True, separators=(",", ":")).encode()
+        return f"{self.base}:{_digest(payload)}"
+
+
+def _refresh_early(entry: CacheEntry, beta: float, now: float) -> bool:
+    """
+    XFetch: decide probabilistically whether to recompute before expiry
+    
+    The closer to expiry and the slower the computation, the likelier a
+    caller is to refresh early, so hot keys are rebuilt by one caller
+    before they expire instead of by everyone after.
+    """
+    if beta <= 0 or entry.delta <= 0:
+        return False
+    return now - entry.delta * beta * math.log(1.0 - random.random()) >= entry.expires_at
+
+
+class _SyncFlight:
+    """An in-progress synchronous recomputation other threads can wait on"""
+    
+    def __init__(self):
+        self.event = threading.Event()
+        self.result: Any = None
+        self.error: Optional[BaseException] = None
+
+
+def cached(
+    ttl_seconds: int = 3600,
+    prefix: str = "",
+    stale_ttl_seconds: int = 0,
+    early_refresh_beta: float = 1.0,
+    lock_timeout_seconds: float = 30,
+    key_params: Optional[Sequence[str]] = None,
+    exclude: Optional[Sequence[str]] = None,
+    version: int = CACHE_KEY_SCHEMA_VERSION
+):
     """
     Decorator to cache function results
     
+    Concurrent misses for the same key are coalesced: one caller per
+    process recomputes (others wait on it) and a Redis lock elects one
+    process across workers. Callers that find a value about to expire
+    may refresh it early (XFetch), and with stale_ttl_seconds an expired
+    value is still served to everyone but the one caller recomputing it.
+    
     Args:
         ttl_seconds: Time-to-live in seconds
         prefix: Cache key prefix
+        stale_ttl_seconds: How long an expired value may be served while
+            it is recomputed (stale-while-revalidate, 0 disables)
+        early_refresh_beta: XFetch aggressiveness (0 disables early refresh)
+        lock_timeout_seconds: Max time a recomputation holds the cross-worker lock
+        key_params: Only these parameters make up the key
+        exclude: Parameters left out of the key (self/cls and Session
+            arguments always are)
+        version: Key schema version, bump it when the cached value's shape changes
     
     Usage:
         @cached(ttl_seconds=3600, prefix="predictions")
         def get_predictions(diagnosis_id: int):
             return expensive_computation()
+    
+    The wrapper's cache_key(*args, **kwargs) returns the key for a call.
     """
     def decorator(func: F) -> F:
+        make_key = KeyBuilder(func, prefix, key_params, exclude, version)
+        # key -> in-progress recomputation in this process
+        async_flights: Dict[str, "asyncio.Future"] = {}
+        sync_flights: Dict[str, _SyncFlight] = {}
+        sync_flights_lock = threading.Lock()
+        
+        def is_fresh(entry: Optional[CacheEntry]) -> bool:
+            """Whether entry can be returned as is"""
+            if entry is None:
+                return False
+            now = time.time()
+            return now < entry.expires_at and not _refresh_early(entry, early_refresh_beta, now)
+        
+        def served(cache_obj: RedisCache, cache_k: str, entry: CacheEntry) -> Any:
+            """Record serving an existing entry and return its value"""
+            outcome = "fresh" if entry.expires_at > time.time() else "stale"
+            cache_obj.metrics.record_outcome(cache_k, outcome)
+            return entry.value
+        
         @wraps(func)
         async def async_wrapper(*args, **kwargs):
             cache_obj = get_cache()
+            cache_k = make_key(args, kwargs)
+            if cache_obj.warmer is not None:
+                cache_obj.warmer.record(cache_k, func, args, kwargs, ttl_seconds, stale_ttl_seconds)
             
-            # Generate cache key
-            func_name = func.__name__
-            key_hash = cache_key(*args, **kwargs)
-            cache_k = f"{prefix}:{func_name}:{key_hash}" if prefix else f"{func_name}:{key_hash}"
-            
-            # Try to get from cache
-            cached_result = cache_obj.get(cache_k)
-            if cached_result is not None:
+            entry = await cache_obj.aget_entry(cache_k)
+            if is_fresh(entry):
                 logger.debug(f"Cache HIT: {cache_k}")
-                return cached_result
-            
-            # Call function if not cached
-            result = await func(*args, **kwargs)
+                return served(cache_obj, cache_k, entry)
             
-            # Store in cache
-            cache_obj.set(cache_k, result, ttl_seconds)
-            logger.debug(f"Cache SET: {cache_k} (TTL: {ttl_seconds}s)")
+            pending = async_flights.get(cache_k)
+            if pending is not None:
+                # Someone in this process is already recomputing
+                if entry is not None:
+                    return served(cache_obj, cache_k, entry)
+                cache_obj.metrics.record_outcome(cache_k, "fresh")
+                return await asyncio.shield(pending)
             
-            return result
+            future = asyncio.get_running_loop().create_future()
+            async_flights[cache_k] = future
+            try:
+                token = await cache_obj.aacquire_lock(cache_k, lock_timeout_seconds)
+                try:
+                    if token is None and entry is None:
+                        entry = await _wait_for_other_worker(cache_obj, cache_k, lock_timeout_seconds)
+                    elif token is not None:
+                        entry = _recheck(entry, await cache_obj.aget_entry(cache_k))
+                    
+                    if entry is not None and (token is None or entry.expires_at > time.time()):
+                        # Another worker is recomputing (or just did); use its value
+                        result = served(cache_obj, cache_k, entry)
+                    else:
+                        started = time.perf_counter()
+                        try:
+                            result = await func(*args, **kwargs)
+                        except Exception:
+                            if entry is None:
+                                raise
+                            logger.exception(f"Cache refresh failed, serving stale value: {cache_k}")
+                            result = served(cache_obj, cache_k, entry)
+                        else:
+                            delta = time.perf_counter() - started
+                            cache_obj.metrics.record_outcome(cache_k, "recomputed", delta)
+                            if result is not None:
+                                await cache_obj.aset_entry(cache_k, result, ttl_seconds, delta, stale_ttl_seconds)
+                finally:
+                    if token is not None:
+                        await cache_obj.arelease_lock(cache_k, token)
+                
+                future.set_result(result)
+                return result
+            except BaseException as e:
+                future.set_exception(e)
+                future.exception()  # Mark retrieved when nobody was waiting
+                raise
+            finally:
+                async_flights.pop(cache_k, None)
         
         @wraps(func)
         def sync_wrapper(*args, **kwargs):
             cache_obj = get_cache()
+            cache_k = make_key(args, kwargs)
+            if cache_obj.warmer is not None:
+                cache_obj.warmer.record(cache_k, func, args, kwargs, ttl_seconds, stale_ttl_seconds)
             
-            # Generate cache key
-            func_name = func.__name__
-            key_hash = cache_key(*args, **kwargs)
-            cache_k = f"{prefix}:{func_name}:{key_hash}" if prefix else f"{func_name}:{key_hash}"
-            
-            # Try to get from cache
-            cached_result = cache_obj.get(cache_k)
-            if cached_result is not None:
+            entry = cache_obj.get_entry(cache_k)
+            if is_fresh(entry):
                 logger.debug(f"Cache HIT: {cache_k}")
-                return cached_result
+                return served(cache_obj, cache_k, entry)
             
-            # Call function if not cached
-            result = func(*args, **kwargs)
+            with sync_flights_lock:
+                flight = sync_flights.get(cache_k)
+                leader = flight is None
+                if leader:
+                    flight = sync_flights[cache_k] = _SyncFlight()
             
-            # Store in cache
-            cache_obj.set(cache_k, result, ttl_seconds)
-            logger.debug(f"Cache SET: {cache_k} (TTL: {ttl_seconds}s)")
+            if not leader:
+                # Someone in this process is already recomputing
+                if entry is not None:
+                    return served(cache_obj, cache_k, entry)
+                if flight.event.wait(lock_timeout_seconds):
+                    if flight.error is not None:
+                        raise flight.error
+                    cache_obj.metrics.record_outcome(cache_k, "fresh")
+                    return flight.result
+                return func(*args, **kwargs)
             
-            return result
+            try:
+                token = cache_obj.acquire_lock(cache_k, lock_timeout_seconds)
+                try:
+                    if token is None and entry is None:
+                        entry = _wait_for_other_worker_sync(cache_obj, cache_k, lock_timeout_seconds)
+                    elif token is not None:
+                        entry = _recheck(entry, cache_obj.get_entry(cache_k))
+                    
+                    if entry is not None and (token is None or entry.expires_at > time.time()):
+                        # Another worker is recomputing (or just did); use its value
+                        flight.result = served(cache_obj, cache_k, entry)
+                    else:
+                        started = time.perf_counter()
+                        try:
+                            flight.result = func(*args, **kwargs)
+                        except Exception:
+                            if entry is None:
+                                raise
+                            logger.exception(f"Cache refresh failed, serving stale value: {cache_k}")
+                            flight.result = served(cache_obj, cache_k, entry)
+                        else:
+                            delta = time.perf_counter() - started
+                            cache_obj.metrics.record_outcome(cache_k, "recomputed", delta)
+                            if flight.result is not None:
+                                cache_obj.set_entry(cache_k, flight.result, ttl_seconds, delta, stale_ttl_seconds)
+                finally:
+                    if token is not None:
+                        cache_obj.release_lock(cache_k, token)
+                
+                return flight.result
+            except BaseException as e:
+                flight.error = e
+                raise
+            finally:
+                with sync_flights_lock:
+                    sync_flights.pop(cache_k, None)
+                flight.event.set()
         
         # Return appropriate wrapper
-        if asyncio.iscoroutinefunction(func):
-            return cast(F, async_wrapper)
-        else:
-            return cast(F, sync_wrapper)
+        wrapper = async_wrapper if asyncio.iscoroutinefunction(func) else sync_wrapper
+        wrapper.cache_key = lambda *args, **kwargs: make_key(args, kwargs)
+        return cast(F, wrapper)
     
     return decorator
 
 
+def cached_many(
+    ttl_seconds: int = 3600,
+    prefix: str = "",
+    stale_ttl_seconds: int = 0,
+    item_key: Optional[Callable[..., str]] = None,
+    batch_param: Optional[str] = None,
+    version: int = CACHE_KEY_SCHEMA_VERSION
+):
+    """
+    Decorator to cache a batch function item by item
+    
+    The decorated function takes a collection of ids in batch_param and
+    returns {id: value} for the ids it found. A call reads every id's
+    entry with one MGET, passes only the misses to the function (one IN
+    query instead of one query per id) and writes the results back in
+    one pipeline, so N ids cost three round trips instead of 3 x N.
+    Entries are stored like @cached's, so with item_key set to a single-
+    item function's cache_key both share them. Ids the function doesn't
+    return (or returns None for) are not cached. Batches are not
+    stampede-protected: they are meant for warming and bulk reads.
+    
+    Args:
+        ttl_seconds: Time-to-live in seconds
+        prefix: Cache key prefix (ignored when item_key is given)
+        stale_ttl_seconds: Extra seconds entries are kept for @cached readers
+            to serve stale while recomputing
+        item_key: Builds one id's key from the call's arguments with the id
+            in place of the collection, e.g. get_recommendation.cache_key
+        batch_param: Parameter holding the ids (default: the first one
+            after self/cls)
+        version: Key schema version, bump it when the cached value's shape changes
+    
+    Usage:
+        @cached_many(ttl_seconds=3600, item_key=get_recommendation.cache_key)
+        def get_recommendations(recommendation_ids: List[int]) -> Dict[int, dict]:
+            return {r.id: r.to_dict() for r in query.filter(Recommendation.id.in_(recommendation_ids))}
+    
+    The wrapper's cache_key(*args, **kwargs) returns one id's key.
+    """
+    def decorator(func: F) -> F:
+        signature = inspect.signature(func)
+        params = [name for name in signature.parameters if name not in ("self", "cls")]
+        ids_param = batch_param or (params[0] if params else None)
+        if ids_param not in signature.parameters:
+            raise ValueError(f"{func.__qualname__} has no batch parameter {ids_param!r}")
+        make_key = KeyBuilder(func, prefix, version=version)
+        key_for = item_key or (lambda *args, **kwargs: make_key(args, kwargs))
+        
+        def plan(args: tuple, kwargs: dict) -> Tuple[inspect.BoundArguments, Dict[str, Any]]:
+            """Bind a call; returns (bound arguments, {key: id}) in id order"""
+            bound = signature.bind(*args, **kwargs)
+            bound.apply_defaults()
+            ids = list(dict.fromkeys(bound.arguments[ids_param]))
+            keys = {}
+            for item in ids:
+                bound.arguments[ids_param] = item
+                keys[key_for(*bound.args, **bound.kwargs)] = item
+            return bound, keys
+        
+        def hits(cache_obj: RedisCache, entries: Dict[str, CacheEntry]) -> Dict[str, Any]:
+            """Fresh values by key; stale entries count as misses"""
+            now = time.time()
+            fresh = {}
+            for key, entry in entries.items():
+                if entry.expires_at > now:
+                    fresh[key] = entry.value
+                    cache_obj.metrics.record_outcome(key, "fresh")
+            return fresh
+        
+        def store(
+            cache_obj: RedisCache,
+            missing: Dict[str, Any],
+            computed: Dict[Any, Any],
+            delta: float
+        ) -> Dict[str, Any]:
+            """Computed values by key, with outcomes recorded"""
+            values = {}
+            for key, item in missing.items():
+                cache_obj.metrics.record_outcome(key, "recomputed", delta)
+                value = computed.get(item)
+                if value is not None:
+                    values[key] = value
+            return values
+        
+        @wraps(func)
+        async def async_wrapper(*args, **kwargs):
+            cache_obj = get_cache()
+            bound, keys = plan(args, kwargs)
+            
+            values = hits(cache_obj, await cache_obj.aget_entries(list(keys)))
+            missing = {key: item for key, item in keys.items() if key not in values}
+            if missing:
+                bound.arguments[ids_param] = list(missing.values())
+                started = time.perf_counter()
+                computed = await func(*bound.args, **bound.kwargs) or {}
+                delta = (time.perf_counter() - started) / len(missing)
+                fresh = store(cache_obj, missing, computed, delta)
+                if fresh:
+                    await cache_obj.aset_entries(fresh, ttl_seconds, delta, stale_ttl_seconds)
+                values.update(fresh)
+            logger.debug(f"Cache batch {func.__name__}: {len(keys) - len(missing)} hits, {len(missing)} misses")
+            
+            return {item: values[key] for key, item in keys.items() if key in values}
+        
+        @wraps(func)
+        def sync_wrapper(*args, **kwargs):
+            cache_obj = get_cache()
+            bound, keys = plan(args, kwargs)
+            
+            values = hits(cache_obj, cache_obj.get_entries(list(keys)))
+            missing = {key: item for key, item in keys.items() if key not in values}
+            if missing:
+                bound.arguments[ids_param] = list(missing.values())
+                started = time.perf_counter()
+                computed = func(*bound.args, **bound.kwargs) or {}
+                delta = (time.perf_counter() - started) / len(missing)
+                fresh = store(cache_obj, missing, computed, delta)
+                if fresh:
+                    cache_obj.set_entries(fresh, ttl_seconds, delta, stale_ttl_seconds)
+                values.update(fresh)
+            logger.debug(f"Cache batch {func.__name__}: {len(keys) - len(missing)} hits, {len(missing)} misses")
+            
+            return {item: values[key] for key, item in keys.items() if key in values}
+        
+        wrapper = async_wrapper if asyncio.iscoroutinefunction(func) else sync_wrapper
+        wrapper.cache_key = key_for
+        return cast(F, wrapper)
+    
+    return decorator
+
+
+def _recheck(entry: Optional[CacheEntry], latest: Optional[CacheEntry]) -> Optional[CacheEntry]:
+    """
+    Pick the entry to use after winning a key's lock
+    
+    latest is the key re-read after acquiring the lock: the previous
+    holder may have stored a fresh value since our lookup, and a fresh
+    value is returned as is. An early (XFetch) refresh, whose entry is
+    still fresh, is kept as a refresh by returning the entry with an
+    already-passed expiry.
+    """
+    if latest is not None and (entry is None or latest.expires_at > entry.expires_at):
+        return latest
+    if entry is not None:
+        return entry._replace(expires_at=0)
+    return None
+
+
+# Poll interval while another worker holds a recompute lock
+_LOCK_POLL_SECONDS = 0.05
+
+
+async def _wait_for_other_worker(cache_obj: RedisCache, cache_k: str, timeout: float) -> Optional[CacheEntry]:
+    """Wait for the lock holder's value; None if it doesn't appear in time"""
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        await asyncio.sleep(_LOCK_POLL_SECONDS)
+        entry = await cache_obj.aget_entry(cache_k)
+        if entry is not None:
+            return entry
+    return None
+
+
+def _wait_for_other_worker_sync(cache_obj: RedisCache, cache_k: str, timeout: float) -> Optional[CacheEntry]:
+    """Blocking variant of _wait_for_other_worker for sync functions"""
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        time.sleep(_LOCK_POLL_SECONDS)
+        entry = cache_obj.get_entry(cache_k)
+        if entry is not None:
+            return entry
+    return None
+
+
 def cache_invalidate(pattern: str = None, keys: list = None):
     """
     Decorator to invalidate cache after function execution
     
     Args:
-        pattern: Cache pattern to invalidate (e.g., "pred:*")
+        pattern: Cache pattern to invalidate (e.g., "pred:*"); its whole
+            namespace moves to a new generation in O(1)
         keys: Specific cache keys to invalidate
     
     Usage:
@@ -321,11 +1988,11 @@ def cache_invalidate(pattern: str = None, keys: list = None):
             
             cache_obj = get_cache()
             if pattern:
-                cache_obj.delete_pattern(pattern)
+                await cache_obj.ainvalidate_namespace(key_namespace(pattern))
                 logger.debug(f"Cache INVALIDATE pattern: {pattern}")
             if keys:
                 for key in keys:
-                    cache_obj.delete(key)
+                    await cache_obj.adelete(key)
                 logger.debug(f"Cache INVALIDATE keys: {keys}")
             
             return result
@@ -336,7 +2003,7 @@ def cache_invalidate(pattern: str = None, keys: list = None):
             
             cache_obj = get_cache()
             if pattern:
-                cache_obj.delete_pattern(pattern)
+                cache_obj.invalidate_namespace(key_namespace(pattern))
                 logger.debug(f"Cache INVALIDATE pattern: {pattern}")
             if keys:
                 for key in keys:
@@ -357,9 +2024,13 @@ def cache_invalidate(pattern: str = None, keys: list = None):
 import asyncio
 
 __all__ = [
+    "LocalCache",
     "RedisCache",
+    "CacheEntry",
+    "KeyBuilder",
     "init_cache",
     "get_cache",
     "cached",
+    "cached_many",
     "cache_invalidate",
 ]
@@ -0,0 +1,249 @@
+"""
+Cache storage backends
+Pluggable stores behind RedisCache
+
+RedisCache talks to its store through the subset of the Redis command
+API listed on CacheBackend, so a redis client plugs in directly. The
+in-process LocalBackend implements the same commands with a bounded
+TTL/LRU dict, letting dev and single-node deployments keep caching
+(including namespace generations and recompute locks) while Redis is
+down or not deployed at all.
+"""
+
+import fnmatch
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+# Lua script RedisCache uses to release recompute locks
+RELEASE_LOCK_SCRIPT = """
+if redis.call("get", KEYS[1]) == ARGV[1] then
+    return redis.call("del", KEYS[1])
+end
+return 0
+"""
+
+
+class CacheBackend:
+    """
+    Commands RedisCache needs from its store (redis.Redis implements them all)
+    
+    get, mget, setex, set(nx, px), delete, unlink, incr, eval (lock
+    release script only), pipeline, scan_iter, flushdb, info and ping.
+    """
+    
+    def get(self, key: str) -> Any:
+        raise NotImplementedError
+    
+    def mget(self, keys: List[str]) -> List[Any]:
+        raise NotImplementedError
+    
+    def setex(self, key: str, ttl_seconds: int, value: Any) -> bool:
+        raise NotImplementedError
+    
+    def set(self, key: str, value: Any, nx: bool = False, px: Optional[int] = None) -> Optional[bool]:
+        raise NotImplementedError
+    
+    def delete(self, *keys: str) -> int:
+        raise NotImplementedError
+    
+    def incr(self, key: str) -> int:
+        raise NotImplementedError
+    
+    def eval(self, script: str, numkeys: int, *args: Any) -> Any:
+        raise NotImplementedError
+    
+    def pipeline(self, transaction: bool = True) -> "LocalPipeline":
+        raise NotImplementedError
+    
+    def scan_iter(self, match: str = "*", count: Optional[int] = None) -> Iterator[str]:
+        raise NotImplementedError
+    
+    def flushdb(self) -> bool:
+        raise NotImplementedError
+    
+    def info(self) -> Dict[str, Any]:
+        raise NotImplementedError
+    
+    def ping(self) -> bool:
+        raise NotImplementedError
+
+
+class LocalBackend(CacheBackend):
+    """
+    Bounded in-process TTL/LRU store
+    
+    Counters (namespace versions) are kept apart from entries and never
+    evicted: losing one would reset its namespace to an old generation.
+    Thread-safe, since sync endpoints run in FastAPI's threadpool.
+    """
+    
+    def __init__(self, max_entries: int = 50000):
+        self.max_entries = max_entries
+        # key -> (value, expires_at monotonic or None)
+        self.entries: "OrderedDict[str, Tuple[Any, Optional[float]]]" = OrderedDict()
+        self.counters: Dict[str, int] = {}
+        self.lock = threading.Lock()
+        self.evicted_keys = 0
+        self.expired_keys = 0
+    
+    def _live(self, key: str) -> Optional[Tuple[Any, Optional[float]]]:
+        """Entry for key if present and not expired (caller holds the lock)"""
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        if entry[1] is not None and entry[1] <= time.monotonic():
+            del self.entries[key]
+            self.expired_keys += 1
+            return None
+        self.entries.move_to_end(key)
+        return entry
+    
+    def _store(self, key: str, value: Any, ttl_seconds: Optional[float]) -> None:
+        expires_at = time.monotonic() + ttl_seconds if ttl_seconds is not None else None
+        self.entries[key] = (value, expires_at)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+            self.evicted_keys += 1
+    
+    def get(self, key: str) -> Any:
+        with self.lock:
+            if key in self.counters:
+                return str(self.counters[key]).encode()
+            entry = self._live(key)
+            return entry[0] if entry else None
+    
+    def mget(self, keys: List[str]) -> List[Any]:
+        return [self.get(key) for key in keys]
+    
+    def setex(self, key: str, ttl_seconds: int, value: Any) -> bool:
+        with self.lock:
+            self._store(key, value, ttl_seconds)
+        return True
+    
+    def set(self, key: str, value: Any, nx: bool = False, px: Optional[int] = None) -> Optional[bool]:
+        with self.lock:
+            if nx and self._live(key) is not None:
+                return None
+            self._store(key, value, px / 1000 if px is not None else None)
+        return True
+    
+    def delete(self, *keys: str) -> int:
+        removed = 0
+        with self.lock:
+            for key in keys:
+                if self._live(key) is not None:
+                    del self.entries[key]
+                    removed += 1
+                elif self.counters.pop(key, None) is not None:
+                    removed += 1
+        return removed
+    
+    unlink = delete
+    
+    def incr(self, key: str) -> int:
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + 1
+            return self.counters[key]
+    
+    def eval(self, script: str, numkeys: int, *args: Any) -> Any:
+        if script != RELEASE_LOCK_SCRIPT:
+            raise NotImplementedError("LocalBackend only runs the lock release script")
+        key, token = args
+        with self.lock:
+            entry = self._live(key)
+            if entry is not None and entry[0] == token:
+                del self.entries[key]
+                return 1
+        return 0
+    
+    def pipeline(self, transaction: bool = True) -> "LocalPipeline":
+        return LocalPipeline(self)
+    
+    def scan_iter(self, match: str = "*", count: Optional[int] = None) -> Iterator[str]:
+        with self.lock:
+            keys = list(self.counters) + list(self.entries)
+        return iter([key for key in keys if fnmatch.fnmatchcase(key, match)])
+    
+    def flushdb(self) -> bool:
+        with self.lock:
+            self.entries.clear()
+            self.counters.clear()
+        return True
+    
+    def info(self) -> Dict[str, Any]:
+        return {
+            "used_memory": 0,
+            "used_memory_peak": 0,
+            "evicted_keys": self.evicted_keys,
+            "expired_keys": self.expired_keys,
+            "total_commands_processed": 0,
+        }
+    
+    def ping(self) -> bool:
+        return True
+    
+    def get_stats(self) -> Dict[str, Any]:
+        return {
+            "entries": len(self.entries),
+            "max_entries": self.max_entries,
+            "counters": len(self.counters),
+            "evicted_keys": self.evicted_keys,
+            "expired_keys": self.expired_keys,
+        }
+
+
+class LocalPipeline:
+    """Buffers commands for a LocalBackend and runs them on execute"""
+    
+    def __init__(self, backend: LocalBackend):
+        self.backend = backend
+        self.commands: List[Tuple[str, tuple, dict]] = []
+    
+    def __getattr__(self, name: str):
+        def queue(*args, **kwargs):
+            self.commands.append((name, args, kwargs))
+            return self
+        return queue
+    
+    def execute(self) -> List[Any]:
+        commands, self.commands = self.commands, []
+        return [getattr(self.backend, name)(*args, **kwargs) for name, args, kwargs in commands]
+
+
+class AsyncLocalBackend:
+    """
+    redis.asyncio-style facade over a LocalBackend
+    
+    Commands are plain dict operations, so they run inline on the loop.
+    """
+    
+    def __init__(self, backend: LocalBackend):
+        self.backend = backend
+    
+    def pipeline(self, transaction: bool = True) -> "AsyncLocalPipeline":
+        return AsyncLocalPipeline(self.backend)
+    
+    def __getattr__(self, name: str):
+        command = getattr(self.backend, name)
+        
+        async def call(*args, **kwargs):
+            return command(*args, **kwargs)
+        return call
+
+
+class AsyncLocalPipeline(LocalPipeline):
+    """LocalPipeline with an awaitable execute"""
+    
+    async def execute(self) -> List[Any]:
+        return LocalPipeline.execute(self)
+
+
+__all__ = [
+    "CacheBackend",
+    "LocalBackend",
+    "AsyncLocalBackend",
+    "RELEASE_LOCK_SCRIPT",
+]
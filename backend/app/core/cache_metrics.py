@@ -0,0 +1,253 @@
+"""
+Cache metrics
+Per-namespace and per-function hit ratios, latencies, sizes and recompute times
+
+Series are labelled by namespace (the key prefix) and, for keys built by
+@cached, the decorated function, so TTLs can be tuned per call site.
+Lookups count where a read was answered (L1, Redis/L2 or miss); outcomes
+count what @cached did with it (served fresh, served stale, recomputed).
+Rendered as JSON for the admin endpoint and in the Prometheus text
+exposition format, without a client library.
+"""
+
+import threading
+from bisect import bisect_left
+from typing import Any, Dict, List, Sequence, Tuple
+
+# Histogram bucket upper bounds
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0)
+SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576)
+RECOMPUTE_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+LOOKUP_RESULTS = ("l1_hit", "l2_hit", "miss")
+OUTCOMES = ("fresh", "stale", "recomputed")
+
+# (namespace, function)
+Labels = Tuple[str, str]
+
+
+def key_labels(key: str) -> Labels:
+    """
+    Labels for a cache key
+    
+    Keys built by @cached look like "{prefix}:{func}:v{n}:{hash}" (or
+    "{func}:v{n}:{hash}" without a prefix); other keys only carry a
+    namespace.
+    """
+    parts = key.split(":", 3)
+    if len(parts) >= 3 and _is_version(parts[1]):
+        return parts[0], parts[0]
+    if len(parts) == 4 and _is_version(parts[2]):
+        return parts[0], parts[1]
+    return parts[0], ""
+
+
+def _is_version(part: str) -> bool:
+    return part[:1] == "v" and part[1:].isdigit()
+
+
+class Histogram:
+    """Fixed-bucket histogram"""
+    
+    def __init__(self, buckets: Sequence[float]):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)  # Last one is +Inf
+        self.sum = 0.0
+        self.count = 0
+    
+    def observe(self, value: float) -> None:
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+    
+    def quantile(self, q: float) -> float:
+        """Upper bound of the bucket holding the q-th observation"""
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return float("inf")
+    
+    def snapshot(self) -> Dict[str, Any]:
+        return {
+            "count": self.count,
+            "avg": round(self.sum / self.count, 6) if self.count else 0.0,
+            "p50": self.quantile(0.5),
+            "p95": self.quantile(0.95),
+            "p99": self.quantile(0.99),
+        }
+
+
+class SeriesMetrics:
+    """Metrics for one (namespace, function)"""
+    
+    def __init__(self):
+        self.lookups = dict.fromkeys(LOOKUP_RESULTS, 0)
+        self.outcomes = dict.fromkeys(OUTCOMES, 0)
+        self.sets = 0
+        self.get_seconds = Histogram(LATENCY_BUCKETS)
+        self.set_seconds = Histogram(LATENCY_BUCKETS)
+        self.payload_bytes = Histogram(SIZE_BUCKETS)
+        self.recompute_seconds = Histogram(RECOMPUTE_BUCKETS)
+    
+    def snapshot(self) -> Dict[str, Any]:
+        lookups = sum(self.lookups.values())
+        hits = self.lookups["l1_hit"] + self.lookups["l2_hit"]
+        return {
+            "lookups": dict(self.lookups),
+            "hit_ratio": round(hits / lookups, 3) if lookups else 0.0,
+            "outcomes": dict(self.outcomes),
+            "sets": self.sets,
+            "get_seconds": self.get_seconds.snapshot(),
+            "set_seconds": self.set_seconds.snapshot(),
+            "payload_bytes": self.payload_bytes.snapshot(),
+            "recompute_seconds": self.recompute_seconds.snapshot(),
+        }
+
+
+class CacheMetrics:
+    """Thread-safe registry of per-series cache metrics"""
+    
+    def __init__(self, enabled: bool = True):
+        self.enabled = enabled
+        self.series: Dict[Labels, SeriesMetrics] = {}
+        self.lock = threading.Lock()
+    
+    def _series(self, key: str) -> SeriesMetrics:
+        labels = key_labels(key)
+        series = self.series.get(labels)
+        if series is None:
+            series = self.series.setdefault(labels, SeriesMetrics())
+        return series
+    
+    def record_get(self, key: str, result: str, seconds: float, size: int = 0) -> None:
+        """
+        Record a lookup
+        
+        Args:
+            key: Cache key
+            result: "l1_hit", "l2_hit" or "miss"
+            seconds: Lookup latency
+            size: Encoded payload size for values read from Redis
+        """
+        if not self.enabled:
+            return
+        with self.lock:
+            series = self._series(key)
+            series.lookups[result] += 1
+            series.get_seconds.observe(seconds)
+            if size:
+                series.payload_bytes.observe(size)
+    
+    def record_set(self, key: str, seconds: float, size: int) -> None:
+        """Record a write and its encoded payload size"""
+        if not self.enabled:
+            return
+        with self.lock:
+            series = self._series(key)
+            series.sets += 1
+            series.set_seconds.observe(seconds)
+            series.payload_bytes.observe(size)
+    
+    def record_outcome(self, key: str, outcome: str, recompute_seconds: float = 0.0) -> None:
+        """
+        Record what @cached did for a call
+        
+        Args:
+            key: Cache key
+            outcome: "fresh", "stale" or "recomputed"
+            recompute_seconds: Time spent in the wrapped function
+        """
+        if not self.enabled:
+            return
+        with self.lock:
+            series = self._series(key)
+            series.outcomes[outcome] += 1
+            if outcome == "recomputed":
+                series.recompute_seconds.observe(recompute_seconds)
+    
+    def reset(self) -> None:
+        with self.lock:
+            self.series.clear()
+    
+    def snapshot(self) -> Dict[str, Dict[str, Any]]:
+        """
+        Metrics grouped by namespace, then function ("" for direct key access)
+        
+        Returns:
+            {namespace: {function: metrics}}
+        """
+        with self.lock:
+            items = [(labels, series.snapshot()) for labels, series in self.series.items()]
+        
+        grouped: Dict[str, Dict[str, Any]] = {}
+        for (namespace, function), data in sorted(items):
+            grouped.setdefault(namespace, {})[function] = data
+        return grouped
+    
+    def render_prometheus(self, prefix: str = "avicenna_cache") -> str:
+        """Render every series in the Prometheus text exposition format"""
+        with self.lock:
+            series = sorted(self.series.items())
+            lines: List[str] = []
+            
+            _header(lines, f"{prefix}_lookups_total", "counter", "Cache lookups by where they were answered")
+            for labels, data in series:
+                for result, value in data.lookups.items():
+                    lines.append(f"{prefix}_lookups_total{_labels(labels, result=result)} {value}")
+            
+            _header(lines, f"{prefix}_outcomes_total", "counter", "@cached calls served fresh, served stale or recomputed")
+            for labels, data in series:
+                for outcome, value in data.outcomes.items():
+                    lines.append(f"{prefix}_outcomes_total{_labels(labels, outcome=outcome)} {value}")
+            
+            _header(lines, f"{prefix}_sets_total", "counter", "Cache writes")
+            for labels, data in series:
+                lines.append(f"{prefix}_sets_total{_labels(labels)} {data.sets}")
+            
+            for name, attr, help_text in (
+                ("get_seconds", "get_seconds", "Cache lookup latency"),
+                ("set_seconds", "set_seconds", "Cache write latency"),
+                ("payload_bytes", "payload_bytes", "Encoded size of values written to or read from Redis"),
+                ("recompute_seconds", "recompute_seconds", "Time spent recomputing @cached values"),
+            ):
+                _header(lines, f"{prefix}_{name}", "histogram", help_text)
+                for labels, data in series:
+                    _histogram(lines, f"{prefix}_{name}", labels, getattr(data, attr))
+        
+        return "\n".join(lines) + "\n"
+
+
+def _header(lines: List[str], name: str, kind: str, help_text: str) -> None:
+    lines.append(f"# HELP {name} {help_text}")
+    lines.append(f"# TYPE {name} {kind}")
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _labels(labels: Labels, **extra: str) -> str:
+    pairs = [("namespace", labels[0]), ("function", labels[1]), *extra.items()]
+    return "{" + ",".join(f'{name}="{_escape(str(value))}"' for name, value in pairs) + "}"
+
+
+def _histogram(lines: List[str], name: str, labels: Labels, histogram: Histogram) -> None:
+    cumulative = 0
+    for bound, count in zip(histogram.buckets, histogram.counts):
+        cumulative += count
+        lines.append(f"{name}_bucket{_labels(labels, le=repr(float(bound)))} {cumulative}")
+    lines.append(f"{name}_bucket{_labels(labels, le='+Inf')} {histogram.count}")
+    lines.append(f"{name}_sum{_labels(labels)} {histogram.sum}")
+    lines.append(f"{name}_count{_labels(labels)} {histogram.count}")
+
+
+__all__ = [
+    "CacheMetrics",
+    "Histogram",
+    "key_labels",
+]
@@ -0,0 +1,215 @@
+"""
+Cache value serialization
+Pluggable serializers with transparent compression for cached values
+
+Every stored value starts with one header byte: the low bits name the
+serializer and the high bit marks a zlib-compressed body. Readers pick
+the serializer from the header rather than from configuration, so
+switching CACHE_SERIALIZER never strands existing entries. Values
+written before headers existed (plain JSON text) are still readable,
+since JSON text never starts with a header byte.
+
+- json:    orjson when installed (stdlib otherwise); datetimes come back
+           as ISO strings and Decimals as floats, like API responses
+- msgpack: binary, smaller and faster; datetime, date and Decimal
+           round-trip as their own types
+Pydantic models are stored as their field dicts by both.
+"""
+
+import json
+import logging
+import uuid
+import zlib
+from datetime import date, datetime
+from decimal import Decimal
+from typing import Any, Dict, Union
+
+from pydantic import BaseModel
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover - optional speedup
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:  # pragma: no cover - optional dependency
+    msgpack = None
+
+logger = logging.getLogger(__name__)
+
+# Header byte layout
+COMPRESSED = 0x80
+FORMAT_MASK = 0x7F
+
+# msgpack extension type codes
+_EXT_DATETIME = 1
+_EXT_DATE = 2
+_EXT_DECIMAL = 3
+
+
+class Serializer:
+    """Base value serializer"""
+    
+    name = ""
+    format_id = 0
+    
+    def dumps(self, value: Any) -> bytes:
+        raise NotImplementedError
+    
+    def loads(self, data: bytes) -> Any:
+        raise NotImplementedError
+
+
+def _json_default(value: Any) -> Any:
+    """Encode values the JSON encoders don't handle"""
+    if isinstance(value, BaseModel):
+        return value.model_dump()
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    if isinstance(value, Decimal):
+        return float(value)
+    if isinstance(value, uuid.UUID):
+        return str(value)
+    if isinstance(value, (set, frozenset)):
+        return list(value)
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+
+class JSONSerializer(Serializer):
+    """JSON, using orjson when available"""
+    
+    name = "json"
+    format_id = 1
+    
+    def dumps(self, value: Any) -> bytes:
+        if orjson is not None:
+            return orjson.dumps(value, default=_json_default, option=orjson.OPT_NON_STR_KEYS)
+        return json.dumps(value, default=_json_default, separators=(",", ":")).encode()
+    
+    def loads(self, data: bytes) -> Any:
+        if orjson is not None:
+            return orjson.loads(data)
+        return json.loads(data)
+
+
+def _msgpack_default(value: Any) -> Any:
+    """Encode values msgpack doesn't handle natively"""
+    if isinstance(value, BaseModel):
+        return value.model_dump()
+    if isinstance(value, datetime):
+        return msgpack.ExtType(_EXT_DATETIME, value.isoformat().encode())
+    if isinstance(value, date):
+        return msgpack.ExtType(_EXT_DATE, value.isoformat().encode())
+    if isinstance(value, Decimal):
+        return msgpack.ExtType(_EXT_DECIMAL, str(value).encode())
+    if isinstance(value, uuid.UUID):
+        return str(value)
+    if isinstance(value, (set, frozenset)):
+        return list(value)
+    raise TypeError(f"Object of type {type(value).__name__} is not msgpack serializable")
+
+
+def _msgpack_ext_hook(code: int, data: bytes) -> Any:
+    if code == _EXT_DATETIME:
+        return datetime.fromisoformat(data.decode())
+    if code == _EXT_DATE:
+        return date.fromisoformat(data.decode())
+    if code == _EXT_DECIMAL:
+        return Decimal(data.decode())
+    return msgpack.ExtType(code, data)
+
+
+class MsgPackSerializer(Serializer):
+    """Binary msgpack with extension types for datetime, date and Decimal"""
+    
+    name = "msgpack"
+    format_id = 2
+    
+    def dumps(self, value: Any) -> bytes:
+        return msgpack.packb(value, default=_msgpack_default, use_bin_type=True)
+    
+    def loads(self, data: bytes) -> Any:
+        return msgpack.unpackb(data, raw=False, ext_hook=_msgpack_ext_hook, strict_map_key=False)
+
+
+SERIALIZERS: Dict[str, Serializer] = {"json": JSONSerializer()}
+if msgpack is not None:
+    SERIALIZERS["msgpack"] = MsgPackSerializer()
+
+_BY_FORMAT_ID: Dict[int, Serializer] = {s.format_id: s for s in SERIALIZERS.values()}
+
+
+class CacheCodec:
+    """
+    Encodes values as header byte + (optionally compressed) serialized body
+    """
+    
+    def __init__(self, serializer: str = "msgpack", compress_min_bytes: int = 1024, compress_level: int = 1):
+        """
+        Args:
+            serializer: "json" or "msgpack" (falls back to json if msgpack isn't installed)
+            compress_min_bytes: Bodies at least this large are zlib-compressed (0 disables)
+            compress_level: zlib level; low levels keep encoding cheap
+        """
+        if serializer not in SERIALIZERS:
+            logger.warning(f"⚠ Cache serializer '{serializer}' unavailable, using json")
+            serializer = "json"
+        self.serializer = SERIALIZERS[serializer]
+        self.compress_min_bytes = compress_min_bytes
+        self.compress_level = compress_level
+        # Stats
+        self.compressed_values = 0
+        self.bytes_saved = 0
+    
+    def encode(self, value: Any) -> bytes:
+        body = self.serializer.dumps(value)
+        header = self.serializer.format_id
+        
+        if self.compress_min_bytes and len(body) >= self.compress_min_bytes:
+            packed = zlib.compress(body, self.compress_level)
+            if len(packed) < len(body):
+                self.compressed_values += 1
+                self.bytes_saved += len(body) - len(packed)
+                body, header = packed, header | COMPRESSED
+        
+        return bytes((header,)) + body
+    
+    def decode(self, raw: Union[bytes, str]) -> Any:
+        """
+        Decode a stored value, whatever serializer wrote it
+        
+        Raises:
+            ValueError: If the header names a serializer that isn't installed
+        """
+        if isinstance(raw, str):
+            raw = raw.encode()
+        
+        header = raw[0]
+        serializer = _BY_FORMAT_ID.get(header & FORMAT_MASK)
+        if serializer is None:
+            if header & FORMAT_MASK <= 0x08:
+                raise ValueError(f"Unknown cache value format {header & FORMAT_MASK}")
+            return json.loads(raw)  # Written before headers existed
+        
+        body = raw[1:]
+        if header & COMPRESSED:
+            body = zlib.decompress(body)
+        return serializer.loads(body)
+    
+    def get_stats(self) -> Dict[str, Any]:
+        return {
+            "serializer": self.serializer.name,
+            "compress_min_bytes": self.compress_min_bytes,
+            "compressed_values": self.compressed_values,
+            "bytes_saved": self.bytes_saved,
+        }
+
+
+__all__ = [
+    "Serializer",
+    "JSONSerializer",
+    "MsgPackSerializer",
+    "SERIALIZERS",
+    "CacheCodec",
+]
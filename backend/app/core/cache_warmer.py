@@ -0,0 +1,347 @@
+"""
+Refresh-ahead cache warmer
+Keeps the most requested @cached entries from expiring cold
+
+@cached reports every call's key to the warmer, which estimates access
+frequency with a count-min sketch (fixed memory however many distinct
+keys there are) and remembers how to recompute the few hundred hottest.
+A background task reads the top-N entries in one MGET every interval and
+recomputes those missing or about to expire, at most `concurrency` at a
+time and under the same cross-worker lock @cached uses, so workers don't
+refresh a key twice. Counts are halved every decay period so yesterday's
+hot keys make room for today's. Keys seen fewer than `min_hits` times
+(after decay) are never candidates, so one-off lookups are not kept warm.
+
+Calls with a SQLAlchemy Session argument are counted but never refreshed:
+the request's session is closed by the time the warmer runs. Methods of
+objects that keep their own Session (CacheService's self.db) are replayed
+on a shallow copy holding a fresh SessionLocal(), because Sessions are not
+thread-safe and replays run concurrently in worker threads.
+"""
+
+import asyncio
+import copy
+import heapq
+import logging
+import random
+import threading
+import time
+from typing import TYPE_CHECKING, Any, Callable, Dict, List, Optional, Tuple
+
+from sqlalchemy.orm import Session
+
+if TYPE_CHECKING:
+    from app.core.cache import RedisCache
+
+logger = logging.getLogger(__name__)
+
+
+class CountMinSketch:
+    """
+    Approximate per-key counters in width x depth cells
+    
+    Estimates never undercount; with conservative updates they overcount
+    by roughly total / width on a few colliding keys.
+    """
+    
+    def __init__(self, width: int = 2048, depth: int = 4):
+        self.width = width
+        self.depth = depth
+        self.seeds = [random.getrandbits(32) for _ in range(depth)]
+        self.rows = [[0] * width for _ in range(depth)]
+    
+    def _cells(self, key: str) -> List[int]:
+        return [hash((seed, key)) % self.width for seed in self.seeds]
+    
+    def add(self, key: str, count: int = 1) -> int:
+        """Count key; returns its new estimate"""
+        cells = self._cells(key)
+        estimate = min(row[cell] for row, cell in zip(self.rows, cells)) + count
+        # Conservative update: only raise cells that would undercount
+        for row, cell in zip(self.rows, cells):
+            if row[cell] < estimate:
+                row[cell] = estimate
+        return estimate
+    
+    def estimate(self, key: str) -> int:
+        return min(row[cell] for row, cell in zip(self.rows, self._cells(key)))
+    
+    def decay(self) -> None:
+        """Halve every counter"""
+        for row in self.rows:
+            row[:] = [count >> 1 for count in row]
+    
+    def clear(self) -> None:
+        for row in self.rows:
+            row[:] = [0] * self.width
+
+
+class HotKey:
+    """A frequently requested @cached call and how to recompute it"""
+    
+    __slots__ = ("key", "func", "args", "kwargs", "ttl_seconds", "stale_ttl_seconds", "hits")
+    
+    def __init__(
+        self,
+        key: str,
+        func: Callable,
+        args: tuple,
+        kwargs: dict,
+        ttl_seconds: int,
+        stale_ttl_seconds: int,
+        hits: int
+    ):
+        self.key = key
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+        self.ttl_seconds = ttl_seconds
+        self.stale_ttl_seconds = stale_ttl_seconds
+        self.hits = hits
+
+
+def _refreshable(args: tuple, kwargs: dict) -> bool:
+    """Whether a call can be replayed outside its request"""
+    return not any(isinstance(value, Session) for value in (*args, *kwargs.values()))
+
+
+def _with_own_sessions(args: tuple) -> Tuple[tuple, List[Session]]:
+    """
+    Swap a bound method's shared Session for a fresh one
+    
+    If the first argument (self) holds Session attributes, it is replaced
+    by a shallow copy whose sessions are new SessionLocal() instances.
+    
+    Returns:
+        (args to replay with, sessions the caller must close)
+    """
+    owner = args[0] if args else None
+    names = [
+        name for name, value in getattr(owner, "__dict__", {}).items()
+        if isinstance(value, Session)
+    ]
+    if not names:
+        return args, []
+    
+    from app.database import SessionLocal
+    
+    clone = copy.copy(owner)
+    sessions = []
+    for name in names:
+        session = SessionLocal()
+        sessions.append(session)
+        setattr(clone, name, session)
+    return (clone, *args[1:]), sessions
+
+
+class RefreshAheadWarmer:
+    """Recomputes the hottest @cached entries shortly before they expire"""
+    
+    def __init__(
+        self,
+        cache: "RedisCache",
+        top_n: int = 100,
+        interval_seconds: float = 10,
+        refresh_window_seconds: float = 60,
+        concurrency: int = 4,
+        decay_seconds: float = 300,
+        sketch_width: int = 2048,
+        sketch_depth: int = 4,
+        lock_timeout_seconds: float = 30,
+        min_hits: int = 2
+    ):
+        """
+        Args:
+            cache: Cache the entries live in
+            top_n: How many of the hottest keys are kept warm
+            interval_seconds: How often entries are checked
+            refresh_window_seconds: Entries expiring within this are recomputed
+                (raised to two intervals so none slips between checks)
+            concurrency: Max recomputations running at once
+            decay_seconds: How often access counts are halved (0 never)
+            sketch_width: Count-min sketch columns
+            sketch_depth: Count-min sketch rows (hash functions)
+            lock_timeout_seconds: Max time a recomputation holds the cross-worker lock
+            min_hits: Estimated accesses a key needs before it is kept warm
+        """
+        self.cache = cache
+        self.top_n = top_n
+        self.interval_seconds = interval_seconds
+        self.refresh_window_seconds = max(refresh_window_seconds, 2 * interval_seconds)
+        self.concurrency = concurrency
+        self.decay_seconds = decay_seconds
+        self.lock_timeout_seconds = lock_timeout_seconds
+        self.min_hits = max(min_hits, 1)
+        
+        self.sketch = CountMinSketch(sketch_width, sketch_depth)
+        # Keys that may make the top N, with their recompute recipe
+        self.candidates: Dict[str, HotKey] = {}
+        self.capacity = top_n * 4
+        # Lower bound on the coldest candidate's hits when full
+        self.floor = 0
+        self.lock = threading.Lock()
+        
+        self.task: Optional[asyncio.Task] = None
+        self.last_decay = time.monotonic()
+        self.stats = {"runs": 0, "refreshed": 0, "failed": 0, "skipped": 0, "dropped": 0}
+    
+    def record(
+        self,
+        key: str,
+        func: Callable,
+        args: tuple,
+        kwargs: dict,
+        ttl_seconds: int,
+        stale_ttl_seconds: int = 0
+    ) -> None:
+        """
+        Count an access to a @cached key
+        
+        Args:
+            key: Cache key
+            func: The undecorated function that computes it
+            args: Call arguments
+            kwargs: Call keyword arguments
+            ttl_seconds: The decorator's TTL
+            stale_ttl_seconds: The decorator's stale grace period
+        """
+        with self.lock:
+            hits = self.sketch.add(key)
+            hot = self.candidates.get(key)
+            if hot is not None:
+                hot.hits = hits
+                return
+            if hits < self.min_hits or hits <= self.floor or not _refreshable(args, kwargs):
+                return
+            if len(self.candidates) >= self.capacity:
+                coldest = min(self.candidates.values(), key=lambda h: h.hits)
+                if hits <= coldest.hits:
+                    self.floor = coldest.hits
+                    return
+                del self.candidates[coldest.key]
+            self.candidates[key] = HotKey(key, func, args, kwargs, ttl_seconds, stale_ttl_seconds, hits)
+    
+    def hottest(self) -> List[HotKey]:
+        """The top_n candidates by estimated access count, at least min_hits each"""
+        with self.lock:
+            hot = [h for h in self.candidates.values() if h.hits >= self.min_hits]
+            return heapq.nlargest(self.top_n, hot, key=lambda h: h.hits)
+    
+    def decay(self) -> None:
+        """Halve access counts so recent traffic dominates, dropping keys gone cold"""
+        with self.lock:
+            self.sketch.decay()
+            for hot in list(self.candidates.values()):
+                hot.hits >>= 1
+                if hot.hits < self.min_hits:
+                    del self.candidates[hot.key]
+            self.floor = 0
+        self.last_decay = time.monotonic()
+    
+    async def run_once(self) -> int:
+        """
+        Recompute the hot entries that are missing or about to expire
+        
+        Returns:
+            Number of entries refreshed
+        """
+        self.stats["runs"] += 1
+        hot = self.hottest()
+        if not hot:
+            return 0
+        
+        entries = await self.cache.aget_entries([h.key for h in hot])
+        deadline = time.time() + self.refresh_window_seconds
+        due = [h for h in hot if h.key not in entries or entries[h.key].expires_at <= deadline]
+        if not due:
+            return 0
+        
+        semaphore = asyncio.Semaphore(self.concurrency)
+        refreshed = await asyncio.gather(*(self._refresh(h, semaphore) for h in due))
+        return sum(refreshed)
+    
+    async def _refresh(self, hot: HotKey, semaphore: asyncio.Semaphore) -> bool:
+        async with semaphore:
+            token = await self.cache.aacquire_lock(hot.key, self.lock_timeout_seconds)
+            if token is None:
+                # A caller or another worker is recomputing it right now
+                self.stats["skipped"] += 1
+                return False
+            args, sessions = _with_own_sessions(hot.args)
+            try:
+                started = time.perf_counter()
+                if asyncio.iscoroutinefunction(hot.func):
+                    value = await hot.func(*args, **hot.kwargs)
+                else:
+                    value = await asyncio.to_thread(hot.func, *args, **hot.kwargs)
+                delta = time.perf_counter() - started
+                
+                if value is None:
+                    # Never cached, so there is nothing to keep warm
+                    self._drop(hot.key)
+                    return False
+                await self.cache.aset_entry(hot.key, value, hot.ttl_seconds, delta, hot.stale_ttl_seconds)
+                self.stats["refreshed"] += 1
+                return True
+            except Exception as e:
+                self.stats["failed"] += 1
+                logger.error(f"⚠ Cache warmer failed to refresh {hot.key}: {e}")
+                return False
+            finally:
+                for session in sessions:
+                    session.close()
+                await self.cache.arelease_lock(hot.key, token)
+    
+    def _drop(self, key: str) -> None:
+        with self.lock:
+            if self.candidates.pop(key, None) is not None:
+                self.stats["dropped"] += 1
+    
+    def start(self) -> None:
+        """Start the background refresh loop (no-op if already running)"""
+        if self.task is None or self.task.done():
+            self.task = asyncio.create_task(self._loop())
+            logger.info(
+                f"✓ Cache warmer started (top_n={self.top_n}, interval={self.interval_seconds}s, "
+                f"window={self.refresh_window_seconds}s, concurrency={self.concurrency})"
+            )
+    
+    async def stop(self) -> None:
+        """Stop the background refresh loop"""
+        if self.task:
+            self.task.cancel()
+            try:
+                await self.task
+            except (asyncio.CancelledError, Exception):
+                pass
+            self.task = None
+    
+    async def _loop(self) -> None:
+        """Run run_once() every interval_seconds"""
+        while True:
+            await asyncio.sleep(self.interval_seconds)
+            try:
+                await self.run_once()
+            except Exception as e:
+                logger.error(f"⚠ Cache warmer run failed: {e}")
+            if self.decay_seconds and time.monotonic() - self.last_decay >= self.decay_seconds:
+                self.decay()
+    
+    def get_stats(self) -> Dict[str, Any]:
+        hottest = self.hottest()
+        return {
+            "running": self.task is not None and not self.task.done(),
+            "top_n": self.top_n,
+            "min_hits": self.min_hits,
+            "candidates": len(self.candidates),
+            "refresh_window_seconds": self.refresh_window_seconds,
+            "concurrency": self.concurrency,
+            **self.stats,
+            "hottest": [{"key": h.key, "hits": h.hits} for h in hottest[:10]],
+        }
+
+
+__all__ = [
+    "CountMinSketch",
+    "RefreshAheadWarmer",
+]
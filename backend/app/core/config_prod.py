@@ -30,8 +30,35 @@ class ProductionSettings(BaseSettings):
     
     # Redis/Cache
     REDIS_URL: str = "redis://localhost:6379/0"
+    REDIS_ASYNC_MAX_CONNECTIONS: int = 50  # redis.asyncio pool used by async endpoints and WebSockets
     CACHE_DEFAULT_TIMEOUT: int = 3600
     CACHE_PREDICTION_TIMEOUT: int = 86400  # 24 hours
+    CACHE_L1_MAX_ENTRIES: int = 10000  # In-process LRU in front of Redis (0 disables)
+    CACHE_L1_TTL_SECONDS: int = 60  # Upper bound on L1 entry lifetime
+    CACHE_VERSION_CHECK_SECONDS: float = 1.0  # Max staleness of namespace versions per worker
+    CACHE_GENERATION_CLEANER_SECONDS: int = 0  # SCAN+UNLINK old generations (0 = rely on TTL)
+    CACHE_BACKEND: str = "auto"  # "redis", "local" (in-process only) or "auto" (in-process while Redis is down)
+    CACHE_LOCAL_MAX_ENTRIES: int = 50000  # In-process backend capacity
+    CACHE_REDIS_RETRY_SECONDS: int = 5  # How often "auto" re-checks Redis health
+    CACHE_SERIALIZER: str = "msgpack"  # "msgpack" or "json" (values are self-describing, switching is safe)
+    CACHE_COMPRESS_MIN_BYTES: int = 1024  # zlib-compress serialized values at least this large (0 disables)
+    CACHE_COMPRESS_LEVEL: int = 1
+    CACHE_METRICS_ENABLED: bool = True  # Per-namespace hit ratios, latencies and sizes
+    CACHE_METRICS_SCRAPE_TOKEN: str = ""  # Bearer token for GET /api/cache/metrics (empty = not served)
+    CACHE_WARMER_ENABLED: bool = True  # Refresh the hottest @cached keys before they expire
+    CACHE_WARMER_TOP_N: int = 100
+    CACHE_WARMER_INTERVAL_SECONDS: float = 10
+    CACHE_WARMER_REFRESH_WINDOW_SECONDS: float = 60  # Recompute entries expiring within this
+    CACHE_WARMER_CONCURRENCY: int = 4  # Max recomputations at once per worker
+    CACHE_WARMER_DECAY_SECONDS: float = 300  # Halve access counts so recent traffic dominates
+    CACHE_WARMER_MIN_HITS: int = 2  # Accesses (after decay) before a key is kept warm
+    KB_HTTP_CACHE_ENABLED: bool = True  # ETags, 304s and rendered-response caching for knowledge-base GETs
+    KB_HTTP_MAX_AGE_SECONDS: int = 60  # Cache-Control max-age; clients revalidate with If-None-Match after it
+    KB_HTTP_CACHE_TTL_SECONDS: int = 3600  # Server-side rendered responses (a KB change drops them sooner)
+    KB_HTTP_CACHE_MAX_BYTES: int = 2 * 1024 * 1024
+    KNOWLEDGE_MATCH_BUDGET_SECONDS: float = 5.0  # Per-request budget for cross-tradition matching (0 for none)
+    KNOWLEDGE_MATCH_MEMO_TTL_SECONDS: int = 3600  # Memoized match results per normalized findings (0 disables)
+    KNOWLEDGE_MATCH_CONFIDENCE_STEP: float = 0.01  # Confidences are matched and memoized rounded to this
     
     # Security
     SECRET_KEY: str
@@ -84,6 +111,20 @@ class ProductionSettings(BaseSettings):
     ENABLE_ML_PREDICTIONS: bool = True
     ENABLE_ADMIN_PANEL: bool = True
     
+    # WebSocket
+    WS_SEND_QUEUE_SIZE: int = 256  # Max pending outbound messages per connection
+    WS_OVERFLOW_POLICY: str = "drop_oldest"  # "drop_oldest", "coalesce" or "disconnect"
+    WS_REPLAY_BUFFER_SIZE: int = 100  # Broadcasts kept per diagnosis for ?since= resume
+    WS_REPLAY_TTL_SECONDS: int = 3600  # Idle replay buffers are dropped after this
+    WS_MAX_TOPICS_PER_CONNECTION: int = 200  # Subscriptions allowed on /ws/multiplex
+    WS_HEARTBEAT_INTERVAL_SECONDS: int = 30  # Ping clients silent for this long
+    WS_IDLE_TIMEOUT_SECONDS: int = 90  # Evict clients silent for this long
+    WS_SWEEP_INTERVAL_SECONDS: int = 15
+    WS_AUTH_CACHE_TTL_SECONDS: int = 30  # Handshake authorization decisions
+    WS_AUTH_CACHE_MAX_ENTRIES: int = 10000
+    WS_BACKPLANE: str = "redis"  # Fan broadcasts out across WORKERS
+    WS_BACKPLANE_CHANNEL: str = "avicenna:ws:broadcast"
+    
     class Config:
         env_file = ".env"
         case_sensitive = True
@@ -0,0 +1,299 @@
+"""
+Knowledge-base content version and HTTP caching
+Conditional GETs and rendered-response caching for the knowledge-base endpoints
+
+The knowledge base changes rarely, so its content is versioned by the
+"kb" cache namespace generation: any committed change to a KB model,
+any successful write to a KB endpoint (or an explicit bump_kb_version())
+moves every worker to the next version, and with it every KB-derived
+cache entry, including the knowledge index used for matching. The
+commit hook runs whether or not the HTTP cache below is enabled.
+
+KnowledgeBaseCacheMiddleware serves GETs under KB_PATH_PREFIXES:
+- Strong ETags are derived from (KB version, path, query, Accept-Language),
+  so If-None-Match is answered with a 304 before any DB work
+- Rendered 200 responses are cached in the "kb" namespace keyed by the
+  same variant, so a repeated read costs one cache lookup
+- Cache-Control and Vary: Accept-Language let clients and proxies reuse
+  responses and revalidate cheaply
+
+Without a cache backend (CACHE_BACKEND="redis" with Redis down) requests
+pass through untouched, since workers could not agree on the version.
+"""
+
+import hashlib
+import itertools
+import logging
+import time
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+
+from app.core.cache import get_cache
+from app.core.config import settings
+
+logger = logging.getLogger(__name__)
+
+# Cache namespace whose generation is the KB content version
+KB_NAMESPACE = "kb"
+
+# Knowledge-base routes (knowledge_base and avicenna_diseases routers);
+# patient-specific routes such as /api/v1/patients/... are never cached
+KB_PATH_PREFIXES = (
+    "/api/v1/knowledge/",
+    "/api/v1/diseases",
+    "/api/v1/symptoms",
+    "/api/v1/remedies",
+    "/api/v1/medical-plants",
+)
+
+_SAFE_METHODS = ("GET", "HEAD", "OPTIONS")
+
+# Modules whose models hold knowledge-base content
+KB_MODEL_MODULES = (
+    "app.models.avicenna_knowledge_base",
+    "app.models.tcm_knowledge_base",
+    "app.models.ayurveda_knowledge_base",
+    "app.models.knowledge_base_models",
+    "app.models.avicenna_diseases",
+)
+
+# Patient data that lives next to the KB models
+_NON_KB_MODELS = ("MizajBalanceTreatment",)
+
+
+def get_kb_version() -> int:
+    """Current knowledge-base content version"""
+    return get_cache().get_namespace_version(KB_NAMESPACE)
+
+
+async def aget_kb_version() -> int:
+    """Async variant of get_kb_version"""
+    return (await get_cache().aget_namespace_versions([KB_NAMESPACE]))[KB_NAMESPACE]
+
+
+def bump_kb_version() -> int:
+    """
+    Mark the knowledge base as changed on every worker
+    
+    Returns:
+        New KB version
+    """
+    return get_cache().invalidate_namespace(KB_NAMESPACE)
+
+
+async def abump_kb_version() -> int:
+    """Async variant of bump_kb_version"""
+    return await get_cache().ainvalidate_namespace(KB_NAMESPACE)
+
+
+def is_kb_model(cls: type) -> bool:
+    """Whether rows of this mapped class are knowledge-base content"""
+    return cls.__module__ in KB_MODEL_MODULES and cls.__name__ not in _NON_KB_MODELS
+
+
+# Bump the version on KB changes, whichever code path makes them (KB
+# routers, seed scripts, admin tasks). Flushed changes are not visible
+# to other sessions yet, so they are only noted; the bump happens after
+# commit.
+_PENDING_KEY = "kb_changed"
+
+
+@event.listens_for(Session, "after_flush")
+def _note_kb_rows(session, flush_context) -> None:
+    rows = itertools.chain(session.new, session.dirty, session.deleted)
+    if any(is_kb_model(type(row)) for row in rows):
+        session.info[_PENDING_KEY] = True
+
+
+@event.listens_for(Session, "do_orm_execute")
+def _note_kb_statement(state) -> None:
+    # Bulk query.update() / delete() and insert() statements skip the flush
+    if (state.is_insert or state.is_update or state.is_delete) and state.bind_mapper is not None:
+        if is_kb_model(state.bind_mapper.class_):
+            state.session.info[_PENDING_KEY] = True
+
+
+@event.listens_for(Session, "after_commit")
+def _bump_after_commit(session) -> None:
+    if not session.info.pop(_PENDING_KEY, False):
+        return
+    try:
+        version = bump_kb_version()
+        logger.info(f"✓ Knowledge base committed, now version {version}")
+    except Exception as e:
+        # The commit already succeeded; never fail the caller over the cache
+        logger.warning(f"⚠ Could not bump knowledge base version: {e}")
+
+
+@event.listens_for(Session, "after_rollback")
+def _discard_kb_changes(session) -> None:
+    session.info.pop(_PENDING_KEY, None)
+
+
+def _variant(scope: Dict[str, Any]) -> str:
+    """Digest of what selects a representation: path, query and Accept-Language"""
+    language = b""
+    for name, value in scope["headers"]:
+        if name == b"accept-language":
+            language = value
+            break
+    raw = b"\n".join((scope["path"].encode(), scope.get("query_string", b""), language))
+    return hashlib.blake2b(raw, digest_size=12).hexdigest()
+
+
+def _etag_matches(if_none_match: str, etag: str) -> bool:
+    """If-None-Match comparison (weak, as RFC 9110 prescribes for it)"""
+    if if_none_match.strip() == "*":
+        return True
+    tags = [tag.strip() for tag in if_none_match.split(",")]
+    return any(tag.removeprefix("W/") == etag for tag in tags)
+
+
+class KnowledgeBaseCacheMiddleware:
+    """ASGI middleware adding conditional GETs and response caching to KB routes"""
+    
+    def __init__(
+        self,
+        app: Any,
+        path_prefixes: Sequence[str] = KB_PATH_PREFIXES,
+        max_age_seconds: Optional[int] = None,
+        ttl_seconds: Optional[int] = None,
+        max_body_bytes: Optional[int] = None
+    ):
+        """
+        Args:
+            app: The wrapped ASGI app
+            path_prefixes: Paths served as knowledge-base content
+            max_age_seconds: Cache-Control max-age sent to clients
+            ttl_seconds: How long rendered responses stay in the server-side cache
+            max_body_bytes: Larger responses are not cached server-side
+        """
+        self.app = app
+        self.path_prefixes = tuple(path_prefixes)
+        self.max_age_seconds = settings.KB_HTTP_MAX_AGE_SECONDS if max_age_seconds is None else max_age_seconds
+        self.ttl_seconds = ttl_seconds or settings.KB_HTTP_CACHE_TTL_SECONDS
+        self.max_body_bytes = max_body_bytes or settings.KB_HTTP_CACHE_MAX_BYTES
+        self.cache_control = f"public, max-age={self.max_age_seconds}, must-revalidate"
+    
+    async def __call__(self, scope: Dict[str, Any], receive: Any, send: Any) -> None:
+        if scope["type"] != "http" or not scope["path"].startswith(self.path_prefixes):
+            await self.app(scope, receive, send)
+            return
+        
+        if scope["method"] not in _SAFE_METHODS:
+            await self._write(scope, receive, send)
+        elif scope["method"] == "GET" and get_cache().backend is not None:
+            await self._read(scope, receive, send)
+        else:
+            await self.app(scope, receive, send)
+    
+    async def _write(self, scope: Dict[str, Any], receive: Any, send: Any) -> None:
+        """Pass a write through and bump the KB version if it succeeded"""
+        status = 500
+        
+        async def send_wrapper(message: Dict[str, Any]) -> None:
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+        
+        await self.app(scope, receive, send_wrapper)
+        if status < 400:
+            version = await abump_kb_version()
+            logger.info(f"✓ Knowledge base changed ({scope['method']} {scope['path']}), now version {version}")
+    
+    async def _read(self, scope: Dict[str, Any], receive: Any, send: Any) -> None:
+        cache = get_cache()
+        version = await aget_kb_version()
+        variant = _variant(scope)
+        etag = f'"kb{version}-{variant}"'
+        headers = [
+            (b"etag", etag.encode()),
+            (b"cache-control", self.cache_control.encode()),
+            (b"vary", b"Accept-Language"),
+        ]
+        
+        if_none_match = next((v.decode("latin-1") for k, v in scope["headers"] if k == b"if-none-match"), None)
+        if if_none_match and _etag_matches(if_none_match, etag):
+            await send({"type": "http.response.start", "status": 304, "headers": headers})
+            await send({"type": "http.response.body", "body": b""})
+            return
+        
+        cache_k = f"{KB_NAMESPACE}:http:{variant}"
+        cached_response = await cache.aget(cache_k)
+        if cached_response is not None:
+            body = cached_response["body"].encode()
+            await send({
+                "type": "http.response.start",
+                "status": 200,
+                "headers": [
+                    (b"content-type", cached_response["content_type"].encode()),
+                    (b"content-length", str(len(body)).encode()),
+                    (b"x-cache", b"HIT"),
+                    *headers,
+                ],
+            })
+            await send({"type": "http.response.body", "body": body})
+            return
+        
+        await self._render(scope, receive, send, headers, cache_k, version)
+    
+    async def _render(
+        self,
+        scope: Dict[str, Any],
+        receive: Any,
+        send: Any,
+        headers: List[Tuple[bytes, bytes]],
+        cache_k: str,
+        version: int
+    ) -> None:
+        """Run the endpoint, tagging a 200 with the validators and keeping a copy"""
+        status = 0
+        content_type = ""
+        chunks: List[bytes] = []
+        size = 0
+        
+        async def send_wrapper(message: Dict[str, Any]) -> None:
+            nonlocal status, content_type, size
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                if status == 200:
+                    content_type = next(
+                        (v.decode("latin-1") for k, v in message.get("headers", []) if k.lower() == b"content-type"),
+                        "",
+                    )
+                    message = {**message, "headers": [*message.get("headers", []), (b"x-cache", b"MISS"), *headers]}
+            elif message["type"] == "http.response.body" and status == 200 and size <= self.max_body_bytes:
+                body = message.get("body", b"")
+                chunks.append(body)
+                size += len(body)
+            await send(message)
+        
+        started = time.perf_counter()
+        await self.app(scope, receive, send_wrapper)
+        
+        if status != 200 or size > self.max_body_bytes or not content_type:
+            return
+        if await aget_kb_version() != version:
+            # The KB changed while rendering; this body may predate it
+            return
+        try:
+            body = b"".join(chunks).decode()
+        except UnicodeDecodeError:
+            return
+        await get_cache().aset(cache_k, {"content_type": content_type, "body": body}, self.ttl_seconds)
+        logger.debug(f"Cached KB response {scope['path']} ({size} bytes, {time.perf_counter() - started:.3f}s)")
+
+
+__all__ = [
+    "KB_NAMESPACE",
+    "KB_PATH_PREFIXES",
+    "KnowledgeBaseCacheMiddleware",
+    "get_kb_version",
+    "aget_kb_version",
+    "bump_kb_version",
+    "abump_kb_version",
+    "is_kb_model",
+]
@@ -1,3 +1,5 @@
+import asyncio
+
 from fastapi import FastAPI, Depends
 from fastapi.middleware.cors import CORSMiddleware
 from sqlalchemy.orm import Session
@@ -5,7 +7,13 @@ from app.database import engine, Base, get_db
 from app.routers import auth, patients, health
 from app.routers import avicenna_diagnosis, avicenna_diseases, analysis_service
 from app.routers import sensor_diagnostic, knowledge_base, image_analysis, websocket, analytics, feedback, predictions
+from app.routers import cache_admin
 from app.core.config import settings
+from app.core.cache import get_cache
+from app.core.kb_cache import KnowledgeBaseCacheMiddleware
+from app.services.knowledge_index import load_knowledge_index
+from app.services.websocket_backplane import get_backplane
+from app.services.websocket_manager import get_connection_manager
 from app.services.health_check import (
     get_health_check_endpoint,
     get_readiness_check,
@@ -35,6 +43,13 @@ app = FastAPI(
     version="1.0.0"
 )
 
+# Conditional GETs and response caching for knowledge-base routes (added
+# before CORS so cached responses still get CORS headers). The KB version
+# itself is bumped on every KB commit by app.core.kb_cache, with or
+# without this middleware.
+if settings.KB_HTTP_CACHE_ENABLED:
+    app.add_middleware(KnowledgeBaseCacheMiddleware)
+
 # تنظیمات CORS
 app.add_middleware(
     CORSMiddleware,
@@ -58,6 +73,42 @@ app.include_router(websocket.router)  # ✨ Real-time WebSocket updates
 app.include_router(analytics.router)  # ✨ Analytics and effectiveness tracking
 app.include_router(feedback.router)  # ✨ User feedback collection and management
 app.include_router(predictions.router)  # ✨ ML-based recommendation predictions
+app.include_router(cache_admin.router)  # ✨ Cache metrics (admin + Prometheus)
+
+
+@app.on_event("startup")
+async def start_websocket_services():
+    """Subscribe this worker to cross-process broadcasts and start the connection sweeper"""
+    await get_backplane().start()
+    get_connection_manager().start_sweeper()
+
+
+@app.on_event("startup")
+async def start_cache_generation_cleaner():
+    """Reclaim memory held by invalidated cache generations (optional, TTL also expires them)"""
+    if settings.CACHE_GENERATION_CLEANER_SECONDS:
+        get_cache().start_generation_cleaner(settings.CACHE_GENERATION_CLEANER_SECONDS)
+
+
+@app.on_event("startup")
+async def start_cache_warmer():
+    """Keep the most requested cached entries warm (refresh-ahead)"""
+    if settings.CACHE_WARMER_ENABLED:
+        get_cache().start_warmer()
+
+
+@app.on_event("startup")
+async def load_knowledge_base_index():
+    """Load the knowledge index used for matching before the first analysis needs it"""
+    await asyncio.to_thread(load_knowledge_index)
+
+
+@app.on_event("shutdown")
+async def stop_websocket_services():
+    await get_connection_manager().stop_sweeper()
+    await get_backplane().stop()
+    await get_cache().stop_warmer()
+    await get_cache().aclose()
 
 @app.get("/")
 def root():
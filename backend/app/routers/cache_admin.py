@@ -0,0 +1,116 @@
+"""
+Cache Admin API Endpoints
+
+Per-namespace cache metrics, so TTLs can be tuned from data.
+
+Endpoints:
+  GET    /api/cache/stats            - Backend stats and per-namespace/function metrics (admin)
+  POST   /api/cache/metrics/reset    - Reset the metrics window (admin)
+  POST   /api/cache/kb/invalidate    - Bump the knowledge-base version after out-of-band edits (admin)
+  GET    /api/cache/metrics          - Prometheus text exposition (scrape token)
+
+The metrics name every namespace and cached function, so the Prometheus
+endpoint is only served when CACHE_METRICS_SCRAPE_TOKEN is set, and only
+to requests presenting it as a bearer token.
+"""
+
+import logging
+import secrets
+from datetime import datetime
+from typing import Any, Dict
+
+from fastapi import APIRouter, Depends, Header, HTTPException
+from fastapi.responses import PlainTextResponse
+
+from app.core.cache import get_cache
+from app.core.config import settings
+from app.core.kb_cache import abump_kb_version
+from app.core.security import get_current_user
+from app.models.user import User
+
+logger = logging.getLogger(__name__)
+
+router = APIRouter(prefix="/api/cache", tags=["Cache"])
+
+PROMETHEUS_CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+def require_admin(current_user: User = Depends(get_current_user)) -> User:
+    """Only admins may inspect or reset cache metrics"""
+    if current_user.role != "admin":
+        raise HTTPException(status_code=403, detail="Admin access required")
+    return current_user
+
+
+def require_scrape_token(authorization: str = Header("")) -> None:
+    """Prometheus authenticates with CACHE_METRICS_SCRAPE_TOKEN as a bearer token"""
+    token = settings.CACHE_METRICS_SCRAPE_TOKEN
+    if not token:
+        # Not configured: don't reveal that the endpoint exists
+        raise HTTPException(status_code=404, detail="Not Found")
+    
+    scheme, _, credentials = authorization.partition(" ")
+    if scheme.lower() != "bearer" or not secrets.compare_digest(credentials.encode(), token.encode()):
+        raise HTTPException(
+            status_code=401,
+            detail="Invalid scrape token",
+            headers={"WWW-Authenticate": "Bearer"}
+        )
+
+
+@router.get("/stats")
+async def cache_stats(current_user: User = Depends(require_admin)) -> Dict[str, Any]:
+    """
+    Cache backend stats plus metrics per namespace and decorated function
+    
+    Returns:
+    {
+        "backend": {...RedisCache.get_stats()},
+        "namespaces": {
+            namespace: {
+                function: {
+                    "lookups": {"l1_hit", "l2_hit", "miss"},
+                    "hit_ratio": float,
+                    "outcomes": {"fresh", "stale", "recomputed"},
+                    "sets": int,
+                    "get_seconds" / "set_seconds" / "payload_bytes" / "recompute_seconds":
+                        {count, avg, p50, p95, p99}
+                }
+            }
+        },
+        "timestamp": str
+    }
+    """
+    cache = get_cache()
+    return {
+        "backend": cache.get_stats(),
+        "namespaces": cache.metrics.snapshot(),
+        "timestamp": datetime.utcnow().isoformat(),
+    }
+
+
+@router.post("/metrics/reset")
+async def reset_cache_metrics(current_user: User = Depends(require_admin)) -> Dict[str, Any]:
+    """Start a fresh metrics window (e.g. after changing a TTL)"""
+    get_cache().metrics.reset()
+    logger.info(f"Cache metrics reset by user {current_user.id}")
+    return {"status": "reset", "timestamp": datetime.utcnow().isoformat()}
+
+
+@router.post("/kb/invalidate")
+async def invalidate_knowledge_base(current_user: User = Depends(require_admin)) -> Dict[str, Any]:
+    """
+    Move every worker to a new knowledge-base version
+    
+    Writes through the KB endpoints do this automatically; call it after
+    seeding or editing KB tables directly.
+    """
+    version = await abump_kb_version()
+    logger.info(f"Knowledge base version bumped to {version} by user {current_user.id}")
+    return {"kb_version": version, "timestamp": datetime.utcnow().isoformat()}
+
+
+@router.get("/metrics", response_class=PlainTextResponse, dependencies=[Depends(require_scrape_token)])
+async def cache_metrics_prometheus() -> PlainTextResponse:
+    """Cache metrics for Prometheus to scrape (bearer CACHE_METRICS_SCRAPE_TOKEN)"""
+    return PlainTextResponse(get_cache().metrics.render_prometheus(), media_type=PROMETHEUS_CONTENT_TYPE)
@@ -344,7 +344,7 @@ async def get_knowledge_matches(
         
         # Get matches
         matching_service = get_matching_service()
-        matches = await matching_service.get_all_matches(diagnosis_id, db)
+        matches = await matching_service.get_all_matches(diagnosis_id, db, diagnosis=diagnosis)
         
         return {
             "success": True,
@@ -397,7 +397,7 @@ async def get_recommendations(
         
         # Get matches first
         matching_service = get_matching_service()
-        matches = await matching_service.get_all_matches(diagnosis_id, db)
+        matches = await matching_service.get_all_matches(diagnosis_id, db, diagnosis=diagnosis)
         
         # Get recommendations based on matches
         rec_engine = get_recommendation_engine()
@@ -466,7 +466,7 @@ async def compare_traditions(
         
         # Get all matches (comparison)
         matching_service = get_matching_service()
-        matches = await matching_service.get_all_matches(diagnosis_id, db)
+        matches = await matching_service.get_all_matches(diagnosis_id, db, diagnosis=diagnosis)
         
         # Prepare comparison
         comparison = {
@@ -3,19 +3,33 @@ WebSocket Router
 Handles WebSocket connections and message routing
 """
 
+import asyncio
 import logging
+from typing import Dict, List, Optional, Set, Tuple
 from fastapi import APIRouter, WebSocket, WebSocketDisconnect, Depends, Query, HTTPException, status
 from sqlalchemy.orm import Session
-from app.database import get_db
+from app.database import get_db, SessionLocal
 from app.core.security import verify_token
 from app.models.patient_and_health_data import Patient, DiagnosticFinding
+from app.models.patient_and_diagnosis_data import Recommendation
 from app.services.websocket_manager import (
     get_connection_manager,
+    parse_topic,
     WebSocketMessage,
     broadcast_recommendation_update,
     broadcast_effectiveness_update,
     broadcast_feedback_update
 )
+from app.services.websocket_auth import get_handshake_cache
+from app.services.websocket_backplane import get_backplane
+from app.services.websocket_protocol import (
+    negotiate,
+    ProtocolError,
+    PingFrame,
+    PongFrame,
+    AckFrame,
+    SubscribeFrame
+)
 
 logger = logging.getLogger(__name__)
 
@@ -25,18 +39,190 @@ router = APIRouter(
 )
 
 
+async def _iter_frames(websocket: WebSocket, codec):
+    """
+    Yield validated inbound frames, answering keep-alive pings inline
+    
+    Invalid frames are yielded as ProtocolError instances so the caller
+    can report them in its own message shape.
+    
+    Raises:
+        WebSocketDisconnect: When the client disconnects
+    """
+    manager = get_connection_manager()
+    
+    while True:
+        frame = await websocket.receive()
+        if frame["type"] == "websocket.disconnect":
+            raise WebSocketDisconnect(frame.get("code", 1000))
+        
+        manager.touch(websocket)
+        data = frame.get("text") if frame.get("text") is not None else frame.get("bytes")
+        
+        # Fast path: canonical keep-alive ping, answered with a pre-encoded pong
+        if codec.is_ping(data):
+            manager.send_pong(websocket)
+            continue
+        
+        try:
+            inbound = codec.parse(data)
+        except ProtocolError as e:
+            logger.debug(f"⚠️ Invalid WebSocket frame: {str(e)}")
+            yield e
+            continue
+        
+        logger.debug(f"📥 WebSocket message received: {inbound.type}")
+        
+        if isinstance(inbound, PingFrame):
+            manager.send_pong(websocket)
+        elif isinstance(inbound, AckFrame):
+            manager.record_ack(websocket, inbound.seq)
+        elif not isinstance(inbound, PongFrame):
+            yield inbound
+
+
+def _authorize_topics(user_id: int, topics: List[str]) -> Tuple[List[str], List[str]]:
+    """
+    Split topics into those the user may subscribe to and those denied
+    (runs in a worker thread)
+    
+    Ownership is checked with one IN query per topic kind rather than
+    one query per topic, on a short-lived session so a long-lived socket
+    never pins a pooled connection.
+    
+    Returns:
+        (allowed, denied)
+    """
+    ids: Dict[str, Set[int]] = {"diagnosis": set(), "recommendation": set()}
+    parsed = {}
+    for topic in topics:
+        parsed[topic] = parse_topic(topic)
+        if parsed[topic] and parsed[topic][0] in ids:
+            ids[parsed[topic][0]].add(parsed[topic][1])
+    
+    owned: Dict[str, Set[int]] = {"diagnosis": set(), "recommendation": set(), "patient": {user_id}}
+    
+    if ids["diagnosis"] or ids["recommendation"]:
+        db = SessionLocal()
+        try:
+            if ids["diagnosis"]:
+                owned["diagnosis"] = {
+                    row.id for row in db.query(DiagnosticFinding.id).filter(
+                        DiagnosticFinding.id.in_(ids["diagnosis"]),
+                        DiagnosticFinding.patient_id == user_id
+                    )
+                }
+            
+            if ids["recommendation"]:
+                owned["recommendation"] = {
+                    row.id for row in db.query(Recommendation.id).join(
+                        DiagnosticFinding, Recommendation.diagnosis_id == DiagnosticFinding.id
+                    ).filter(
+                        Recommendation.id.in_(ids["recommendation"]),
+                        DiagnosticFinding.patient_id == user_id
+                    )
+                }
+        finally:
+            db.close()
+    
+    allowed, denied = [], []
+    for topic in topics:
+        kind_id = parsed[topic]
+        if kind_id and kind_id[1] in owned[kind_id[0]]:
+            allowed.append(topic)
+        else:
+            denied.append(topic)
+    return allowed, denied
+
+
+@router.websocket("/ws/multiplex")
+async def websocket_multiplex_endpoint(
+    websocket: WebSocket,
+    token: str = Query(...)
+):
+    """
+    Multiplexed WebSocket endpoint: one socket, many topics
+    
+    Connection format:
+    ws://localhost:8000/ws/multiplex?token=jwt_token
+    
+    Receives:
+    - {"type": "subscribe", "topics": ["diagnosis:42", "recommendation:7", "patient:3"],
+       "since": {"diagnosis:42": last_seq}}
+    - {"type": "unsubscribe", "topics": [...]}
+    - ping, ack {seq}
+    
+    Sends:
+    - subscribed / unsubscribed: {"topics": [...], "denied": [...]}
+    - every broadcast for a subscribed topic, with its diagnosis_id
+    
+    Subprotocols are negotiated as on /ws/{diagnosis_id}.
+    """
+    
+    try:
+        user_id = int(verify_token(token, ValueError("Invalid token")))
+    except Exception as e:
+        await websocket.close(code=status.WS_1008_POLICY_VIOLATION, reason="Invalid token")
+        logger.warning(f"❌ Multiplexed WebSocket rejected: invalid token - {str(e)}")
+        return
+    
+    manager = get_connection_manager()
+    _, codec = negotiate(websocket.scope.get("subprotocols", []))
+    
+    try:
+        await manager.connect_multiplex(user_id, websocket, codec=codec)
+        await manager.send_to_client(websocket, WebSocketMessage(
+            type="connect",
+            data={"message": "Connected to real-time updates", "user_id": user_id}
+        ))
+        
+        async for inbound in _iter_frames(websocket, codec):
+            if isinstance(inbound, ProtocolError):
+                await manager.send_to_client(websocket, WebSocketMessage(
+                    type="error",
+                    data={"message": "Invalid message"}
+                ))
+            elif inbound.type == "subscribe":
+                allowed, denied = await asyncio.to_thread(_authorize_topics, user_id, inbound.topics)
+                added = await manager.subscribe(websocket, allowed, since=inbound.since)
+                await manager.send_to_client(websocket, WebSocketMessage(
+                    type="subscribed",
+                    data={"topics": added, "denied": denied}
+                ))
+            else:
+                removed = manager.unsubscribe(websocket, inbound.topics)
+                await manager.send_to_client(websocket, WebSocketMessage(
+                    type="unsubscribed",
+                    data={"topics": removed}
+                ))
+    
+    except WebSocketDisconnect:
+        await manager.disconnect(None, websocket)
+    
+    except Exception as e:
+        logger.error(f"❌ Multiplexed WebSocket error: {str(e)}")
+        try:
+            await manager.disconnect(None, websocket)
+        except:
+            pass
+
+
 @router.websocket("/ws/{diagnosis_id}")
 async def websocket_endpoint(
     diagnosis_id: int,
     websocket: WebSocket,
     token: str = Query(None),
-    db: Session = Depends(get_db)
+    since: Optional[int] = Query(None, ge=0)
 ):
     """
     WebSocket endpoint for real-time diagnosis updates
     
     Connection format:
-    ws://localhost:8000/ws/{diagnosis_id}?token=jwt_token
+    ws://localhost:8000/ws/{diagnosis_id}?token=jwt_token&since=last_seq
+    
+    Every broadcast carries a per-diagnosis "seq". Clients that reconnect
+    with ?since=<seq> receive the messages they missed; if some are no
+    longer retained a "replay_gap" message is sent first.
     
     Sends:
     - recommendation_update: When recommendations change
@@ -44,41 +230,25 @@ async def websocket_endpoint(
     - feedback_update: When new feedback received
     - analytics_update: When analytics data changes
     
-    Returns:
-    JSON messages with type and data fields
-    """
+    Subprotocols (Sec-WebSocket-Protocol):
+    - avicenna.msgpack.v1: binary msgpack frames
+    - avicenna.json.v1: compact JSON frames
+    - none: legacy JSON frames
     
-    # Verify diagnosis exists
-    diagnosis = db.query(DiagnosticFinding).filter(
-        DiagnosticFinding.id == diagnosis_id
-    ).first()
+    Receives (validated): ping, pong, ack {seq}
     
-    if not diagnosis:
-        await websocket.close(code=status.WS_1008_POLICY_VIOLATION, reason="Diagnosis not found")
-        logger.warning(f"❌ WebSocket connection rejected: diagnosis_id={diagnosis_id} not found")
-        return
+    The server pings connections that have been silent for a while and
+    closes those that stay silent past the idle timeout.
     
-    # Verify token if provided
+    Returns:
+    Messages with type and data fields in the negotiated encoding
+    """
+    
+    # Authorize from the handshake cache; DB lookups run off the event loop
     user_id = None
     if token:
         try:
-            payload = verify_token(token)
-            user_id = payload.get("sub")
-            
-            # Verify user owns this diagnosis
-            user = db.query(Patient).filter(Patient.id == user_id).first()
-            if not user or diagnosis.patient_id != user_id:
-                await websocket.close(
-                    code=status.WS_1008_POLICY_VIOLATION,
-                    reason="Access denied"
-                )
-                logger.warning(
-                    f"❌ WebSocket connection rejected: user_id={user_id} "
-                    f"doesn't own diagnosis_id={diagnosis_id}"
-                )
-                return
-            
-            logger.info(f"🔐 WebSocket authenticated: user_id={user_id}, diagnosis_id={diagnosis_id}")
+            user_id = int(verify_token(token, ValueError("Invalid token")))
         except Exception as e:
             await websocket.close(
                 code=status.WS_1008_POLICY_VIOLATION,
@@ -86,16 +256,29 @@ async def websocket_endpoint(
             )
             logger.warning(f"❌ WebSocket connection rejected: invalid token - {str(e)}")
             return
+    
+    decision = await get_handshake_cache().authorize(user_id, diagnosis_id)
+    
+    if not decision.allowed:
+        await websocket.close(code=status.WS_1008_POLICY_VIOLATION, reason=decision.reason)
+        logger.warning(
+            f"❌ WebSocket connection rejected: user_id={user_id}, "
+            f"diagnosis_id={diagnosis_id} ({decision.reason})"
+        )
+        return
+    
+    user_id = decision.user_id
+    if token:
+        logger.info(f"🔐 WebSocket authenticated: user_id={user_id}, diagnosis_id={diagnosis_id}")
     else:
-        # If no token provided, use diagnosis patient_id
-        user_id = diagnosis.patient_id
         logger.info(f"ℹ️ WebSocket connected (no auth): user_id={user_id}, diagnosis_id={diagnosis_id}")
     
     # Get connection manager and connect
     manager = get_connection_manager()
+    _, codec = negotiate(websocket.scope.get("subprotocols", []))
     
     try:
-        await manager.connect(diagnosis_id, user_id, websocket)
+        await manager.connect(diagnosis_id, user_id, websocket, since=since, codec=codec)
         
         # Send welcome message
         welcome_msg = WebSocketMessage(
@@ -104,33 +287,27 @@ async def websocket_endpoint(
             data={
                 "message": "Connected to real-time updates",
                 "diagnosis_id": diagnosis_id,
-                "user_id": user_id
+                "user_id": user_id,
+                "last_seq": manager.get_last_seq(diagnosis_id)
             }
         )
-        await websocket.send_json(welcome_msg.dict())
+        await manager.send_to_client(websocket, welcome_msg)
         logger.info(f"✅ WebSocket welcome sent: diagnosis_id={diagnosis_id}")
         
         # Keep connection open and listen for messages
-        while True:
-            data = await websocket.receive_text()
-            
-            try:
-                message_data = eval(data)  # Parse JSON
-                logger.debug(f"📥 WebSocket message received: {message_data}")
-                
-                # Handle ping/pong for keep-alive
-                if message_data.get("type") == "ping":
-                    pong = WebSocketMessage(
-                        type="pong",
-                        diagnosis_id=diagnosis_id
-                    )
-                    await websocket.send_json(pong.dict())
-                    logger.debug("🏓 Pong sent")
-                
-            except Exception as e:
-                logger.error(f"❌ Error processing message: {str(e)}")
-                # Continue listening for more messages
-                continue
+        async for inbound in _iter_frames(websocket, codec):
+            if isinstance(inbound, ProtocolError):
+                await manager.send_to_client(websocket, WebSocketMessage(
+                    type="error",
+                    diagnosis_id=diagnosis_id,
+                    data={"message": "Invalid message"}
+                ))
+            elif isinstance(inbound, SubscribeFrame):
+                await manager.send_to_client(websocket, WebSocketMessage(
+                    type="error",
+                    diagnosis_id=diagnosis_id,
+                    data={"message": "Subscriptions are only supported on /ws/multiplex"}
+                ))
     
     except WebSocketDisconnect:
         await manager.disconnect(diagnosis_id, websocket)
@@ -155,9 +332,18 @@ async def get_websocket_status():
             diagnosis_id: {
                 "connection_count": int,
                 "queued_messages": int,
-                "users": [int, ...]
+                "last_seq": int,
+                "users": [int, ...],
+                "send_queue_depth": int,
+                "dropped_messages": int,
+                "clients": [{user_id, queue_depth, max_queue_depth, sent, dropped, coalesced}, ...]
             }
         },
+        "send_queue": {max_size, overflow_policy, total_queued, total_dropped, ...},
+        "topics": {multiplexed_connections, topics, subscriptions},
+        "memory": {connections, diagnoses, locks, replay_buffers, rss_bytes, ...},
+        "sweeper": {running, sweeps, pinged, idle_evicted, reclaimed_locks, ...},
+        "handshake_cache": {entries, hits, misses, hit_rate, db_loads, invalidations},
         "total_diagoses": int,
         "total_connections": int
     }
@@ -174,6 +360,12 @@ async def get_websocket_status():
         "active_connections": connections_info,
         "total_diagnoses": len(connections_info),
         "total_connections": total_connections,
+        "send_queue": manager.get_send_queue_stats(),
+        "topics": manager.get_topic_stats(),
+        "memory": manager.get_memory_stats(),
+        "sweeper": manager.get_sweeper_stats(),
+        "handshake_cache": get_handshake_cache().get_stats(),
+        "backplane": get_backplane().get_stats(),
         "timestamp": __import__('datetime').datetime.utcnow().isoformat()
     }
     
@@ -191,6 +383,7 @@ async def broadcast_recommendation_update_endpoint(
     old_data: dict,
     new_data: dict,
     reason: str = "Updated",
+    recommendation_id: Optional[int] = None,
     db: Session = Depends(get_db),
     current_user: Patient = Depends(get_current_user)
 ):
@@ -203,6 +396,7 @@ async def broadcast_recommendation_update_endpoint(
         old_data: Old recommendation data
         new_data: New recommendation data
         reason: Reason for update
+        recommendation_id: Recommendation ID, for "recommendation:<id>" subscribers
     """
     
     try:
@@ -219,7 +413,9 @@ async def broadcast_recommendation_update_endpoint(
             diagnosis_id,
             old_data,
             new_data,
-            reason
+            reason,
+            recommendation_id=recommendation_id,
+            patient_id=diagnosis.patient_id
         )
         
         return {
@@ -272,7 +468,8 @@ async def broadcast_effectiveness_update_endpoint(
             recommendation_id,
             new_effectiveness,
             confidence,
-            sample_size
+            sample_size,
+            patient_id=diagnosis.patient_id
         )
         
         return {
@@ -330,7 +527,8 @@ async def broadcast_feedback_update_endpoint(
             diagnosis_id,
             feedback_id,
             rating,
-            effectiveness
+            effectiveness,
+            patient_id=diagnosis.patient_id
         )
         
         return {
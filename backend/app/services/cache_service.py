@@ -6,7 +6,7 @@ Handles cache warming, invalidation, and multi-level caching
 import logging
 from typing import Any, Optional, List, Dict, Callable
 from datetime import datetime, timedelta
-from app.core.cache import get_cache, cache_invalidate, cached
+from app.core.cache import get_cache, cache_invalidate, cached, cached_many
 from app.database import SessionLocal
 from sqlalchemy.orm import Session
 
@@ -38,27 +38,46 @@ class CacheService:
         ).first()
         
         if rec:
-            return {
-                "id": rec.id,
-                "herb_name": rec.herb_name,
-                "dosage": rec.dosage,
-                "duration_days": rec.duration_days,
-                "effectiveness_rating": rec.effectiveness_rating,
-            }
+            return self._recommendation_dict(rec)
         return None
     
+    @cached_many(ttl_seconds=3600, item_key=get_recommendation_cache.cache_key)
+    def get_recommendations_cache(self, recommendation_ids: List[int]) -> Dict[int, Dict[str, Any]]:
+        """
+        Get many recommendations, loading only the uncached ones
+        
+        Shares entries with get_recommendation_cache; the misses are
+        loaded with one IN query and written back in one pipeline.
+        """
+        from app.models.patient_and_diagnosis_data import Recommendation
+        
+        recs = self.db.query(Recommendation).filter(
+            Recommendation.id.in_(recommendation_ids)
+        ).all()
+        
+        return {rec.id: self._recommendation_dict(rec) for rec in recs}
+    
+    @staticmethod
+    def _recommendation_dict(rec) -> Dict[str, Any]:
+        return {
+            "id": rec.id,
+            "herb_name": rec.herb_name,
+            "dosage": rec.dosage,
+            "duration_days": rec.duration_days,
+            "effectiveness_rating": rec.effectiveness_rating,
+        }
+    
     @cache_invalidate(pattern="recommendations:*")
     def invalidate_recommendations_cache(self):
         """Clear all recommendation caches"""
         logger.info("Invalidated recommendations cache")
     
     def warm_recommendations_cache(self, recommendation_ids: List[int]):
-        """Warm cache with popular recommendations"""
-        for rec_id in recommendation_ids:
-            try:
-                self.get_recommendation_cache(rec_id)
-            except Exception as e:
-                logger.error(f"Error warming recommendation cache {rec_id}: {e}")
+        """Warm cache with popular recommendations (one MGET, one query, one pipelined write)"""
+        try:
+            self.get_recommendations_cache(recommendation_ids)
+        except Exception as e:
+            logger.error(f"Error warming recommendation cache for {len(recommendation_ids)} ids: {e}")
     
     # ===========================
     # Analytics Cache
@@ -84,16 +103,44 @@ class CacheService:
         ).first()
         
         if result and result[1] > 0:
-            avg_rating, total, successful = result
-            return {
-                "recommendation_id": recommendation_id,
-                "average_rating": float(avg_rating) if avg_rating else 0.0,
-                "total_feedbacks": total,
-                "successful_count": successful or 0,
-                "effectiveness_score": (successful or 0) / total if total > 0 else 0.0,
-            }
+            return self._effectiveness_dict(recommendation_id, *result)
         return None
     
+    @cached_many(ttl_seconds=1800, item_key=get_effectiveness_cache.cache_key)
+    def get_effectiveness_many(self, recommendation_ids: List[int]) -> Dict[int, Dict[str, Any]]:
+        """
+        Get effectiveness metrics for many recommendations in one grouped query
+        
+        Shares entries with get_effectiveness_cache.
+        """
+        from app.models.patient_and_diagnosis_data import HealthRecord
+        from sqlalchemy import func
+        
+        rows = self.db.query(
+            HealthRecord.recommendation_id,
+            func.avg(HealthRecord.rating),
+            func.count(HealthRecord.id),
+            func.sum(HealthRecord.rating >= 3)
+        ).filter(
+            HealthRecord.recommendation_id.in_(recommendation_ids)
+        ).group_by(HealthRecord.recommendation_id).all()
+        
+        return {
+            rec_id: self._effectiveness_dict(rec_id, avg_rating, total, successful)
+            for rec_id, avg_rating, total, successful in rows
+            if total > 0
+        }
+    
+    @staticmethod
+    def _effectiveness_dict(recommendation_id: int, avg_rating, total: int, successful) -> Dict[str, Any]:
+        return {
+            "recommendation_id": recommendation_id,
+            "average_rating": float(avg_rating) if avg_rating else 0.0,
+            "total_feedbacks": total,
+            "successful_count": successful or 0,
+            "effectiveness_score": (successful or 0) / total if total > 0 else 0.0,
+        }
+    
     @cache_invalidate(pattern="analytics:*")
     def invalidate_analytics_cache(self):
         """Clear all analytics caches"""
@@ -206,8 +253,9 @@ class CacheService:
         try:
             # Warm recommendations
             from app.models.patient_and_diagnosis_data import Recommendation
-            popular_recs = self.db.query(Recommendation).limit(20).all()
-            self.warm_recommendations_cache([r.id for r in popular_recs])
+            popular_ids = [r.id for r in self.db.query(Recommendation.id).limit(20).all()]
+            self.warm_recommendations_cache(popular_ids)
+            self.get_effectiveness_many(popular_ids)
             
             # Warm trending
             self.get_trending_recommendations()
@@ -231,7 +279,8 @@ class CacheService:
         
         return {
             "healthy": healthy,
-            "cache_type": "Redis",
+            "cache_type": {"redis": "Redis", "local": "In-process"}.get(stats.get("backend"), "Disabled"),
+            "degraded": stats.get("backend") == "local" and stats.get("backend_mode") == "auto",
             "stats": stats,
         }
     
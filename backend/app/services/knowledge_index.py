@@ -0,0 +1,613 @@
+"""
+Knowledge Index
+Immutable in-memory snapshot of the tradition knowledge bases used for matching
+
+KnowledgeMatchingService used to load every Avicenna disease, TCM pattern
+and Ayurveda disease from the database on each analysis and lower() the
+same attributes again for every comparison. The index loads them once
+(at startup, then whenever the KB version from app.core.kb_cache moves)
+into tuples of NamedTuples whose matched attributes are already
+normalized, together with each entry's recommended herbs (the first
+HERBS_PER_MATCH per disease or pattern, read with one windowed query per
+tradition), so matching touches no database.
+
+Each tradition is also encoded as a FeatureMatrix: one-hot columns per
+distinct attribute value, reached from finding values through per-
+attribute postings (an inverted index from values to columns). Scoring
+all entries is one matrix-vector product with a findings vector of
+per-tradition weights, and argpartition narrows them to the few that
+can make the top matches.
+
+A snapshot is never modified: a KB change builds a new one and swaps
+the module-level reference in a single assignment, so matches already
+running keep the consistent snapshot they started with.
+"""
+
+import logging
+import math
+import threading
+import time
+from typing import Any, Dict, Iterable, List, NamedTuple, Optional, Sequence, Tuple
+
+import numpy as np
+from sqlalchemy import func
+from sqlalchemy.orm import Session, aliased
+
+from app.core.kb_cache import get_kb_version
+
+logger = logging.getLogger(__name__)
+
+# Score each matched attribute adds (the matchers' scoring rules)
+AVICENNA_WEIGHTS = {"mizaj": 0.3, "color": 0.2, "coating": 0.2, "moisture": 0.15}
+TCM_WEIGHTS = {"color": 0.3, "coating": 0.3, "moisture": 0.2, "shape": 0.2}
+AYURVEDA_WEIGHTS = {"dosha": 0.3, "color": 0.25, "coating": 0.25, "moisture": 0.2}
+
+# Weights are summed as integers in hundredths
+WEIGHT_SCALE = 100
+
+# Slack for float scores compared against thresholds
+SCORE_EPSILON = 1e-9
+
+# Distinct finding values memoized per text postings
+POSTINGS_MEMO_SIZE = 1024
+
+# Herbs recommended with each match
+HERBS_PER_MATCH = 3
+
+# Herb attributes in match responses: (response field, model attribute)
+AVICENNA_HERB_FIELDS = (("name", "name_fa"), ("name_en", "name_en"), ("dosage", "dosage"), ("frequency", "frequency"))
+TCM_HERB_FIELDS = (("name", "name_fa"), ("name_en", "name_en"), ("actions", "actions"), ("dosage", "dosage"))
+AYURVEDA_HERB_FIELDS = (
+    ("name", "name_fa"), ("name_en", "name_en"), ("rasa", "rasa"), ("virya", "virya"), ("dosage", "dosage"),
+)
+
+# A match's recommended herbs, as they appear in responses
+Herbs = Tuple[Dict[str, Any], ...]
+
+
+# How scoring reads each finding: (lower-cased, empty values never match)
+MATCH_FINDINGS = {
+    "mizaj": (False, False),
+    "color": (True, True),
+    "coating": (True, True),
+    "moisture": (True, True),
+    "shape": (True, True),
+    "dosha": (False, True),
+}
+
+
+def canonical_findings(findings: Dict) -> Dict[str, Any]:
+    """
+    The findings that decide match scores, normalized as scoring compares them
+
+    Findings that score the same map to the same dict ("Red" and "red",
+    "" and a missing value), so they can share memoized results.
+    Non-text values, which scoring treats specially, stay distinct.
+    """
+    canonical: Dict[str, Any] = {}
+    for finding, (lower, required) in MATCH_FINDINGS.items():
+        value = findings.get(finding)
+        if required and not value:
+            value = None
+        elif isinstance(value, str):
+            value = value.lower() if lower else value
+        elif value is not None:
+            value = {"repr": repr(value)}
+        canonical[finding] = value
+    return canonical
+
+
+def confidence_bucket(confidence: Any, step: float) -> Optional[float]:
+    """
+    Confidence rounded to a multiple of step (None if it isn't a number)
+
+    Args:
+        confidence: Analysis confidence
+        step: Bucket width, e.g. 0.01
+    """
+    if isinstance(confidence, bool) or not isinstance(confidence, (int, float)) or not math.isfinite(confidence):
+        return None
+    if not step:
+        return float(confidence)
+    return round(round(confidence / step) * step, 6)
+
+
+def _text(value: Any) -> str:
+    """Lower-cased text of a KB attribute ("" when empty), as matching compares it"""
+    return str(value).lower() if value else ""
+
+
+def _herbs_by_owner(rows: Iterable[Any], owner: str, fields: Sequence[Tuple[str, str]]) -> Dict[int, Herbs]:
+    """
+    Group herb rows by their disease/pattern into response payloads
+
+    Args:
+        rows: Herb rows, in recommendation order
+        owner: Attribute holding the disease or pattern id
+        fields: (response field, model attribute) pairs
+
+    Returns:
+        {owner id: first HERBS_PER_MATCH herbs}
+    """
+    grouped: Dict[int, List[Dict[str, Any]]] = {}
+    for row in rows:
+        herbs = grouped.setdefault(getattr(row, owner), [])
+        if len(herbs) < HERBS_PER_MATCH:
+            herbs.append({field: getattr(row, attribute) for field, attribute in fields})
+    return {owner_id: tuple(herbs) for owner_id, herbs in grouped.items()}
+
+
+def top_herbs_query(db: Session, model: Any, owner_column: Any, limit: int = HERBS_PER_MATCH):
+    """
+    The first `limit` herbs of every disease/pattern, in one query
+
+    ROW_NUMBER() OVER (PARTITION BY owner ORDER BY id) replaces one
+    LIMIT query per matched entry.
+
+    Args:
+        db: Database session
+        model: Herb model
+        owner_column: Its disease/pattern foreign key column
+        limit: Herbs per owner
+    """
+    rank = func.row_number().over(partition_by=owner_column, order_by=model.id).label("herb_rank")
+    ranked = db.query(model, rank).subquery()
+    herb = aliased(model, ranked)
+    return (
+        db.query(herb)
+        .filter(ranked.c.herb_rank <= limit)
+        .order_by(getattr(herb, owner_column.key), herb.id)
+    )
+
+
+class AvicennaEntry(NamedTuple):
+    """An Avicenna disease with its matched attributes normalized"""
+    id: int
+    name_fa: str
+    name_en: str
+    mizaj: Optional[str]  # Compared as is
+    description: Optional[str]
+    color: str
+    coating: str
+    moisture: str
+    herbs: Herbs = ()
+
+
+class TCMEntry(NamedTuple):
+    """A TCM pattern of disharmony with its matched attributes normalized"""
+    id: int
+    name_fa: str
+    name_en: str
+    organs: Any
+    imbalance_type: Optional[str]
+    description: Optional[str]
+    balancing_method: Any
+    tongue_appearance: str
+    coating: str
+    moisture: str
+    shape: str
+    herbs: Herbs = ()
+
+
+class AyurvedaEntry(NamedTuple):
+    """An Ayurvedic disease with its matched attributes normalized"""
+    id: int
+    name_fa: str
+    name_en: str
+    dosha: Optional[str]  # As stored, for responses
+    description: Optional[str]
+    balancing_doshas: Any
+    dosha_text: str
+    tongue_signs: str
+    normal_digestion: bool
+    herbs: Herbs = ()
+
+
+class TextPostings:
+    """
+    Distinct texts of one attribute, matched by the matchers' substring test
+
+    The texts are an attribute's feature columns: each entry has a code
+    (its text's column, -1 when empty) and lookup() returns the columns
+    containing a finding value, memoized per value since findings come
+    from a small vocabulary.
+    """
+
+    def __init__(self, texts: Sequence[str]):
+        columns: Dict[str, int] = {}
+        self.codes = [columns.setdefault(text, len(columns)) if text else -1 for text in texts]
+        self.texts = tuple(columns)
+        self.width = len(self.texts)
+        self.memo: Dict[str, Tuple[int, ...]] = {}
+
+    def lookup(self, value: Any) -> Tuple[int, ...]:
+        if not isinstance(value, str):
+            return ()
+        columns = self.memo.get(value)
+        if columns is None:
+            columns = tuple(column for column, text in enumerate(self.texts) if value in text)
+            if len(self.memo) < POSTINGS_MEMO_SIZE:
+                self.memo[value] = columns
+        return columns
+
+
+class ValuePostings:
+    """Distinct values of one attribute, matched by equality"""
+
+    def __init__(self, values: Sequence[Any]):
+        columns: Dict[Any, int] = {}
+        self.codes = [columns.setdefault(value, len(columns)) for value in values]
+        self.columns = columns
+        self.width = len(columns)
+
+    def lookup(self, value: Any) -> Tuple[int, ...]:
+        try:
+            column = self.columns.get(value)
+        except TypeError:
+            # Unhashable findings never equal a stored value
+            return ()
+        return () if column is None else (column,)
+
+
+class FlagPostings:
+    """A single column for entries with a flag set, whatever the finding's value"""
+
+    def __init__(self, flags: Sequence[bool]):
+        self.codes = [0 if flag else -1 for flag in flags]
+        self.width = 1
+
+    def lookup(self, value: Any) -> Tuple[int, ...]:
+        return (0,)
+
+
+class Feature(NamedTuple):
+    """One scoring rule: the finding it reads, its weight and its postings"""
+    finding: str
+    weight: float
+    postings: Any  # TextPostings, ValuePostings or FlagPostings
+    lower: bool = True  # Lower-case the finding first
+    required: bool = True  # Empty findings never match
+
+
+class FeatureMatrix:
+    """
+    One tradition's entries as a one-hot matrix over its attribute values
+
+    Column blocks follow the features; an entry has a 1 in the column of
+    each attribute value it has. A findings vector carries each feature's
+    weight (in hundredths, so sums are exact) in the columns its value
+    matches, making every entry's score one matrix-vector product.
+    """
+
+    def __init__(self, features: Sequence[Feature], size: int):
+        self.features = tuple(features)
+        self.size = size
+        self.weights = [int(round(feature.weight * WEIGHT_SCALE)) for feature in self.features]
+        self.offsets = []
+
+        width = 0
+        for feature in self.features:
+            self.offsets.append(width)
+            width += feature.postings.width
+        self.width = width
+
+        self.matrix = np.zeros((size, width), dtype=np.int8)
+        for feature, offset in zip(self.features, self.offsets):
+            codes = np.asarray(feature.postings.codes, dtype=np.int64)
+            rows = np.flatnonzero(codes >= 0)
+            self.matrix[rows, offset + codes[rows]] = 1
+
+    def scores(self, findings: Dict) -> np.ndarray:
+        """
+        Every entry's score, in hundredths
+
+        Returns:
+            int32 array of length size
+        """
+        vector = np.zeros(self.width, dtype=np.int32)
+        broken: List[int] = []
+
+        for index, (feature, weight, offset) in enumerate(zip(self.features, self.weights, self.offsets)):
+            value = findings.get(feature.finding)
+            if feature.required and not value:
+                continue
+            if isinstance(feature.postings, TextPostings) and not isinstance(value, str):
+                # The matchers' substring test raises for it, scoring every
+                # entry that has this attribute 0
+                broken.append(index)
+                continue
+            if feature.lower:
+                value = value.lower()
+            for column in feature.postings.lookup(value):
+                vector[offset + column] += weight
+
+        scores = self.matrix @ vector
+        for index in broken:
+            offset = self.offsets[index]
+            block = self.matrix[:, offset:offset + self.features[index].postings.width]
+            scores[block.any(axis=1)] = 0
+        return scores
+
+    def candidates(
+        self,
+        findings: Dict,
+        threshold: float,
+        confidence: float,
+        limit: int = 5
+    ) -> List[Tuple[int, float]]:
+        """
+        Entries that can make the top `limit`, best first
+
+        argpartition finds the limit-th best score; entries below it are
+        kept only if their rounded confidence could still tie with it
+        (ties go to knowledge-base order).
+
+        Args:
+            findings: Analysis findings
+            threshold: Minimum score of a match
+            confidence: Analysis confidence
+            limit: Matches wanted
+
+        Returns:
+            [(entry position, score), ...] by score, then position
+        """
+        if not self.size:
+            return []
+        scores = self.scores(findings)
+        passing = np.flatnonzero(scores >= math.ceil(threshold * WEIGHT_SCALE - SCORE_EPSILON))
+
+        if len(passing) > limit:
+            kth = int(np.partition(scores[passing], -limit)[-limit])
+            floor = round(max(kth / WEIGHT_SCALE - SCORE_EPSILON, 0.0) * confidence, 2)
+            # Only a handful of distinct scores exist, so this loop is tiny
+            cutoff = kth
+            for value in np.unique(scores[passing]):
+                if round(min(value / WEIGHT_SCALE + SCORE_EPSILON, 1.0) * confidence, 2) >= floor:
+                    cutoff = int(value)
+                    break
+            passing = passing[scores[passing] >= cutoff]
+
+        order = np.lexsort((passing, -scores[passing]))
+        return [(int(position), int(scores[position]) / WEIGHT_SCALE) for position in passing[order]]
+
+
+class KnowledgeIndex:
+    """One immutable snapshot of the three knowledge bases"""
+
+    __slots__ = (
+        "version", "loaded_at", "avicenna", "tcm", "ayurveda",
+        "avicenna_matrix", "tcm_matrix", "ayurveda_matrix",
+    )
+
+    def __init__(
+        self,
+        version: int,
+        avicenna: Tuple[AvicennaEntry, ...],
+        tcm: Tuple[TCMEntry, ...],
+        ayurveda: Tuple[AyurvedaEntry, ...]
+    ):
+        self.version = version
+        self.loaded_at = time.time()
+        self.avicenna = avicenna
+        self.tcm = tcm
+        self.ayurveda = ayurveda
+
+        self.avicenna_matrix = FeatureMatrix([
+            # Mizaj is compared as is, and a missing one matches entries without one
+            Feature(
+                "mizaj", AVICENNA_WEIGHTS["mizaj"], ValuePostings([d.mizaj for d in avicenna]),
+                lower=False, required=False,
+            ),
+            Feature("color", AVICENNA_WEIGHTS["color"], TextPostings([d.color for d in avicenna])),
+            Feature("coating", AVICENNA_WEIGHTS["coating"], TextPostings([d.coating for d in avicenna])),
+            Feature("moisture", AVICENNA_WEIGHTS["moisture"], TextPostings([d.moisture for d in avicenna])),
+        ], len(avicenna))
+        self.tcm_matrix = FeatureMatrix([
+            Feature("color", TCM_WEIGHTS["color"], TextPostings([p.tongue_appearance for p in tcm])),
+            Feature("coating", TCM_WEIGHTS["coating"], TextPostings([p.coating for p in tcm])),
+            Feature("moisture", TCM_WEIGHTS["moisture"], TextPostings([p.moisture for p in tcm])),
+            Feature("shape", TCM_WEIGHTS["shape"], TextPostings([p.shape for p in tcm])),
+        ], len(tcm))
+        tongue_signs = TextPostings([d.tongue_signs for d in ayurveda])
+        self.ayurveda_matrix = FeatureMatrix([
+            # The dosha finding is compared as is, against the lower-cased dosha
+            Feature(
+                "dosha", AYURVEDA_WEIGHTS["dosha"], TextPostings([d.dosha_text for d in ayurveda]),
+                lower=False,
+            ),
+            Feature("color", AYURVEDA_WEIGHTS["color"], tongue_signs),
+            Feature("coating", AYURVEDA_WEIGHTS["coating"], tongue_signs),
+            Feature("moisture", AYURVEDA_WEIGHTS["moisture"], FlagPostings([d.normal_digestion for d in ayurveda])),
+        ], len(ayurveda))
+
+    @classmethod
+    def build(
+        cls,
+        version: int,
+        avicenna_diseases: Iterable[Any],
+        tcm_patterns: Iterable[Any],
+        ayurveda_diseases: Iterable[Any],
+        avicenna_herbs: Iterable[Any] = (),
+        tcm_herbs: Iterable[Any] = (),
+        ayurveda_herbs: Iterable[Any] = ()
+    ) -> "KnowledgeIndex":
+        """
+        Build an index from KB rows (ORM objects or anything with the same attributes)
+
+        Args:
+            version: KB version the rows were read at
+            avicenna_diseases: AvicennaDisease rows
+            tcm_patterns: TCMPatternDisharmony rows
+            ayurveda_diseases: AyurvedicDisease rows
+            avicenna_herbs: AvicennaHerb rows, in recommendation order
+            tcm_herbs: TCMHerb rows, in recommendation order
+            ayurveda_herbs: AyurvedicHerb rows, in recommendation order
+        """
+        avicenna_herbs = _herbs_by_owner(avicenna_herbs, "disease_id", AVICENNA_HERB_FIELDS)
+        tcm_herbs = _herbs_by_owner(tcm_herbs, "pattern_id", TCM_HERB_FIELDS)
+        ayurveda_herbs = _herbs_by_owner(ayurveda_herbs, "disease_id", AYURVEDA_HERB_FIELDS)
+
+        avicenna = []
+        for disease in avicenna_diseases:
+            characteristics = disease.characteristics or {}
+            avicenna.append(AvicennaEntry(
+                id=disease.id,
+                name_fa=disease.name_fa,
+                name_en=disease.name_en,
+                mizaj=disease.mizaj,
+                description=disease.description_fa,
+                color=_text(characteristics.get("color")),
+                coating=_text(characteristics.get("coating")),
+                moisture=_text(characteristics.get("moisture")),
+                herbs=avicenna_herbs.get(disease.id, ()),
+            ))
+
+        tcm = [
+            TCMEntry(
+                id=pattern.id,
+                name_fa=pattern.name_fa,
+                name_en=pattern.name_en,
+                organs=pattern.organs,
+                imbalance_type=pattern.imbalance_type,
+                description=pattern.description_fa,
+                balancing_method=pattern.balancing_method,
+                tongue_appearance=_text(pattern.tongue_appearance),
+                coating=_text(pattern.coating),
+                moisture=_text(pattern.moisture),
+                shape=_text(pattern.shape),
+                herbs=tcm_herbs.get(pattern.id, ()),
+            )
+            for pattern in tcm_patterns
+        ]
+
+        ayurveda = [
+            AyurvedaEntry(
+                id=disease.id,
+                name_fa=disease.name_fa,
+                name_en=disease.name_en,
+                dosha=disease.dosha,
+                description=disease.description_fa,
+                balancing_doshas=disease.balancing_doshas,
+                dosha_text=_text(disease.dosha),
+                tongue_signs=_text(disease.tongue_signs),
+                normal_digestion="normal" in _text(disease.digestion_status),
+                herbs=ayurveda_herbs.get(disease.id, ()),
+            )
+            for disease in ayurveda_diseases
+        ]
+
+        return cls(version, tuple(avicenna), tuple(tcm), tuple(ayurveda))
+
+    @classmethod
+    def load(cls, db: Session, version: int) -> "KnowledgeIndex":
+        """Read the three knowledge bases from the database"""
+        from app.models.knowledge_base_models import (
+            AvicennaDisease,
+            AvicennaHerb,
+            TCMPatternDisharmony,
+            TCMHerb,
+            AyurvedicDisease,
+            AyurvedicHerb,
+        )
+
+        started = time.perf_counter()
+        index = cls.build(
+            version,
+            db.query(AvicennaDisease).all(),
+            db.query(TCMPatternDisharmony).all(),
+            db.query(AyurvedicDisease).all(),
+            top_herbs_query(db, AvicennaHerb, AvicennaHerb.disease_id).all(),
+            top_herbs_query(db, TCMHerb, TCMHerb.pattern_id).all(),
+            top_herbs_query(db, AyurvedicHerb, AyurvedicHerb.disease_id).all(),
+        )
+        logger.info(
+            f"✅ Knowledge index v{version} loaded: {len(index.avicenna)} Avicenna, "
+            f"{len(index.tcm)} TCM, {len(index.ayurveda)} Ayurveda entries "
+            f"in {time.perf_counter() - started:.2f}s"
+        )
+        return index
+
+
+# Current snapshot; replaced, never mutated
+_index: Optional[KnowledgeIndex] = None
+_reload_lock = threading.Lock()
+
+
+def get_knowledge_index(db: Optional[Session] = None) -> KnowledgeIndex:
+    """
+    Current knowledge index, rebuilt first if the KB version moved
+
+    While one caller rebuilds, others keep using the previous snapshot;
+    only the very first load makes callers wait.
+
+    Args:
+        db: Session to load with (a new one is opened if omitted)
+    """
+    version = get_kb_version()
+    index = _index
+    if index is not None and index.version == version:
+        return index
+
+    if not _reload_lock.acquire(blocking=index is None):
+        return index
+    try:
+        index = _index
+        if index is None or index.version != version:
+            index = _load(db, version) or index
+        return index
+    finally:
+        _reload_lock.release()
+
+
+def load_knowledge_index(db: Optional[Session] = None) -> Optional[KnowledgeIndex]:
+    """
+    Load the index now (called at startup so the first analysis doesn't pay for it)
+
+    Returns:
+        The new index, or None if loading failed (the next match retries)
+    """
+    try:
+        with _reload_lock:
+            return _load(db, get_kb_version())
+    except Exception as e:
+        logger.error(f"❌ Knowledge index load failed: {e}")
+        return None
+
+
+def _load(db: Optional[Session], version: int) -> Optional[KnowledgeIndex]:
+    """Build and publish a new snapshot; keeps the old one if loading fails"""
+    global _index
+
+    session = db
+    if session is None:
+        from app.database import SessionLocal
+        session = SessionLocal()
+    try:
+        index = KnowledgeIndex.load(session, version)
+    except Exception as e:
+        if _index is None:
+            raise
+        logger.error(f"❌ Knowledge index reload failed, keeping v{_index.version}: {e}")
+        return None
+    finally:
+        if db is None:
+            session.close()
+
+    _index = index
+    return index
+
+
+__all__ = [
+    "KnowledgeIndex",
+    "AvicennaEntry",
+    "TCMEntry",
+    "AyurvedaEntry",
+    "Feature",
+    "FeatureMatrix",
+    "HERBS_PER_MATCH",
+    "canonical_findings",
+    "confidence_bucket",
+    "top_herbs_query",
+    "get_knowledge_index",
+    "load_knowledge_index",
+]
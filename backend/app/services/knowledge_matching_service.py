@@ -12,20 +12,31 @@ Services:
 - calculate_match_score()       → محاسبه امتیاز تطابق
 """
 
+import asyncio
+import heapq
 import logging
-from typing import List, Dict, Tuple, Optional
+import time
+from typing import Any, Callable, List, Dict, Tuple, Optional, Sequence
 from sqlalchemy.orm import Session
 from sqlalchemy import func
 
-from app.models.knowledge_base_models import (
-    AvicennaDisease,
-    AvicennaHerb,
-    TCMPatternDisharmony,
-    TCMHerb,
-    AyurvedicDisease,
-    AyurvedicHerb,
-)
+from app.core.cache import cache_key, get_cache
+from app.core.config import settings
+from app.core.kb_cache import KB_NAMESPACE
 from app.models.sensor_and_diagnostic_data import DiagnosticFinding
+from app.services.knowledge_index import (
+    AVICENNA_WEIGHTS,
+    TCM_WEIGHTS,
+    AYURVEDA_WEIGHTS,
+    SCORE_EPSILON,
+    AvicennaEntry,
+    TCMEntry,
+    AyurvedaEntry,
+    KnowledgeIndex,
+    canonical_findings,
+    confidence_bucket,
+    get_knowledge_index,
+)
 
 logger = logging.getLogger(__name__)
 
@@ -59,51 +70,43 @@ class KnowledgeMatchingService:
             [{disease_name, confidence, supporting_findings, recommendations}, ...]
         """
         try:
-            # دریافت تمام بیماری‌های Avicenna
-            diseases = db.query(AvicennaDisease).all()
-            
-            matches = []
-            
-            for disease in diseases:
-                score = self._calculate_avicenna_score(findings, disease)
-                
-                if score >= self.avicenna_threshold:
-                    # دریافت گیاهان مرتبط
-                    herbs = db.query(AvicennaHerb).filter(
-                        AvicennaHerb.disease_id == disease.id
-                    ).limit(3).all()
-                    
-                    match = {
-                        "disease_id": disease.id,
-                        "disease_name": disease.name_fa,
-                        "disease_name_en": disease.name_en,
-                        "mizaj": disease.mizaj,
-                        "confidence": round(score * confidence, 2),
-                        "supporting_findings": self._get_supporting_findings(findings, disease),
-                        "description": disease.description_fa,
-                        "recommended_herbs": [
-                            {
-                                "name": herb.name_fa,
-                                "name_en": herb.name_en,
-                                "dosage": herb.dosage,
-                                "frequency": herb.frequency,
-                            }
-                            for herb in herbs
-                        ],
-                        "severity": self._assess_severity(score),
-                    }
-                    matches.append(match)
-            
-            # مرتب‌سازی بر اساس امتیاز (بالاترین اول)
-            matches.sort(key=lambda x: x["confidence"], reverse=True)
-            
-            # برگرداندن 5 بهترین تطابق
-            return matches[:5]
+            # بیماری‌های Avicenna از ایندکس حافظه (بدون پرس‌وجوی پایگاه داده)
+            return self._match_avicenna(findings, confidence, get_knowledge_index(db))
             
         except Exception as e:
             logger.error(f"Error matching Avicenna diseases: {e}")
             return []
 
+    def _match_avicenna(self, findings: Dict, confidence: float, index: KnowledgeIndex) -> List[Dict]:
+        """Avicenna matches from the in-memory index (CPU only, no database)"""
+        top = self._top_matches(
+            index.avicenna,
+            index.avicenna_matrix.candidates(findings, self.avicenna_threshold, confidence),
+            lambda disease: self._calculate_avicenna_score(findings, disease),
+            self.avicenna_threshold,
+            confidence,
+        )
+        
+        matches = []
+        
+        for disease, score in top:
+            match = {
+                "disease_id": disease.id,
+                "disease_name": disease.name_fa,
+                "disease_name_en": disease.name_en,
+                "mizaj": disease.mizaj,
+                "confidence": round(score * confidence, 2),
+                "supporting_findings": self._get_supporting_findings(findings, disease),
+                "description": disease.description,
+                # گیاهان از ایندکس (۳ گیاه اول هر مورد، بدون پرس‌وجو)
+                "recommended_herbs": [dict(herb) for herb in disease.herbs],
+                "severity": self._assess_severity(score),
+            }
+            matches.append(match)
+        
+        # _top_matches از قبل 5 بهترین را به ترتیب امتیاز برمی‌گرداند
+        return matches
+
     async def match_tcm_patterns(
         self,
         findings: Dict,
@@ -122,51 +125,44 @@ class KnowledgeMatchingService:
             [{pattern_name, confidence, supporting_findings, recommendations}, ...]
         """
         try:
-            # دریافت تمام الگوهای TCM
-            patterns = db.query(TCMPatternDisharmony).all()
-            
-            matches = []
-            
-            for pattern in patterns:
-                score = self._calculate_tcm_score(findings, pattern)
-                
-                if score >= self.tcm_threshold:
-                    # دریافت گیاهان مرتبط
-                    herbs = db.query(TCMHerb).filter(
-                        TCMHerb.pattern_id == pattern.id
-                    ).limit(3).all()
-                    
-                    match = {
-                        "pattern_id": pattern.id,
-                        "pattern_name": pattern.name_fa,
-                        "pattern_name_en": pattern.name_en,
-                        "organs": pattern.organs,
-                        "imbalance_type": pattern.imbalance_type,
-                        "confidence": round(score * confidence, 2),
-                        "supporting_findings": self._get_supporting_findings(findings, pattern),
-                        "description": pattern.description_fa,
-                        "recommended_herbs": [
-                            {
-                                "name": herb.name_fa,
-                                "name_en": herb.name_en,
-                                "actions": herb.actions,
-                                "dosage": herb.dosage,
-                            }
-                            for herb in herbs
-                        ],
-                        "balancing_method": pattern.balancing_method,
-                    }
-                    matches.append(match)
-            
-            # مرتب‌سازی بر اساس امتیاز
-            matches.sort(key=lambda x: x["confidence"], reverse=True)
-            
-            return matches[:5]
+            # الگوهای TCM از ایندکس حافظه
+            return self._match_tcm(findings, confidence, get_knowledge_index(db))
             
         except Exception as e:
             logger.error(f"Error matching TCM patterns: {e}")
             return []
 
+    def _match_tcm(self, findings: Dict, confidence: float, index: KnowledgeIndex) -> List[Dict]:
+        """TCM matches from the in-memory index (CPU only, no database)"""
+        top = self._top_matches(
+            index.tcm,
+            index.tcm_matrix.candidates(findings, self.tcm_threshold, confidence),
+            lambda pattern: self._calculate_tcm_score(findings, pattern),
+            self.tcm_threshold,
+            confidence,
+        )
+        
+        matches = []
+        
+        for pattern, score in top:
+            match = {
+                "pattern_id": pattern.id,
+                "pattern_name": pattern.name_fa,
+                "pattern_name_en": pattern.name_en,
+                "organs": pattern.organs,
+                "imbalance_type": pattern.imbalance_type,
+                "confidence": round(score * confidence, 2),
+                "supporting_findings": self._get_supporting_findings(findings, pattern),
+                "description": pattern.description,
+                # گیاهان از ایندکس (۳ گیاه اول هر مورد، بدون پرس‌وجو)
+                "recommended_herbs": [dict(herb) for herb in pattern.herbs],
+                "balancing_method": pattern.balancing_method,
+            }
+            matches.append(match)
+        
+        # _top_matches از قبل 5 بهترین را به ترتیب امتیاز برمی‌گرداند
+        return matches
+
     async def match_ayurveda_diseases(
         self,
         findings: Dict,
@@ -185,75 +181,92 @@ class KnowledgeMatchingService:
             [{disease_name, dosha, confidence, recommendations}, ...]
         """
         try:
-            # دریافت تمام بیماری‌های Ayurveda
-            diseases = db.query(AyurvedicDisease).all()
-            
-            matches = []
-            
-            for disease in diseases:
-                score = self._calculate_ayurveda_score(findings, disease)
-                
-                if score >= self.ayurveda_threshold:
-                    # دریافت گیاهان مرتبط
-                    herbs = db.query(AyurvedicHerb).filter(
-                        AyurvedicHerb.disease_id == disease.id
-                    ).limit(3).all()
-                    
-                    match = {
-                        "disease_id": disease.id,
-                        "disease_name": disease.name_fa,
-                        "disease_name_en": disease.name_en,
-                        "dosha": disease.dosha,
-                        "confidence": round(score * confidence, 2),
-                        "supporting_findings": self._get_supporting_findings(findings, disease),
-                        "description": disease.description_fa,
-                        "recommended_herbs": [
-                            {
-                                "name": herb.name_fa,
-                                "name_en": herb.name_en,
-                                "rasa": herb.rasa,
-                                "virya": herb.virya,
-                                "dosage": herb.dosage,
-                            }
-                            for herb in herbs
-                        ],
-                        "balancing_doshas": disease.balancing_doshas,
-                    }
-                    matches.append(match)
-            
-            # مرتب‌سازی بر اساس امتیاز
-            matches.sort(key=lambda x: x["confidence"], reverse=True)
-            
-            return matches[:5]
+            # بیماری‌های Ayurveda از ایندکس حافظه
+            return self._match_ayurveda(findings, confidence, get_knowledge_index(db))
             
         except Exception as e:
             logger.error(f"Error matching Ayurveda diseases: {e}")
             return []
 
+    def _match_ayurveda(self, findings: Dict, confidence: float, index: KnowledgeIndex) -> List[Dict]:
+        """Ayurveda matches from the in-memory index (CPU only, no database)"""
+        top = self._top_matches(
+            index.ayurveda,
+            index.ayurveda_matrix.candidates(findings, self.ayurveda_threshold, confidence),
+            lambda disease: self._calculate_ayurveda_score(findings, disease),
+            self.ayurveda_threshold,
+            confidence,
+        )
+        
+        matches = []
+        
+        for disease, score in top:
+            match = {
+                "disease_id": disease.id,
+                "disease_name": disease.name_fa,
+                "disease_name_en": disease.name_en,
+                "dosha": disease.dosha,
+                "confidence": round(score * confidence, 2),
+                "supporting_findings": self._get_supporting_findings(findings, disease),
+                "description": disease.description,
+                # گیاهان از ایندکس (۳ گیاه اول هر مورد، بدون پرس‌وجو)
+                "recommended_herbs": [dict(herb) for herb in disease.herbs],
+                "balancing_doshas": disease.balancing_doshas,
+            }
+            matches.append(match)
+        
+        # _top_matches از قبل 5 بهترین را به ترتیب امتیاز برمی‌گرداند
+        return matches
+
     async def get_all_matches(
         self,
         diagnosis_id: int,
-        db: Session
+        db: Session,
+        diagnosis: Optional[DiagnosticFinding] = None,
+        budget_seconds: Optional[float] = None
     ) -> Dict:
         """
         دریافت تمام تطابق‌ها برای یک تشخیص
         
+        The three traditions are matched concurrently on worker threads
+        (database work included), so a request takes about as long as the
+        slowest one. Traditions that haven't finished when the budget runs
+        out come back empty and are listed under "timed_out".
+        
+        Results are memoized in the "kb" cache namespace, keyed by the
+        normalized findings, the confidence rounded to
+        KNOWLEDGE_MATCH_CONFIDENCE_STEP (which is also what matching uses)
+        and the KB version, so common presentations are a cache hit and a
+        KB change invalidates them all.
+        
         Args:
             diagnosis_id: شناسه DiagnosticFinding
             db: جلسه پایگاه داده
+            diagnosis: The DiagnosticFinding, if the caller already loaded it
+            budget_seconds: Time budget (default settings.KNOWLEDGE_MATCH_BUDGET_SECONDS, 0 for none)
             
         Returns:
             {
                 avicenna_matches: [...],
                 tcm_matches: [...],
-                ayurveda_matches: [...]
+                ayurveda_matches: [...],
+                timed_out: [...]  # Only when the budget ran out
             }
         """
+        started = time.monotonic()
+        budget = settings.KNOWLEDGE_MATCH_BUDGET_SECONDS if budget_seconds is None else budget_seconds
+        
+        def remaining() -> Optional[float]:
+            return max(budget - (time.monotonic() - started), 0) if budget else None
+        
         try:
             # دریافت نتایج تشخیص
-            diagnosis = db.query(DiagnosticFinding).filter(
-                DiagnosticFinding.id == diagnosis_id
-            ).first()
+            if diagnosis is None:
+                diagnosis = await asyncio.to_thread(
+                    lambda: db.query(DiagnosticFinding).filter(
+                        DiagnosticFinding.id == diagnosis_id
+                    ).first()
+                )
             
             if not diagnosis:
                 logger.warning(f"Diagnosis {diagnosis_id} not found")
@@ -267,12 +280,40 @@ class KnowledgeMatchingService:
             findings = diagnosis.findings
             confidence = diagnosis.confidence
             
-            # دریافت تطابق‌های تمام سنت‌ها
-            avicenna = await self.match_avicenna_diseases(findings, confidence, db)
-            tcm = await self.match_tcm_patterns(findings, confidence, db)
-            ayurveda = await self.match_ayurveda_diseases(findings, confidence, db)
+            # ایندکس (در صورت تغییر پایگاه دانش از پایگاه داده بارگذاری می‌شود)
+            # A reload opens its own session: this thread may outlive the
+            # request if the budget runs out, and must not keep using db
+            index = await asyncio.wait_for(asyncio.to_thread(get_knowledge_index), remaining())
+            
+            # نتایج ذخیره‌شده برای همین یافته‌ها (یافته‌ها از واژگان کوچکی می‌آیند)
+            memo_key = None
+            match_confidence = confidence
+            bucket = confidence_bucket(confidence, settings.KNOWLEDGE_MATCH_CONFIDENCE_STEP)
+            if settings.KNOWLEDGE_MATCH_MEMO_TTL_SECONDS and bucket is not None:
+                match_confidence = bucket
+                memo_key = f"{KB_NAMESPACE}:matches:{cache_key(canonical_findings(findings), bucket, index.version)}"
+                results = await get_cache().aget(memo_key)
+                if results is not None:
+                    # Keys ignore findings that don't affect scores; these reflect this request's
+                    supporting = self._get_supporting_findings(findings, None)
+                    results = {
+                        tradition: [{**match, "supporting_findings": supporting} for match in matches]
+                        for tradition, matches in results.items()
+                    }
+            else:
+                results = None
             
-            return {
+            timed_out = []
+            if results is None:
+                results, timed_out = await self._match_all(findings, match_confidence, index, remaining())
+                if memo_key and not timed_out:
+                    await get_cache().aset(memo_key, results, settings.KNOWLEDGE_MATCH_MEMO_TTL_SECONDS)
+            
+            avicenna = results["avicenna"]
+            tcm = results["tcm"]
+            ayurveda = results["ayurveda"]
+            
+            response = {
                 "diagnosis_id": diagnosis_id,
                 "analysis_type": diagnosis.analysis_type,
                 "original_findings": findings,
@@ -282,7 +323,20 @@ class KnowledgeMatchingService:
                 "ayurveda_matches": ayurveda,
                 "total_matches": len(avicenna) + len(tcm) + len(ayurveda),
             }
+            if timed_out:
+                logger.warning(f"⚠ Matching for diagnosis {diagnosis_id} exceeded {budget}s: {', '.join(timed_out)}")
+                response["timed_out"] = timed_out
+            return response
             
+        except asyncio.TimeoutError:
+            logger.error(f"Knowledge index not ready within {budget}s for diagnosis {diagnosis_id}")
+            return {
+                "error": "Knowledge base unavailable",
+                "avicenna_matches": [],
+                "tcm_matches": [],
+                "ayurveda_matches": [],
+                "timed_out": ["avicenna", "tcm", "ayurveda"],
+            }
         except Exception as e:
             logger.error(f"Error getting all matches: {e}")
             return {
@@ -292,7 +346,107 @@ class KnowledgeMatchingService:
                 "ayurveda_matches": [],
             }
 
-    def _calculate_avicenna_score(self, findings: Dict, disease) -> float:
+    async def _match_all(
+        self,
+        findings: Dict,
+        confidence: float,
+        index: KnowledgeIndex,
+        timeout: Optional[float]
+    ) -> Tuple[Dict[str, List[Dict]], List[str]]:
+        """
+        تطابق هم‌زمان تمام سنت‌ها روی thread pool
+        
+        Returns:
+            ({tradition: matches}, traditions that didn't finish within timeout)
+        """
+        tasks = {
+            tradition: asyncio.create_task(asyncio.to_thread(
+                self._safe_match, tradition, match, findings, confidence, index
+            ))
+            for tradition, match in (
+                ("avicenna", self._match_avicenna),
+                ("tcm", self._match_tcm),
+                ("ayurveda", self._match_ayurveda),
+            )
+        }
+        _, pending = await asyncio.wait(tasks.values(), timeout=timeout)
+        
+        results = {}
+        timed_out = []
+        for tradition, task in tasks.items():
+            if task in pending:
+                # The thread runs to completion, but nobody waits for it
+                task.cancel()
+                timed_out.append(tradition)
+                results[tradition] = []
+            else:
+                results[tradition] = task.result()
+        return results, timed_out
+
+    def _safe_match(
+        self,
+        tradition: str,
+        match: Callable[[Dict, float, KnowledgeIndex], List[Dict]],
+        findings: Dict,
+        confidence: float,
+        index: KnowledgeIndex
+    ) -> List[Dict]:
+        """Run one tradition's matcher; errors give no matches, as in the async matchers"""
+        try:
+            return match(findings, confidence, index)
+        except Exception as e:
+            logger.error(f"Error matching {tradition}: {e}")
+            return []
+
+    def _top_matches(
+        self,
+        entries: Sequence[Any],
+        candidates: List[Tuple[int, float]],
+        score: Callable[[Any], float],
+        threshold: float,
+        confidence: float,
+        limit: int = 5
+    ) -> List[Tuple[Any, float]]:
+        """
+        بهترین تطابق‌ها از میان نامزدهای ماتریس ویژگی
+        
+        Candidates are rescored with the exact scoring rules, best first;
+        once `limit` matches are held and the next can't beat the weakest,
+        the rest are skipped. Ordered as the matchers always returned them:
+        by confidence, then knowledge-base order.
+        
+        Args:
+            entries: Index entries of one tradition
+            candidates: FeatureMatrix.candidates() output, [(position, score), ...]
+            score: Exact scoring function for an entry
+            threshold: Minimum score
+            confidence: Analysis confidence
+            limit: Matches to return
+            
+        Returns:
+            [(entry, score), ...]
+        """
+        # Min-heap whose root is the weakest match held:
+        # lowest confidence, then latest in knowledge-base order
+        top: List[Tuple[float, int, float]] = []
+        
+        for position, bound in candidates:
+            if len(top) == limit and round(min(bound + SCORE_EPSILON, 1.0) * confidence, 2) < top[0][0]:
+                break
+            
+            entry_score = score(entries[position])
+            if entry_score < threshold:
+                continue
+            
+            item = (round(entry_score * confidence, 2), -position, entry_score)
+            if len(top) < limit:
+                heapq.heappush(top, item)
+            else:
+                heapq.heappushpop(top, item)
+        
+        return [(entries[-position], entry_score) for _, position, entry_score in sorted(top, reverse=True)]
+
+    def _calculate_avicenna_score(self, findings: Dict, disease: AvicennaEntry) -> float:
         """
         محاسبه امتیاز تطابق برای بیماری Avicenna
         
@@ -300,26 +454,25 @@ class KnowledgeMatchingService:
         """
         try:
             score = 0.0
-            disease_characteristics = disease.characteristics or {}
             
             # بررسی Mizaj
             if findings.get("mizaj") == disease.mizaj:
-                score += 0.3
+                score += AVICENNA_WEIGHTS["mizaj"]
             
-            # بررسی رنگ زبان
-            if findings.get("color") and disease_characteristics.get("color"):
-                if findings["color"].lower() in str(disease_characteristics.get("color", "")).lower():
-                    score += 0.2
+            # بررسی رنگ زبان (ویژگی‌های ایندکس از قبل lowercase شده‌اند)
+            if findings.get("color") and disease.color:
+                if findings["color"].lower() in disease.color:
+                    score += AVICENNA_WEIGHTS["color"]
             
             # بررسی پوشش زبان
-            if findings.get("coating") and disease_characteristics.get("coating"):
-                if findings["coating"].lower() in str(disease_characteristics.get("coating", "")).lower():
-                    score += 0.2
+            if findings.get("coating") and disease.coating:
+                if findings["coating"].lower() in disease.coating:
+                    score += AVICENNA_WEIGHTS["coating"]
             
             # بررسی سایر مشخصات
-            if findings.get("moisture") and disease_characteristics.get("moisture"):
-                if findings["moisture"].lower() in str(disease_characteristics.get("moisture", "")).lower():
-                    score += 0.15
+            if findings.get("moisture") and disease.moisture:
+                if findings["moisture"].lower() in disease.moisture:
+                    score += AVICENNA_WEIGHTS["moisture"]
             
             # عادی‌سازی امتیاز (0-1)
             return min(score, 1.0)
@@ -328,30 +481,30 @@ class KnowledgeMatchingService:
             logger.error(f"Error calculating Avicenna score: {e}")
             return 0.0
 
-    def _calculate_tcm_score(self, findings: Dict, pattern) -> float:
+    def _calculate_tcm_score(self, findings: Dict, pattern: TCMEntry) -> float:
         """محاسبه امتیاز برای الگوی TCM"""
         try:
             score = 0.0
             
             # بررسی رنگ
             if findings.get("color") and pattern.tongue_appearance:
-                if findings["color"].lower() in str(pattern.tongue_appearance).lower():
-                    score += 0.3
+                if findings["color"].lower() in pattern.tongue_appearance:
+                    score += TCM_WEIGHTS["color"]
             
             # بررسی پوشش
             if findings.get("coating") and pattern.coating:
-                if findings["coating"].lower() in str(pattern.coating).lower():
-                    score += 0.3
+                if findings["coating"].lower() in pattern.coating:
+                    score += TCM_WEIGHTS["coating"]
             
             # بررسی رطوبت
             if findings.get("moisture") and pattern.moisture:
-                if findings["moisture"].lower() in str(pattern.moisture).lower():
-                    score += 0.2
+                if findings["moisture"].lower() in pattern.moisture:
+                    score += TCM_WEIGHTS["moisture"]
             
             # بررسی شکل
             if findings.get("shape") and pattern.shape:
-                if findings["shape"].lower() in str(pattern.shape).lower():
-                    score += 0.2
+                if findings["shape"].lower() in pattern.shape:
+                    score += TCM_WEIGHTS["shape"]
             
             return min(score, 1.0)
             
@@ -359,30 +512,29 @@ class KnowledgeMatchingService:
             logger.error(f"Error calculating TCM score: {e}")
             return 0.0
 
-    def _calculate_ayurveda_score(self, findings: Dict, disease) -> float:
+    def _calculate_ayurveda_score(self, findings: Dict, disease: AyurvedaEntry) -> float:
         """محاسبه امتیاز برای بیماری Ayurveda"""
         try:
             score = 0.0
             
             # بررسی Dosha
-            if findings.get("dosha") and disease.dosha:
-                if findings.get("dosha") in str(disease.dosha).lower():
-                    score += 0.3
+            if findings.get("dosha") and disease.dosha_text:
+                if findings.get("dosha") in disease.dosha_text:
+                    score += AYURVEDA_WEIGHTS["dosha"]
             
             # بررسی رنگ
             if findings.get("color") and disease.tongue_signs:
-                if findings["color"].lower() in str(disease.tongue_signs).lower():
-                    score += 0.25
+                if findings["color"].lower() in disease.tongue_signs:
+                    score += AYURVEDA_WEIGHTS["color"]
             
             # بررسی سایر علائم
             if findings.get("coating") and disease.tongue_signs:
-                if findings["coating"].lower() in str(disease.tongue_signs).lower():
-                    score += 0.25
+                if findings["coating"].lower() in disease.tongue_signs:
+                    score += AYURVEDA_WEIGHTS["coating"]
             
             # بررسی شرایط پوسی‌دگی
-            if findings.get("moisture") and disease.digestion_status:
-                if "normal" in str(disease.digestion_status).lower():
-                    score += 0.2
+            if findings.get("moisture") and disease.normal_digestion:
+                score += AYURVEDA_WEIGHTS["moisture"]
             
             return min(score, 1.0)
             
@@ -0,0 +1,256 @@
+"""
+WebSocket Handshake Authorization
+Short-TTL cache of (user_id, diagnosis_id) -> allowed for /ws/{diagnosis_id}
+
+Reconnect storms (e.g. after a deploy) would otherwise run the same
+ownership queries thousands of times inside the event loop. Decisions
+are loaded with one joined query in a worker thread, concurrent misses
+for the same key share that load, and entries are dropped once a change
+to a diagnosis or patient row commits.
+
+Invalidation only reaches the worker that committed the change; other
+workers keep their decisions until WS_AUTH_CACHE_TTL_SECONDS (30s by
+default) runs out, so keep that TTL short.
+"""
+
+import asyncio
+import logging
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, NamedTuple, Optional, Set, Tuple
+
+from sqlalchemy import event
+from sqlalchemy.orm import Session, object_session
+
+from app.core.config import settings
+from app.database import SessionLocal
+from app.models.patient_and_health_data import Patient, DiagnosticFinding
+
+logger = logging.getLogger(__name__)
+
+# (user_id or None for unauthenticated connects, diagnosis_id)
+AuthKey = Tuple[Optional[int], int]
+
+
+class HandshakeDecision(NamedTuple):
+    """Outcome of a handshake authorization check"""
+    allowed: bool
+    user_id: Optional[int]  # Connecting user (diagnosis owner when no token)
+    reason: Optional[str] = None  # "Diagnosis not found" / "Access denied"
+
+
+class HandshakeAuthCache:
+    """
+    Bounded LRU cache of handshake decisions with a TTL
+
+    Negative decisions are cached too, so storms against a missing or
+    foreign diagnosis are absorbed as well. Commits in threadpool threads
+    invalidate entries while the event loop reads them, so every access
+    to the entries and indexes holds `lock`.
+    """
+
+    def __init__(self, ttl_seconds: float = 30, max_entries: int = 10000):
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        # key -> (decision, expires_at)
+        self.entries: "OrderedDict[AuthKey, Tuple[HandshakeDecision, float]]" = OrderedDict()
+        # diagnosis_id / user_id -> keys, for invalidation
+        self.by_diagnosis: Dict[int, Set[AuthKey]] = {}
+        self.by_user: Dict[int, Set[AuthKey]] = {}
+        # In-flight loads shared by concurrent misses
+        self.pending: Dict[AuthKey, asyncio.Future] = {}
+        self.lock = threading.Lock()
+        # Bumped on invalidation so loads started earlier aren't stored
+        self.generation = 0
+        # Stats
+        self.hits = 0
+        self.misses = 0
+        self.loads = 0
+        self.invalidations = 0
+
+    async def authorize(self, user_id: Optional[int], diagnosis_id: int) -> HandshakeDecision:
+        """
+        Decide whether user_id may connect to diagnosis_id
+
+        Args:
+            user_id: Authenticated user ID, or None for a connect without token
+            diagnosis_id: The diagnosis ID
+
+        Returns:
+            HandshakeDecision
+        """
+        key = (user_id, diagnosis_id)
+
+        with self.lock:
+            cached = self.entries.get(key)
+            if cached and cached[1] > time.monotonic():
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return cached[0]
+
+        self.misses += 1
+
+        pending = self.pending.get(key)
+        if pending:
+            return await asyncio.shield(pending)
+
+        future = asyncio.get_running_loop().create_future()
+        self.pending[key] = future
+        generation = self.generation
+
+        try:
+            self.loads += 1
+            decision = await asyncio.to_thread(_load_decision, user_id, diagnosis_id)
+            with self.lock:
+                if generation == self.generation:
+                    self._store(key, decision)
+            future.set_result(decision)
+            return decision
+        except Exception as e:
+            future.set_exception(e)
+            future.exception()  # Mark retrieved when nobody else was waiting
+            raise
+        finally:
+            del self.pending[key]
+
+    def _store(self, key: AuthKey, decision: HandshakeDecision) -> None:
+        """Add a decision (caller holds the lock)"""
+        self.entries[key] = (decision, time.monotonic() + self.ttl_seconds)
+        self.entries.move_to_end(key)
+        self.by_diagnosis.setdefault(key[1], set()).add(key)
+        if key[0] is not None:
+            self.by_user.setdefault(key[0], set()).add(key)
+
+        while len(self.entries) > self.max_entries:
+            self._discard(next(iter(self.entries)))
+
+    def _discard(self, key: AuthKey) -> None:
+        """Remove a decision (caller holds the lock)"""
+        self.entries.pop(key, None)
+        for index, ident in ((self.by_diagnosis, key[1]), (self.by_user, key[0])):
+            keys = index.get(ident)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del index[ident]
+
+    def invalidate_diagnosis(self, diagnosis_id: int) -> None:
+        """Drop decisions for a diagnosis (created, deleted or re-owned)"""
+        with self.lock:
+            self.generation += 1
+            self.invalidations += 1
+            for key in list(self.by_diagnosis.get(diagnosis_id, ())):
+                self._discard(key)
+
+    def invalidate_user(self, user_id: int) -> None:
+        """Drop decisions for a user (patient deleted or changed)"""
+        with self.lock:
+            self.generation += 1
+            self.invalidations += 1
+            for key in list(self.by_user.get(user_id, ())):
+                self._discard(key)
+
+    def clear(self) -> None:
+        """Drop every decision"""
+        with self.lock:
+            self.generation += 1
+            self.entries.clear()
+            self.by_diagnosis.clear()
+            self.by_user.clear()
+
+    def get_stats(self) -> Dict[str, Any]:
+        """Get cache size and hit rate"""
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self.entries),
+            "ttl_seconds": self.ttl_seconds,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 3) if lookups else 0.0,
+            "db_loads": self.loads,
+            "invalidations": self.invalidations,
+        }
+
+
+def _load_decision(user_id: Optional[int], diagnosis_id: int) -> HandshakeDecision:
+    """
+    Load a decision with one joined query (runs in a worker thread)
+
+    The join on Patient also confirms the owning patient still exists.
+    """
+    db = SessionLocal()
+    try:
+        row = db.query(DiagnosticFinding.patient_id).join(
+            Patient, Patient.id == DiagnosticFinding.patient_id
+        ).filter(
+            DiagnosticFinding.id == diagnosis_id
+        ).first()
+    finally:
+        db.close()
+
+    if row is None:
+        return HandshakeDecision(False, user_id, "Diagnosis not found")
+
+    owner_id = row.patient_id
+    if user_id is None:
+        return HandshakeDecision(True, owner_id)
+    if owner_id != user_id:
+        return HandshakeDecision(False, user_id, "Access denied")
+    return HandshakeDecision(True, user_id)
+
+
+# Global handshake cache instance
+handshake_cache: Optional[HandshakeAuthCache] = None
+
+
+def get_handshake_cache() -> HandshakeAuthCache:
+    """Get or create global handshake authorization cache"""
+    global handshake_cache
+    if handshake_cache is None:
+        handshake_cache = HandshakeAuthCache(
+            ttl_seconds=settings.WS_AUTH_CACHE_TTL_SECONDS,
+            max_entries=settings.WS_AUTH_CACHE_MAX_ENTRIES
+        )
+    return handshake_cache
+
+
+# Invalidate on ownership changes, whichever code path makes them. Mapper
+# events fire at flush, before the change is visible to other sessions, so
+# they only note what changed; the cache is invalidated after commit.
+_PENDING_KEY = "ws_auth_invalidations"
+
+
+def _note_change(target, kind: str) -> None:
+    session = object_session(target)
+    if handshake_cache is not None and session is not None and target.id is not None:
+        session.info.setdefault(_PENDING_KEY, set()).add((kind, target.id))
+
+
+@event.listens_for(DiagnosticFinding, "after_insert")
+@event.listens_for(DiagnosticFinding, "after_update")
+@event.listens_for(DiagnosticFinding, "after_delete")
+def _diagnosis_changed(mapper, connection, target) -> None:
+    _note_change(target, "diagnosis")
+
+
+@event.listens_for(Patient, "after_delete")
+def _patient_deleted(mapper, connection, target) -> None:
+    _note_change(target, "user")
+
+
+@event.listens_for(Session, "after_commit")
+def _apply_invalidations(session) -> None:
+    changes = session.info.pop(_PENDING_KEY, None)
+    if not changes or handshake_cache is None:
+        return
+    for kind, ident in changes:
+        if kind == "diagnosis":
+            handshake_cache.invalidate_diagnosis(ident)
+        else:
+            handshake_cache.invalidate_user(ident)
+
+
+@event.listens_for(Session, "after_rollback")
+def _discard_invalidations(session) -> None:
+    session.info.pop(_PENDING_KEY, None)
@@ -0,0 +1,317 @@
+"""
+WebSocket Backplane Service
+Fans broadcasts out across uvicorn workers over Redis pub/sub
+
+Every worker subscribes to the same channel and delivers incoming
+messages to its own local sockets. Broadcasts are published once and
+reach every worker, including the one that published them, so all
+workers see messages in the same (Redis) order.
+"""
+
+import asyncio
+import json
+import logging
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+from app.core.cache import get_cache
+from app.core.config import settings
+from app.services.websocket_manager import WebSocketMessage, get_connection_manager
+
+logger = logging.getLogger(__name__)
+
+# Local delivery callback: (diagnosis_id, message, record=...) -> None
+DeliveryHandler = Callable[..., Awaitable[None]]
+
+# Assigns the sequence number and publishes in one atomic step, so the
+# order Redis fans messages out in always matches their seq order.
+# Frames are "<seq> <envelope>" since the seq is only known inside Redis.
+PUBLISH_SCRIPT = """
+local seq = redis.call('INCR', KEYS[1])
+redis.call('PUBLISH', KEYS[2], seq .. ' ' .. ARGV[1])
+return seq
+"""
+
+
+class Backplane:
+    """Base class for cross-process broadcast transports"""
+
+    def __init__(self):
+        self.handlers: List[DeliveryHandler] = []
+        self.running = False
+        self.published_count = 0
+        self.delivered_count = 0
+
+    def subscribe(self, handler: DeliveryHandler) -> None:
+        """Register a local delivery handler (usually ConnectionManager.broadcast)"""
+        self.handlers.append(handler)
+
+    async def start(self) -> None:
+        """Start receiving messages from other workers"""
+        self.running = True
+
+    async def stop(self) -> None:
+        """Stop receiving messages"""
+        self.running = False
+
+    async def publish(self, diagnosis_id: int, message: WebSocketMessage) -> None:
+        """
+        Publish message to every worker
+
+        Args:
+            diagnosis_id: The diagnosis ID
+            message: The message to broadcast
+        """
+        raise NotImplementedError
+
+    async def _dispatch(
+        self, diagnosis_id: int, message: WebSocketMessage, record: bool = True
+    ) -> None:
+        """
+        Deliver a message to this worker's local sockets
+
+        Args:
+            diagnosis_id: The diagnosis ID
+            message: The message to deliver
+            record: False when the message has no shared sequence number
+                and must not enter the replay buffer
+        """
+        for handler in self.handlers:
+            try:
+                await handler(diagnosis_id, message, record=record)
+            except Exception as e:
+                logger.error(f"❌ Backplane delivery error: {str(e)}")
+        self.delivered_count += 1
+
+    def get_stats(self) -> Dict[str, Any]:
+        """Get backplane statistics"""
+        return {
+            "type": self.__class__.__name__,
+            "running": self.running,
+            "published": self.published_count,
+            "delivered": self.delivered_count,
+        }
+
+
+class InMemoryHub:
+    """Shared registry standing in for a Redis channel inside one process"""
+
+    def __init__(self):
+        self.members: List["InMemoryBackplane"] = []
+
+
+class InMemoryBackplane(Backplane):
+    """
+    In-process backplane for single-worker deployments and tests
+
+    Backplanes sharing the same hub behave like workers subscribed to
+    the same Redis channel.
+    """
+
+    def __init__(self, hub: Optional[InMemoryHub] = None):
+        super().__init__()
+        self.hub = hub or InMemoryHub()
+        self.hub.members.append(self)
+        self.running = True
+
+    async def publish(self, diagnosis_id: int, message: WebSocketMessage) -> None:
+        self.published_count += 1
+        for member in list(self.hub.members):
+            if member.running:
+                await member._dispatch(diagnosis_id, message)
+
+
+class RedisBackplane(Backplane):
+    """
+    Redis pub/sub backplane for multi-worker deployments
+
+    Each publish runs PUBLISH_SCRIPT, which increments a per-diagnosis
+    Redis counter and publishes in one step, so sequence numbers agree
+    across workers and every worker receives them in order. A single
+    listener task delivers them in the order Redis fans them out, and a
+    client can resume with ?since= on any worker.
+
+    Publishes and the subscription go through the cache's redis.asyncio
+    pool when both point at the same Redis, instead of a second pool.
+    """
+
+    def __init__(
+        self,
+        url: Optional[str] = None,
+        channel: Optional[str] = None,
+        reconnect_min_seconds: float = 0.5,
+        reconnect_max_seconds: float = 30.0,
+    ):
+        super().__init__()
+        self.url = url or settings.REDIS_URL
+        self.channel = channel or settings.WS_BACKPLANE_CHANNEL
+        self.reconnect_min_seconds = reconnect_min_seconds
+        self.reconnect_max_seconds = reconnect_max_seconds
+        self.client = None
+        self.pubsub = None
+        self.listener_task: Optional[asyncio.Task] = None
+        self.reconnect_count = 0
+
+    async def start(self) -> None:
+        """
+        Subscribe to the channel and start the listener task
+
+        Never raises: if Redis is unreachable the worker stays in
+        local-dispatch mode and the listener keeps retrying in the
+        background.
+        """
+        if self.listener_task:
+            return
+
+        try:
+            self.client = self._async_client()
+            await self._subscribe()
+        except Exception as e:
+            logger.error(
+                f"❌ WebSocket backplane could not reach Redis, delivering locally until it does: {e}"
+            )
+        self.listener_task = asyncio.create_task(self._listen())
+
+    async def _subscribe(self) -> None:
+        """Open a fresh pub/sub connection and subscribe to the channel"""
+        pubsub = self.client.pubsub()
+        await pubsub.subscribe(self.channel)
+        self.pubsub = pubsub
+        self.running = True
+        logger.info(f"✅ WebSocket backplane subscribed to Redis channel '{self.channel}'")
+
+    async def _drop_subscription(self) -> None:
+        """Mark the subscription lost and close it quietly"""
+        self.running = False
+        pubsub, self.pubsub = self.pubsub, None
+        if pubsub is not None:
+            try:
+                await pubsub.close()
+            except Exception:
+                pass
+
+    def _async_client(self):
+        """Share the cache's async pool, or open one for a different Redis"""
+        cache = get_cache()
+        if cache.url == self.url and cache.backend == "redis":
+            client = cache.get_async_client()
+            if client is not None:
+                return client
+
+        import redis.asyncio as aioredis
+        return aioredis.from_url(self.url)
+
+    async def stop(self) -> None:
+        self.running = False
+
+        if self.listener_task:
+            self.listener_task.cancel()
+            try:
+                await self.listener_task
+            except (asyncio.CancelledError, Exception):
+                pass
+            self.listener_task = None
+
+        if self.pubsub:
+            try:
+                await self.pubsub.unsubscribe(self.channel)
+                await self.pubsub.close()
+            except Exception as e:
+                logger.warning(f"⚠ Error closing backplane subscription: {e}")
+            self.pubsub = None
+
+    async def publish(self, diagnosis_id: int, message: WebSocketMessage) -> None:
+        if self.listener_task is None:
+            # Not started (e.g. startup or tests): deliver locally only
+            await self._dispatch(diagnosis_id, message)
+            return
+
+        envelope = json.dumps({
+            "diagnosis_id": diagnosis_id,
+            "message": json.loads(message.json(exclude={"seq"}, exclude_none=True)),
+        })
+        try:
+            message.seq = await self.client.eval(
+                PUBLISH_SCRIPT, 2, f"{self.channel}:seq:{diagnosis_id}", self.channel, envelope
+            )
+            self.published_count += 1
+        except Exception as e:
+            # The seq is unknown, so deliver live but keep it out of replay
+            # rather than invent a local number another worker may reuse
+            logger.error(f"❌ Backplane publish failed, delivering locally: {e}")
+            await self._dispatch(diagnosis_id, message, record=False)
+            return
+
+        if not self.running:
+            # Published, but our own subscription is down and will not echo it
+            await self._dispatch(diagnosis_id, message)
+
+    def get_stats(self) -> Dict[str, Any]:
+        stats = super().get_stats()
+        stats["reconnects"] = self.reconnect_count
+        return stats
+
+    async def _listen(self) -> None:
+        """
+        Deliver messages from the channel to local sockets, in order
+
+        Resubscribes with exponential backoff whenever the connection
+        drops; while disconnected, publish() falls back to local delivery.
+        """
+        delay = self.reconnect_min_seconds
+        while True:
+            if self.pubsub is None:
+                try:
+                    if self.client is None:
+                        self.client = self._async_client()
+                    await self._subscribe()
+                    self.reconnect_count += 1
+                except Exception as e:
+                    logger.warning(f"⚠ Backplane resubscribe failed, retrying in {delay:.1f}s: {e}")
+                    await asyncio.sleep(delay)
+                    delay = min(delay * 2, self.reconnect_max_seconds)
+                    continue
+
+            try:
+                async for item in self.pubsub.listen():
+                    delay = self.reconnect_min_seconds
+                    if item.get("type") != "message":
+                        continue
+
+                    try:
+                        data = item["data"]
+                        if isinstance(data, bytes):
+                            data = data.decode()
+                        seq, _, body = data.partition(" ")
+                        envelope = json.loads(body)
+                        message = WebSocketMessage(**envelope["message"], seq=int(seq))
+                    except Exception as e:
+                        logger.error(f"❌ Invalid backplane message: {e}")
+                        continue
+
+                    await self._dispatch(envelope["diagnosis_id"], message)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"❌ Backplane subscription lost, reconnecting in {delay:.1f}s: {e}")
+            else:
+                logger.warning(f"⚠ Backplane subscription ended, reconnecting in {delay:.1f}s")
+
+            await self._drop_subscription()
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, self.reconnect_max_seconds)
+
+
+# Global backplane instance
+backplane: Optional[Backplane] = None
+
+
+def get_backplane() -> Backplane:
+    """Get or create global backplane bound to the local connection manager"""
+    global backplane
+    if backplane is None:
+        if settings.WS_BACKPLANE == "redis":
+            backplane = RedisBackplane(settings.REDIS_URL, settings.WS_BACKPLANE_CHANNEL)
+        else:
+            backplane = InMemoryBackplane()
+        backplane.subscribe(get_connection_manager().broadcast)
+    return backplane
@@ -6,10 +6,16 @@ Handles real-time connections, message broadcasting, and state management
 import asyncio
 import json
 import logging
+import os
+import time
+from collections import Counter, deque
 from datetime import datetime
-from typing import Dict, Set, Optional, List, Any
-from fastapi import WebSocket
+from enum import Enum
+from typing import Dict, Set, Optional, List, Any, Deque, Callable, Awaitable, Tuple
+from fastapi import WebSocket, status
 from pydantic import BaseModel
+from app.core.config import settings
+from app.services.websocket_protocol import Codec, LEGACY_CODEC
 
 logger = logging.getLogger(__name__)
 
@@ -17,9 +23,10 @@ logger = logging.getLogger(__name__)
 class WebSocketMessage(BaseModel):
     """WebSocket message model"""
     type: str  # connect, disconnect, recommendation_update, effectiveness_update, etc.
-    diagnosis_id: int
+    diagnosis_id: Optional[int] = None  # None for connection-level messages on /ws/multiplex
     timestamp: datetime = None
     data: Dict[str, Any] = None
+    seq: Optional[int] = None  # Per-diagnosis sequence number (set for broadcasts)
     
     def __init__(self, **data):
         if 'timestamp' not in data or data['timestamp'] is None:
@@ -27,25 +34,327 @@ class WebSocketMessage(BaseModel):
         super().__init__(**data)
 
 
+# Topic kinds a multiplexed connection can subscribe to ("<kind>:<id>")
+TOPIC_KINDS = ("diagnosis", "recommendation", "patient")
+
+
+def parse_topic(topic: str) -> Optional[Tuple[str, int]]:
+    """
+    Split a topic like "diagnosis:42" into ("diagnosis", 42)
+    
+    Returns:
+        (kind, id) or None if the topic is malformed
+    """
+    kind, _, ident = topic.partition(":")
+    if kind not in TOPIC_KINDS or not ident.isdigit():
+        return None
+    return kind, int(ident)
+
+
+class OverflowPolicy(str, Enum):
+    """What to do when a client's outbound queue is full"""
+    DROP_OLDEST = "drop_oldest"  # Discard the oldest pending message
+    COALESCE = "coalesce"        # Replace the pending message of the same type
+    DISCONNECT = "disconnect"    # Evict the slow consumer
+
+
+class ReplayBuffer:
+    """
+    Bounded, sequence-numbered log of recent broadcasts for one diagnosis
+    
+    Reconnecting clients pass the last sequence number they saw and
+    receive exactly the messages after it that are still retained.
+    """
+    
+    def __init__(self, max_size: int = 100):
+        # (seq, payload) pairs, oldest first; deque drops the oldest in O(1)
+        self.entries: Deque[Tuple[int, Dict[str, Any]]] = deque(maxlen=max_size)
+        self.last_seq = 0
+        self.last_activity = time.monotonic()
+    
+    def append(self, message: WebSocketMessage) -> Dict[str, Any]:
+        """
+        Stamp message with the next sequence number and record it
+        
+        Messages that already carry a sequence number (assigned by the
+        backplane) keep it. One that arrives late, at most a buffer's
+        length behind the newest, is slotted into place (or skipped if
+        already held). A larger backwards jump means the upstream counter
+        was reset, so older entries are discarded.
+        
+        Returns:
+            The serialized payload
+        """
+        self.last_activity = time.monotonic()
+        
+        if message.seq is None:
+            message.seq = self.last_seq + 1
+        elif message.seq <= self.last_seq:
+            if self.last_seq - message.seq < self.entries.maxlen:
+                return self._insert_late(message)
+            self.entries.clear()
+        
+        payload = message.dict()
+        self.entries.append((message.seq, payload))
+        self.last_seq = message.seq
+        return payload
+    
+    def _insert_late(self, message: WebSocketMessage) -> Dict[str, Any]:
+        """Slot an out-of-order message into the log by sequence number"""
+        payload = message.dict()
+        
+        # Late messages are near the newest end, so scan from the right
+        index = len(self.entries)
+        while index and self.entries[index - 1][0] > message.seq:
+            index -= 1
+        if index and self.entries[index - 1][0] == message.seq:
+            return payload
+        
+        if len(self.entries) == self.entries.maxlen:
+            if index == 0:
+                return payload
+            self.entries.popleft()
+            index -= 1
+        self.entries.insert(index, (message.seq, payload))
+        return payload
+    
+    @property
+    def first_seq(self) -> int:
+        """Oldest retained sequence number (last_seq + 1 when empty)"""
+        return self.entries[0][0] if self.entries else self.last_seq + 1
+    
+    def since(self, seq: int) -> Tuple[bool, List[Dict[str, Any]]]:
+        """
+        Get messages published after seq
+        
+        Args:
+            seq: Last sequence number the client received
+            
+        Returns:
+            (gap, payloads) where gap is True if some messages after seq
+            are no longer retained and the client must resync
+        """
+        self.last_activity = time.monotonic()
+        gap = seq < self.first_seq - 1 or seq > self.last_seq
+        
+        missed = []
+        for entry_seq, payload in reversed(self.entries):
+            if entry_seq <= seq:
+                break
+            missed.append(payload)
+        missed.reverse()
+        
+        return gap, missed
+    
+    def __len__(self) -> int:
+        return len(self.entries)
+
+
+class ClientConnection:
+    """
+    A single WebSocket client with its own bounded outbound queue
+    
+    Messages are drained by a dedicated writer task, so a slow or stuck
+    client only fills its own queue instead of blocking broadcasts.
+    """
+    
+    def __init__(
+        self,
+        websocket: WebSocket,
+        diagnosis_id: Optional[int],
+        user_id: int,
+        max_queue_size: int = 256,
+        overflow_policy: OverflowPolicy = OverflowPolicy.DROP_OLDEST,
+        codec: Optional[Codec] = None
+    ):
+        self.websocket = websocket
+        self.codec = codec or LEGACY_CODEC
+        # None for multiplexed connections, which use topics instead
+        self.diagnosis_id = diagnosis_id
+        self.topics: Set[str] = set()
+        self.user_id = user_id
+        self.max_queue_size = max_queue_size
+        self.overflow_policy = OverflowPolicy(overflow_policy)
+        self.connected_at = datetime.utcnow()
+        self.closed = False
+        # Pending (payload, encoded frame) pairs; frame is None until encoded
+        self.queue: Deque[Tuple[Dict[str, Any], Any]] = deque()
+        self.writer_task: Optional[asyncio.Task] = None
+        self._ready = asyncio.Event()
+        self._idle = asyncio.Event()
+        self._idle.set()
+        # Counters
+        self.sent_count = 0
+        self.dropped_count = 0
+        self.coalesced_count = 0
+        self.max_queue_depth = 0
+        self.last_ack_seq: Optional[int] = None
+        # Liveness: last inbound frame, and whether a server ping is unanswered
+        self.last_seen = time.monotonic()
+        self.ping_pending = False
+    
+    def touch(self) -> None:
+        """Record inbound activity from the client"""
+        self.last_seen = time.monotonic()
+        self.ping_pending = False
+    
+    def start(self, on_error: Callable[["ClientConnection"], Awaitable[None]]) -> None:
+        """Start the writer task draining this client's queue"""
+        self.writer_task = asyncio.create_task(self._writer(on_error))
+    
+    def enqueue(self, payload: Dict[str, Any], frame: Any = None) -> bool:
+        """
+        Add payload to the outbound queue, applying the overflow policy
+        
+        Args:
+            payload: Serialized message to send
+            frame: Payload already encoded with this client's codec (optional)
+            
+        Returns:
+            False if the client is closed or must be evicted, True otherwise
+        """
+        if self.closed:
+            return False
+        
+        if len(self.queue) >= self.max_queue_size:
+            if self.overflow_policy == OverflowPolicy.DISCONNECT:
+                self.dropped_count += 1
+                return False
+            
+            if self.overflow_policy == OverflowPolicy.COALESCE and self._coalesce(payload, frame):
+                return True
+            
+            self.queue.popleft()  # Remove oldest
+            self.dropped_count += 1
+        
+        self.queue.append((payload, frame))
+        self.max_queue_depth = max(self.max_queue_depth, len(self.queue))
+        self._idle.clear()
+        self._ready.set()
+        return True
+    
+    def _coalesce(self, payload: Dict[str, Any], frame: Any) -> bool:
+        """Replace the newest pending message of the same type with payload"""
+        message_type = payload.get("type")
+        
+        for index in range(len(self.queue) - 1, -1, -1):
+            if self.queue[index][0].get("type") == message_type:
+                del self.queue[index]
+                self.queue.append((payload, frame))
+                self.coalesced_count += 1
+                return True
+        
+        return False
+    
+    async def _writer(self, on_error: Callable[["ClientConnection"], Awaitable[None]]) -> None:
+        """Send queued payloads one at a time until the client closes"""
+        try:
+            while not self.closed:
+                if not self.queue:
+                    self._idle.set()
+                    self._ready.clear()
+                    await self._ready.wait()
+                    continue
+                
+                payload, frame = self.queue.popleft()
+                if frame is None:
+                    frame = self.codec.encode(payload)
+                await self.codec.send(self.websocket, frame)
+                self.sent_count += 1
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"❌ Error sending message: {str(e)}")
+            self._idle.set()
+            await on_error(self)
+    
+    async def wait_idle(self) -> None:
+        """Wait until every queued message has been sent"""
+        await self._idle.wait()
+    
+    def close(self) -> None:
+        """Stop the writer task and discard pending messages"""
+        self.closed = True
+        self.queue.clear()
+        self._idle.set()
+        self._ready.set()
+        
+        if self.writer_task and self.writer_task is not asyncio.current_task():
+            self.writer_task.cancel()
+    
+    def get_stats(self) -> Dict[str, Any]:
+        """Get queue depth and drop counters for this client"""
+        return {
+            "user_id": self.user_id,
+            "connected_at": self.connected_at.isoformat(),
+            "queue_depth": len(self.queue),
+            "max_queue_depth": self.max_queue_depth,
+            "sent": self.sent_count,
+            "dropped": self.dropped_count,
+            "coalesced": self.coalesced_count,
+            "last_ack_seq": self.last_ack_seq,
+            "protocol": self.codec.subprotocol or "legacy",
+            "topics": len(self.topics),
+            "idle_seconds": round(time.monotonic() - self.last_seen, 1),
+        }
+
+
 class ConnectionManager:
     """
     Manages WebSocket connections per diagnosis
     Broadcasts messages to all connected clients for a diagnosis
+    
+    Each connection gets a bounded outbound queue drained by its own
+    writer task; the overflow policy decides what happens to slow consumers.
     """
     
-    def __init__(self):
+    def __init__(
+        self,
+        send_queue_size: int = 256,
+        overflow_policy: OverflowPolicy = OverflowPolicy.DROP_OLDEST,
+        close_timeout: float = 5.0,
+        replay_buffer_size: int = 100,
+        replay_ttl_seconds: float = 3600,
+        max_topics_per_connection: int = 200,
+        heartbeat_interval: float = 30,
+        idle_timeout: float = 90,
+        sweep_interval: float = 15
+    ):
         # diagnosis_id -> Set of WebSocket connections
         self.active_connections: Dict[int, Set[WebSocket]] = {}
         # diagnosis_id -> user_id (for tracking)
         self.connection_users: Dict[int, Dict[WebSocket, int]] = {}
+        # WebSocket -> per-client send queue and writer
+        self.clients: Dict[WebSocket, ClientConnection] = {}
+        # topic -> WebSockets subscribed through the multiplexed endpoint
+        self.topic_subscribers: Dict[str, Set[WebSocket]] = {}
+        self.max_topics_per_connection = max_topics_per_connection
         # Locks for thread-safe operations
         self.locks: Dict[int, asyncio.Lock] = {}
-        # Message queue for offline clients
-        self.message_queue: Dict[int, List[WebSocketMessage]] = {}
-        # Max messages per queue
-        self.max_queue_size = 100
+        # diagnosis_id -> recent broadcasts for resuming clients
+        self.replay_buffers: Dict[int, ReplayBuffer] = {}
+        # Max messages retained per diagnosis
+        self.max_queue_size = replay_buffer_size
+        # Idle replay buffers are expired after this many seconds
+        self.replay_ttl_seconds = replay_ttl_seconds
+        self._last_replay_expiry = time.monotonic()
+        # Per-connection outbound queue settings
+        self.send_queue_size = send_queue_size
+        self.overflow_policy = OverflowPolicy(overflow_policy)
+        self.close_timeout = close_timeout
+        # Slow consumers evicted under the disconnect policy
+        self.evicted_count = 0
+        # Background sweeper: pings quiet clients, evicts dead ones, reclaims maps
+        self.heartbeat_interval = heartbeat_interval
+        self.idle_timeout = idle_timeout
+        self.sweep_interval = sweep_interval
+        self.sweeper_task: Optional[asyncio.Task] = None
+        self.sweep_stats = Counter()
         
-        logger.info("✅ WebSocket ConnectionManager initialized")
+        logger.info(
+            f"✅ WebSocket ConnectionManager initialized "
+            f"(send_queue_size={send_queue_size}, overflow_policy={self.overflow_policy.value})"
+        )
     
     async def _get_lock(self, diagnosis_id: int) -> asyncio.Lock:
         """Get or create lock for diagnosis_id"""
@@ -57,7 +366,9 @@ class ConnectionManager:
         self,
         diagnosis_id: int,
         user_id: int,
-        websocket: WebSocket
+        websocket: WebSocket,
+        since: Optional[int] = None,
+        codec: Optional[Codec] = None
     ) -> None:
         """
         Add new WebSocket connection
@@ -66,16 +377,32 @@ class ConnectionManager:
             diagnosis_id: The diagnosis ID to connect to
             user_id: The user ID (for tracking)
             websocket: The WebSocket connection
+            since: Last sequence number the client saw; messages after
+                it are replayed (None for a fresh connection)
+            codec: Frame codec negotiated for this connection (legacy JSON if None)
         """
-        await websocket.accept()
+        if codec and codec.subprotocol:
+            await websocket.accept(subprotocol=codec.subprotocol)
+        else:
+            await websocket.accept()
         
         lock = await self._get_lock(diagnosis_id)
         async with lock:
             if diagnosis_id not in self.active_connections:
                 self.active_connections[diagnosis_id] = set()
                 self.connection_users[diagnosis_id] = {}
-                self.message_queue[diagnosis_id] = []
             
+            client = ClientConnection(
+                websocket,
+                diagnosis_id,
+                user_id,
+                max_queue_size=self.send_queue_size,
+                overflow_policy=self.overflow_policy,
+                codec=codec
+            )
+            client.start(self._on_send_error)
+            
+            self.clients[websocket] = client
             self.active_connections[diagnosis_id].add(websocket)
             self.connection_users[diagnosis_id][websocket] = user_id
             
@@ -84,17 +411,128 @@ class ConnectionManager:
                 f"user_id={user_id}, total_connections={len(self.active_connections[diagnosis_id])}"
             )
             
-            # Send queued messages to new client
-            await self._send_queued_messages(diagnosis_id, websocket)
+            # Replay missed messages to resuming client
+            if since is not None:
+                await self._replay(diagnosis_id, client, since)
     
-    async def disconnect(self, diagnosis_id: int, websocket: WebSocket) -> None:
+    async def connect_multiplex(
+        self,
+        user_id: int,
+        websocket: WebSocket,
+        codec: Optional[Codec] = None
+    ) -> None:
+        """
+        Add a multiplexed connection that receives messages by topic
+        
+        Args:
+            user_id: The authenticated user ID
+            websocket: The WebSocket connection
+            codec: Frame codec negotiated for this connection (legacy JSON if None)
+        """
+        if codec and codec.subprotocol:
+            await websocket.accept(subprotocol=codec.subprotocol)
+        else:
+            await websocket.accept()
+        
+        client = ClientConnection(
+            websocket,
+            None,
+            user_id,
+            max_queue_size=self.send_queue_size,
+            overflow_policy=self.overflow_policy,
+            codec=codec
+        )
+        client.start(self._on_send_error)
+        self.clients[websocket] = client
+        
+        logger.info(f"🔗 Multiplexed WebSocket connected: user_id={user_id}")
+    
+    async def subscribe(
+        self,
+        websocket: WebSocket,
+        topics: List[str],
+        since: Optional[Dict[str, int]] = None
+    ) -> List[str]:
+        """
+        Subscribe a multiplexed connection to topics
+        
+        Topics must already be authorized for the connection's user.
+        
+        Args:
+            websocket: The WebSocket connection
+            topics: Topics such as "diagnosis:42"
+            since: Optional topic -> last seen seq, replayed for diagnosis topics
+            
+        Returns:
+            Topics newly subscribed
+        """
+        client = self.clients.get(websocket)
+        if not client:
+            return []
+        
+        added = []
+        for topic in topics:
+            if topic in client.topics:
+                continue
+            if len(client.topics) >= self.max_topics_per_connection:
+                logger.warning(f"⚠️ Topic limit reached for user_id={client.user_id}")
+                break
+            
+            client.topics.add(topic)
+            self.topic_subscribers.setdefault(topic, set()).add(websocket)
+            added.append(topic)
+            
+            parsed = parse_topic(topic)
+            if since and topic in since and parsed and parsed[0] == "diagnosis":
+                await self._replay(parsed[1], client, since[topic])
+        
+        return added
+    
+    def unsubscribe(self, websocket: WebSocket, topics: List[str]) -> List[str]:
+        """
+        Unsubscribe a multiplexed connection from topics
+        
+        Returns:
+            Topics that were removed
+        """
+        client = self.clients.get(websocket)
+        if not client:
+            return []
+        
+        removed = [topic for topic in topics if topic in client.topics]
+        for topic in removed:
+            client.topics.discard(topic)
+            self._remove_subscriber(topic, websocket)
+        return removed
+    
+    def _remove_subscriber(self, topic: str, websocket: WebSocket) -> None:
+        """Remove websocket from a topic, dropping the topic when empty"""
+        subscribers = self.topic_subscribers.get(topic)
+        if subscribers is not None:
+            subscribers.discard(websocket)
+            if not subscribers:
+                del self.topic_subscribers[topic]
+    
+    async def disconnect(self, diagnosis_id: Optional[int], websocket: WebSocket) -> None:
         """
         Remove WebSocket connection
         
         Args:
-            diagnosis_id: The diagnosis ID
+            diagnosis_id: The diagnosis ID (None for multiplexed connections)
             websocket: The WebSocket connection to remove
         """
+        client = self.clients.pop(websocket, None)
+        if client:
+            client.close()
+            for topic in client.topics:
+                self._remove_subscriber(topic, websocket)
+            client.topics.clear()
+        
+        if diagnosis_id is None:
+            if client:
+                logger.info(f"🔌 Multiplexed WebSocket disconnected: user_id={client.user_id}")
+            return
+        
         lock = await self._get_lock(diagnosis_id)
         async with lock:
             if diagnosis_id in self.active_connections:
@@ -112,83 +550,235 @@ class ConnectionManager:
                     del self.active_connections[diagnosis_id]
                     del self.connection_users[diagnosis_id]
     
+    async def _on_send_error(self, client: ClientConnection) -> None:
+        """Drop a client whose writer failed to send"""
+        await self.disconnect(client.diagnosis_id, client.websocket)
+    
+    def _evict(
+        self,
+        client: ClientConnection,
+        reason: str,
+        code: int = status.WS_1013_TRY_AGAIN_LATER
+    ) -> None:
+        """Stop queueing for a client and close its socket in the background"""
+        self.evicted_count += 1
+        logger.warning(
+            f"🐢 Evicting WebSocket consumer ({reason}): diagnosis_id={client.diagnosis_id}, "
+            f"user_id={client.user_id}, queue_depth={len(client.queue)}"
+        )
+        
+        client.close()
+        asyncio.create_task(self._close_evicted(client, reason, code))
+    
+    async def _close_evicted(
+        self,
+        client: ClientConnection,
+        reason: str,
+        code: int = status.WS_1013_TRY_AGAIN_LATER
+    ) -> None:
+        """Remove an evicted client and close its socket"""
+        await self.disconnect(client.diagnosis_id, client.websocket)
+        
+        try:
+            await asyncio.wait_for(
+                client.websocket.close(code=code, reason=reason),
+                timeout=self.close_timeout
+            )
+        except Exception:
+            pass
+    
+    def _enqueue(self, client: ClientConnection, payload: Dict[str, Any], frame: Any = None) -> bool:
+        """
+        Queue payload for a client, evicting it if the policy demands
+        
+        Returns:
+            True if queued, False if the client was closed or evicted
+        """
+        if client.enqueue(payload, frame):
+            return True
+        
+        if not client.closed:
+            self._evict(client, reason="Slow consumer")
+        return False
+    
+    async def send_to_client(self, websocket: WebSocket, message: WebSocketMessage) -> bool:
+        """
+        Queue message for a single connection
+        
+        Args:
+            websocket: The WebSocket connection
+            message: The message to send
+            
+        Returns:
+            True if queued, False otherwise
+        """
+        client = self.clients.get(websocket)
+        if not client:
+            return False
+        return self._enqueue(client, message.dict())
+    
+    def send_pong(self, websocket: WebSocket) -> bool:
+        """Queue the connection codec's pre-encoded pong"""
+        client = self.clients.get(websocket)
+        if not client:
+            return False
+        return self._enqueue(client, {"type": "pong"}, client.codec.pong_frame)
+    
+    def touch(self, websocket: WebSocket) -> None:
+        """Mark a connection as alive after an inbound frame"""
+        client = self.clients.get(websocket)
+        if client:
+            client.touch()
+    
+    def record_ack(self, websocket: WebSocket, seq: int) -> None:
+        """Remember the last sequence number a client acknowledged"""
+        client = self.clients.get(websocket)
+        if client and (client.last_ack_seq is None or seq > client.last_ack_seq):
+            client.last_ack_seq = seq
+    
     async def broadcast(
         self,
         diagnosis_id: int,
         message: WebSocketMessage,
-        exclude_websocket: Optional[WebSocket] = None
+        exclude_websocket: Optional[WebSocket] = None,
+        record: bool = True
     ) -> None:
         """
         Broadcast message to all clients connected to this diagnosis
         
+        Messages are placed on each client's outbound queue, so this
+        never waits on a slow socket.
+        
         Args:
             diagnosis_id: The diagnosis ID
             message: The message to broadcast
             exclude_websocket: Optional websocket to exclude from broadcast
+            record: Sequence and keep the message for replay. The backplane
+                passes False when the shared sequence number is unknown, so
+                a local one never collides with numbers other workers use.
         """
-        if diagnosis_id not in self.active_connections:
-            logger.debug(f"⚠️ No connections for diagnosis_id={diagnosis_id}, queuing message")
-            await self._queue_message(diagnosis_id, message)
+        payload = self._record(diagnosis_id, message) if record else message.dict()
+        
+        recipients = set(self.active_connections.get(diagnosis_id, ()))
+        for topic in self._topics_for(diagnosis_id, message):
+            recipients.update(self.topic_subscribers.get(topic, ()))
+        
+        if not recipients:
+            logger.debug(f"⚠️ No connections for diagnosis_id={diagnosis_id}, message kept for replay")
             return
         
-        lock = await self._get_lock(diagnosis_id)
-        async with lock:
-            disconnected_clients = []
-            
-            for websocket in self.active_connections.get(diagnosis_id, set()).copy():
-                if exclude_websocket and websocket == exclude_websocket:
-                    continue
-                
-                try:
-                    await websocket.send_json(message.dict())
-                    logger.debug(f"📤 Message sent to diagnosis_id={diagnosis_id}")
-                except Exception as e:
-                    logger.error(f"❌ Error sending message: {str(e)}")
-                    disconnected_clients.append(websocket)
-            
-            # Remove disconnected clients
-            for websocket in disconnected_clients:
-                await self.disconnect(diagnosis_id, websocket)
+        self._deliver(recipients, payload, exclude_websocket)
+        logger.debug(f"📤 Message queued for diagnosis_id={diagnosis_id}")
     
-    async def _queue_message(
+    @staticmethod
+    def _topics_for(diagnosis_id: int, message: WebSocketMessage) -> List[str]:
+        """Topics a diagnosis broadcast is delivered to"""
+        topics = [f"diagnosis:{diagnosis_id}"]
+        data = message.data or {}
+        if data.get("recommendation_id") is not None:
+            topics.append(f"recommendation:{data['recommendation_id']}")
+        if data.get("patient_id") is not None:
+            topics.append(f"patient:{data['patient_id']}")
+        return topics
+    
+    def _deliver(
         self,
-        diagnosis_id: int,
-        message: WebSocketMessage
+        recipients: Set[WebSocket],
+        payload: Dict[str, Any],
+        exclude_websocket: Optional[WebSocket] = None
     ) -> None:
-        """Queue message for clients that come online later"""
-        if diagnosis_id not in self.message_queue:
-            self.message_queue[diagnosis_id] = []
+        """Queue payload for each recipient, encoding once per codec"""
+        frames: Dict[Codec, Any] = {}
+        
+        for websocket in recipients:
+            if exclude_websocket and websocket == exclude_websocket:
+                continue
+            
+            client = self.clients.get(websocket)
+            if not client:
+                continue
+            
+            frame = frames.get(client.codec)
+            if frame is None:
+                frame = frames[client.codec] = client.codec.encode(payload)
+            
+            self._enqueue(client, payload, frame)
+    
+    def _record(self, diagnosis_id: int, message: WebSocketMessage) -> Dict[str, Any]:
+        """Sequence message in the diagnosis replay buffer and return its payload"""
+        buffer = self.replay_buffers.get(diagnosis_id)
+        if buffer is None:
+            buffer = self.replay_buffers[diagnosis_id] = ReplayBuffer(self.max_queue_size)
         
-        queue = self.message_queue[diagnosis_id]
+        payload = buffer.append(message)
+        logger.debug(f"📦 Message seq={message.seq} recorded for diagnosis_id={diagnosis_id}")
         
-        # Keep queue size limited
-        if len(queue) >= self.max_queue_size:
-            queue.pop(0)  # Remove oldest
+        # Opportunistically drop buffers nobody has used for a while
+        if time.monotonic() - self._last_replay_expiry >= self.replay_ttl_seconds / 4:
+            self.expire_replay_buffers()
         
-        queue.append(message)
-        logger.debug(f"📦 Message queued for diagnosis_id={diagnosis_id}")
+        return payload
     
-    async def _send_queued_messages(
+    async def _replay(
         self,
         diagnosis_id: int,
-        websocket: WebSocket
+        client: ClientConnection,
+        since: int
     ) -> None:
-        """Send all queued messages to new client"""
-        if diagnosis_id not in self.message_queue:
-            return
+        """Queue every retained message after since for a resuming client"""
+        buffer = self.replay_buffers.get(diagnosis_id)
+        gap, missed = buffer.since(since) if buffer else (since > 0, [])
         
-        queue = self.message_queue[diagnosis_id]
+        if gap:
+            # Some messages are gone; tell the client to refetch state
+            notice = WebSocketMessage(
+                type="replay_gap",
+                diagnosis_id=diagnosis_id,
+                data={
+                    "since": since,
+                    "first_available_seq": buffer.first_seq if buffer else 1,
+                    "last_seq": buffer.last_seq if buffer else 0,
+                }
+            )
+            client.enqueue(notice.dict())
         
-        for message in queue.copy():
-            try:
-                await websocket.send_json(message.dict())
-                logger.debug(f"📬 Queued message sent to diagnosis_id={diagnosis_id}")
-            except Exception as e:
-                logger.error(f"❌ Error sending queued message: {str(e)}")
+        for payload in missed:
+            if not client.enqueue(payload):
                 break
         
-        # Clear queue after sending
-        self.message_queue[diagnosis_id] = []
+        logger.debug(
+            f"📬 Replayed {len(missed)} messages after seq={since} to diagnosis_id={diagnosis_id}"
+        )
+    
+    def get_last_seq(self, diagnosis_id: int) -> int:
+        """Get the latest sequence number broadcast for a diagnosis"""
+        buffer = self.replay_buffers.get(diagnosis_id)
+        return buffer.last_seq if buffer else 0
+    
+    def expire_replay_buffers(self) -> int:
+        """
+        Drop replay buffers idle for longer than the TTL
+        
+        Buffers of diagnoses with connected clients are kept.
+        
+        Returns:
+            Number of buffers removed
+        """
+        now = time.monotonic()
+        self._last_replay_expiry = now
+        
+        expired = [
+            diagnosis_id
+            for diagnosis_id, buffer in self.replay_buffers.items()
+            if diagnosis_id not in self.active_connections
+            and now - buffer.last_activity >= self.replay_ttl_seconds
+        ]
+        for diagnosis_id in expired:
+            del self.replay_buffers[diagnosis_id]
+        
+        if expired:
+            logger.debug(f"🧹 Expired {len(expired)} idle replay buffers")
+        return len(expired)
     
     async def send_personal_message(
         self,
@@ -199,6 +789,8 @@ class ConnectionManager:
         """
         Send message to specific user's connection
         
+        Personal messages are not recorded for replay.
+        
         Args:
             diagnosis_id: The diagnosis ID
             user_id: The user ID
@@ -208,24 +800,29 @@ class ConnectionManager:
             True if sent, False otherwise
         """
         if diagnosis_id not in self.active_connections:
-            await self._queue_message(diagnosis_id, message)
             return False
         
-        lock = await self._get_lock(diagnosis_id)
-        async with lock:
-            for websocket, conn_user_id in self.connection_users.get(diagnosis_id, {}).items():
-                if conn_user_id == user_id:
-                    try:
-                        await websocket.send_json(message.dict())
-                        logger.debug(f"💬 Personal message sent to user_id={user_id}")
-                        return True
-                    except Exception as e:
-                        logger.error(f"❌ Error sending personal message: {str(e)}")
-                        return False
-        
-        await self._queue_message(diagnosis_id, message)
+        for websocket, conn_user_id in list(self.connection_users.get(diagnosis_id, {}).items()):
+            if conn_user_id == user_id:
+                client = self.clients.get(websocket)
+                if client and self._enqueue(client, message.dict()):
+                    logger.debug(f"💬 Personal message queued for user_id={user_id}")
+                    return True
+                return False
+        
         return False
     
+    async def drain(self, timeout: Optional[float] = None) -> None:
+        """
+        Wait until every client's outbound queue has been flushed
+        
+        Args:
+            timeout: Maximum seconds to wait (None waits indefinitely)
+        """
+        waiters = [client.wait_idle() for client in list(self.clients.values())]
+        if waiters:
+            await asyncio.wait_for(asyncio.gather(*waiters), timeout=timeout)
+    
     def get_connection_count(self, diagnosis_id: int) -> int:
         """Get number of active connections for diagnosis"""
         return len(self.active_connections.get(diagnosis_id, set()))
@@ -234,14 +831,173 @@ class ConnectionManager:
         """Get info about all active connections"""
         info = {}
         for diagnosis_id, connections in self.active_connections.items():
+            clients = [
+                self.clients[websocket].get_stats()
+                for websocket in connections
+                if websocket in self.clients
+            ]
             info[diagnosis_id] = {
                 "connection_count": len(connections),
-                "queued_messages": len(self.message_queue.get(diagnosis_id, [])),
+                "queued_messages": len(self.replay_buffers.get(diagnosis_id, ())),
+                "last_seq": self.get_last_seq(diagnosis_id),
                 "users": list(set(
                     self.connection_users[diagnosis_id].values()
-                )) if diagnosis_id in self.connection_users else []
+                )) if diagnosis_id in self.connection_users else [],
+                "send_queue_depth": sum(c["queue_depth"] for c in clients),
+                "dropped_messages": sum(c["dropped"] for c in clients),
+                "clients": clients,
             }
         return info
+    
+    def start_sweeper(self) -> None:
+        """Start the background sweeper (no-op if already running)"""
+        if self.sweeper_task is None or self.sweeper_task.done():
+            self.sweeper_task = asyncio.create_task(self._sweep_loop())
+            logger.info(
+                f"✅ WebSocket sweeper started (interval={self.sweep_interval}s, "
+                f"heartbeat={self.heartbeat_interval}s, idle_timeout={self.idle_timeout}s)"
+            )
+    
+    async def stop_sweeper(self) -> None:
+        """Stop the background sweeper"""
+        if self.sweeper_task:
+            self.sweeper_task.cancel()
+            try:
+                await self.sweeper_task
+            except (asyncio.CancelledError, Exception):
+                pass
+            self.sweeper_task = None
+    
+    async def _sweep_loop(self) -> None:
+        """Run sweep() every sweep_interval seconds"""
+        while True:
+            await asyncio.sleep(self.sweep_interval)
+            try:
+                self.sweep()
+            except Exception as e:
+                logger.error(f"❌ WebSocket sweep failed: {str(e)}")
+    
+    def sweep(self) -> Dict[str, int]:
+        """
+        Check connection liveness and reclaim per-diagnosis state
+        
+        Clients silent for heartbeat_interval get a ping; clients silent
+        for idle_timeout (e.g. half-open sockets that never answered) are
+        evicted. Locks, connection maps and topic sets left empty by
+        disconnects are deleted, and idle replay buffers expired.
+        
+        Returns:
+            Counts of pinged and evicted clients and reclaimed entries
+        """
+        now = time.monotonic()
+        result = Counter(pinged=0, idle_evicted=0)
+        
+        for client in list(self.clients.values()):
+            if client.closed:
+                continue
+            
+            idle = now - client.last_seen
+            if idle >= self.idle_timeout:
+                self._evict(client, reason="Idle timeout", code=status.WS_1001_GOING_AWAY)
+                result["idle_evicted"] += 1
+            elif idle >= self.heartbeat_interval and not client.ping_pending:
+                if self._enqueue(client, {"type": "ping"}, client.codec.ping_frame):
+                    client.ping_pending = True
+                    result["pinged"] += 1
+        
+        # A lock is only safe to drop when nobody holds or waits on it;
+        # connect/disconnect acquire right after _get_lock without yielding
+        stale_locks = [
+            diagnosis_id
+            for diagnosis_id, lock in self.locks.items()
+            if diagnosis_id not in self.active_connections and not lock.locked()
+        ]
+        for diagnosis_id in stale_locks:
+            del self.locks[diagnosis_id]
+        result["reclaimed_locks"] = len(stale_locks)
+        
+        empty_diagnoses = [d for d, connections in self.active_connections.items() if not connections]
+        for diagnosis_id in empty_diagnoses:
+            del self.active_connections[diagnosis_id]
+        orphaned_users = [
+            d for d, users in self.connection_users.items()
+            if not users or d not in self.active_connections
+        ]
+        for diagnosis_id in orphaned_users:
+            del self.connection_users[diagnosis_id]
+        result["reclaimed_user_maps"] = len(orphaned_users)
+        
+        empty_topics = [topic for topic, subscribers in self.topic_subscribers.items() if not subscribers]
+        for topic in empty_topics:
+            del self.topic_subscribers[topic]
+        result["reclaimed_topics"] = len(empty_topics)
+        
+        result["expired_replay_buffers"] = self.expire_replay_buffers()
+        
+        self.sweep_stats.update(result)
+        self.sweep_stats["sweeps"] += 1
+        self.sweep_stats["last_sweep_ms"] = int((time.monotonic() - now) * 1000)
+        
+        if result["idle_evicted"] or stale_locks:
+            logger.info(
+                f"🧹 WebSocket sweep: evicted={result['idle_evicted']}, "
+                f"pinged={result['pinged']}, reclaimed_locks={len(stale_locks)}"
+            )
+        return dict(result)
+    
+    def get_memory_stats(self) -> Dict[str, Any]:
+        """Get gauges for connection state and process memory"""
+        return {
+            "connections": len(self.clients),
+            "diagnoses": len(self.active_connections),
+            "locks": len(self.locks),
+            "user_maps": len(self.connection_users),
+            "replay_buffers": len(self.replay_buffers),
+            "replay_messages": sum(len(buffer) for buffer in self.replay_buffers.values()),
+            "topics": len(self.topic_subscribers),
+            "queued_messages": sum(len(client.queue) for client in self.clients.values()),
+            "rss_bytes": _rss_bytes(),
+        }
+    
+    def get_sweeper_stats(self) -> Dict[str, Any]:
+        """Get sweeper configuration and cumulative counters"""
+        return {
+            "running": self.sweeper_task is not None and not self.sweeper_task.done(),
+            "interval_seconds": self.sweep_interval,
+            "heartbeat_interval_seconds": self.heartbeat_interval,
+            "idle_timeout_seconds": self.idle_timeout,
+            **self.sweep_stats,
+        }
+    
+    def get_topic_stats(self) -> Dict[str, Any]:
+        """Get multiplexed connection and subscription totals"""
+        return {
+            "multiplexed_connections": sum(1 for c in self.clients.values() if c.diagnosis_id is None),
+            "topics": len(self.topic_subscribers),
+            "subscriptions": sum(len(s) for s in self.topic_subscribers.values()),
+        }
+    
+    def get_send_queue_stats(self) -> Dict[str, Any]:
+        """Get outbound queue configuration and totals across all clients"""
+        clients = list(self.clients.values())
+        return {
+            "max_size": self.send_queue_size,
+            "overflow_policy": self.overflow_policy.value,
+            "total_queued": sum(len(c.queue) for c in clients),
+            "protocols": dict(Counter(c.codec.subprotocol or "legacy" for c in clients)),
+            "total_dropped": sum(c.dropped_count for c in clients),
+            "total_coalesced": sum(c.coalesced_count for c in clients),
+            "evicted_connections": self.evicted_count,
+        }
+
+
+def _rss_bytes() -> Optional[int]:
+    """Resident set size of this process, or None where /proc isn't available"""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, AttributeError):
+        return None
 
 
 # Global connection manager instance
@@ -252,15 +1008,63 @@ def get_connection_manager() -> ConnectionManager:
     """Get or create global connection manager"""
     global manager
     if manager is None:
-        manager = ConnectionManager()
+        manager = ConnectionManager(
+            send_queue_size=settings.WS_SEND_QUEUE_SIZE,
+            overflow_policy=settings.WS_OVERFLOW_POLICY,
+            replay_buffer_size=settings.WS_REPLAY_BUFFER_SIZE,
+            replay_ttl_seconds=settings.WS_REPLAY_TTL_SECONDS,
+            max_topics_per_connection=settings.WS_MAX_TOPICS_PER_CONNECTION,
+            heartbeat_interval=settings.WS_HEARTBEAT_INTERVAL_SECONDS,
+            idle_timeout=settings.WS_IDLE_TIMEOUT_SECONDS,
+            sweep_interval=settings.WS_SWEEP_INTERVAL_SECONDS
+        )
     return manager
 
 
+async def _diagnosis_owner(diagnosis_id: int) -> Optional[int]:
+    """Patient who owns a diagnosis, from the handshake authorization cache"""
+    try:
+        # Imported here to avoid circular imports
+        from app.services.websocket_auth import get_handshake_cache
+        
+        decision = await get_handshake_cache().authorize(None, diagnosis_id)
+    except Exception as e:
+        logger.warning(f"⚠️ Could not resolve owner of diagnosis_id={diagnosis_id}: {e}")
+        return None
+    return decision.user_id if decision.allowed else None
+
+
+async def publish_broadcast(diagnosis_id: int, message: WebSocketMessage) -> None:
+    """
+    Broadcast message to clients on every worker via the backplane
+    
+    The owning patient is added to message data when the caller didn't
+    set it, so "patient:<id>" subscribers receive the update too.
+    
+    Args:
+        diagnosis_id: The diagnosis ID
+        message: The message to broadcast
+    """
+    # Imported here to avoid circular imports
+    from app.services.websocket_backplane import get_backplane
+    
+    if message.data is None:
+        message.data = {}
+    if message.data.get("patient_id") is None:
+        patient_id = await _diagnosis_owner(diagnosis_id)
+        if patient_id is not None:
+            message.data["patient_id"] = patient_id
+    
+    await get_backplane().publish(diagnosis_id, message)
+
+
 async def broadcast_recommendation_update(
     diagnosis_id: int,
     old_data: Dict[str, Any],
     new_data: Dict[str, Any],
-    reason: str = "Updated"
+    reason: str = "Updated",
+    recommendation_id: Optional[int] = None,
+    patient_id: Optional[int] = None
 ) -> None:
     """
     Broadcast recommendation update to all clients
@@ -270,13 +1074,15 @@ async def broadcast_recommendation_update(
         old_data: Old recommendation data
         new_data: New recommendation data
         reason: Reason for update
+        recommendation_id: Also deliver to "recommendation:<id>" subscribers
+        patient_id: Owning patient (looked up when omitted)
     """
-    manager = get_connection_manager()
-    
     message = WebSocketMessage(
         type="recommendation_update",
         diagnosis_id=diagnosis_id,
         data={
+            "recommendation_id": recommendation_id,
+            "patient_id": patient_id,
             "old_data": old_data,
             "new_data": new_data,
             "reason": reason,
@@ -287,7 +1093,7 @@ async def broadcast_recommendation_update(
         }
     )
     
-    await manager.broadcast(diagnosis_id, message)
+    await publish_broadcast(diagnosis_id, message)
     logger.info(f"📢 Recommendation update broadcasted for diagnosis_id={diagnosis_id}")
 
 
@@ -296,7 +1102,8 @@ async def broadcast_effectiveness_update(
     recommendation_id: int,
     new_effectiveness: float,
     confidence: float,
-    sample_size: int
+    sample_size: int,
+    patient_id: Optional[int] = None
 ) -> None:
     """
     Broadcast effectiveness update to all clients
@@ -307,21 +1114,21 @@ async def broadcast_effectiveness_update(
         new_effectiveness: New effectiveness score (0-1)
         confidence: Confidence in the score (0-1)
         sample_size: Number of samples used
+        patient_id: Owning patient (looked up when omitted)
     """
-    manager = get_connection_manager()
-    
     message = WebSocketMessage(
         type="effectiveness_update",
         diagnosis_id=diagnosis_id,
         data={
             "recommendation_id": recommendation_id,
+            "patient_id": patient_id,
             "new_effectiveness": new_effectiveness,
             "confidence": confidence,
             "sample_size": sample_size
         }
     )
     
-    await manager.broadcast(diagnosis_id, message)
+    await publish_broadcast(diagnosis_id, message)
     logger.info(
         f"📊 Effectiveness update broadcasted: "
         f"recommendation_id={recommendation_id}, effectiveness={new_effectiveness}"
@@ -332,7 +1139,8 @@ async def broadcast_feedback_update(
     diagnosis_id: int,
     feedback_id: int,
     rating: int,
-    effectiveness: float
+    effectiveness: float,
+    patient_id: Optional[int] = None
 ) -> None:
     """
     Broadcast feedback update to all clients
@@ -342,18 +1150,18 @@ async def broadcast_feedback_update(
         feedback_id: The feedback ID
         rating: User rating (1-5)
         effectiveness: Effectiveness score (0-1)
+        patient_id: Owning patient (looked up when omitted)
     """
-    manager = get_connection_manager()
-    
     message = WebSocketMessage(
         type="feedback_update",
         diagnosis_id=diagnosis_id,
         data={
+            "patient_id": patient_id,
             "feedback_id": feedback_id,
             "rating": rating,
             "effectiveness": effectiveness
         }
     )
     
-    await manager.broadcast(diagnosis_id, message)
+    await publish_broadcast(diagnosis_id, message)
     logger.info(f"👥 Feedback update broadcasted for diagnosis_id={diagnosis_id}")
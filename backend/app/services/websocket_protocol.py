@@ -0,0 +1,252 @@
+"""
+WebSocket Protocol
+Frame codecs, subprotocol negotiation and inbound message schemas
+
+Clients pick an encoding through the Sec-WebSocket-Protocol header:
+- avicenna.msgpack.v1: binary msgpack frames, timestamps as epoch milliseconds
+- avicenna.json.v1:    compact JSON text frames, null fields omitted
+- (none):              legacy JSON text frames, unchanged for old clients
+
+Inbound frames are validated against the schemas below instead of being
+evaluated. Keep-alive pings are matched byte-for-byte against their
+canonical encodings and answered with a pre-encoded pong, so idle
+clients cost no decoding or allocation.
+"""
+
+import json
+import logging
+from datetime import datetime, timezone
+from decimal import Decimal
+from typing import Annotated, Any, Dict, List, Literal, Optional, Tuple, Union
+
+from pydantic import BaseModel, Field, TypeAdapter
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover - optional speedup
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:  # pragma: no cover - optional dependency
+    msgpack = None
+
+logger = logging.getLogger(__name__)
+
+MSGPACK_SUBPROTOCOL = "avicenna.msgpack.v1"
+JSON_SUBPROTOCOL = "avicenna.json.v1"
+
+
+# ===========================
+# Inbound message schemas
+# ===========================
+
+class PingFrame(BaseModel):
+    """Keep-alive ping"""
+    type: Literal["ping"]
+
+
+class PongFrame(BaseModel):
+    """Reply to a server heartbeat ping"""
+    type: Literal["pong"]
+
+
+class AckFrame(BaseModel):
+    """Client acknowledges every message up to seq"""
+    type: Literal["ack"]
+    seq: int = Field(ge=0)
+
+
+class SubscribeFrame(BaseModel):
+    """Subscribe to (or unsubscribe from) topics"""
+    type: Literal["subscribe", "unsubscribe"]
+    topics: List[str] = Field(min_length=1, max_length=100)
+    since: Optional[Dict[str, int]] = None  # topic -> last seen seq
+
+
+InboundFrame = Annotated[
+    Union[PingFrame, PongFrame, AckFrame, SubscribeFrame],
+    Field(discriminator="type")
+]
+
+_inbound_adapter = TypeAdapter(InboundFrame)
+
+
+class ProtocolError(ValueError):
+    """Raised when an inbound frame can't be decoded or validated"""
+
+
+# ===========================
+# Codecs
+# ===========================
+
+def _json_default(value: Any) -> Any:
+    """Encode values the stdlib JSON encoder doesn't handle"""
+    if isinstance(value, datetime):
+        return value.isoformat()
+    if isinstance(value, Decimal):
+        return float(value)
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+
+def _msgpack_default(value: Any) -> Any:
+    """Encode values msgpack doesn't handle natively"""
+    if isinstance(value, datetime):
+        if value.tzinfo is None:
+            value = value.replace(tzinfo=timezone.utc)
+        return int(value.timestamp() * 1000)
+    if isinstance(value, Decimal):
+        return float(value)
+    raise TypeError(f"Object of type {type(value).__name__} is not msgpack serializable")
+
+
+def _compact(payload: Dict[str, Any]) -> Dict[str, Any]:
+    """Drop top-level null fields"""
+    return {key: value for key, value in payload.items() if value is not None}
+
+
+class Codec:
+    """Base frame codec"""
+
+    subprotocol: Optional[str] = None
+    binary = False
+
+    def __init__(self):
+        # Canonical ping encodings recognized without decoding
+        self.ping_frames = self._canonical_frames({"type": "ping"})
+        self.ping_frame = self.encode({"type": "ping"})
+        self.pong_frame = self.encode({"type": "pong"})
+
+    def _canonical_frames(self, payload: Dict[str, Any]) -> set:
+        return {self.encode(payload)}
+
+    def encode(self, payload: Dict[str, Any]) -> Any:
+        raise NotImplementedError
+
+    def decode(self, data: Union[str, bytes]) -> Any:
+        raise NotImplementedError
+
+    async def send(self, websocket, frame: Any) -> None:
+        """Send an encoded frame"""
+        if self.binary:
+            await websocket.send_bytes(frame)
+        else:
+            await websocket.send_text(frame)
+
+    def is_ping(self, data: Union[str, bytes, None]) -> bool:
+        """Fast check for a canonical keep-alive ping"""
+        return data in self.ping_frames
+
+    def parse(self, data: Union[str, bytes, None]) -> BaseModel:
+        """
+        Decode and validate an inbound frame
+
+        Raises:
+            ProtocolError: If the frame is malformed or not a known message
+        """
+        if data is None:
+            raise ProtocolError("Empty frame")
+
+        try:
+            return _inbound_adapter.validate_python(self.decode(data))
+        except ProtocolError:
+            raise
+        except Exception as e:
+            raise ProtocolError(str(e)) from e
+
+
+class LegacyJSONCodec(Codec):
+    """
+    Original JSON framing for clients that don't negotiate a subprotocol
+
+    Frames stay as dicts sent with send_json, with datetimes as ISO strings.
+    """
+
+    def _canonical_frames(self, payload: Dict[str, Any]) -> set:
+        return {
+            json.dumps(payload),
+            json.dumps(payload, separators=(",", ":")),
+        }
+
+    def encode(self, payload: Dict[str, Any]) -> Any:
+        return json.loads(json.dumps(payload, default=_json_default))
+
+    def decode(self, data: Union[str, bytes]) -> Any:
+        return json.loads(data)
+
+    async def send(self, websocket, frame: Any) -> None:
+        await websocket.send_json(frame)
+
+
+class CompactJSONCodec(Codec):
+    """Compact JSON text frames using orjson when available"""
+
+    subprotocol = JSON_SUBPROTOCOL
+
+    def _canonical_frames(self, payload: Dict[str, Any]) -> set:
+        return {self.encode(payload), json.dumps(payload)}
+
+    def encode(self, payload: Dict[str, Any]) -> str:
+        if orjson is not None:
+            return orjson.dumps(_compact(payload), default=_json_default).decode()
+        return json.dumps(_compact(payload), default=_json_default, separators=(",", ":"))
+
+    def decode(self, data: Union[str, bytes]) -> Any:
+        if orjson is not None:
+            return orjson.loads(data)
+        return json.loads(data)
+
+
+class MsgPackCodec(Codec):
+    """Binary msgpack frames"""
+
+    subprotocol = MSGPACK_SUBPROTOCOL
+    binary = True
+
+    def encode(self, payload: Dict[str, Any]) -> bytes:
+        return msgpack.packb(_compact(payload), default=_msgpack_default, use_bin_type=True)
+
+    def decode(self, data: Union[str, bytes]) -> Any:
+        if isinstance(data, str):
+            raise ProtocolError("Expected binary frame")
+        return msgpack.unpackb(data, raw=False)
+
+
+LEGACY_CODEC = LegacyJSONCodec()
+
+# Supported subprotocols in server preference order
+CODECS: Dict[str, Codec] = {JSON_SUBPROTOCOL: CompactJSONCodec()}
+if msgpack is not None:
+    CODECS = {MSGPACK_SUBPROTOCOL: MsgPackCodec(), **CODECS}
+
+
+def negotiate(requested: List[str]) -> Tuple[Optional[str], Codec]:
+    """
+    Pick the codec for a connection
+
+    Args:
+        requested: Subprotocols offered by the client, in its order
+
+    Returns:
+        (subprotocol to accept or None, codec)
+    """
+    for subprotocol, codec in CODECS.items():
+        if subprotocol in requested:
+            return subprotocol, codec
+    return None, LEGACY_CODEC
+
+
+__all__ = [
+    "PingFrame",
+    "PongFrame",
+    "AckFrame",
+    "SubscribeFrame",
+    "ProtocolError",
+    "Codec",
+    "LegacyJSONCodec",
+    "CompactJSONCodec",
+    "MsgPackCodec",
+    "LEGACY_CODEC",
+    "CODECS",
+    "negotiate",
+]
@@ -0,0 +1,357 @@
+#!/usr/bin/env python
+"""
+WebSocket Load Test
+Opens thousands of simulated clients and measures broadcast delivery at scale
+
+Usage:
+    python load_test_websocket.py --clients 5000 --diagnoses 100 --rate 200 --duration 30
+    python load_test_websocket.py --mode localhost --clients 1000 --protocol avicenna.msgpack.v1
+
+Modes:
+- inprocess: clients are in-memory sockets registered directly with the
+  ConnectionManager; measures the manager, queues and codecs alone
+- localhost: starts the real app under uvicorn on 127.0.0.1 and connects
+  real WebSocket clients to /ws/{diagnosis_id} (diagnoses must exist in the DB)
+
+Broadcasts are driven through broadcast_effectiveness_update and
+broadcast_feedback_update, so they take the same backplane path as
+production. Reports p50/p99 delivery latency, memory per connection and
+drop counts.
+"""
+import argparse
+import asyncio
+import json
+import logging
+import random
+import sys
+import time
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple
+
+# Add parent directory to path
+sys.path.insert(0, str(Path(__file__).parent))
+
+import msgpack
+
+from app.services.websocket_manager import (
+    _rss_bytes,
+    broadcast_effectiveness_update,
+    broadcast_feedback_update,
+    get_connection_manager,
+)
+from app.services.websocket_protocol import negotiate
+
+logger = logging.getLogger("load_test_websocket")
+
+# (message type, recommendation_id / feedback_id) -> perf_counter at broadcast
+BroadcastKey = Tuple[str, int]
+
+
+class LoadStats:
+    """Delivery latencies and counters shared by every simulated client"""
+
+    def __init__(self):
+        self.sent_at: Dict[BroadcastKey, float] = {}
+        self.latencies: List[float] = []
+        self.expected = 0
+        self.delivered = 0
+        self.replay_gaps = 0
+
+    def receive(self, payload: Dict[str, Any]) -> Optional[str]:
+        """Record a delivered payload; returns its type"""
+        message_type = payload.get("type")
+        data = payload.get("data") or {}
+
+        if message_type == "effectiveness_update":
+            key = (message_type, data.get("recommendation_id"))
+        elif message_type == "feedback_update":
+            key = (message_type, data.get("feedback_id"))
+        else:
+            if message_type == "replay_gap":
+                self.replay_gaps += 1
+            return message_type
+
+        started = self.sent_at.get(key)
+        if started is not None:
+            self.latencies.append(time.perf_counter() - started)
+            self.delivered += 1
+        return message_type
+
+
+def _decode(frame: Any) -> Dict[str, Any]:
+    """Decode a frame in any of the negotiated encodings"""
+    if isinstance(frame, dict):
+        return frame
+    if isinstance(frame, (bytes, bytearray)):
+        return msgpack.unpackb(frame, raw=False)
+    return json.loads(frame)
+
+
+class SimulatedWebSocket:
+    """
+    In-memory stand-in for a Starlette WebSocket
+
+    Implements just what ConnectionManager uses. An optional per-send
+    delay simulates slow consumers.
+    """
+
+    def __init__(self, stats: LoadStats, delay: float = 0):
+        self.stats = stats
+        self.delay = delay
+        self.closed = False
+
+    async def accept(self, subprotocol: Optional[str] = None) -> None:
+        pass
+
+    async def _deliver(self, frame: Any) -> None:
+        if self.delay:
+            await asyncio.sleep(self.delay)
+        self.stats.receive(_decode(frame))
+
+    async def send_json(self, data: Any) -> None:
+        await self._deliver(data)
+
+    async def send_text(self, data: str) -> None:
+        await self._deliver(data)
+
+    async def send_bytes(self, data: bytes) -> None:
+        await self._deliver(data)
+
+    async def close(self, code: int = 1000, reason: Optional[str] = None) -> None:
+        self.closed = True
+
+
+async def connect_inprocess(args, stats: LoadStats) -> List[Tuple[int, Any]]:
+    """Register simulated sockets with the global ConnectionManager"""
+    manager = get_connection_manager()
+    _, codec = negotiate([args.protocol] if args.protocol else [])
+    clients = []
+
+    for index in range(args.clients):
+        diagnosis_id = args.first_diagnosis + index % args.diagnoses
+        delay = args.slow_delay if random.random() < args.slow_fraction else 0
+        ws = SimulatedWebSocket(stats, delay=delay)
+        await manager.connect(diagnosis_id, index, ws, codec=codec)
+        clients.append((diagnosis_id, ws))
+
+    return clients
+
+
+async def _client_loop(connection, stats: LoadStats) -> None:
+    """Read frames from a real socket, answering server heartbeats"""
+    try:
+        async for frame in connection:
+            if stats.receive(_decode(frame)) == "ping":
+                await connection.send(json.dumps({"type": "pong"}))
+    except Exception:
+        pass
+
+
+async def connect_localhost(args, stats: LoadStats) -> Tuple[List[Tuple[int, Any]], Any]:
+    """Start the app under uvicorn and connect real WebSocket clients"""
+    import uvicorn
+    import websockets
+    from app.main import app
+
+    config = uvicorn.Config(app, host="127.0.0.1", port=args.port, log_level="warning", ws_max_queue=1024)
+    server = uvicorn.Server(config)
+    server_task = asyncio.create_task(server.serve())
+    while not server.started:
+        await asyncio.sleep(0.05)
+
+    subprotocols = [args.protocol] if args.protocol else None
+    clients = []
+    semaphore = asyncio.Semaphore(args.connect_concurrency)
+
+    async def open_client(index: int) -> None:
+        diagnosis_id = args.first_diagnosis + index % args.diagnoses
+        url = f"ws://127.0.0.1:{args.port}{args.path.format(diagnosis_id=diagnosis_id)}"
+        async with semaphore:
+            connection = await websockets.connect(url, subprotocols=subprotocols, max_queue=None)
+        asyncio.create_task(_client_loop(connection, stats))
+        clients.append((diagnosis_id, connection))
+
+    await asyncio.gather(*(open_client(index) for index in range(args.clients)))
+    return clients, (server, server_task)
+
+
+async def drive_broadcasts(args, stats: LoadStats, clients_per_diagnosis: Dict[int, int]) -> int:
+    """Send broadcasts at the configured rate for the configured duration"""
+    diagnosis_ids = list(clients_per_diagnosis)
+    interval = 1.0 / args.rate
+    deadline = time.perf_counter() + args.duration
+    next_send = time.perf_counter()
+    sent = 0
+
+    while time.perf_counter() < deadline:
+        diagnosis_id = random.choice(diagnosis_ids)
+        sent += 1
+
+        if random.random() < args.effectiveness_ratio:
+            stats.sent_at[("effectiveness_update", sent)] = time.perf_counter()
+            await broadcast_effectiveness_update(
+                diagnosis_id, sent, random.random(), random.random(), random.randint(1, 500)
+            )
+        else:
+            stats.sent_at[("feedback_update", sent)] = time.perf_counter()
+            await broadcast_feedback_update(
+                diagnosis_id, sent, random.randint(1, 5), random.random()
+            )
+        stats.expected += clients_per_diagnosis[diagnosis_id]
+
+        next_send += interval
+        delay = next_send - time.perf_counter()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        elif sent % 100 == 0:
+            await asyncio.sleep(0)  # Falling behind: still let writers run
+
+    return sent
+
+
+def _percentile(values: List[float], percentile: float) -> float:
+    if not values:
+        return 0.0
+    index = min(len(values) - 1, int(round(percentile / 100 * (len(values) - 1))))
+    return values[index]
+
+
+async def run(args) -> Dict[str, Any]:
+    stats = LoadStats()
+    manager = get_connection_manager()
+    rss_before = _rss_bytes()
+
+    started = time.perf_counter()
+    server = None
+    if args.mode == "localhost":
+        clients, server = await connect_localhost(args, stats)
+    else:
+        clients = await connect_inprocess(args, stats)
+    connect_seconds = time.perf_counter() - started
+
+    await asyncio.sleep(0.5)  # Let welcome messages flush
+    rss_connected = _rss_bytes()
+
+    clients_per_diagnosis: Dict[int, int] = {}
+    for diagnosis_id, _ in clients:
+        clients_per_diagnosis[diagnosis_id] = clients_per_diagnosis.get(diagnosis_id, 0) + 1
+
+    started = time.perf_counter()
+    sent = await drive_broadcasts(args, stats, clients_per_diagnosis)
+    send_seconds = time.perf_counter() - started
+
+    # Wait for in-flight deliveries
+    settle_deadline = time.perf_counter() + args.settle
+    while stats.delivered < stats.expected and time.perf_counter() < settle_deadline:
+        await asyncio.sleep(0.05)
+
+    queue_stats = manager.get_send_queue_stats()
+    memory_stats = manager.get_memory_stats()
+    latencies = sorted(stats.latencies)
+
+    per_connection = None
+    if rss_before is not None and rss_connected is not None and clients:
+        per_connection = (rss_connected - rss_before) / len(clients)
+
+    report = {
+        "mode": args.mode,
+        "protocol": args.protocol or "legacy",
+        "clients": len(clients),
+        "diagnoses": len(clients_per_diagnosis),
+        "connect_seconds": round(connect_seconds, 2),
+        "broadcasts": sent,
+        "broadcast_rate": round(sent / send_seconds, 1) if send_seconds else 0,
+        "expected_deliveries": stats.expected,
+        "delivered": stats.delivered,
+        "missing": stats.expected - stats.delivered,
+        "latency_ms": {
+            "p50": round(_percentile(latencies, 50) * 1000, 2),
+            "p95": round(_percentile(latencies, 95) * 1000, 2),
+            "p99": round(_percentile(latencies, 99) * 1000, 2),
+            "max": round(latencies[-1] * 1000, 2) if latencies else 0,
+        },
+        "memory_per_connection_bytes": round(per_connection) if per_connection is not None else None,
+        "rss_bytes": memory_stats["rss_bytes"],
+        "server_dropped": queue_stats["total_dropped"],
+        "server_coalesced": queue_stats["total_coalesced"],
+        "server_evicted": queue_stats["evicted_connections"],
+        "replay_gaps": stats.replay_gaps,
+    }
+
+    if server:
+        for _, connection in clients:
+            await connection.close()
+        uvicorn_server, server_task = server
+        uvicorn_server.should_exit = True
+        await server_task
+    else:
+        for diagnosis_id, ws in clients:
+            await manager.disconnect(diagnosis_id, ws)
+
+    return report
+
+
+def print_report(report: Dict[str, Any]) -> None:
+    latency = report["latency_ms"]
+    per_connection = report["memory_per_connection_bytes"]
+
+    print("=" * 60)
+    print(f"WebSocket load test ({report['mode']}, {report['protocol']})")
+    print("=" * 60)
+    print(f"Clients:            {report['clients']} across {report['diagnoses']} diagnoses "
+          f"(connected in {report['connect_seconds']}s)")
+    print(f"Broadcasts:         {report['broadcasts']} at {report['broadcast_rate']}/s")
+    print(f"Deliveries:         {report['delivered']}/{report['expected_deliveries']} "
+          f"({report['missing']} missing)")
+    print(f"Latency (ms):       p50={latency['p50']}  p95={latency['p95']}  "
+          f"p99={latency['p99']}  max={latency['max']}")
+    print(f"Memory/connection:  {per_connection if per_connection is not None else 'n/a'} bytes")
+    print(f"Server drops:       dropped={report['server_dropped']}  "
+          f"coalesced={report['server_coalesced']}  evicted={report['server_evicted']}")
+    print(f"Replay gaps:        {report['replay_gaps']}")
+
+
+def parse_args(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(description="WebSocket broadcast load test")
+    parser.add_argument("--mode", choices=["inprocess", "localhost"], default="inprocess")
+    parser.add_argument("--clients", type=int, default=1000, help="Simulated clients to open")
+    parser.add_argument("--diagnoses", type=int, default=50, help="Diagnoses clients are spread across")
+    parser.add_argument("--first-diagnosis", type=int, default=1, help="First diagnosis ID used")
+    parser.add_argument("--rate", type=float, default=100, help="Broadcasts per second")
+    parser.add_argument("--duration", type=float, default=10, help="Seconds to send broadcasts for")
+    parser.add_argument("--effectiveness-ratio", type=float, default=0.5,
+                        help="Fraction of broadcasts that are effectiveness updates (rest are feedback)")
+    parser.add_argument("--protocol", default=None,
+                        help="Subprotocol to negotiate (avicenna.msgpack.v1, avicenna.json.v1; default legacy)")
+    parser.add_argument("--slow-fraction", type=float, default=0.0,
+                        help="Fraction of in-process clients that are slow consumers")
+    parser.add_argument("--slow-delay", type=float, default=0.05, help="Per-message delay of slow clients")
+    parser.add_argument("--settle", type=float, default=5, help="Seconds to wait for in-flight deliveries")
+    parser.add_argument("--port", type=int, default=8765, help="Port for localhost mode")
+    parser.add_argument("--path", default="/ws/ws/{diagnosis_id}", help="WebSocket path template")
+    parser.add_argument("--connect-concurrency", type=int, default=200,
+                        help="Concurrent handshakes in localhost mode")
+    parser.add_argument("--seed", type=int, default=None, help="Random seed")
+    parser.add_argument("--json", action="store_true", help="Print the report as JSON")
+    parser.add_argument("--verbose", action="store_true", help="Keep per-broadcast logging")
+    return parser.parse_args(argv)
+
+
+def main(argv: Optional[List[str]] = None) -> Dict[str, Any]:
+    args = parse_args(argv)
+    if args.seed is not None:
+        random.seed(args.seed)
+
+    # Per-broadcast info logs would dominate the measurement
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.WARNING)
+
+    report = asyncio.run(run(args))
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        print_report(report)
+    return report
+
+
+if __name__ == "__main__":
+    main()
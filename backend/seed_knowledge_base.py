@@ -7,6 +7,7 @@ Usage:
 """
 
 from app.database import SessionLocal, engine, Base
+import app.core.kb_cache  # noqa: F401  (bumps the KB version on commit, so running workers reload)
 from app.models.avicenna_knowledge_base import (
     AvicennaDisease, AvicennaTongueDiagnosis, AvicennaPulseDiagnosis,
     AvicennaHerbalRemedyDictionary, AvicennaMizajBalanceGuide
@@ -0,0 +1,1252 @@
+"""
+Cache Layer Tests
+
+Tests for app/core/cache.py: the in-process L1, namespace versions and
+the cached / cache_invalidate decorators. Redis is replaced by a small
+in-memory fake so the tests run without a server.
+"""
+
+import asyncio
+import fnmatch
+import itertools
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from app.core.cache import (
+    CacheEntry,
+    LocalCache,
+    RedisCache,
+    cache_invalidate,
+    cache_key,
+    cached,
+    cached_many,
+    key_namespace,
+)
+from app.core.cache_backends import LocalBackend
+from app.core.cache_metrics import CacheMetrics, key_labels
+from app.core.cache_warmer import CountMinSketch, RefreshAheadWarmer
+from app.core.cache_serializers import COMPRESSED, CacheCodec
+import app.core.cache as cache_module
+
+
+class FakeRedis:
+    """Just enough of the redis client for RedisCache"""
+
+    def __init__(self):
+        self.data = {}
+        self.expiry = {}
+        self.calls = []
+
+    def _alive(self, key):
+        expires = self.expiry.get(key)
+        if expires is not None and expires <= time.time():
+            self.data.pop(key, None)
+            self.expiry.pop(key, None)
+        return key in self.data
+
+    def ping(self):
+        return True
+
+    def get(self, key):
+        self.calls.append(("get", key))
+        return self.data.get(key) if self._alive(key) else None
+
+    def mget(self, keys):
+        self.calls.append(("mget", tuple(keys)))
+        return [self.data.get(key) if self._alive(key) else None for key in keys]
+
+    def pipeline(self, transaction=True):
+        return FakePipeline(self)
+
+    def set(self, key, value, nx=False, px=None):
+        if nx and self._alive(key):
+            return None
+        self.data[key] = value.encode() if isinstance(value, str) else value
+        if px is not None:
+            self.expiry[key] = time.time() + px / 1000
+        return True
+
+    def eval(self, script, numkeys, key, token):
+        if self.data.get(key) == token.encode():
+            return self.delete(key)
+        return 0
+
+    def setex(self, key, ttl, value):
+        self.calls.append(("setex", key))
+        self.data[key] = value.encode() if isinstance(value, str) else value
+        self.expiry[key] = time.time() + ttl
+
+    def delete(self, *keys):
+        return sum(1 for key in keys if self.data.pop(key, None) is not None)
+
+    unlink = delete
+
+    def incr(self, key):
+        self.data[key] = str(int(self.data.get(key, 0)) + 1).encode()
+        return int(self.data[key])
+
+    def keys(self, pattern):
+        self.calls.append(("keys", pattern))
+        return [key for key in list(self.data) if fnmatch.fnmatch(key, pattern)]
+
+    def scan_iter(self, match="*", count=None):
+        return iter([key for key in list(self.data) if fnmatch.fnmatch(key, match)])
+
+    def flushdb(self):
+        self.data.clear()
+
+    def info(self):
+        return {}
+
+
+class FakePipeline:
+    """Buffers commands and runs them on execute, like a redis pipeline"""
+
+    def __init__(self, redis):
+        self.redis = redis
+        self.commands = []
+
+    def __getattr__(self, name):
+        def queue(*args, **kwargs):
+            self.commands.append((name, args, kwargs))
+            return self
+        return queue
+
+    def execute(self):
+        self.redis.calls.append(("execute", len(self.commands)))
+        return [getattr(self.redis, name)(*args, **kwargs) for name, args, kwargs in self.commands]
+
+
+class FakeAsyncRedis:
+    """redis.asyncio facade over a FakeRedis, sharing its data"""
+
+    def __init__(self, redis):
+        self.redis = redis
+
+    def pipeline(self, transaction=True):
+        pipeline = FakePipeline(self.redis)
+        sync_execute = pipeline.execute
+
+        async def execute():
+            return sync_execute()
+
+        pipeline.execute = execute
+        return pipeline
+
+    def __getattr__(self, name):
+        method = getattr(self.redis, name)
+
+        async def call(*args, **kwargs):
+            self.redis.calls.append(("async", name))
+            return method(*args, **kwargs)
+        return call
+
+
+def make_cache(**kwargs):
+    cache = RedisCache("redis://127.0.0.1:1/0", backend="redis", **kwargs)
+    cache.client = fake = FakeRedis()
+    cache.get_async_client = lambda: FakeAsyncRedis(fake) if cache.client else None
+    return cache
+
+
+@pytest.fixture
+def cache(monkeypatch):
+    cache = make_cache(version_check_seconds=0)
+    monkeypatch.setattr(cache_module, "cache", cache)
+    return cache
+
+
+class TestLocalCache:
+    """Test the in-process LRU"""
+
+    def test_lru_eviction(self):
+        """Test that the least recently used entry is evicted first"""
+        local = LocalCache(max_entries=2)
+        local.set("a:1", 1)
+        local.set("a:2", 2)
+        local.get("a:1")
+        local.set("a:3", 3)
+
+        assert local.get("a:1") == 1
+        assert local.get("a:2") is cache_module._MISSING
+        assert local.get("a:3") == 3
+
+    def test_ttl_expiry(self):
+        """Test that expired entries are misses"""
+        local = LocalCache(ttl_seconds=0)
+        local.set("a:1", 1)
+
+        assert local.get("a:1") is cache_module._MISSING
+
+    def test_version_mismatch_is_a_miss(self):
+        """Test that entries stamped with an older version are ignored"""
+        local = LocalCache()
+        local.set("a:1", 1, version=3)
+
+        assert local.get("a:1", version=3) == 1
+        assert local.get("a:1", version=4) is cache_module._MISSING
+
+    def test_hits_are_independent_copies(self):
+        """Test that mutating a returned value doesn't change the next hit"""
+        local = LocalCache()
+        value = {"x": [1]}
+        local.set("a:1", value)
+        value["x"].append(99)
+
+        local.get("a:1")["x"].append(2)
+        assert local.get("a:1") == {"x": [1]}
+
+        local.set("a:2", CacheEntry({"x": [1]}, 10.0, 0.5))
+        local.get("a:2").value["x"].append(2)
+        assert local.get("a:2") == CacheEntry({"x": [1]}, 10.0, 0.5)
+
+    def test_key_namespace(self):
+        """Test namespace extraction from keys and patterns"""
+        assert key_namespace("recommendations:get:abc") == "recommendations"
+        assert key_namespace("recommendations:*") == "recommendations"
+        assert key_namespace("plain") == "plain"
+
+
+class TestTwoTierCache:
+    """Test L1 in front of Redis"""
+
+    def test_hot_reads_skip_redis(self, cache):
+        """Test that repeated reads are served from L1"""
+        cache.set("kb:disease:1", {"name": "Sar'"})
+        cache.client.calls.clear()
+
+        for _ in range(10):
+            assert cache.get("kb:disease:1") == {"name": "Sar'"}
+
+        assert ("get", "kb:disease:1") not in cache.client.calls
+        assert cache.get_stats()["l1"]["hits"] >= 10
+
+    def test_mutating_a_result_does_not_corrupt_l1(self, cache):
+        """Test that callers may mutate what get() and @cached return"""
+        cache.set("recommendations:1", {"herbs": ["chamomile"]})
+        cache.get("recommendations:1")["herbs"].append("saffron")
+        assert cache.get("recommendations:1") == {"herbs": ["chamomile"]}
+
+        @cached(ttl_seconds=60, prefix="profile")
+        def get_profile(patient_id: int):
+            return {"patient_id": patient_id, "tags": []}
+
+        get_profile(1)["tags"].append("mutated")
+        assert get_profile(1) == {"patient_id": 1, "tags": []}
+
+    def test_redis_hit_fills_l1(self, cache):
+        """Test that a value read from Redis is kept in L1"""
+        other = make_cache(version_check_seconds=0)
+        other.client = cache.client
+        other.set("kb:disease:2", [1, 2])
+
+        assert cache.get("kb:disease:2") == [1, 2]
+        cache.client.calls.clear()
+        assert cache.get("kb:disease:2") == [1, 2]
+        assert ("get", "kb:disease:2") not in cache.client.calls
+
+    def test_invalidation_reaches_other_workers(self, cache):
+        """Test that a namespace bump on one worker invalidates L1 on another"""
+        worker_a = cache
+        worker_b = make_cache(version_check_seconds=0)
+        worker_b.client = worker_a.client
+
+        worker_a.set("kb:disease:1", "old")
+        assert worker_b.get("kb:disease:1") == "old"
+
+        worker_a.invalidate_namespace("kb")
+        assert worker_b.get("kb:disease:1") is None
+
+        worker_a.set("kb:disease:1", "new")
+        assert worker_b.get("kb:disease:1") == "new"
+
+    def test_version_checks_are_rate_limited(self):
+        """Test that namespace versions are re-read at most once per interval"""
+        cache = make_cache(version_check_seconds=60)
+        cache.set("kb:a", 1)
+        cache.client.calls.clear()
+
+        for _ in range(5):
+            cache.get("kb:a")
+
+        assert cache.client.calls == []
+
+    def test_l1_can_be_disabled(self):
+        """Test that local_max_entries=0 reads straight from Redis"""
+        cache = make_cache(local_max_entries=0)
+        cache.set("kb:a", 1)
+        cache.client.calls.clear()
+
+        assert cache.get("kb:a") == 1
+        assert ("get", "kb:g0:a") in cache.client.calls
+        assert cache.get_stats()["l1"] is None
+
+
+class TestNamespaceGenerations:
+    """Test generation-stamped keys and O(1) invalidation"""
+
+    def test_keys_embed_generation(self, cache):
+        """Test that stored Redis keys carry the namespace generation"""
+        cache.set("recommendations:get:1", 1)
+        cache.invalidate_namespace("recommendations")
+        cache.set("recommendations:get:1", 2)
+
+        assert set(cache.client.data) >= {"recommendations:g0:get:1", "recommendations:g1:get:1"}
+        assert cache.get("recommendations:get:1") == 2
+
+    def test_invalidation_never_scans_keys(self, cache):
+        """Test that invalidation is one INCR, never KEYS"""
+        for i in range(100):
+            cache.set(f"analytics:score:{i}", i)
+        cache.client.calls.clear()
+
+        cache.delete_pattern("analytics:*")
+
+        assert not any(call[0] == "keys" for call in cache.client.calls)
+        assert cache.get("analytics:score:1") is None
+        assert cache.client.data["cache:version:analytics"] == b"1"
+
+    def test_other_namespaces_untouched(self, cache):
+        """Test that invalidating one namespace keeps the others"""
+        cache.set("analytics:a", 1)
+        cache.set("trending:a", 2)
+
+        cache.invalidate_namespace("analytics")
+
+        assert cache.get("analytics:a") is None
+        assert cache.get("trending:a") == 2
+
+    def test_cleaner_unlinks_old_generations(self, cache):
+        """Test that the SCAN+UNLINK cleaner removes only stale generations"""
+        cache.set("profile:1", "a")
+        cache.set("trending:1", "b")
+        cache.invalidate_namespace("profile")
+        cache.set("profile:1", "c")
+
+        assert cache.cleanup_stale_generations() == 1
+        assert "profile:g0:1" not in cache.client.data
+        assert "profile:g1:1" in cache.client.data
+        assert "trending:g0:1" in cache.client.data
+
+
+class TestDecorators:
+    """Test cached and cache_invalidate"""
+
+    def test_cached_function_runs_once(self, cache):
+        """Test that a cached function body runs once per key"""
+        calls = []
+
+        @cached(ttl_seconds=60, prefix="trending")
+        def get_trending(limit: int = 10):
+            calls.append(limit)
+            return list(range(limit))
+
+        assert get_trending(3) == [0, 1, 2]
+        assert get_trending(3) == [0, 1, 2]
+        assert calls == [3]
+
+    def test_cache_invalidate_drops_namespace(self, cache):
+        """Test that cache_invalidate makes the next call recompute"""
+        calls = []
+
+        @cached(ttl_seconds=60, prefix="trending")
+        def get_trending(limit: int = 10):
+            calls.append(limit)
+            return len(calls)
+
+        @cache_invalidate(pattern="trending:*")
+        def update():
+            pass
+
+        assert get_trending(5) == 1
+        update()
+        assert get_trending(5) == 2
+
+    @pytest.mark.asyncio
+    async def test_async_cached(self, cache):
+        """Test that async functions are cached too"""
+        calls = []
+
+        @cached(ttl_seconds=60, prefix="analytics")
+        async def get_score(recommendation_id: int):
+            calls.append(recommendation_id)
+            return {"score": 0.9}
+
+        assert await get_score(1) == {"score": 0.9}
+        assert await get_score(1) == {"score": 0.9}
+        assert calls == [1]
+
+
+class TestStampedeProtection:
+    """Test single-flight, XFetch early refresh and stale-while-revalidate"""
+
+    @pytest.mark.asyncio
+    async def test_concurrent_async_misses_compute_once(self, cache):
+        """Test that concurrent callers of a cold key share one computation"""
+        calls = []
+
+        @cached(ttl_seconds=60, prefix="trending")
+        async def get_trending(limit: int):
+            calls.append(limit)
+            await asyncio.sleep(0.05)
+            return list(range(limit))
+
+        results = await asyncio.gather(*(get_trending(3) for _ in range(50)))
+
+        assert calls == [3]
+        assert all(result == [0, 1, 2] for result in results)
+
+    def test_concurrent_sync_misses_compute_once(self, cache):
+        """Test that threads calling a cold key share one computation"""
+        calls = []
+        lock = threading.Lock()
+
+        @cached(ttl_seconds=60, prefix="trending")
+        def get_trending(limit: int):
+            with lock:
+                calls.append(limit)
+            time.sleep(0.1)
+            return limit * 2
+
+        with ThreadPoolExecutor(max_workers=16) as pool:
+            results = list(pool.map(lambda _: get_trending(4), range(16)))
+
+        assert calls == [4]
+        assert results == [8] * 16
+
+    @pytest.mark.asyncio
+    async def test_stale_value_served_while_one_caller_refreshes(self, cache):
+        """Test that only one caller recomputes an expired key and others get the old value"""
+        calls = []
+        release = asyncio.Event()
+
+        @cached(ttl_seconds=60, prefix="trending", stale_ttl_seconds=300)
+        async def get_trending(limit: int):
+            calls.append(limit)
+            await release.wait()
+            return "new"
+
+        cache.set_entry(get_trending.cache_key(5), "old", ttl_seconds=0, stale_ttl_seconds=300)
+
+        refresher = asyncio.create_task(get_trending(5))
+        await asyncio.sleep(0.01)
+        others = await asyncio.gather(*(get_trending(5) for _ in range(10)))
+        release.set()
+
+        assert others == ["old"] * 10
+        assert await refresher == "new"
+        assert calls == [5]
+        assert await get_trending(5) == "new"
+
+    def test_other_worker_holding_lock_gets_stale_value(self, cache):
+        """Test that a worker losing the Redis lock serves the previous value"""
+        calls = []
+
+        @cached(ttl_seconds=60, prefix="analytics", stale_ttl_seconds=300)
+        def get_score(recommendation_id: int):
+            calls.append(recommendation_id)
+            return 1.0
+
+        key = get_score.cache_key(7)
+        cache.set_entry(key, 0.5, ttl_seconds=0, stale_ttl_seconds=300)
+        assert cache.acquire_lock(key) is not None  # Another worker is recomputing
+
+        assert get_score(7) == 0.5
+        assert calls == []
+
+    def test_failed_refresh_serves_stale_value(self, cache):
+        """Test that an error while refreshing falls back to the stale value"""
+        @cached(ttl_seconds=60, prefix="analytics", stale_ttl_seconds=300)
+        def get_score(recommendation_id: int):
+            raise RuntimeError("database unavailable")
+
+        cache.set_entry(get_score.cache_key(8), 0.5, ttl_seconds=0, stale_ttl_seconds=300)
+
+        assert get_score(8) == 0.5
+
+    def test_lock_released_after_refresh(self, cache):
+        """Test that the recompute lock is released, including on errors"""
+        @cached(ttl_seconds=60, prefix="analytics")
+        def get_score(recommendation_id: int):
+            raise RuntimeError("boom")
+
+        with pytest.raises(RuntimeError):
+            get_score(9)
+
+        assert not any(key.startswith("cache:lock:") for key in cache.client.data)
+
+    def test_xfetch_refreshes_slow_keys_near_expiry(self, monkeypatch):
+        """Test the early-refresh decision"""
+        monkeypatch.setattr(cache_module.random, "random", lambda: 0.5)
+        now = time.time()
+
+        slow = CacheEntry("v", expires_at=now + 1, delta=10)
+        fast = CacheEntry("v", expires_at=now + 1, delta=0.001)
+
+        assert cache_module._refresh_early(slow, 1.0, now)
+        assert not cache_module._refresh_early(fast, 1.0, now)
+        assert not cache_module._refresh_early(slow, 0, now)
+
+    def test_early_refresh_recomputes_before_expiry(self, cache, monkeypatch):
+        """Test that a caller chosen by XFetch recomputes a still-valid key"""
+        monkeypatch.setattr(cache_module.random, "random", lambda: 0.5)
+        calls = []
+
+        @cached(ttl_seconds=60, prefix="trending")
+        def get_trending(limit: int):
+            calls.append(limit)
+            return "new"
+
+        key = get_trending.cache_key(2)
+        cache.set_entry(key, "old", ttl_seconds=1, delta=10)
+
+        assert get_trending(2) == "new"
+        assert calls == [2]
+
+
+class TestAsyncClient:
+    """Test the redis.asyncio path and the multi-key helpers"""
+
+    @pytest.mark.asyncio
+    async def test_async_cached_uses_async_client(self, cache):
+        """Test that async endpoints never touch the blocking client"""
+        @cached(ttl_seconds=60, prefix="analytics")
+        async def get_score(recommendation_id: int):
+            return 0.9
+
+        fake = cache.client
+        blocking = cache.client = FakeRedis()  # Any call here would block the loop
+
+        assert await get_score(1) == 0.9
+        cache.local.clear()
+        assert await get_score(1) == 0.9
+
+        assert blocking.calls == [] and blocking.data == {}
+        assert ("async", "get") in fake.calls
+        assert ("async", "setex") in fake.calls
+
+    @pytest.mark.asyncio
+    async def test_async_and_sync_share_entries(self, cache):
+        """Test that both clients read and write the same keys"""
+        await cache.aset("kb:herb:1", {"name": "chamomile"})
+        cache.local.clear()
+        assert cache.get("kb:herb:1") == {"name": "chamomile"}
+
+        await cache.ainvalidate_namespace("kb")
+        assert await cache.aget("kb:herb:1") is None
+
+    def test_mget_mset_round_trips(self, cache):
+        """Test that mset is one pipeline and mget one MGET"""
+        assert cache.mset({"kb:1": 1, "kb:2": 2, "user:3": 3}, ttl_seconds=60)
+        assert ("execute", 3) in cache.client.calls
+        cache.local.clear()
+
+        cache.client.calls.clear()
+        assert cache.mget(["kb:1", "kb:2", "user:3", "kb:404"]) == {"kb:1": 1, "kb:2": 2, "user:3": 3}
+        # One MGET for the namespace versions, one for the values
+        assert [c[0] for c in cache.client.calls] == ["mget", "mget"]
+        assert cache.client.calls[1] == ("mget", ("kb:g0:1", "kb:g0:2", "user:g0:3", "kb:g0:404"))
+
+    def test_mget_serves_l1_without_redis(self, cache):
+        """Test that keys held in L1 are not fetched again"""
+        cache.mset({"kb:1": 1, "kb:2": 2}, ttl_seconds=60)
+        cache.local.delete("kb:2")
+
+        cache.client.calls.clear()
+        assert cache.mget(["kb:1", "kb:2"]) == {"kb:1": 1, "kb:2": 2}
+        assert ("mget", ("kb:g0:2",)) in cache.client.calls
+
+    @pytest.mark.asyncio
+    async def test_amget_amset(self, cache):
+        """Test the async multi-key helpers"""
+        assert await cache.amset({"kb:1": [1], "kb:2": [2]}, ttl_seconds=60)
+        cache.local.clear()
+
+        assert await cache.amget(["kb:1", "kb:2", "kb:3"]) == {"kb:1": [1], "kb:2": [2]}
+
+    @pytest.mark.asyncio
+    async def test_async_path_without_redis(self, cache):
+        """Test that the async helpers degrade like the sync ones"""
+        cache.client = None
+
+        assert await cache.aget("kb:1") is None
+        assert await cache.amget(["kb:1"]) == {}
+        assert not await cache.aset("kb:1", 1)
+
+
+class TestCachedMany:
+    """Test batch caching with cached_many"""
+
+    def test_only_misses_are_computed(self, cache):
+        """Test that one call computes the misses and later calls hit"""
+        batches = []
+
+        @cached_many(ttl_seconds=60, prefix="recommendations")
+        def get_recommendations(recommendation_ids):
+            batches.append(list(recommendation_ids))
+            return {rec_id: {"id": rec_id} for rec_id in recommendation_ids if rec_id != 404}
+
+        assert get_recommendations([1, 2, 404]) == {1: {"id": 1}, 2: {"id": 2}}
+        assert get_recommendations([2, 3, 1]) == {2: {"id": 2}, 3: {"id": 3}, 1: {"id": 1}}
+        assert batches == [[1, 2, 404], [3]]
+
+    def test_round_trips_do_not_grow_with_batch_size(self, cache):
+        """Test that a batch is one MGET and one pipelined write"""
+        @cached_many(ttl_seconds=60, prefix="recommendations")
+        def get_recommendations(recommendation_ids):
+            return {rec_id: rec_id * 10 for rec_id in recommendation_ids}
+
+        cache.client.calls.clear()
+        get_recommendations(list(range(50)))
+
+        # The fixture re-reads namespace versions (one MGET) on every access
+        assert [c[0] for c in cache.client.calls if c[0] != "setex"] == ["mget", "mget", "mget", "execute"]
+        assert ("execute", 50) in cache.client.calls
+
+        cache.local.clear()
+        cache.client.calls.clear()
+        assert get_recommendations(list(range(50)))[49] == 490
+        assert [c[0] for c in cache.client.calls] == ["mget", "mget"]
+
+    def test_shares_entries_with_single_item_function(self, cache):
+        """Test that item_key lets a batch warm a @cached function's keys"""
+        calls = []
+
+        class Service:
+            @cached(ttl_seconds=60, prefix="recommendations")
+            def get_one(self, recommendation_id: int):
+                calls.append(recommendation_id)
+                return {"id": recommendation_id}
+
+            @cached_many(ttl_seconds=60, item_key=get_one.cache_key)
+            def get_many(self, recommendation_ids):
+                return {rec_id: {"id": rec_id} for rec_id in recommendation_ids}
+
+        service = Service()
+        service.get_many([1, 2])
+        cache.local.clear()
+
+        assert service.get_one(1) == {"id": 1}
+        assert service.get_one(2) == {"id": 2}
+        assert calls == []
+
+        service.get_one(3)
+        assert service.get_many([3]) == {3: {"id": 3}}
+        assert calls == [3]
+
+    def test_stale_entries_are_recomputed(self, cache):
+        """Test that entries past their TTL are passed to the function again"""
+        batches = []
+
+        @cached_many(ttl_seconds=60, prefix="recommendations", stale_ttl_seconds=60)
+        def get_recommendations(recommendation_ids):
+            batches.append(list(recommendation_ids))
+            return {rec_id: len(batches) for rec_id in recommendation_ids}
+
+        get_recommendations([1, 2])
+        key = get_recommendations.cache_key(1)
+        entry = cache.get_entry(key)
+        cache.set_entry(key, entry.value, ttl_seconds=-1, stale_ttl_seconds=60)
+
+        assert get_recommendations([1, 2]) == {1: 2, 2: 1}
+        assert batches == [[1, 2], [1]]
+
+    @pytest.mark.asyncio
+    async def test_async_cached_many(self, cache):
+        """Test that async batch functions use the async client"""
+        batches = []
+
+        @cached_many(ttl_seconds=60, prefix="analytics")
+        async def get_scores(recommendation_ids, window_days: int = 30):
+            batches.append(list(recommendation_ids))
+            return {rec_id: 0.5 for rec_id in recommendation_ids}
+
+        assert await get_scores([1, 2]) == {1: 0.5, 2: 0.5}
+        cache.local.clear()
+        assert await get_scores([1, 2, 3]) == {1: 0.5, 2: 0.5, 3: 0.5}
+        assert await get_scores([1], window_days=7) == {1: 0.5}
+        assert batches == [[1, 2], [3], [1]]
+        assert ("async", "mget") in cache.client.calls
+
+
+class TestKeyBuilder:
+    """Test deterministic cache keys"""
+
+    def test_self_and_session_are_ignored(self, cache):
+        """Test that service methods hit across instances and sessions"""
+        from sqlalchemy.orm import Session
+
+        calls = []
+
+        class Service:
+            @cached(ttl_seconds=60, prefix="recommendations")
+            def get_recommendation(self, db, recommendation_id: int):
+                calls.append(recommendation_id)
+                return {"id": recommendation_id}
+
+        assert Service().get_recommendation(Session(), 1) == {"id": 1}
+        assert Service().get_recommendation(Session(), 1) == {"id": 1}
+        assert calls == [1]
+
+    def test_binding_normalizes_call_styles(self):
+        """Test that positional, keyword and default arguments share a key"""
+        @cached(prefix="trending")
+        def get_trending(limit: int = 10, days: int = 7):
+            return []
+
+        assert get_trending.cache_key() == get_trending.cache_key(10) == get_trending.cache_key(days=7, limit=10)
+        assert get_trending.cache_key(5) != get_trending.cache_key(10)
+
+    def test_canonical_encoding(self):
+        """Test that equal values encode equally regardless of ordering or type"""
+        from datetime import datetime, timezone, timedelta
+
+        utc = datetime(2024, 1, 1, 12, tzinfo=timezone.utc)
+        tehran = utc.astimezone(timezone(timedelta(hours=3, minutes=30)))
+
+        assert cache_key({"a": 1, "b": [1, 2]}) == cache_key({"b": [1, 2], "a": 1})
+        assert cache_key({3, 1, 2}) == cache_key({1, 2, 3})
+        assert cache_key(utc) == cache_key(tehran)
+        assert cache_key(1) != cache_key("1")
+        assert cache_key([1, 2]) != cache_key([2, 1])
+
+    def test_objects_without_stable_encoding_are_rejected(self):
+        """Test that repr()-based keys (memory addresses) are refused"""
+        with pytest.raises(TypeError):
+            cache_key(object())
+
+    def test_key_params_and_exclude(self):
+        """Test explicit key parameters and exclusions"""
+        @cached(prefix="profile", key_params=["patient_id"])
+        def get_profile(patient_id: int, request_id: str):
+            return {}
+
+        @cached(prefix="profile", exclude=["request_id"])
+        def get_profile_excluded(patient_id: int, request_id: str):
+            return {}
+
+        assert get_profile.cache_key(1, "a") == get_profile.cache_key(1, "b")
+        assert get_profile_excluded.cache_key(1, "a") == get_profile_excluded.cache_key(1, "b")
+
+        with pytest.raises(ValueError):
+            cached(prefix="profile", exclude=["missing"])(get_profile)
+
+    def test_schema_version_and_namespace(self):
+        """Test that keys keep the prefix as namespace and embed the schema version"""
+        @cached(prefix="predictions", version=2)
+        def get_predictions(diagnosis_id: int):
+            return {}
+
+        key = get_predictions.cache_key(1)
+        assert key_namespace(key) == "predictions"
+        assert key.startswith("predictions:get_predictions:v2:")
+
+
+class TestLocalBackend:
+    """Test the in-process backend and switching to and from Redis"""
+
+    def test_lru_and_ttl(self, monkeypatch):
+        """Test that entries are bounded and expire, while counters are kept"""
+        backend = LocalBackend(max_entries=2)
+        backend.incr("cache:version:kb")
+        backend.setex("kb:g1:a", 60, "1")
+        backend.setex("kb:g1:b", 60, "2")
+        backend.get("kb:g1:a")
+        backend.setex("kb:g1:c", 60, "3")
+
+        assert backend.get("kb:g1:b") is None
+        assert backend.mget(["kb:g1:a", "kb:g1:c"]) == ["1", "3"]
+        assert backend.get("cache:version:kb") == b"1"
+
+        now = time.monotonic()
+        monkeypatch.setattr(cache_module.time, "monotonic", lambda: now + 61)
+        assert backend.get("kb:g1:a") is None
+
+    def test_locks(self):
+        """Test SET NX and the compare-and-delete release"""
+        backend = LocalBackend()
+
+        assert backend.set("cache:lock:k", "t1", nx=True, px=1000)
+        assert backend.set("cache:lock:k", "t2", nx=True, px=1000) is None
+        assert backend.eval(cache_module._RELEASE_LOCK_SCRIPT, 1, "cache:lock:k", "t2") == 0
+        assert backend.eval(cache_module._RELEASE_LOCK_SCRIPT, 1, "cache:lock:k", "t1") == 1
+        assert backend.get("cache:lock:k") is None
+
+    @pytest.mark.asyncio
+    async def test_local_mode_caches_without_redis(self, monkeypatch):
+        """Test that decorators, invalidation and async helpers work in process"""
+        local = RedisCache(backend="local", version_check_seconds=0)
+        monkeypatch.setattr(cache_module, "cache", local)
+        calls = []
+
+        @cached(ttl_seconds=60, prefix="kb")
+        async def get_herb(herb_id: int):
+            calls.append(herb_id)
+            return {"id": herb_id}
+
+        assert await get_herb(1) == {"id": 1}
+        local.local.clear()
+        assert await get_herb(1) == {"id": 1}
+        assert calls == [1]
+
+        await local.ainvalidate_namespace("kb")
+        assert await get_herb(1) == {"id": 1}
+        assert calls == [1, 1]
+        assert local.get_stats()["backend"] == "local"
+
+    def test_auto_falls_back_and_recovers(self):
+        """Test hot switching, replaying offline invalidations on recovery"""
+        auto = RedisCache("redis://127.0.0.1:1/0", backend="auto", version_check_seconds=0)
+        auto.stop_backend_monitor()
+        assert auto.backend == "local"
+
+        # Redis still holds a value from before the outage
+        redis_fake = FakeRedis()
+        redis_fake.setex("kb:g0:herb", 60, '"old"')
+        auto.redis_client = redis_fake
+
+        assert auto.set("kb:herb", "offline")
+        assert auto.get("kb:herb") == "offline"
+        auto.invalidate_namespace("kb")
+
+        assert auto.check_backend() == "redis"
+        assert auto.get("kb:herb") is None  # Invalidation was replayed
+        assert redis_fake.get("cache:version:kb") == b"1"
+        assert auto.local_backend.entries == {}
+
+        redis_fake.ping = lambda: (_ for _ in ()).throw(ConnectionError("down"))
+        assert auto.check_backend() == "local"
+        assert auto.set("kb:herb", "degraded") and auto.get("kb:herb") == "degraded"
+
+    def test_redis_mode_disables_caching(self):
+        """Test that the legacy mode stays off without Redis"""
+        off = RedisCache("redis://127.0.0.1:1/0", backend="redis")
+
+        assert off.backend is None
+        assert not off.set("kb:herb", 1)
+        assert off.get("kb:herb") is None
+
+
+class TestSerialization:
+    """Test serializers, compression and self-describing values"""
+
+    @staticmethod
+    def _value():
+        from datetime import datetime
+        from decimal import Decimal
+
+        return {
+            "created_at": datetime(2024, 3, 20, 8, 30),
+            "score": Decimal("0.875"),
+            "herbs": ["chamomile", "saffron"],
+            1: "int key",
+        }
+
+    def test_msgpack_round_trips_native_types(self):
+        """Test that datetime, Decimal and int keys survive msgpack"""
+        codec = CacheCodec("msgpack", compress_min_bytes=0)
+
+        assert codec.decode(codec.encode(self._value())) == self._value()
+
+    def test_json_encodes_datetime_and_decimal(self):
+        """Test that JSON stores datetimes as ISO strings and Decimals as floats"""
+        codec = CacheCodec("json", compress_min_bytes=0)
+
+        decoded = codec.decode(codec.encode(self._value()))
+        assert decoded["created_at"] == "2024-03-20T08:30:00"
+        assert decoded["score"] == 0.875
+
+    def test_pydantic_models_are_stored_as_dicts(self):
+        """Test that pydantic models serialize to their fields"""
+        from pydantic import BaseModel
+
+        class Herb(BaseModel):
+            name: str
+            potency: float
+
+        for name in ("json", "msgpack"):
+            codec = CacheCodec(name)
+            assert codec.decode(codec.encode(Herb(name="saffron", potency=0.5))) == {"name": "saffron", "potency": 0.5}
+
+    def test_large_values_are_compressed(self):
+        """Test that bodies above the threshold are compressed transparently"""
+        codec = CacheCodec("msgpack", compress_min_bytes=1024)
+        listing = [{"herb": "chamomile", "dosage": "2 cups daily", "index": i} for i in range(200)]
+
+        raw = codec.encode(listing)
+        assert raw[0] & COMPRESSED
+        assert len(raw) < len(codec.serializer.dumps(listing)) / 3
+        assert codec.decode(raw) == listing
+
+        small = codec.encode({"id": 1})
+        assert not small[0] & COMPRESSED
+
+    def test_values_are_self_describing(self):
+        """Test that any codec reads values written by another or before headers"""
+        json_codec = CacheCodec("json")
+        msgpack_codec = CacheCodec("msgpack")
+
+        assert json_codec.decode(msgpack_codec.encode([1, 2])) == [1, 2]
+        assert msgpack_codec.decode(json_codec.encode([1, 2])) == [1, 2]
+        assert msgpack_codec.decode(b'{"legacy": true}') == {"legacy": True}
+
+    def test_cache_stores_encoded_values(self, cache):
+        """Test that RedisCache writes codec output and reads it back"""
+        from datetime import datetime
+
+        listing = {"updated": datetime(2024, 1, 1), "items": ["x" * 50] * 100}
+        cache.codec = CacheCodec("msgpack", compress_min_bytes=1024)
+
+        assert cache.set("kb:listing", listing)
+        assert cache.client.data["kb:g0:listing"][0] & COMPRESSED
+        cache.local.clear()
+        assert cache.get("kb:listing") == listing
+
+
+class TestMetrics:
+    """Test per-namespace and per-function cache metrics"""
+
+    def test_key_labels(self):
+        """Test that keys map to (namespace, function)"""
+        assert key_labels("predictions:get_score:v1:abc") == ("predictions", "get_score")
+        assert key_labels("get_score:v1:abc") == ("get_score", "get_score")
+        assert key_labels("profile:42") == ("profile", "")
+        assert key_labels("plain") == ("plain", "")
+
+    def test_lookups_and_outcomes_per_function(self, cache):
+        """Test that hits, misses and recomputes are counted per decorated function"""
+
+        @cached(ttl_seconds=60, prefix="analytics")
+        def get_trending(limit: int = 10):
+            return list(range(limit))
+
+        get_trending(3)
+        get_trending(3)
+        cache.local.clear()
+        get_trending(3)
+
+        data = cache.metrics.snapshot()["analytics"]["get_trending"]
+        # The miss is read again under the recompute lock
+        assert data["lookups"] == {"l1_hit": 1, "l2_hit": 1, "miss": 2}
+        assert data["hit_ratio"] == 0.5
+        assert data["outcomes"] == {"fresh": 2, "stale": 0, "recomputed": 1}
+        assert data["recompute_seconds"]["count"] == 1
+        assert data["sets"] == 1
+        assert data["payload_bytes"]["count"] == 2  # The write and the L2 read
+
+    def test_direct_access_is_grouped_by_namespace(self, cache):
+        """Test that plain get/set calls are recorded under their prefix"""
+        cache.set("profile:1", {"name": "Sina"})
+        cache.get("profile:1")
+        cache.get("profile:2")
+
+        data = cache.metrics.snapshot()["profile"][""]
+        assert data["lookups"]["l1_hit"] == 1
+        assert data["lookups"]["miss"] == 1
+        assert data["set_seconds"]["count"] == 1
+
+    def test_prometheus_rendering(self, cache):
+        """Test the Prometheus text exposition output"""
+        cache.set("profile:1", {"name": "Sina"})
+        cache.get("profile:1")
+
+        text = cache.metrics.render_prometheus()
+        assert "# TYPE avicenna_cache_lookups_total counter" in text
+        assert 'avicenna_cache_lookups_total{namespace="profile",function="",result="l1_hit"} 1' in text
+        assert 'avicenna_cache_get_seconds_bucket{namespace="profile",function="",le="+Inf"} 1' in text
+        assert 'avicenna_cache_sets_total{namespace="profile",function=""} 1' in text
+
+    def test_disabled_metrics_record_nothing(self):
+        """Test that CACHE_METRICS_ENABLED=False turns recording off"""
+        metrics = CacheMetrics(enabled=False)
+        metrics.record_get("profile:1", "miss", 0.001)
+        metrics.record_set("profile:1", 0.001, 100)
+
+        assert metrics.snapshot() == {}
+
+
+class TestRefreshAheadWarmer:
+    """Test the count-min sketch and refresh-ahead warming"""
+
+    def test_sketch_never_undercounts(self):
+        """Test count-min estimates and decay"""
+        sketch = CountMinSketch(width=64, depth=4)
+        for i in range(200):
+            sketch.add(f"kb:{i % 20}")
+        for _ in range(50):
+            sketch.add("kb:hot")
+
+        assert sketch.estimate("kb:hot") >= 50
+        assert all(sketch.estimate(f"kb:{i}") >= 10 for i in range(20))
+        assert sketch.estimate("kb:hot") > sketch.estimate("kb:3")
+
+        sketch.decay()
+        assert 25 <= sketch.estimate("kb:hot") < 50
+
+    def test_tracks_hottest_keys(self, cache):
+        """Test that the warmer keeps the most requested keys as candidates"""
+        warmer = RefreshAheadWarmer(cache, top_n=2)
+        warmer.capacity = 3
+
+        def compute(n):
+            return n
+
+        for key, hits in (("kb:a", 5), ("kb:b", 1), ("kb:c", 3), ("kb:d", 1), ("kb:e", 4)):
+            for _ in range(hits):
+                warmer.record(key, compute, (1,), {}, 60)
+
+        assert [h.key for h in warmer.hottest()] == ["kb:a", "kb:e"]
+        assert "kb:b" not in warmer.candidates and "kb:d" not in warmer.candidates
+
+    @pytest.mark.asyncio
+    async def test_refreshes_hot_entries_before_expiry(self, cache):
+        """Test that only the top-N entries about to expire are recomputed"""
+        calls = []
+        computed = itertools.count(1)
+        cache.warmer = RefreshAheadWarmer(cache, top_n=2, interval_seconds=1, refresh_window_seconds=60)
+
+        @cached(ttl_seconds=30, prefix="predictions")
+        async def get_prediction(diagnosis_id: int):
+            calls.append(diagnosis_id)
+            return {"diagnosis_id": diagnosis_id, "version": next(computed)}
+
+        @cached(ttl_seconds=3600, prefix="predictions")
+        async def get_model_info():
+            calls.append("info")
+            return {"model": "v1"}
+
+        for diagnosis_id, hits in ((1, 3), (2, 1), (3, 2)):
+            for _ in range(hits):
+                await get_prediction(diagnosis_id)
+        for _ in range(5):
+            await get_model_info()
+        calls.clear()
+
+        cache.warmer.top_n = 3
+        assert await cache.warmer.run_once() == 2  # model info isn't about to expire
+        assert sorted(calls) == [1, 3]
+        cache.local.clear()
+        assert (await get_prediction(1))["version"] > 3  # Served the refreshed value
+        assert cache.warmer.get_stats()["refreshed"] == 2
+
+    @pytest.mark.asyncio
+    async def test_skips_session_calls_and_uncacheable_values(self, cache):
+        """Test that request-bound and None-returning calls are not kept warm"""
+        from sqlalchemy.orm import Session
+
+        cache.warmer = RefreshAheadWarmer(cache, top_n=5)
+
+        @cached(ttl_seconds=30, prefix="profile")
+        def get_profile(patient_id: int, db=None):
+            return None if patient_id == 404 else {"patient_id": patient_id}
+
+        for _ in range(2):
+            get_profile(1, db=Session())
+            get_profile(404)
+        assert list(cache.warmer.candidates) == [get_profile.cache_key(404)]
+
+        await cache.warmer.run_once()
+        assert cache.warmer.candidates == {}
+        assert cache.warmer.get_stats()["dropped"] == 1
+
+    @pytest.mark.asyncio
+    async def test_replays_methods_on_their_own_session(self, cache):
+        """Test that methods of session-holding services never share self.db across threads"""
+        from sqlalchemy.orm import Session
+
+        cache.warmer = RefreshAheadWarmer(cache, top_n=5)
+        seen = []
+
+        class Service:
+            def __init__(self):
+                self.db = Session()
+
+            @cached(ttl_seconds=30, prefix="recommendations")
+            def get_recommendation(self, recommendation_id: int):
+                seen.append(self.db)
+                return {"id": recommendation_id}
+
+        service = Service()
+        for recommendation_id in (1, 1, 2, 2):
+            service.get_recommendation(recommendation_id)
+
+        assert await cache.warmer.run_once() == 2
+        replay_sessions = seen[2:]
+        assert len(replay_sessions) == 2
+        assert all(db is not service.db for db in replay_sessions)
+        assert replay_sessions[0] is not replay_sessions[1]
+
+    @pytest.mark.asyncio
+    async def test_one_off_keys_are_never_refreshed(self, cache):
+        """Test that keys below min_hits, or decayed below it, are not kept warm"""
+        cache.warmer = RefreshAheadWarmer(cache, top_n=100)
+        calls = []
+
+        @cached(ttl_seconds=30, prefix="profile")
+        def get_profile(patient_id: int):
+            calls.append(patient_id)
+            return {"patient_id": patient_id}
+
+        for patient_id in range(50):
+            get_profile(patient_id)
+        cache.warmer.decay()
+        calls.clear()
+
+        assert cache.warmer.hottest() == []
+        assert await cache.warmer.run_once() == 0
+        assert calls == []
+
+        # Hot once, then cold: decay drops it
+        cache.warmer.record("kb:hot", get_profile, (1,), {}, 30)
+        cache.warmer.record("kb:hot", get_profile, (1,), {}, 30)
+        assert [h.key for h in cache.warmer.hottest()] == ["kb:hot"]
+        cache.warmer.decay()
+        assert cache.warmer.candidates == {}
+
+
+class TestKnowledgeBaseHttpCache:
+    """Test ETags, 304s and rendered-response caching for KB routes"""
+
+    @pytest.fixture
+    def client(self, cache):
+        from fastapi import FastAPI, Header
+        from fastapi.testclient import TestClient
+
+        from app.core.kb_cache import KnowledgeBaseCacheMiddleware
+
+        app = FastAPI()
+        app.add_middleware(KnowledgeBaseCacheMiddleware, max_age_seconds=60, ttl_seconds=600)
+        app.state.renders = []
+        app.state.herbs = ["chamomile"]
+
+        @app.get("/api/v1/knowledge/avicenna/herbal-remedies")
+        def list_herbs(limit: int = 20, accept_language: str = Header("fa")):
+            app.state.renders.append((limit, accept_language))
+            return {"herbs": app.state.herbs[:limit], "lang": accept_language}
+
+        @app.post("/api/v1/remedies")
+        def create_remedy(name: str):
+            app.state.herbs.append(name)
+            return {"name": name}
+
+        @app.get("/api/v1/patients/1/mizaj-treatments")
+        def patient_treatments():
+            return []
+
+        return TestClient(app)
+
+    def test_repeated_reads_are_served_from_cache(self, client):
+        """Test that the second read skips the endpoint and carries validators"""
+        first = client.get("/api/v1/knowledge/avicenna/herbal-remedies")
+        second = client.get("/api/v1/knowledge/avicenna/herbal-remedies")
+
+        assert first.json() == second.json() == {"herbs": ["chamomile"], "lang": "fa"}
+        assert first.headers["x-cache"] == "MISS" and second.headers["x-cache"] == "HIT"
+        assert first.headers["etag"] == second.headers["etag"]
+        assert first.headers["cache-control"] == "public, max-age=60, must-revalidate"
+        assert first.headers["vary"] == "Accept-Language"
+        assert client.app.state.renders == [(20, "fa")]
+
+    def test_if_none_match_returns_304(self, client):
+        """Test conditional GETs"""
+        etag = client.get("/api/v1/knowledge/avicenna/herbal-remedies").headers["etag"]
+
+        response = client.get("/api/v1/knowledge/avicenna/herbal-remedies", headers={"If-None-Match": f'"x", W/{etag}'})
+        assert response.status_code == 304
+        assert response.content == b""
+        assert response.headers["etag"] == etag
+
+        other = client.get("/api/v1/knowledge/avicenna/herbal-remedies", headers={"If-None-Match": '"stale"'})
+        assert other.status_code == 200
+
+    def test_variants_are_keyed_by_query_and_language(self, client):
+        """Test that query strings and Accept-Language select separate entries"""
+        fa = client.get("/api/v1/knowledge/avicenna/herbal-remedies")
+        en = client.get("/api/v1/knowledge/avicenna/herbal-remedies", headers={"Accept-Language": "en"})
+        limited = client.get("/api/v1/knowledge/avicenna/herbal-remedies?limit=5")
+
+        assert en.json()["lang"] == "en"
+        assert len({fa.headers["etag"], en.headers["etag"], limited.headers["etag"]}) == 3
+        assert len(client.app.state.renders) == 3
+
+    def test_kb_writes_change_the_version(self, client):
+        """Test that a successful KB write invalidates ETags and cached responses"""
+        etag = client.get("/api/v1/knowledge/avicenna/herbal-remedies").headers["etag"]
+
+        assert client.post("/api/v1/remedies?name=saffron").status_code == 200
+
+        response = client.get("/api/v1/knowledge/avicenna/herbal-remedies", headers={"If-None-Match": etag})
+        assert response.status_code == 200
+        assert response.headers["etag"] != etag
+        assert response.json()["herbs"] == ["chamomile", "saffron"]
+
+    def test_other_routes_are_untouched(self, client):
+        """Test that patient routes get no validators"""
+        response = client.get("/api/v1/patients/1/mizaj-treatments")
+
+        assert "etag" not in response.headers
+        assert "x-cache" not in response.headers
+
+
+class TestKnowledgeBaseCommitHook:
+    """Test that committed KB changes bump the version without the HTTP cache"""
+
+    @pytest.fixture
+    def db(self, cache):
+        from sqlalchemy import Column, Integer, String, create_engine
+        from sqlalchemy.orm import declarative_base, sessionmaker
+
+        import app.core.kb_cache as kb_cache
+
+        base = declarative_base()
+
+        class Plant(base):
+            __tablename__ = "medical_plants"
+            id = Column(Integer, primary_key=True)
+            name = Column(String)
+
+        class Note(base):
+            __tablename__ = "notes"
+            id = Column(Integer, primary_key=True)
+
+        # Stand-ins for the app models, which need the full model graph
+        Plant.__module__ = "app.models.avicenna_diseases"
+        assert kb_cache.is_kb_model(Plant) and not kb_cache.is_kb_model(Note)
+
+        engine = create_engine("sqlite://")
+        base.metadata.create_all(engine)
+        session = sessionmaker(bind=engine)()
+        session.models = (Plant, Note)
+        yield session
+        session.close()
+        engine.dispose()
+
+    def test_kb_commit_bumps_the_version(self, cache, db):
+        from app.core.kb_cache import get_kb_version
+
+        plant_model, _ = db.models
+        before = get_kb_version()
+        plant = plant_model(name="بابونه")
+        db.add(plant)
+        db.commit()
+        assert get_kb_version() == before + 1
+
+        db.query(plant_model).filter(plant_model.id == plant.id).update({"name": "Chamomile"})
+        db.commit()
+        assert get_kb_version() == before + 2
+
+    def test_rollbacks_and_other_models_do_not_bump(self, cache, db):
+        from app.core.kb_cache import get_kb_version
+
+        plant_model, note_model = db.models
+        before = get_kb_version()
+        db.add(plant_model(name="زعفران"))
+        db.flush()
+        db.rollback()
+
+        db.add(note_model())
+        db.commit()
+        assert get_kb_version() == before
@@ -0,0 +1,438 @@
+"""
+Knowledge Index Tests
+
+Tests for app/services/knowledge_index.py: building the immutable
+snapshot from KB rows, loading recommended herbs, vectorized scoring
+through the feature matrices, memo keys for match results and swapping
+the snapshot when the KB version moves. Rows are plain SimpleNamespace
+objects with the ORM attributes, so no database is needed.
+"""
+
+import random
+import threading
+from types import SimpleNamespace
+
+import pytest
+
+import app.services.knowledge_index as knowledge_index
+from sqlalchemy import Column, Integer, String, create_engine
+from sqlalchemy.orm import declarative_base, sessionmaker
+
+from app.services.knowledge_index import (
+    AVICENNA_WEIGHTS,
+    AYURVEDA_WEIGHTS,
+    TCM_WEIGHTS,
+    KnowledgeIndex,
+    TextPostings,
+    ValuePostings,
+    canonical_findings,
+    confidence_bucket,
+    top_herbs_query,
+)
+
+
+def avicenna_disease(id, mizaj="garm_tar", **characteristics):
+    return SimpleNamespace(
+        id=id,
+        name_fa=f"بیماری {id}",
+        name_en=f"Disease {id}",
+        mizaj=mizaj,
+        description_fa="شرح",
+        characteristics=characteristics or None,
+    )
+
+
+def tcm_pattern(id, **attributes):
+    values = {"tongue_appearance": None, "coating": None, "moisture": None, "shape": None, **attributes}
+    return SimpleNamespace(
+        id=id,
+        name_fa=f"الگو {id}",
+        name_en=f"Pattern {id}",
+        organs=["Liver"],
+        imbalance_type="excess",
+        description_fa="شرح",
+        balancing_method="clear heat",
+        **values,
+    )
+
+
+def ayurveda_disease(id, dosha="Pitta", tongue_signs=None, digestion_status=None):
+    return SimpleNamespace(
+        id=id,
+        name_fa=f"بیماری {id}",
+        name_en=f"Disease {id}",
+        dosha=dosha,
+        description_fa="شرح",
+        balancing_doshas=["Vata"],
+        tongue_signs=tongue_signs,
+        digestion_status=digestion_status,
+    )
+
+
+def sample_index(version=1):
+    return KnowledgeIndex.build(
+        version,
+        [avicenna_disease(1, color="Red", coating="Thick White"), avicenna_disease(2, mizaj=None)],
+        [tcm_pattern(10, tongue_appearance="Pale", shape="Swollen")],
+        [ayurveda_disease(20, tongue_signs="Red, Yellow coating", digestion_status="Normal agni")],
+    )
+
+
+@pytest.fixture
+def kb(monkeypatch):
+    """Controllable KB version and loader; the published index is reset afterwards"""
+    state = SimpleNamespace(version=1, loads=0, fail=False)
+
+    def load(cls, db, version):
+        state.loads += 1
+        if state.fail:
+            raise RuntimeError("database unavailable")
+        return sample_index(version)
+
+    monkeypatch.setattr(knowledge_index, "get_kb_version", lambda: state.version)
+    monkeypatch.setattr(KnowledgeIndex, "load", classmethod(load))
+    monkeypatch.setattr(knowledge_index, "_index", None)
+    return state
+
+
+class TestKnowledgeIndexBuild:
+    """Snapshot contents"""
+
+    def test_matched_attributes_are_lowercased(self):
+        index = sample_index()
+
+        disease = index.avicenna[0]
+        assert disease.color == "red"
+        assert disease.coating == "thick white"
+        assert disease.moisture == ""
+        assert disease.description == "شرح"
+
+        pattern = index.tcm[0]
+        assert pattern.tongue_appearance == "pale"
+        assert pattern.shape == "swollen"
+        assert pattern.coating == ""
+
+        ayurveda = index.ayurveda[0]
+        assert ayurveda.dosha == "Pitta"
+        assert ayurveda.dosha_text == "pitta"
+        assert ayurveda.tongue_signs == "red, yellow coating"
+        assert ayurveda.normal_digestion is True
+
+    def test_missing_attributes(self):
+        index = KnowledgeIndex.build(1, [avicenna_disease(1)], [], [ayurveda_disease(2, dosha=None)])
+
+        assert index.avicenna[0].color == ""
+        assert index.ayurveda[0].dosha_text == ""
+        assert index.ayurveda[0].normal_digestion is False
+
+    def test_snapshot_is_immutable(self):
+        index = sample_index()
+
+        assert isinstance(index.avicenna, tuple)
+        with pytest.raises(AttributeError):
+            index.avicenna[0].color = "pale"
+        with pytest.raises(AttributeError):
+            index.extra = True
+
+
+def reference_scores(findings, avicenna, tcm, ayurveda):
+    """Scores as KnowledgeMatchingService computed them by scanning every row"""
+    def contains(key, text):
+        return bool(findings.get(key) and text and findings[key].lower() in str(text).lower())
+
+    scores = {"avicenna": [], "tcm": [], "ayurveda": []}
+    for d in avicenna:
+        c = d.characteristics or {}
+        score = AVICENNA_WEIGHTS["mizaj"] if findings.get("mizaj") == d.mizaj else 0.0
+        score += sum(AVICENNA_WEIGHTS[key] for key in ("color", "coating", "moisture") if contains(key, c.get(key)))
+        scores["avicenna"].append(score)
+    for p in tcm:
+        texts = {"color": p.tongue_appearance, "coating": p.coating, "moisture": p.moisture, "shape": p.shape}
+        scores["tcm"].append(sum(TCM_WEIGHTS[key] for key, text in texts.items() if contains(key, text)))
+    for d in ayurveda:
+        score = 0.0
+        if findings.get("dosha") and d.dosha and findings["dosha"] in str(d.dosha).lower():
+            score += AYURVEDA_WEIGHTS["dosha"]
+        score += sum(AYURVEDA_WEIGHTS[key] for key in ("color", "coating") if contains(key, d.tongue_signs))
+        if findings.get("moisture") and d.digestion_status and "normal" in str(d.digestion_status).lower():
+            score += AYURVEDA_WEIGHTS["moisture"]
+        scores["ayurveda"].append(score)
+    return scores
+
+
+def reference_top(scores, confidence, threshold=0.5, limit=5):
+    """Positions the matchers returned: sorted by rounded confidence, stable, top 5"""
+    matched = [(round(score * confidence, 2), position) for position, score in enumerate(scores) if score >= threshold]
+    matched.sort(key=lambda item: item[0], reverse=True)
+    return [position for _, position in matched[:limit]]
+
+
+def random_kb(rng, size=300):
+    words = ["red", "pale", "dark red", "thick", "thin white", "yellow", "dry", "wet", "swollen", "normal", None]
+    mizajes = ["garm_tar", "sard_khoshk", "garm_khoshk", None]
+    doshas = ["Vata", "Pitta", "Kapha", "Vata-Pitta", None]
+
+    avicenna = [
+        avicenna_disease(
+            i, mizaj=rng.choice(mizajes),
+            color=rng.choice(words), coating=rng.choice(words), moisture=rng.choice(words),
+        )
+        for i in range(size)
+    ]
+    tcm = [
+        tcm_pattern(
+            i, tongue_appearance=rng.choice(words), coating=rng.choice(words),
+            moisture=rng.choice(words), shape=rng.choice(words),
+        )
+        for i in range(size)
+    ]
+    ayurveda = [
+        ayurveda_disease(
+            i, dosha=rng.choice(doshas),
+            tongue_signs=", ".join(rng.sample(words[:-1], 2)),
+            digestion_status=rng.choice(["Normal", "weak agni", None]),
+        )
+        for i in range(size)
+    ]
+    return words, mizajes, avicenna, tcm, ayurveda
+
+
+HerbBase = declarative_base()
+
+
+class Herb(HerbBase):
+    """Stand-in herb table with the columns the windowed query uses"""
+    __tablename__ = "herbs"
+
+    id = Column(Integer, primary_key=True)
+    disease_id = Column(Integer, index=True)
+    name_fa = Column(String)
+    name_en = Column(String)
+    dosage = Column(String)
+    frequency = Column(String)
+
+
+class TestHerbs:
+    """Recommended herbs loaded with the index"""
+
+    def test_top_herbs_query_limits_each_disease(self):
+        engine = create_engine("sqlite://")
+        HerbBase.metadata.create_all(engine)
+        db = sessionmaker(bind=engine)()
+        # Interleaved so per-disease order comes from the window, not insertion
+        for herb_id in range(1, 13):
+            db.add(Herb(id=herb_id, disease_id=herb_id % 3, name_fa=f"h{herb_id}", name_en=f"h{herb_id}"))
+        db.add(Herb(id=20, disease_id=7, name_fa="only", name_en="only"))
+        db.commit()
+
+        rows = top_herbs_query(db, Herb, Herb.disease_id).all()
+
+        assert [(row.disease_id, row.id) for row in rows] == [
+            (0, 3), (0, 6), (0, 9),
+            (1, 1), (1, 4), (1, 7),
+            (2, 2), (2, 5), (2, 8),
+            (7, 20),
+        ]
+        db.close()
+
+    def test_herbs_attached_to_entries(self):
+        herbs = [
+            SimpleNamespace(disease_id=1, name_fa=f"گیاه {i}", name_en=f"Herb {i}", dosage="5g", frequency="daily")
+            for i in range(4)
+        ]
+        formulas = [SimpleNamespace(pattern_id=10, name_fa="فرمول", name_en="Formula", actions="clears heat", dosage="9g")]
+
+        index = KnowledgeIndex.build(
+            1,
+            [avicenna_disease(1), avicenna_disease(2)],
+            [tcm_pattern(10)],
+            [ayurveda_disease(20)],
+            avicenna_herbs=herbs,
+            tcm_herbs=formulas,
+        )
+
+        assert [herb["name_en"] for herb in index.avicenna[0].herbs] == ["Herb 0", "Herb 1", "Herb 2"]
+        assert index.avicenna[0].herbs[0] == {"name": "گیاه 0", "name_en": "Herb 0", "dosage": "5g", "frequency": "daily"}
+        assert index.avicenna[1].herbs == ()
+        assert index.tcm[0].herbs == ({"name": "فرمول", "name_en": "Formula", "actions": "clears heat", "dosage": "9g"},)
+        assert index.ayurveda[0].herbs == ()
+
+
+class TestFeatureMatrix:
+    """Vectorized scoring through the postings and one-hot matrices"""
+
+    def test_text_postings_match_substrings(self):
+        postings = TextPostings(["red", "dark red", "", "pale", "red"])
+
+        assert postings.codes == [0, 1, -1, 2, 0]
+        assert postings.lookup("red") == (0, 1)
+        assert postings.lookup("dark") == (1,)
+        assert postings.lookup("blue") == ()
+        assert postings.lookup(None) == ()
+        assert "red" in postings.memo
+
+    def test_value_postings(self):
+        postings = ValuePostings(["garm_tar", None, "garm_tar"])
+
+        assert postings.codes == [0, 1, 0]
+        assert postings.lookup("garm_tar") == (0,)
+        assert postings.lookup(None) == (1,)
+        assert postings.lookup(["unhashable"]) == ()
+
+    def test_scores_in_hundredths(self):
+        index = sample_index()
+
+        scores = index.avicenna_matrix.scores({"mizaj": "garm_tar", "color": "red", "coating": "white"})
+
+        assert scores.tolist() == [70, 0]
+
+    def test_missing_mizaj_matches_entries_without_one(self):
+        index = sample_index()
+
+        assert index.avicenna_matrix.scores({"color": "x"}).tolist() == [0, 30]
+
+    def test_non_text_finding_zeroes_entries_with_the_attribute(self):
+        index = sample_index()
+
+        # findings["color"].lower() raised for entries with a color
+        scores = index.avicenna_matrix.scores({"mizaj": None, "color": 5, "coating": "thick"})
+
+        assert scores.tolist() == [0, 30]
+
+    def test_candidates_below_threshold_are_pruned(self):
+        index = sample_index()
+
+        assert index.avicenna_matrix.candidates({"mizaj": "sard_khoshk", "color": "red"}, 0.5, 0.9) == []
+        assert index.avicenna_matrix.candidates({"mizaj": "garm_tar", "color": "red"}, 0.5, 0.9) == [(0, 0.5)]
+
+    def test_rounding_ties_are_kept(self):
+        diseases = [avicenna_disease(i, color="red" if i >= 6 else "pale", coating="thick") for i in range(8)]
+        matrix = KnowledgeIndex.build(1, diseases, [], []).avicenna_matrix
+        findings = {"mizaj": "garm_tar", "color": "red", "coating": "thick"}
+
+        # 0.7 for the last two, 0.5 for the rest: two confidences at 0.9,
+        # one at 0.01, where knowledge-base order decides
+        assert [p for p, _ in matrix.candidates(findings, 0.5, 0.9)] == [6, 7, 0, 1, 2, 3, 4, 5]
+        assert len(matrix.candidates(findings, 0.5, 0.01)) == 8
+
+        many = [avicenna_disease(i, color="red", coating="thick" if i < 10 else None) for i in range(20)]
+        matrix = KnowledgeIndex.build(1, many, [], []).avicenna_matrix
+        # 0.7 for ten entries: the 0.5 ones can't make the top 5
+        assert [p for p, _ in matrix.candidates(findings, 0.5, 0.9)] == list(range(10))
+
+    def test_matches_reference_scoring(self):
+        rng = random.Random(7)
+        words, mizajes, avicenna, tcm, ayurveda = random_kb(rng)
+        index = KnowledgeIndex.build(1, avicenna, tcm, ayurveda)
+
+        for _ in range(200):
+            findings = {
+                key: rng.choice(words + ["Red", "WHITE", ""])
+                for key in ("color", "coating", "moisture", "shape")
+            }
+            findings["mizaj"] = rng.choice(mizajes)
+            findings["dosha"] = rng.choice(["vata", "pitta", "Kapha", None])
+            confidence = rng.choice([0.01, 0.33, 0.5, 0.87, 1.0])
+            expected = reference_scores(findings, avicenna, tcm, ayurveda)
+
+            for tradition, matrix in (
+                ("avicenna", index.avicenna_matrix),
+                ("tcm", index.tcm_matrix),
+                ("ayurveda", index.ayurveda_matrix),
+            ):
+                scores = matrix.scores(findings) / 100
+                assert scores == pytest.approx(expected[tradition]), tradition
+
+                found = dict(matrix.candidates(findings, 0.5, confidence))
+                assert set(reference_top(expected[tradition], confidence)) <= set(found), tradition
+
+
+class TestMatchMemoKeys:
+    """Normalization behind memoized match results"""
+
+    def test_equivalent_findings_share_a_key(self):
+        a = canonical_findings({"color": "Red", "coating": "", "mizaj": "garm_tar", "note": "x"})
+        b = canonical_findings({"color": "red", "mizaj": "garm_tar", "size": "large"})
+
+        assert a == b
+
+    def test_findings_that_score_differently_dont(self):
+        base = canonical_findings({"color": "red"})
+
+        # Mizaj and dosha are compared as is; a missing mizaj differs from ""
+        assert canonical_findings({"color": "red", "mizaj": ""}) != base
+        assert canonical_findings({"color": "red", "dosha": "Vata"}) != canonical_findings({"color": "red", "dosha": "vata"})
+        # Non-text values zero scores, so they can't collide with text
+        assert canonical_findings({"color": 1}) != canonical_findings({"color": "1"})
+
+    def test_confidence_bucket(self):
+        assert confidence_bucket(0.853, 0.01) == 0.85
+        assert confidence_bucket(0.856, 0.01) == 0.86
+        assert confidence_bucket(0.8, 0.05) == 0.8
+        assert confidence_bucket(0.853, 0) == 0.853
+        assert confidence_bucket(None, 0.01) is None
+        assert confidence_bucket("high", 0.01) is None
+        assert confidence_bucket(float("nan"), 0.01) is None
+
+
+class TestKnowledgeIndexSwap:
+    """Reloading when the KB version moves"""
+
+    def test_loaded_once_per_version(self, kb):
+        first = knowledge_index.get_knowledge_index()
+
+        assert knowledge_index.get_knowledge_index() is first
+        assert kb.loads == 1
+
+        kb.version = 2
+        second = knowledge_index.get_knowledge_index()
+
+        assert second is not first
+        assert second.version == 2
+        assert kb.loads == 2
+
+    def test_failed_reload_keeps_previous_index(self, kb):
+        first = knowledge_index.get_knowledge_index()
+
+        kb.version = 2
+        kb.fail = True
+
+        assert knowledge_index.get_knowledge_index() is first
+
+    def test_first_load_failure_raises(self, kb):
+        kb.fail = True
+
+        with pytest.raises(RuntimeError):
+            knowledge_index.get_knowledge_index()
+
+    def test_startup_load_failure_is_not_fatal(self, kb):
+        kb.fail = True
+
+        assert knowledge_index.load_knowledge_index() is None
+
+    def test_readers_keep_old_index_during_reload(self, kb):
+        first = knowledge_index.get_knowledge_index()
+        kb.version = 2
+
+        # Another caller is rebuilding: don't wait for it
+        with knowledge_index._reload_lock:
+            assert knowledge_index.get_knowledge_index() is first
+
+        assert knowledge_index.get_knowledge_index().version == 2
+
+    def test_concurrent_callers_load_once(self, kb):
+        knowledge_index.get_knowledge_index()
+        kb.version = 2
+        results = []
+
+        threads = [
+            threading.Thread(target=lambda: results.append(knowledge_index.get_knowledge_index()))
+            for _ in range(8)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        assert len(results) == 8
+        assert kb.loads == 2
@@ -0,0 +1,184 @@
+"""
+Knowledge Matching Tests
+
+Tests for KnowledgeMatchingService.get_all_matches: matching the three
+traditions concurrently within a time budget and memoizing results by
+normalized findings. The knowledge index is built in memory from the
+row helpers in test_knowledge_index, and the diagnosis is passed in
+directly, so no database is needed.
+"""
+
+import importlib
+import sys
+import time
+import types
+from types import SimpleNamespace
+
+import pytest
+
+import app.core.cache as cache_module
+from app.core.cache import RedisCache
+from app.services.knowledge_index import KnowledgeIndex
+
+from test_knowledge_index import avicenna_disease, ayurveda_disease, tcm_pattern
+
+try:
+    import app.models.sensor_and_diagnostic_data  # noqa: F401
+    MODELS_IMPORT = True
+except Exception:
+    # The model module redefines 'pulse_analyses'; these tests pass the
+    # diagnosis in, so only the DiagnosticFinding name has to import
+    MODELS_IMPORT = False
+
+FINDINGS = {"mizaj": "garm_tar", "color": "red", "coating": "thick white", "dosha": "pitta"}
+
+
+def matching_index(version=1):
+    return KnowledgeIndex.build(
+        version,
+        [avicenna_disease(1, color="Red", coating="Thick White"), avicenna_disease(2, color="Pale")],
+        [tcm_pattern(10, tongue_appearance="Red", coating="Thick White"), tcm_pattern(11, shape="Swollen")],
+        [ayurveda_disease(20, tongue_signs="Red, thick white coating")],
+    )
+
+
+def diagnosis(findings=None, confidence=0.8):
+    return SimpleNamespace(findings=findings or dict(FINDINGS), confidence=confidence, analysis_type="tongue")
+
+
+@pytest.fixture
+def matching(monkeypatch):
+    """The service module with a stub index and an in-process cache"""
+    if not MODELS_IMPORT:
+        models = types.ModuleType("app.models.sensor_and_diagnostic_data")
+        models.DiagnosticFinding = object
+        monkeypatch.setitem(sys.modules, models.__name__, models)
+    monkeypatch.delitem(sys.modules, "app.services.knowledge_matching_service", raising=False)
+    module = importlib.import_module("app.services.knowledge_matching_service")
+
+    state = SimpleNamespace(index=matching_index(), module=module, service=module.KnowledgeMatchingService())
+    monkeypatch.setattr(module, "get_knowledge_index", lambda db=None: state.index)
+    monkeypatch.setattr(cache_module, "cache", RedisCache(backend="local", version_check_seconds=0))
+    monkeypatch.setattr(module.settings, "KNOWLEDGE_MATCH_MEMO_TTL_SECONDS", 0)
+    monkeypatch.setattr(module.settings, "KNOWLEDGE_MATCH_BUDGET_SECONDS", 5.0)
+    return state
+
+
+class TestConcurrentMatching:
+    """Matching the three traditions within a time budget"""
+
+    @pytest.mark.asyncio
+    async def test_same_results_as_sequential_matching(self, matching):
+        service = matching.service
+        result = await service.get_all_matches(1, None, diagnosis=diagnosis())
+
+        assert result["avicenna_matches"] == await service.match_avicenna_diseases(FINDINGS, 0.8, None)
+        assert result["tcm_matches"] == await service.match_tcm_patterns(FINDINGS, 0.8, None)
+        assert result["ayurveda_matches"] == await service.match_ayurveda_diseases(FINDINGS, 0.8, None)
+        assert result["avicenna_matches"] and result["tcm_matches"] and result["ayurveda_matches"]
+        assert "timed_out" not in result
+
+    @pytest.mark.asyncio
+    async def test_slow_tradition_times_out(self, matching, monkeypatch):
+        service = matching.service
+
+        def slow_tcm(findings, confidence, index):
+            time.sleep(0.5)
+            return [{"pattern_id": 10}]
+
+        monkeypatch.setattr(service, "_match_tcm", slow_tcm)
+        started = time.monotonic()
+        result = await service.get_all_matches(1, None, diagnosis=diagnosis(), budget_seconds=0.1)
+
+        assert time.monotonic() - started < 0.4
+        assert result["timed_out"] == ["tcm"]
+        assert result["tcm_matches"] == []
+        assert result["avicenna_matches"] and result["ayurveda_matches"]
+
+    @pytest.mark.asyncio
+    async def test_failing_tradition_keeps_the_others(self, matching, monkeypatch):
+        service = matching.service
+
+        def broken(findings, confidence, index):
+            raise RuntimeError("bad entry")
+
+        monkeypatch.setattr(service, "_match_avicenna", broken)
+        result = await service.get_all_matches(1, None, diagnosis=diagnosis())
+
+        assert "error" not in result
+        assert result["avicenna_matches"] == []
+        assert result["tcm_matches"] and result["ayurveda_matches"]
+        assert result["total_matches"] == len(result["tcm_matches"]) + len(result["ayurveda_matches"])
+
+
+@pytest.fixture
+def memo(matching, monkeypatch):
+    """Memoization on, with a count of matcher calls per tradition"""
+    monkeypatch.setattr(matching.module.settings, "KNOWLEDGE_MATCH_MEMO_TTL_SECONDS", 3600)
+    monkeypatch.setattr(matching.module.settings, "KNOWLEDGE_MATCH_CONFIDENCE_STEP", 0.01)
+    matching.calls = []
+
+    for tradition in ("_match_avicenna", "_match_tcm", "_match_ayurveda"):
+        def counted(findings, confidence, index, match=getattr(matching.service, tradition), tradition=tradition):
+            matching.calls.append(tradition)
+            return match(findings, confidence, index)
+
+        monkeypatch.setattr(matching.service, tradition, counted)
+    return matching
+
+
+class TestMatchMemo:
+    """Memoized results by normalized findings"""
+
+    @pytest.mark.asyncio
+    async def test_equivalent_findings_hit_without_matching(self, memo):
+        first = await memo.service.get_all_matches(1, None, diagnosis=diagnosis())
+        assert len(memo.calls) == 3
+
+        memo.calls.clear()
+        equivalent = {**FINDINGS, "color": "Red", "size": "large"}
+        second = await memo.service.get_all_matches(2, None, diagnosis=diagnosis(equivalent, confidence=0.801))
+
+        assert memo.calls == []
+        assert [m["disease_id"] for m in second["avicenna_matches"]] == [m["disease_id"] for m in first["avicenna_matches"]]
+        assert second["tcm_matches"][0]["confidence"] == first["tcm_matches"][0]["confidence"]
+
+    @pytest.mark.asyncio
+    async def test_hit_rebuilds_supporting_findings(self, memo):
+        await memo.service.get_all_matches(1, None, diagnosis=diagnosis())
+        equivalent = {**FINDINGS, "color": "Red", "size": "large"}
+        result = await memo.service.get_all_matches(2, None, diagnosis=diagnosis(equivalent))
+
+        expected = memo.service._get_supporting_findings(equivalent, None)
+        assert "size: large" in expected and "color: Red" in expected
+        for tradition in ("avicenna_matches", "tcm_matches", "ayurveda_matches"):
+            assert all(m["supporting_findings"] == expected for m in result[tradition])
+
+    @pytest.mark.asyncio
+    async def test_results_cut_short_are_not_stored(self, memo, monkeypatch):
+        match_tcm = memo.service._match_tcm
+
+        def slow_tcm(findings, confidence, index):
+            time.sleep(0.3)
+            return []
+
+        monkeypatch.setattr(memo.service, "_match_tcm", slow_tcm)
+        result = await memo.service.get_all_matches(1, None, diagnosis=diagnosis(), budget_seconds=0.05)
+        assert result["timed_out"] == ["tcm"]
+
+        monkeypatch.setattr(memo.service, "_match_tcm", match_tcm)
+        memo.calls.clear()
+        result = await memo.service.get_all_matches(1, None, diagnosis=diagnosis())
+
+        assert sorted(memo.calls) == ["_match_avicenna", "_match_ayurveda", "_match_tcm"]
+        assert result["tcm_matches"] and "timed_out" not in result
+
+    @pytest.mark.asyncio
+    async def test_kb_version_bump_misses(self, memo):
+        await memo.service.get_all_matches(1, None, diagnosis=diagnosis())
+        memo.index = matching_index(version=2)
+        memo.calls.clear()
+
+        await memo.service.get_all_matches(1, None, diagnosis=diagnosis())
+
+        assert len(memo.calls) == 3
@@ -0,0 +1,1244 @@
+"""
+WebSocket Service Tests
+
+Unit tests for app/services/websocket_*: connection management, replay
+buffers, send queues, the broadcast backplane, the wire protocol, topic
+subscriptions, the sweeper and handshake authorization caching. Sockets
+and Redis are faked and nothing imports app.main, so these run without
+the full application. Endpoint tests live in test_websocket.py.
+"""
+
+import asyncio
+import json
+from unittest.mock import MagicMock, AsyncMock, patch
+import msgpack
+import pytest
+from app.services.websocket_manager import (
+    ConnectionManager,
+    OverflowPolicy,
+    ReplayBuffer,
+    get_connection_manager,
+    parse_topic,
+    WebSocketMessage,
+)
+from app.services.websocket_backplane import InMemoryBackplane, InMemoryHub, RedisBackplane
+from app.services.websocket_protocol import (
+    CODECS,
+    LEGACY_CODEC,
+    AckFrame,
+    PingFrame,
+    PongFrame,
+    ProtocolError,
+    negotiate,
+)
+
+
+class TestConnectionManager:
+    """Test ConnectionManager class functionality"""
+
+    def test_singleton_pattern(self):
+        """Test that get_connection_manager returns same instance"""
+        manager1 = get_connection_manager()
+        manager2 = get_connection_manager()
+        assert manager1 is manager2
+
+    @pytest.mark.asyncio
+    async def test_connect_creates_entry(self):
+        """Test that connect creates connection entry"""
+        manager = ConnectionManager()
+        mock_ws = AsyncMock()
+        mock_ws.accept = AsyncMock()
+
+        await manager.connect(diagnosis_id=1, user_id=100, websocket=mock_ws)
+
+        assert 1 in manager.active_connections
+        assert mock_ws in manager.active_connections[1]
+        mock_ws.accept.assert_called_once()
+
+    @pytest.mark.asyncio
+    async def test_disconnect_removes_connection(self):
+        """Test that disconnect removes connection"""
+        manager = ConnectionManager()
+        mock_ws = AsyncMock()
+        mock_ws.accept = AsyncMock()
+        mock_ws.close = AsyncMock()
+
+        await manager.connect(diagnosis_id=1, user_id=100, websocket=mock_ws)
+        await manager.disconnect(diagnosis_id=1, websocket=mock_ws)
+
+        assert len(manager.active_connections.get(1, set())) == 0
+
+    @pytest.mark.asyncio
+    async def test_broadcast_to_all_connections(self):
+        """Test broadcast sends to all connections in group"""
+        manager = ConnectionManager()
+        ws1 = AsyncMock()
+        ws1.accept = AsyncMock()
+        ws1.send_json = AsyncMock()
+        ws2 = AsyncMock()
+        ws2.accept = AsyncMock()
+        ws2.send_json = AsyncMock()
+
+        await manager.connect(diagnosis_id=1, user_id=100, websocket=ws1)
+        await manager.connect(diagnosis_id=1, user_id=101, websocket=ws2)
+
+        message = WebSocketMessage(
+            type="test_update",
+            diagnosis_id=1,
+            data={"test": "data"},
+            timestamp=None
+        )
+        await manager.broadcast(diagnosis_id=1, message=message)
+        await manager.drain(timeout=1)
+
+        ws1.send_json.assert_called()
+        ws2.send_json.assert_called()
+
+    @pytest.mark.asyncio
+    async def test_broadcast_excludes_websocket(self):
+        """Test broadcast can exclude specific websocket"""
+        manager = ConnectionManager()
+        ws1 = AsyncMock()
+        ws1.accept = AsyncMock()
+        ws1.send_json = AsyncMock()
+        ws2 = AsyncMock()
+        ws2.accept = AsyncMock()
+        ws2.send_json = AsyncMock()
+
+        await manager.connect(diagnosis_id=1, user_id=100, websocket=ws1)
+        await manager.connect(diagnosis_id=1, user_id=101, websocket=ws2)
+
+        message = WebSocketMessage(
+            type="test_update",
+            diagnosis_id=1,
+            data={"test": "data"},
+            timestamp=None
+        )
+        await manager.broadcast(diagnosis_id=1, message=message, exclude_websocket=ws1)
+        await manager.drain(timeout=1)
+
+        ws1.send_json.assert_not_called()
+        ws2.send_json.assert_called()
+
+    @pytest.mark.asyncio
+    async def test_send_personal_message(self):
+        """Test sending message to specific user"""
+        manager = ConnectionManager()
+        ws1 = AsyncMock()
+        ws1.accept = AsyncMock()
+        ws1.send_json = AsyncMock()
+        ws2 = AsyncMock()
+        ws2.accept = AsyncMock()
+        ws2.send_json = AsyncMock()
+
+        await manager.connect(diagnosis_id=1, user_id=100, websocket=ws1)
+        await manager.connect(diagnosis_id=1, user_id=101, websocket=ws2)
+
+        message = WebSocketMessage(
+            type="personal_message",
+            diagnosis_id=1,
+            data={"message": "private"},
+            timestamp=None
+        )
+        await manager.send_personal_message(diagnosis_id=1, user_id=100, message=message)
+        await manager.drain(timeout=1)
+
+        ws1.send_json.assert_called()
+        ws2.send_json.assert_not_called()
+
+    @pytest.mark.asyncio
+    async def test_message_queueing(self):
+        """Test that broadcasts without clients are kept for replay"""
+        manager = ConnectionManager()
+
+        message = WebSocketMessage(
+            type="test_update",
+            diagnosis_id=1,
+            data={"test": "data"},
+            timestamp=None
+        )
+        await manager.broadcast(diagnosis_id=1, message=message)
+
+        assert len(manager.replay_buffers[1]) == 1
+        assert manager.replay_buffers[1].entries[0][1]["type"] == "test_update"
+        assert message.seq == 1
+
+    @pytest.mark.asyncio
+    async def test_max_queue_size(self):
+        """Test that replay buffer respects max size"""
+        manager = ConnectionManager(replay_buffer_size=5)
+
+        for i in range(10):
+            message = WebSocketMessage(
+                type="test_update",
+                diagnosis_id=1,
+                data={"index": i},
+                timestamp=None
+            )
+            await manager.broadcast(diagnosis_id=1, message=message)
+
+        # Buffer should only contain last 5 messages
+        assert len(manager.replay_buffers[1]) == 5
+        assert manager.replay_buffers[1].first_seq == 6
+
+    @pytest.mark.asyncio
+    async def test_queued_messages_delivered_on_reconnect(self):
+        """Test that missed messages are delivered when client reconnects with since"""
+        manager = ConnectionManager()
+
+        # Broadcast while nobody is connected
+        message = WebSocketMessage(
+            type="test_update",
+            diagnosis_id=1,
+            data={"test": "data"},
+            timestamp=None
+        )
+        await manager.broadcast(diagnosis_id=1, message=message)
+
+        # Simulate client reconnection
+        ws = AsyncMock()
+        ws.accept = AsyncMock()
+        ws.send_json = AsyncMock()
+
+        await manager.connect(diagnosis_id=1, user_id=100, websocket=ws, since=0)
+        await manager.drain(timeout=1)
+
+        # Check that the missed message was sent
+        ws.send_json.assert_called_once()
+        assert ws.send_json.call_args.args[0]["seq"] == 1
+
+    def test_get_connection_count(self):
+        """Test connection counting"""
+        manager = ConnectionManager()
+        manager.active_connections[1] = {AsyncMock(), AsyncMock(), AsyncMock()}
+        manager.active_connections[2] = {AsyncMock()}
+
+        assert manager.get_connection_count(1) == 3
+        assert manager.get_connection_count(2) == 1
+        assert manager.get_connection_count(3) == 0
+
+class TestReplayBuffer:
+    """Test sequence-numbered replay for resuming clients"""
+
+    @staticmethod
+    def _websocket():
+        ws = AsyncMock()
+        ws.accept = AsyncMock()
+        ws.send_json = AsyncMock()
+        return ws
+
+    @staticmethod
+    async def _broadcast(manager, count, start=0):
+        for i in range(start, start + count):
+            await manager.broadcast(
+                1, WebSocketMessage(type="test_update", diagnosis_id=1, data={"index": i})
+            )
+
+    @pytest.mark.asyncio
+    async def test_sequence_numbers_are_monotonic(self):
+        """Test that broadcasts get increasing per-diagnosis sequence numbers"""
+        manager = ConnectionManager()
+        await self._broadcast(manager, 3)
+        await manager.broadcast(2, WebSocketMessage(type="test_update", diagnosis_id=2))
+
+        assert [seq for seq, _ in manager.replay_buffers[1].entries] == [1, 2, 3]
+        assert manager.get_last_seq(1) == 3
+        assert manager.get_last_seq(2) == 1
+
+    @pytest.mark.asyncio
+    async def test_resume_receives_exactly_missed_messages(self):
+        """Test that since=<seq> replays only later messages"""
+        manager = ConnectionManager()
+        await self._broadcast(manager, 5)
+
+        ws = self._websocket()
+        await manager.connect(diagnosis_id=1, user_id=100, websocket=ws, since=3)
+        await manager.drain(timeout=1)
+
+        received = [call.args[0]["seq"] for call in ws.send_json.call_args_list]
+        assert received == [4, 5]
+
+    @pytest.mark.asyncio
+    async def test_replay_does_not_consume_messages(self):
+        """Test that one client resuming doesn't remove messages for others"""
+        manager = ConnectionManager()
+        await self._broadcast(manager, 3)
+
+        ws1 = self._websocket()
+        ws2 = self._websocket()
+        await manager.connect(diagnosis_id=1, user_id=100, websocket=ws1, since=0)
+        await manager.connect(diagnosis_id=1, user_id=101, websocket=ws2, since=1)
+        await manager.drain(timeout=1)
+
+        assert ws1.send_json.call_count == 3
+        assert ws2.send_json.call_count == 2
+
+    @pytest.mark.asyncio
+    async def test_fresh_connection_gets_no_replay(self):
+        """Test that connecting without since doesn't replay history"""
+        manager = ConnectionManager()
+        await self._broadcast(manager, 3)
+
+        ws = self._websocket()
+        await manager.connect(diagnosis_id=1, user_id=100, websocket=ws)
+        await manager.drain(timeout=1)
+
+        ws.send_json.assert_not_called()
+
+    @pytest.mark.asyncio
+    async def test_gap_notice_when_messages_evicted(self):
+        """Test that a replay_gap notice precedes replay when history is truncated"""
+        manager = ConnectionManager(replay_buffer_size=3)
+        await self._broadcast(manager, 6)
+
+        ws = self._websocket()
+        await manager.connect(diagnosis_id=1, user_id=100, websocket=ws, since=1)
+        await manager.drain(timeout=1)
+
+        payloads = [call.args[0] for call in ws.send_json.call_args_list]
+        assert payloads[0]["type"] == "replay_gap"
+        assert payloads[0]["data"]["first_available_seq"] == 4
+        assert [p["seq"] for p in payloads[1:]] == [4, 5, 6]
+
+    @pytest.mark.asyncio
+    async def test_idle_buffers_expire(self):
+        """Test that idle replay buffers without connections are dropped"""
+        manager = ConnectionManager(replay_ttl_seconds=60)
+        await self._broadcast(manager, 2)
+        await manager.broadcast(2, WebSocketMessage(type="test_update", diagnosis_id=2))
+        await manager.connect(diagnosis_id=2, user_id=100, websocket=self._websocket())
+
+        for buffer in manager.replay_buffers.values():
+            buffer.last_activity -= 120
+
+        assert manager.expire_replay_buffers() == 1
+        assert 1 not in manager.replay_buffers
+        assert 2 in manager.replay_buffers
+
+    def test_upstream_sequence_is_kept(self):
+        """Test that sequence numbers assigned by the backplane are preserved"""
+        buffer = ReplayBuffer(max_size=10)
+        buffer.append(WebSocketMessage(type="a", diagnosis_id=1, seq=41))
+        buffer.append(WebSocketMessage(type="b", diagnosis_id=1, seq=42))
+
+        gap, missed = buffer.since(41)
+        assert not gap
+        assert [p["seq"] for p in missed] == [42]
+
+    def test_late_sequence_is_slotted_in_order(self):
+        """Test that a slightly older seq is inserted instead of wiping history"""
+        buffer = ReplayBuffer(max_size=10)
+        for seq in (1, 2, 4, 5):
+            buffer.append(WebSocketMessage(type="a", diagnosis_id=1, seq=seq))
+        buffer.append(WebSocketMessage(type="a", diagnosis_id=1, seq=3))
+        buffer.append(WebSocketMessage(type="a", diagnosis_id=1, seq=4))
+
+        gap, missed = buffer.since(0)
+        assert not gap
+        assert [p["seq"] for p in missed] == [1, 2, 3, 4, 5]
+        assert buffer.last_seq == 5
+
+    def test_late_sequence_evicts_oldest_when_full(self):
+        """Test that slotting a late seq into a full buffer drops the oldest entry"""
+        buffer = ReplayBuffer(max_size=3)
+        for seq in (5, 7, 8):
+            buffer.append(WebSocketMessage(type="a", diagnosis_id=1, seq=seq))
+        buffer.append(WebSocketMessage(type="a", diagnosis_id=1, seq=6))
+
+        assert [seq for seq, _ in buffer.entries] == [6, 7, 8]
+
+    def test_large_backwards_jump_resets(self):
+        """Test that a counter reset far below the window clears the buffer"""
+        buffer = ReplayBuffer(max_size=3)
+        for seq in (50, 51, 52):
+            buffer.append(WebSocketMessage(type="a", diagnosis_id=1, seq=seq))
+        buffer.append(WebSocketMessage(type="a", diagnosis_id=1, seq=1))
+
+        assert [seq for seq, _ in buffer.entries] == [1]
+        assert buffer.last_seq == 1
+
+
+class TestSendQueues:
+    """Test per-connection bounded send queues"""
+
+    @staticmethod
+    def _message(index, message_type="test_update"):
+        return WebSocketMessage(
+            type=message_type,
+            diagnosis_id=1,
+            data={"index": index},
+            timestamp=None
+        )
+
+    @staticmethod
+    def _blocked_websocket():
+        """WebSocket whose sends never complete (stuck client)"""
+        async def never_completes(payload):
+            await asyncio.Event().wait()
+
+        ws = AsyncMock()
+        ws.accept = AsyncMock()
+        ws.close = AsyncMock()
+        ws.send_json = AsyncMock(side_effect=never_completes)
+        return ws
+
+    @pytest.mark.asyncio
+    async def test_slow_client_does_not_block_others(self):
+        """Test that a stuck client doesn't delay delivery to other clients"""
+        manager = ConnectionManager(send_queue_size=4)
+        slow = self._blocked_websocket()
+        fast = AsyncMock()
+        fast.accept = AsyncMock()
+        fast.send_json = AsyncMock()
+
+        await manager.connect(diagnosis_id=1, user_id=100, websocket=slow)
+        await manager.connect(diagnosis_id=1, user_id=101, websocket=fast)
+
+        for i in range(3):
+            await asyncio.wait_for(manager.broadcast(1, self._message(i)), timeout=1)
+        await asyncio.wait_for(manager.clients[fast].wait_idle(), timeout=1)
+
+        assert fast.send_json.call_count == 3
+
+    @pytest.mark.asyncio
+    async def test_drop_oldest_policy(self):
+        """Test that drop-oldest keeps the newest messages and counts drops"""
+        manager = ConnectionManager(send_queue_size=3, overflow_policy=OverflowPolicy.DROP_OLDEST)
+        ws = self._blocked_websocket()
+        await manager.connect(diagnosis_id=1, user_id=100, websocket=ws)
+        await asyncio.sleep(0)
+
+        for i in range(10):
+            await manager.broadcast(1, self._message(i))
+
+        client = manager.clients[ws]
+        assert len(client.queue) == 3
+        assert [p["data"]["index"] for p, _ in client.queue] == [7, 8, 9]
+        assert client.dropped_count == 7
+
+    @pytest.mark.asyncio
+    async def test_coalesce_policy(self):
+        """Test that coalesce replaces pending messages of the same type"""
+        manager = ConnectionManager(send_queue_size=2, overflow_policy=OverflowPolicy.COALESCE)
+        ws = self._blocked_websocket()
+        await manager.connect(diagnosis_id=1, user_id=100, websocket=ws)
+        await asyncio.sleep(0)
+
+        await manager.broadcast(1, self._message(0, "feedback_update"))
+        await manager.broadcast(1, self._message(1, "effectiveness_update"))
+        await manager.broadcast(1, self._message(2, "feedback_update"))
+
+        client = manager.clients[ws]
+        assert [(p["type"], p["data"]["index"]) for p, _ in client.queue] == [
+            ("effectiveness_update", 1),
+            ("feedback_update", 2),
+        ]
+        assert client.coalesced_count == 1
+        assert client.dropped_count == 0
+
+    @pytest.mark.asyncio
+    async def test_disconnect_policy_evicts_slow_consumer(self):
+        """Test that disconnect policy evicts a client whose queue is full"""
+        manager = ConnectionManager(send_queue_size=2, overflow_policy=OverflowPolicy.DISCONNECT)
+        ws = self._blocked_websocket()
+        await manager.connect(diagnosis_id=1, user_id=100, websocket=ws)
+        await asyncio.sleep(0)
+
+        for i in range(4):
+            await manager.broadcast(1, self._message(i))
+        await asyncio.sleep(0.01)
+
+        assert ws not in manager.clients
+        assert manager.get_connection_count(1) == 0
+        assert manager.evicted_count == 1
+        ws.close.assert_called_once()
+
+    @pytest.mark.asyncio
+    async def test_send_error_removes_client(self):
+        """Test that a failing send disconnects the client"""
+        manager = ConnectionManager()
+        ws = AsyncMock()
+        ws.accept = AsyncMock()
+        ws.send_json = AsyncMock(side_effect=RuntimeError("socket closed"))
+
+        await manager.connect(diagnosis_id=1, user_id=100, websocket=ws)
+        await manager.broadcast(1, self._message(0))
+        await asyncio.sleep(0.01)
+
+        assert manager.get_connection_count(1) == 0
+        assert ws not in manager.clients
+
+    @pytest.mark.asyncio
+    async def test_queue_stats_reported(self):
+        """Test that per-connection queue depth and drops are reported"""
+        manager = ConnectionManager(send_queue_size=2)
+        ws = self._blocked_websocket()
+        await manager.connect(diagnosis_id=1, user_id=100, websocket=ws)
+        await asyncio.sleep(0)
+
+        for i in range(5):
+            await manager.broadcast(1, self._message(i))
+
+        info = manager.get_all_connections_info()[1]
+        assert info["send_queue_depth"] == 2
+        assert info["dropped_messages"] == 3
+        assert info["clients"][0]["user_id"] == 100
+
+        stats = manager.get_send_queue_stats()
+        assert stats["overflow_policy"] == "drop_oldest"
+        assert stats["total_dropped"] == 3
+
+
+class TestBackplane:
+    """Test cross-worker broadcast fan-out"""
+
+    @staticmethod
+    async def _worker(hub, diagnosis_id=1):
+        """Simulate a worker: its own manager, a local socket and a backplane"""
+        manager = ConnectionManager()
+        ws = AsyncMock()
+        ws.accept = AsyncMock()
+        ws.send_json = AsyncMock()
+        await manager.connect(diagnosis_id=diagnosis_id, user_id=100, websocket=ws)
+
+        backplane = InMemoryBackplane(hub)
+        backplane.subscribe(manager.broadcast)
+        return manager, ws, backplane
+
+    @pytest.mark.asyncio
+    async def test_publish_reaches_every_worker(self):
+        """Test that one publish is delivered by every worker to its sockets"""
+        hub = InMemoryHub()
+        manager1, ws1, backplane1 = await self._worker(hub)
+        manager2, ws2, _ = await self._worker(hub)
+
+        message = WebSocketMessage(type="feedback_update", diagnosis_id=1, data={"rating": 5})
+        await backplane1.publish(1, message)
+        await manager1.drain(timeout=1)
+        await manager2.drain(timeout=1)
+
+        assert ws1.send_json.call_count == 1
+        assert ws2.send_json.call_count == 1
+        assert backplane1.published_count == 1
+
+    @pytest.mark.asyncio
+    async def test_publish_preserves_order(self):
+        """Test that messages for a diagnosis arrive in publish order on all workers"""
+        hub = InMemoryHub()
+        manager1, ws1, backplane1 = await self._worker(hub)
+        manager2, ws2, backplane2 = await self._worker(hub)
+
+        for i in range(5):
+            backplane = backplane1 if i % 2 == 0 else backplane2
+            await backplane.publish(1, WebSocketMessage(type="test_update", diagnosis_id=1, data={"index": i}))
+        await manager1.drain(timeout=1)
+        await manager2.drain(timeout=1)
+
+        for ws in (ws1, ws2):
+            received = [call.args[0]["data"]["index"] for call in ws.send_json.call_args_list]
+            assert received == [0, 1, 2, 3, 4]
+
+    @pytest.mark.asyncio
+    async def test_stopped_worker_is_skipped(self):
+        """Test that a stopped backplane no longer delivers"""
+        hub = InMemoryHub()
+        manager1, ws1, backplane1 = await self._worker(hub)
+        manager2, ws2, backplane2 = await self._worker(hub)
+        await backplane2.stop()
+
+        await backplane1.publish(1, WebSocketMessage(type="test_update", diagnosis_id=1))
+        await manager1.drain(timeout=1)
+        await manager2.drain(timeout=1)
+
+        assert ws1.send_json.call_count == 1
+        assert ws2.send_json.call_count == 0
+
+    @pytest.mark.asyncio
+    async def test_broadcast_helpers_publish_through_backplane(self):
+        """Test that broadcast_*_update helpers publish once via the backplane"""
+        from app.services.websocket_manager import broadcast_feedback_update
+
+        backplane = AsyncMock()
+        with patch("app.services.websocket_backplane.get_backplane", return_value=backplane):
+            await broadcast_feedback_update(diagnosis_id=1, feedback_id=10, rating=5, effectiveness=0.9)
+
+        backplane.publish.assert_called_once()
+        diagnosis_id, message = backplane.publish.call_args.args
+        assert diagnosis_id == 1
+        assert message.type == "feedback_update"
+
+
+class FakeRedis:
+    """Just enough of redis.asyncio to run PUBLISH_SCRIPT and pub/sub in-process"""
+
+    def __init__(self, failed_subscribes=0):
+        self.counters = {}
+        self.subscribers = []
+        self.eval_calls = 0
+        self.failed_subscribes = failed_subscribes
+
+    def drop_connections(self):
+        """Break every live subscription, as a Redis restart would"""
+        for pubsub in list(self.subscribers):
+            self.subscribers.remove(pubsub)
+            pubsub.queue.put_nowait(ConnectionError("Connection reset by peer"))
+
+    async def eval(self, script, numkeys, seq_key, channel, envelope):
+        self.eval_calls += 1
+        self.counters[seq_key] = self.counters.get(seq_key, 0) + 1
+        seq = self.counters[seq_key]
+        for pubsub in list(self.subscribers):
+            pubsub.queue.put_nowait({"type": "message", "data": f"{seq} {envelope}".encode()})
+        return seq
+
+    def pubsub(self):
+        return FakePubSub(self)
+
+
+class FakePubSub:
+    def __init__(self, redis):
+        self.redis = redis
+        self.queue = asyncio.Queue()
+
+    async def subscribe(self, channel):
+        if self.redis.failed_subscribes:
+            self.redis.failed_subscribes -= 1
+            raise ConnectionError("Connection refused")
+        self.redis.subscribers.append(self)
+
+    async def unsubscribe(self, channel):
+        if self in self.redis.subscribers:
+            self.redis.subscribers.remove(self)
+
+    async def close(self):
+        pass
+
+    async def listen(self):
+        while True:
+            item = await self.queue.get()
+            if isinstance(item, Exception):
+                raise item
+            yield item
+
+
+class TestRedisBackplane:
+    """Test the Redis backplane against an in-process fake"""
+
+    @staticmethod
+    async def _worker(redis, diagnosis_id=1):
+        manager = ConnectionManager()
+        ws = AsyncMock()
+        ws.accept = AsyncMock()
+        ws.send_json = AsyncMock()
+        await manager.connect(diagnosis_id=diagnosis_id, user_id=100, websocket=ws)
+
+        backplane = RedisBackplane(url="redis://fake", channel="test", reconnect_min_seconds=0.01)
+        backplane._async_client = lambda: redis
+        backplane.subscribe(manager.broadcast)
+        await backplane.start()
+        return manager, ws, backplane
+
+    @staticmethod
+    async def _settle(*managers):
+        await asyncio.sleep(0.1)
+        for manager in managers:
+            await manager.drain(timeout=1)
+
+    @pytest.mark.asyncio
+    async def test_seq_assigned_and_published_in_one_script(self):
+        """Test that one script call assigns the seq and publishes the frame"""
+        redis = FakeRedis()
+        manager, ws, backplane = await self._worker(redis)
+
+        message = WebSocketMessage(type="test_update", diagnosis_id=1)
+        await backplane.publish(1, message)
+        await self._settle(manager)
+        await backplane.stop()
+
+        assert redis.eval_calls == 1
+        assert message.seq == 1
+        assert ws.send_json.call_args.args[0]["seq"] == 1
+
+    @pytest.mark.asyncio
+    async def test_workers_agree_on_seq_order(self):
+        """Test that interleaved publishes from two workers arrive in seq order on both"""
+        redis = FakeRedis()
+        manager1, ws1, backplane1 = await self._worker(redis)
+        manager2, ws2, backplane2 = await self._worker(redis)
+
+        await asyncio.gather(*[
+            (backplane1 if i % 2 == 0 else backplane2).publish(
+                1, WebSocketMessage(type="test_update", diagnosis_id=1, data={"index": i})
+            )
+            for i in range(6)
+        ])
+        await self._settle(manager1, manager2)
+        await backplane1.stop()
+        await backplane2.stop()
+
+        for ws in (ws1, ws2):
+            seqs = [call.args[0]["seq"] for call in ws.send_json.call_args_list]
+            assert seqs == [1, 2, 3, 4, 5, 6]
+
+    @pytest.mark.asyncio
+    async def test_listener_resubscribes_after_connection_loss(self):
+        """Test that a dropped subscription is re-established and delivery resumes"""
+        redis = FakeRedis()
+        manager, ws, backplane = await self._worker(redis)
+
+        redis.drop_connections()
+        await self._settle(manager)
+        assert backplane.running
+        assert backplane.reconnect_count == 1
+
+        await backplane.publish(1, WebSocketMessage(type="test_update", diagnosis_id=1))
+        await self._settle(manager)
+        await backplane.stop()
+
+        assert ws.send_json.call_count == 1
+        assert redis.eval_calls == 1
+
+    @pytest.mark.asyncio
+    async def test_start_without_redis_stays_local(self):
+        """Test that an unreachable Redis at startup does not raise and retries in background"""
+        redis = FakeRedis(failed_subscribes=2)
+        manager, ws, backplane = await self._worker(redis)
+
+        assert not backplane.running
+        await backplane.publish(1, WebSocketMessage(type="test_update", diagnosis_id=1))
+        await manager.drain(timeout=1)
+        assert ws.send_json.call_args.args[0]["seq"] == 1
+
+        await self._settle(manager)
+        assert backplane.running
+        await backplane.stop()
+
+    @pytest.mark.asyncio
+    async def test_failed_publish_is_not_given_a_local_seq(self):
+        """Test that the local fallback delivers live without recording for replay"""
+        redis = FakeRedis()
+        manager, ws, backplane = await self._worker(redis)
+        redis.eval = AsyncMock(side_effect=ConnectionError("Connection refused"))
+
+        await backplane.publish(1, WebSocketMessage(type="test_update", diagnosis_id=1))
+        await manager.drain(timeout=1)
+        await backplane.stop()
+
+        assert ws.send_json.call_args.args[0]["seq"] is None
+        assert 1 not in manager.replay_buffers or len(manager.replay_buffers[1]) == 0
+
+
+class TestProtocol:
+    """Test subprotocol negotiation, codecs and inbound validation"""
+
+    def test_negotiate_prefers_msgpack(self):
+        """Test that msgpack is chosen when offered, legacy JSON otherwise"""
+        subprotocol, codec = negotiate(["avicenna.json.v1", "avicenna.msgpack.v1"])
+        assert subprotocol == "avicenna.msgpack.v1"
+        assert codec.binary
+
+        subprotocol, codec = negotiate(["avicenna.json.v1"])
+        assert subprotocol == "avicenna.json.v1"
+
+        subprotocol, codec = negotiate([])
+        assert subprotocol is None
+        assert codec is LEGACY_CODEC
+
+    @pytest.mark.parametrize("subprotocol", ["avicenna.msgpack.v1", "avicenna.json.v1"])
+    def test_codec_round_trip(self, subprotocol):
+        """Test that messages survive encode/decode with compact framing"""
+        codec = CODECS[subprotocol]
+        message = WebSocketMessage(type="feedback_update", diagnosis_id=7, data={"rating": 5}, seq=3)
+
+        decoded = codec.decode(codec.encode(message.dict()))
+
+        assert decoded["type"] == "feedback_update"
+        assert decoded["seq"] == 3
+        assert decoded["data"] == {"rating": 5}
+        assert "timestamp" in decoded
+
+    def test_compact_frames_omit_nulls(self):
+        """Test that null fields are not sent on compact protocols"""
+        codec = CODECS["avicenna.json.v1"]
+        frame = codec.encode(WebSocketMessage(type="pong", diagnosis_id=1).dict())
+
+        assert "null" not in frame
+
+    def test_msgpack_is_smaller_than_legacy_json(self):
+        """Test that msgpack frames are smaller than legacy JSON"""
+        payload = WebSocketMessage(
+            type="effectiveness_update",
+            diagnosis_id=1,
+            data={"recommendation_id": 5, "new_effectiveness": 0.85, "confidence": 0.9, "sample_size": 100}
+        ).dict()
+
+        msgpack_frame = CODECS["avicenna.msgpack.v1"].encode(payload)
+        legacy_frame = json.dumps(LEGACY_CODEC.encode(payload))
+
+        assert len(msgpack_frame) < len(legacy_frame)
+
+    def test_canonical_ping_fast_path(self):
+        """Test that canonical pings are recognized without decoding"""
+        assert LEGACY_CODEC.is_ping('{"type": "ping"}')
+        assert CODECS["avicenna.json.v1"].is_ping('{"type":"ping"}')
+        assert CODECS["avicenna.msgpack.v1"].is_ping(msgpack.packb({"type": "ping"}))
+        assert not LEGACY_CODEC.is_ping('{"type": "ack", "seq": 1}')
+
+    def test_inbound_validation(self):
+        """Test that inbound frames are schema-validated, not evaluated"""
+        codec = CODECS["avicenna.json.v1"]
+
+        assert isinstance(codec.parse('{"type": "ack", "seq": 12}'), AckFrame)
+        assert isinstance(codec.parse('{"type": "ping", "extra": 1}'), PingFrame)
+        assert isinstance(codec.parse('{"type": "pong"}'), PongFrame)
+
+        for bad in ['__import__("os")', '{"type": "ack"}', '{"type": "ack", "seq": -1}', '{"type": "shutdown"}', None]:
+            with pytest.raises(ProtocolError):
+                codec.parse(bad)
+
+    @pytest.mark.asyncio
+    async def test_binary_client_receives_bytes(self):
+        """Test that msgpack clients get binary frames encoded once per broadcast"""
+        manager = ConnectionManager()
+        codec = CODECS["avicenna.msgpack.v1"]
+        ws = AsyncMock()
+        ws.accept = AsyncMock()
+        ws.send_bytes = AsyncMock()
+
+        await manager.connect(diagnosis_id=1, user_id=100, websocket=ws, codec=codec)
+        await manager.broadcast(1, WebSocketMessage(type="test_update", diagnosis_id=1))
+        manager.send_pong(ws)
+        await manager.drain(timeout=1)
+
+        ws.accept.assert_called_once_with(subprotocol="avicenna.msgpack.v1")
+        frames = [codec.decode(call.args[0]) for call in ws.send_bytes.call_args_list]
+        assert [f["type"] for f in frames] == ["test_update", "pong"]
+
+    @pytest.mark.asyncio
+    async def test_ack_is_recorded(self):
+        """Test that client acks are tracked per connection"""
+        manager = ConnectionManager()
+        ws = AsyncMock()
+        ws.accept = AsyncMock()
+        await manager.connect(diagnosis_id=1, user_id=100, websocket=ws)
+
+        manager.record_ack(ws, 5)
+        manager.record_ack(ws, 3)
+
+        assert manager.clients[ws].last_ack_seq == 5
+
+
+class TestTopicSubscriptions:
+    """Test multiplexed connections subscribed to topics"""
+
+    @staticmethod
+    def _websocket():
+        ws = AsyncMock()
+        ws.accept = AsyncMock()
+        ws.send_json = AsyncMock()
+        return ws
+
+    @staticmethod
+    def _sent(ws):
+        return [call.args[0] for call in ws.send_json.call_args_list]
+
+    def test_parse_topic(self):
+        """Test topic parsing and rejection of malformed topics"""
+        assert parse_topic("diagnosis:42") == ("diagnosis", 42)
+        assert parse_topic("patient:7") == ("patient", 7)
+        assert parse_topic("diagnosis:") is None
+        assert parse_topic("diagnosis:-1") is None
+        assert parse_topic("billing:1") is None
+
+    @pytest.mark.asyncio
+    async def test_one_socket_receives_many_diagnoses(self):
+        """Test that a multiplexed socket gets broadcasts for every subscribed topic"""
+        manager = ConnectionManager()
+        ws = self._websocket()
+        await manager.connect_multiplex(user_id=100, websocket=ws)
+        added = await manager.subscribe(ws, ["diagnosis:1", "diagnosis:2"])
+
+        for diagnosis_id in (1, 2, 3):
+            await manager.broadcast(
+                diagnosis_id, WebSocketMessage(type="test_update", diagnosis_id=diagnosis_id)
+            )
+        await manager.drain(timeout=1)
+
+        assert added == ["diagnosis:1", "diagnosis:2"]
+        assert [m["diagnosis_id"] for m in self._sent(ws)] == [1, 2]
+
+    @pytest.mark.asyncio
+    async def test_recommendation_and_patient_topics(self):
+        """Test that broadcasts reach recommendation and patient topics from their data"""
+        manager = ConnectionManager()
+        rec_ws, patient_ws = self._websocket(), self._websocket()
+        await manager.connect_multiplex(user_id=100, websocket=rec_ws)
+        await manager.connect_multiplex(user_id=100, websocket=patient_ws)
+        await manager.subscribe(rec_ws, ["recommendation:7"])
+        await manager.subscribe(patient_ws, ["patient:100"])
+
+        await manager.broadcast(1, WebSocketMessage(
+            type="effectiveness_update", diagnosis_id=1, data={"recommendation_id": 7}
+        ))
+        await manager.broadcast(1, WebSocketMessage(
+            type="feedback_update", diagnosis_id=1, data={"patient_id": 100}
+        ))
+        await manager.drain(timeout=1)
+
+        assert [m["type"] for m in self._sent(rec_ws)] == ["effectiveness_update"]
+        assert [m["type"] for m in self._sent(patient_ws)] == ["feedback_update"]
+
+    @pytest.mark.asyncio
+    async def test_patient_topic_receives_diagnosis_updates(self):
+        """Test that broadcast helpers reach patient and recommendation subscribers via the backplane"""
+        from app.services import websocket_manager
+        from app.services.websocket_manager import broadcast_feedback_update, broadcast_recommendation_update
+
+        manager = ConnectionManager()
+        rec_ws, patient_ws = self._websocket(), self._websocket()
+        await manager.connect_multiplex(user_id=100, websocket=rec_ws)
+        await manager.connect_multiplex(user_id=100, websocket=patient_ws)
+        await manager.subscribe(rec_ws, ["recommendation:7"])
+        await manager.subscribe(patient_ws, ["patient:100"])
+
+        backplane = InMemoryBackplane()
+        backplane.subscribe(manager.broadcast)
+        owner = AsyncMock(return_value=100)
+        with patch("app.services.websocket_backplane.get_backplane", return_value=backplane), \
+                patch.object(websocket_manager, "_diagnosis_owner", owner):
+            await broadcast_feedback_update(diagnosis_id=1, feedback_id=10, rating=5, effectiveness=0.9)
+            await broadcast_recommendation_update(
+                1, {"dose": 1}, {"dose": 2}, recommendation_id=7, patient_id=100
+            )
+        await manager.drain(timeout=1)
+
+        owner.assert_awaited_once_with(1)
+        assert [m["type"] for m in self._sent(patient_ws)] == ["feedback_update", "recommendation_update"]
+        assert [m["type"] for m in self._sent(rec_ws)] == ["recommendation_update"]
+
+    @pytest.mark.asyncio
+    async def test_message_delivered_once_per_socket(self):
+        """Test that a socket matching several topics gets one copy"""
+        manager = ConnectionManager()
+        ws = self._websocket()
+        await manager.connect_multiplex(user_id=100, websocket=ws)
+        await manager.subscribe(ws, ["diagnosis:1", "recommendation:7"])
+
+        await manager.broadcast(1, WebSocketMessage(
+            type="effectiveness_update", diagnosis_id=1, data={"recommendation_id": 7}
+        ))
+        await manager.drain(timeout=1)
+
+        assert ws.send_json.call_count == 1
+
+    @pytest.mark.asyncio
+    async def test_unsubscribe_and_disconnect_clean_up_index(self):
+        """Test that the topic index drops sockets and empty topics"""
+        manager = ConnectionManager()
+        ws = self._websocket()
+        await manager.connect_multiplex(user_id=100, websocket=ws)
+        await manager.subscribe(ws, ["diagnosis:1", "diagnosis:2"])
+
+        assert manager.unsubscribe(ws, ["diagnosis:1", "diagnosis:9"]) == ["diagnosis:1"]
+        assert "diagnosis:1" not in manager.topic_subscribers
+
+        await manager.disconnect(None, ws)
+
+        assert manager.topic_subscribers == {}
+        assert ws not in manager.clients
+
+    @pytest.mark.asyncio
+    async def test_subscribe_with_since_replays(self):
+        """Test that subscribing with since replays missed diagnosis messages"""
+        manager = ConnectionManager()
+        for i in range(3):
+            await manager.broadcast(1, WebSocketMessage(type="test_update", diagnosis_id=1, data={"index": i}))
+
+        ws = self._websocket()
+        await manager.connect_multiplex(user_id=100, websocket=ws)
+        await manager.subscribe(ws, ["diagnosis:1"], since={"diagnosis:1": 1})
+        await manager.drain(timeout=1)
+
+        assert [m["seq"] for m in self._sent(ws)] == [2, 3]
+
+    @pytest.mark.asyncio
+    async def test_topic_limit(self):
+        """Test that subscriptions beyond the per-connection limit are refused"""
+        manager = ConnectionManager(max_topics_per_connection=2)
+        ws = self._websocket()
+        await manager.connect_multiplex(user_id=100, websocket=ws)
+
+        added = await manager.subscribe(ws, ["diagnosis:1", "diagnosis:2", "diagnosis:3"])
+
+        assert added == ["diagnosis:1", "diagnosis:2"]
+        assert manager.get_topic_stats() == {
+            "multiplexed_connections": 1,
+            "topics": 2,
+            "subscriptions": 2,
+        }
+
+
+class TestSweeper:
+    """Test heartbeat liveness checks and state reclamation"""
+
+    @staticmethod
+    def _websocket():
+        ws = AsyncMock()
+        ws.accept = AsyncMock()
+        ws.send_json = AsyncMock()
+        ws.close = AsyncMock()
+        return ws
+
+    @pytest.mark.asyncio
+    async def test_quiet_client_is_pinged_once(self):
+        """Test that a client silent past the heartbeat interval gets one ping"""
+        manager = ConnectionManager(heartbeat_interval=0, idle_timeout=60)
+        ws = self._websocket()
+        await manager.connect(diagnosis_id=1, user_id=100, websocket=ws)
+
+        assert manager.sweep()["pinged"] == 1
+        assert manager.sweep()["pinged"] == 0
+        await manager.drain(timeout=1)
+
+        ws.send_json.assert_called_once_with({"type": "ping"})
+
+    @pytest.mark.asyncio
+    async def test_touch_resets_heartbeat(self):
+        """Test that inbound activity clears the pending ping"""
+        manager = ConnectionManager(heartbeat_interval=0, idle_timeout=60)
+        ws = self._websocket()
+        await manager.connect(diagnosis_id=1, user_id=100, websocket=ws)
+
+        manager.sweep()
+        manager.touch(ws)
+
+        assert manager.clients[ws].ping_pending is False
+        assert manager.sweep()["pinged"] == 1
+
+    @pytest.mark.asyncio
+    async def test_idle_client_is_evicted(self):
+        """Test that a client silent past the idle timeout is closed and removed"""
+        manager = ConnectionManager(heartbeat_interval=0, idle_timeout=0)
+        ws = self._websocket()
+        await manager.connect(diagnosis_id=1, user_id=100, websocket=ws)
+
+        assert manager.sweep()["idle_evicted"] == 1
+        await asyncio.sleep(0.01)
+
+        assert ws not in manager.clients
+        assert 1 not in manager.active_connections
+        ws.close.assert_called_once()
+        assert ws.close.call_args.kwargs["code"] == 1001
+
+    @pytest.mark.asyncio
+    async def test_stale_locks_are_reclaimed(self):
+        """Test that locks of diagnoses without connections are deleted"""
+        manager = ConnectionManager()
+        for diagnosis_id in range(50):
+            ws = self._websocket()
+            await manager.connect(diagnosis_id=diagnosis_id, user_id=100, websocket=ws)
+            await manager.disconnect(diagnosis_id, ws)
+
+        assert len(manager.locks) == 50
+        assert manager.sweep()["reclaimed_locks"] == 50
+        assert manager.locks == {}
+        assert manager.get_memory_stats()["locks"] == 0
+
+    @pytest.mark.asyncio
+    async def test_held_lock_is_kept(self):
+        """Test that a lock someone holds is never reclaimed"""
+        manager = ConnectionManager()
+        lock = await manager._get_lock(1)
+
+        async with lock:
+            manager.sweep()
+            assert manager.locks[1] is lock
+
+    @pytest.mark.asyncio
+    async def test_memory_stats_flat_after_churn(self):
+        """Test that connection churn leaves no per-diagnosis state behind"""
+        manager = ConnectionManager(replay_ttl_seconds=0)
+        for diagnosis_id in range(20):
+            ws = self._websocket()
+            await manager.connect(diagnosis_id=diagnosis_id, user_id=100, websocket=ws)
+            await manager.broadcast(diagnosis_id, WebSocketMessage(type="test_update", diagnosis_id=diagnosis_id))
+            await manager.drain(timeout=1)
+            await manager.disconnect(diagnosis_id, ws)
+
+        manager.sweep()
+        stats = manager.get_memory_stats()
+
+        for gauge in ("connections", "diagnoses", "locks", "user_maps", "replay_buffers", "topics"):
+            assert stats[gauge] == 0
+        assert manager.get_sweeper_stats()["sweeps"] == 1
+
+    @pytest.mark.asyncio
+    async def test_sweeper_task_lifecycle(self):
+        """Test that the background sweeper starts once and stops cleanly"""
+        manager = ConnectionManager(sweep_interval=0.01)
+        manager.start_sweeper()
+        task = manager.sweeper_task
+        manager.start_sweeper()
+
+        await asyncio.sleep(0.05)
+        assert manager.sweeper_task is task
+        assert manager.get_sweeper_stats()["sweeps"] >= 1
+
+        await manager.stop_sweeper()
+        assert manager.get_sweeper_stats()["running"] is False
+
+
+class TestLoadHarness:
+    """Smoke test for load_test_websocket.py"""
+
+    @pytest.mark.asyncio
+    async def test_inprocess_run_reports_latency(self):
+        """Test that a small in-process run delivers every broadcast"""
+        from load_test_websocket import parse_args, run
+
+        report = await run(parse_args([
+            "--clients", "40", "--diagnoses", "4", "--first-diagnosis", "9000",
+            "--rate", "200", "--duration", "0.2", "--settle", "2",
+        ]))
+
+        assert report["clients"] == 40
+        assert report["missing"] == 0
+        assert report["delivered"] == report["expected_deliveries"] > 0
+        assert report["latency_ms"]["p99"] >= report["latency_ms"]["p50"]
+
+
+class TestHandshakeAuthCache:
+    """Test cached handshake authorization"""
+
+    @pytest.fixture(autouse=True)
+    def _auth_module(self):
+        # websocket_auth maps Patient / DiagnosticFinding, so it needs the app models
+        pytest.importorskip("app.services.websocket_auth")
+
+    @staticmethod
+    def _cache(decide):
+        from app.services.websocket_auth import HandshakeAuthCache
+
+        calls = []
+
+        def load(user_id, diagnosis_id):
+            calls.append((user_id, diagnosis_id))
+            return decide(user_id, diagnosis_id)
+
+        patcher = patch("app.services.websocket_auth._load_decision", side_effect=load)
+        return HandshakeAuthCache(ttl_seconds=60), calls, patcher
+
+    @staticmethod
+    def _owner_is(owner_id):
+        from app.services.websocket_auth import HandshakeDecision
+
+        def decide(user_id, diagnosis_id):
+            if user_id not in (None, owner_id):
+                return HandshakeDecision(False, user_id, "Access denied")
+            return HandshakeDecision(True, owner_id)
+        return decide
+
+    @pytest.mark.asyncio
+    async def test_decisions_are_cached(self):
+        """Test that repeated connects hit the DB once"""
+        cache, calls, patcher = self._cache(self._owner_is(100))
+        with patcher:
+            for _ in range(5):
+                decision = await cache.authorize(100, 1)
+
+        assert decision.allowed and decision.user_id == 100
+        assert calls == [(100, 1)]
+        assert cache.get_stats()["hits"] == 4
+
+    @pytest.mark.asyncio
+    async def test_denials_are_cached(self):
+        """Test that a foreign user is denied and the denial cached"""
+        cache, calls, patcher = self._cache(self._owner_is(100))
+        with patcher:
+            first = await cache.authorize(200, 1)
+            second = await cache.authorize(200, 1)
+
+        assert not first.allowed and first.reason == "Access denied"
+        assert second == first
+        assert len(calls) == 1
+
+    @pytest.mark.asyncio
+    async def test_concurrent_misses_share_one_load(self):
+        """Test that a reconnect storm runs a single DB load per key"""
+        cache, calls, patcher = self._cache(self._owner_is(100))
+        with patcher:
+            decisions = await asyncio.gather(*(cache.authorize(None, 1) for _ in range(200)))
+
+        assert all(d.allowed and d.user_id == 100 for d in decisions)
+        assert calls == [(None, 1)]
+
+    @pytest.mark.asyncio
+    async def test_invalidation_on_ownership_change(self):
+        """Test that invalidating a diagnosis forces a reload"""
+        cache, calls, patcher = self._cache(self._owner_is(100))
+        with patcher:
+            await cache.authorize(100, 1)
+            await cache.authorize(None, 1)
+            await cache.authorize(100, 2)
+            cache.invalidate_diagnosis(1)
+            await cache.authorize(100, 1)
+            await cache.authorize(100, 2)
+
+        assert calls == [(100, 1), (None, 1), (100, 2), (100, 1)]
+
+    @pytest.mark.asyncio
+    async def test_entries_are_bounded(self):
+        """Test that the least recently used decisions are evicted"""
+        cache, calls, patcher = self._cache(self._owner_is(100))
+        cache.max_entries = 10
+        with patcher:
+            for diagnosis_id in range(25):
+                await cache.authorize(100, diagnosis_id)
+
+        assert len(cache.entries) == 10
+        assert (100, 24) in cache.entries and (100, 0) not in cache.entries
+        assert sum(len(keys) for keys in cache.by_diagnosis.values()) == 10
+
+    @pytest.mark.asyncio
+    async def test_invalidation_waits_for_commit(self):
+        """Test that a flushed change invalidates only once it commits, and not on rollback"""
+        from app.services import websocket_auth
+
+        cache, calls, patcher = self._cache(self._owner_is(100))
+        session = MagicMock(info={})
+        with patcher, patch.object(websocket_auth, "handshake_cache", cache), \
+                patch.object(websocket_auth, "object_session", return_value=session):
+            await cache.authorize(100, 1)
+            websocket_auth._diagnosis_changed(None, None, MagicMock(id=1))
+            await cache.authorize(100, 1)
+            assert calls == [(100, 1)]
+
+            websocket_auth._apply_invalidations(session)
+            await cache.authorize(100, 1)
+            assert calls == [(100, 1), (100, 1)]
+
+            websocket_auth._patient_deleted(None, None, MagicMock(id=100))
+            websocket_auth._discard_invalidations(session)
+            websocket_auth._apply_invalidations(session)
+            await cache.authorize(100, 1)
+            assert len(calls) == 2
+
+    @pytest.mark.asyncio
+    async def test_invalidation_from_worker_threads(self):
+        """Test that commits in threadpool threads can invalidate while the loop reads"""
+        cache, calls, patcher = self._cache(self._owner_is(100))
+
+        def invalidate():
+            for diagnosis_id in range(200):
+                cache.invalidate_diagnosis(diagnosis_id % 20)
+
+        with patcher:
+            worker = asyncio.create_task(asyncio.to_thread(invalidate))
+            while not worker.done():
+                for diagnosis_id in range(20):
+                    await cache.authorize(100, diagnosis_id)
+            await worker
+
+        assert set(cache.entries) == {
+            key for keys in cache.by_diagnosis.values() for key in keys
+        }
@@ -12,6 +12,10 @@ class WebSocketService extends GetxService {
   final int _reconnectMaxAttempts = 5;
   final int _reconnectDelayMs = 2000;
 
+  // Last broadcast sequence number seen, used to resume with ?since=
+  int? _diagnosisId;
+  int? _lastSeq;
+
   // Observable streams
   final RxBool isConnected = false.obs;
   final RxInt reconnectAttempts = 0.obs;
@@ -28,8 +32,13 @@ class WebSocketService extends GetxService {
   /// [token] JWT authentication token
   Future<bool> connect(int diagnosisId, String token) async {
     try {
+      if (_diagnosisId != diagnosisId) {
+        _diagnosisId = diagnosisId;
+        _lastSeq = null;
+      }
+      final since = _lastSeq != null ? '&since=$_lastSeq' : '';
       final wsUrl = Uri.parse(
-        '$_baseUrl/ws/$diagnosisId?token=$token',
+        '$_baseUrl/ws/$diagnosisId?token=$token$since',
       );
 
       _channel = WebSocketChannel.connect(wsUrl);
@@ -56,6 +65,14 @@ class WebSocketService extends GetxService {
       final data = jsonDecode(message as String) as Map<String, dynamic>;
       final messageType = data['type'] as String?;
 
+      // Track sequence numbers so a reconnect only replays missed messages
+      final seq = data['seq'];
+      if (seq is int) {
+        _lastSeq = seq;
+      } else if (messageType == 'connect' && _lastSeq == null) {
+        _lastSeq = data['data']?['last_seq'] as int?;
+      }
+
       // Add to history
       messageHistory.add({
         'timestamp': DateTime.now(),
@@ -73,6 +90,15 @@ class WebSocketService extends GetxService {
         case 'feedback_update':
           _handleFeedbackUpdate(data);
           break;
+        case 'ping':
+          // Server heartbeat; connections that never answer are closed
+          _channel.sink.add(jsonEncode({'type': 'pong'}));
+          return;
+        case 'replay_gap':
+          // Missed messages are no longer available; resume from the latest
+          _lastSeq = data['data']?['last_seq'] as int?;
+          print('WebSocket replay gap, some updates were missed');
+          break;
         default:
           print('Unknown message type: $messageType');
       }